@@ -0,0 +1,4 @@
+import time
+
+# 起動時間の計測基準(アプリのパッケージを読み込み始めた時刻)
+IMPORT_STARTED = time.perf_counter()
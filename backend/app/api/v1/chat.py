@@ -1,86 +1,330 @@
-"""チャット関連のAPIエンドポイント"""
-import logging
-
-from fastapi import APIRouter, HTTPException
-
-from app.api.v1.schemas import (
-    ChatMessageRequest,
-    ChatMessageResponse,
-    SummarizeRequest,
-    SummarizeResponse,
-)
-from app.services.gemini_service import GeminiService
-
-logger = logging.getLogger(__name__)
-router = APIRouter()
-_gemini_service: GeminiService | None = None
-
-
-def get_gemini_service() -> GeminiService:
-    """GeminiServiceのシングルトンインスタンスを取得する"""
-    global _gemini_service
-    if _gemini_service is None:
-        _gemini_service = GeminiService()
-    return _gemini_service
-
-
-@router.post("/message", response_model=ChatMessageResponse)
-async def send_message(request: ChatMessageRequest) -> ChatMessageResponse:
-    """
-    ユーザーメッセージに対するAI応答を生成
-
-    Args:
-        request: チャットメッセージリクエスト
-
-    Returns:
-        AIからの応答
-
-    Raises:
-        HTTPException: メッセージ生成に失敗した場合
-    """
-    try:
-        messages_history = None
-        if request.messages:
-            messages_history = [
-                {"role": msg.role, "content": msg.content} for msg in request.messages
-            ]
-
-        logger.info(f"リクエスト受信: content={request.content[:50]}, context={len(request.context) if request.context else 0}件, messages={len(messages_history) if messages_history else 0}件")
-        gemini_service = get_gemini_service()
-        response = await gemini_service.generate_response(
-            user_message=request.content,
-            context=request.context,
-            messages_history=messages_history,
-        )
-        return ChatMessageResponse(content=response)
-    except Exception as e:
-        logger.error(f"メッセージ生成エラー: {type(e).__name__}: {e!s}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"メッセージ生成に失敗しました: {e!s}") from e
-
-
-@router.post("/summarize", response_model=SummarizeResponse)
-async def summarize_conversation(request: SummarizeRequest) -> SummarizeResponse:
-    """
-    会話履歴を要約
-
-    Args:
-        request: 要約リクエスト
-
-    Returns:
-        要約されたテキスト
-
-    Raises:
-        HTTPException: 要約生成に失敗した場合
-    """
-    try:
-        if not request.conversation:
-            raise HTTPException(status_code=400, detail="会話履歴が提供されていません")
-
-        gemini_service = get_gemini_service()
-        summary = await gemini_service.summarize_conversation(request.conversation)
-        return SummarizeResponse(summary=summary)
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"要約生成に失敗しました: {e!s}") from e
-
+"""チャット関連のAPIエンドポイント"""
+import json
+import logging
+from collections.abc import AsyncIterator
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+
+from app.api.v1.diaries import get_diary_owner
+from app.api.v1.errors import upstream_unavailable
+from app.api.v1.idempotency import get_idempotency_key, json_result, run_idempotent
+from app.api.v1.schemas import (
+    ChatMessageRequest,
+    ChatMessageResponse,
+    Message,
+    SessionCreateRequest,
+    SessionMessageRequest,
+    SessionMessageResponse,
+    SessionResponse,
+    SummarizeRequest,
+    SummarizeResponse,
+)
+from app.services.idempotency import StoredResponse, fingerprint_payload
+from app.services.registry import (
+    get_conversation_service,
+    get_diary_service,
+    get_gemini_service,
+    get_summarizer,
+)
+from app.services.resilience import CircuitOpenError
+from app.services.session_store import Session, SessionNotFoundError
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+
+def _to_messages_history(request: ChatMessageRequest) -> list[dict[str, str]] | None:
+    """リクエストの会話履歴をサービス層に渡す形式へ変換する"""
+    if not request.messages:
+        return None
+    return [{"role": msg.role, "content": msg.content} for msg in request.messages]
+
+
+async def _past_diaries(http_request: Request, content: str) -> list[str] | None:
+    """
+    メッセージに関連する過去の日記を取得する(無効な場合や見つからない場合はNone)
+
+    日記の取得に失敗しても応答生成は続ける。
+    """
+    try:
+        diaries = get_diary_service(http_request)
+    except Exception as e:
+        logger.warning("日記サービスを利用できません: %s", e)
+        return None
+    if not diaries.context_enabled:
+        return None
+    return await diaries.context_for(get_diary_owner(http_request), content) or None
+
+
+@router.post("/message", response_model=ChatMessageResponse)
+async def send_message(request: ChatMessageRequest, http_request: Request) -> ChatMessageResponse | Response:
+    """
+    ユーザーメッセージに対するAI応答を生成
+
+    Idempotency-Keyヘッダを指定した場合、同じキーの再送には処理中または保存済みの
+    応答を返す(Geminiを再度呼び出さない)。
+
+    Args:
+        request: チャットメッセージリクエスト
+        http_request: FastAPIのリクエスト(共有サービスの取得に使用)
+
+    Returns:
+        AIからの応答
+
+    Raises:
+        HTTPException: メッセージ生成に失敗した場合
+    """
+    key = get_idempotency_key(http_request)
+    if key is None:
+        return await _generate_message(request, http_request)
+
+    async def work() -> StoredResponse:
+        return json_result(await _generate_message(request, http_request))
+
+    fingerprint = fingerprint_payload([request.model_dump(mode="json"), get_diary_owner(http_request)])
+    return await run_idempotent(http_request, "chat_message", key, fingerprint, work)
+
+
+async def _generate_message(request: ChatMessageRequest, http_request: Request) -> ChatMessageResponse:
+    """ユーザーメッセージに対するAI応答を生成する(失敗はHTTPExceptionに変換する)"""
+    try:
+        messages_history = _to_messages_history(request)
+
+        logger.info(f"リクエスト受信: content={request.content[:50]}, context={len(request.context) if request.context else 0}件, messages={len(messages_history) if messages_history else 0}件")
+        gemini_service = get_gemini_service(http_request)
+        response = await gemini_service.generate_response(
+            user_message=request.content,
+            context=request.context,
+            messages_history=messages_history,
+            past_diaries=await _past_diaries(http_request, request.content),
+        )
+        return ChatMessageResponse(content=response)
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e) from e
+    except TimeoutError as e:
+        logger.error("メッセージ生成タイムアウト")
+        raise HTTPException(status_code=504, detail="メッセージ生成がタイムアウトしました") from e
+    except Exception as e:
+        logger.error(f"メッセージ生成エラー: {type(e).__name__}: {e!s}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"メッセージ生成に失敗しました: {e!s}") from e
+
+
+@router.post("/message/stream", summary="AI応答を逐次返す(ストリーミング)SSE")
+async def send_message_stream(request: ChatMessageRequest, http_request: Request) -> StreamingResponse:
+    """
+    ユーザーメッセージに対するAI応答を生成し、SSEで部分テキストを逐次返す
+
+    - イベント: data: {"delta": "テキストの断片"}
+    - 完了時: data: {"done": true, "text": "全文"}
+
+    クライアントが切断した場合は上流の生成も停止する。
+
+    Args:
+        request: チャットメッセージリクエスト
+        http_request: FastAPIのリクエスト(共有サービスの取得と切断検知に使用)
+
+    Returns:
+        text/event-stream のストリーミングレスポンス
+
+    Raises:
+        HTTPException: サービスの初期化に失敗した場合
+    """
+    try:
+        messages_history = _to_messages_history(request)
+        gemini_service = get_gemini_service(http_request)
+        past_diaries = await _past_diaries(http_request, request.content)
+    except Exception as e:
+        logger.error(f"メッセージ生成エラー: {type(e).__name__}: {e!s}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"メッセージ生成に失敗しました: {e!s}") from e
+
+    async def sse_generator() -> AsyncIterator[str]:
+        stream = gemini_service.stream_response(
+            user_message=request.content,
+            context=request.context,
+            messages_history=messages_history,
+            past_diaries=past_diaries,
+        )
+        try:
+            acc = ""
+            async for delta in stream:
+                if await http_request.is_disconnected():
+                    logger.info("クライアント切断によりストリーミングを中断")
+                    return
+                acc += delta
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+            yield f"data: {json.dumps({'done': True, 'text': acc})}\n\n"
+        except Exception as exc:
+            logger.error(f"ストリーミング生成エラー: {type(exc).__name__}: {exc!s}")
+            yield f"event: error\ndata: {json.dumps({'error': str(exc)})}\n\n"
+        finally:
+            # 途中終了時に上流の生成タスクを確実に停止する
+            await stream.aclose()
+
+    return StreamingResponse(sse_generator(), media_type="text/event-stream")
+
+
+@router.post("/summarize", response_model=SummarizeResponse)
+async def summarize_conversation(request: SummarizeRequest, http_request: Request) -> SummarizeResponse | Response:
+    """
+    会話履歴を要約
+
+    Idempotency-Keyヘッダを指定した場合、同じキーの再送には処理中または保存済みの
+    結果を返す(要約の生成も日記の保存も繰り返さない)。
+
+    Args:
+        request: 要約リクエスト
+        http_request: FastAPIのリクエスト(共有サービスと日記の持ち主の取得に使用)
+
+    Returns:
+        要約されたテキスト(save=Trueの場合は保存した日記のIDを含む)
+
+    Raises:
+        HTTPException: 要約生成に失敗した場合
+    """
+    if not request.conversation:
+        raise HTTPException(status_code=400, detail="会話履歴が提供されていません")
+    key = get_idempotency_key(http_request)
+    if key is None:
+        return await _summarize(request, http_request)
+
+    async def work() -> StoredResponse:
+        return json_result(await _summarize(request, http_request))
+
+    fingerprint = fingerprint_payload([request.model_dump(mode="json"), get_diary_owner(http_request)])
+    return await run_idempotent(http_request, "chat_summarize", key, fingerprint, work)
+
+
+async def _summarize(request: SummarizeRequest, http_request: Request) -> SummarizeResponse:
+    """会話履歴を要約し、指定された場合は日記として保存する(失敗はHTTPExceptionに変換する)"""
+    try:
+        summarizer = get_summarizer(http_request)
+        summary = await summarizer.summarize(request.conversation)
+        diary_id = None
+        if request.save:
+            entry = await get_diary_service(http_request).add(
+                get_diary_owner(http_request), summary, request.entry_date
+            )
+            diary_id = entry.id
+        return SummarizeResponse(summary=summary, diary_id=diary_id)
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e) from e
+    except TimeoutError as e:
+        logger.error("要約生成タイムアウト")
+        raise HTTPException(status_code=504, detail="要約生成がタイムアウトしました") from e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"要約生成に失敗しました: {e!s}") from e
+
+
+def _to_session_response(session: Session) -> SessionResponse:
+    """セッションをレスポンス形式へ変換する"""
+    return SessionResponse(
+        session_id=session.id,
+        summary=session.summary,
+        messages=[Message(role=m["role"], content=m["content"]) for m in session.messages],
+    )
+
+
+@router.post("/sessions", response_model=SessionResponse)
+async def create_session(request: SessionCreateRequest, http_request: Request) -> SessionResponse:
+    """
+    会話セッションを作成
+
+    Args:
+        request: セッション作成リクエスト
+        http_request: FastAPIのリクエスト(共有サービスの取得に使用)
+
+    Returns:
+        作成したセッション
+
+    Raises:
+        HTTPException: セッションの作成に失敗した場合
+    """
+    try:
+        session = await get_conversation_service(http_request).create_session(request.context)
+        return _to_session_response(session)
+    except Exception as e:
+        logger.error(f"セッション作成エラー: {type(e).__name__}: {e!s}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"セッションの作成に失敗しました: {e!s}") from e
+
+
+@router.get("/sessions/{session_id}", response_model=SessionResponse)
+async def get_session(session_id: str, http_request: Request) -> SessionResponse:
+    """
+    会話セッションの要約と直近の履歴を取得
+
+    Args:
+        session_id: セッションID
+        http_request: FastAPIのリクエスト(共有サービスの取得に使用)
+
+    Returns:
+        セッション
+
+    Raises:
+        HTTPException: セッションが存在しない場合
+    """
+    try:
+        session = await get_conversation_service(http_request).get_session(session_id)
+        return _to_session_response(session)
+    except SessionNotFoundError as e:
+        raise HTTPException(status_code=404, detail="セッションが見つかりません") from e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"セッションの取得に失敗しました: {e!s}") from e
+
+
+@router.delete("/sessions/{session_id}", status_code=204)
+async def delete_session(session_id: str, http_request: Request) -> None:
+    """
+    会話セッションを削除
+
+    Args:
+        session_id: セッションID
+        http_request: FastAPIのリクエスト(共有サービスの取得に使用)
+
+    Raises:
+        HTTPException: 削除に失敗した場合
+    """
+    try:
+        await get_conversation_service(http_request).delete_session(session_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"セッションの削除に失敗しました: {e!s}") from e
+
+
+@router.post("/sessions/{session_id}/messages", response_model=SessionMessageResponse)
+async def send_session_message(
+    session_id: str, request: SessionMessageRequest, http_request: Request
+) -> SessionMessageResponse:
+    """
+    会話セッションに新しいメッセージを送り、AI応答を生成
+
+    履歴はサーバー側で保持するため、クライアントは新しいメッセージのみを送る。
+
+    Args:
+        session_id: セッションID
+        request: メッセージ送信リクエスト
+        http_request: FastAPIのリクエスト(共有サービスの取得に使用)
+
+    Returns:
+        AIからの応答
+
+    Raises:
+        HTTPException: セッションが存在しない場合、またはメッセージ生成に失敗した場合
+    """
+    try:
+        reply = await get_conversation_service(http_request).send_message(
+            session_id,
+            request.content,
+            context=request.context,
+            past_diaries=await _past_diaries(http_request, request.content),
+        )
+        return SessionMessageResponse(session_id=session_id, content=reply)
+    except SessionNotFoundError as e:
+        raise HTTPException(status_code=404, detail="セッションが見つかりません") from e
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e) from e
+    except TimeoutError as e:
+        logger.error("メッセージ生成タイムアウト")
+        raise HTTPException(status_code=504, detail="メッセージ生成がタイムアウトしました") from e
+    except Exception as e:
+        logger.error(f"メッセージ生成エラー: {type(e).__name__}: {e!s}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"メッセージ生成に失敗しました: {e!s}") from e
@@ -0,0 +1,225 @@
+"""日記の保存・一覧・検索のAPIエンドポイント"""
+import logging
+
+from fastapi import APIRouter, HTTPException, Query, Request
+
+from app.api.v1.errors import upstream_unavailable
+from app.api.v1.schemas import DiaryCreateRequest, DiaryListResponse, DiaryResponse
+from app.services.diary_store import DiaryEntry, DiaryPage
+from app.services.registry import get_diary_service
+from app.services.resilience import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+# 日記の持ち主を示すリクエストヘッダ(未指定の場合は共通の持ち主として扱う)。
+# 自己申告の値のため、利用者ごとのアクセス制御には使えない
+OWNER_HEADER = "X-Diary-Owner"
+DEFAULT_OWNER = "default"
+
+
+def get_diary_owner(request: Request) -> str:
+    """
+    リクエストの日記の持ち主を取得する
+
+    持ち主はクライアントが送る X-Diary-Owner ヘッダの値をそのまま使う。このAPIは認証を
+    行わないため、これは日記を区分けするためのもので、アクセス制御の境界ではない
+    (ヘッダを書き換えれば他の持ち主の日記を読み書きできる)。利用者ごとに日記を保護する
+    場合は、認証を行うプロキシの背後に置き、プロキシが認証済みの利用者をこのヘッダに設定する
+    (クライアントが送った値は上書きする)こと。
+
+    Args:
+        request: FastAPIのリクエスト
+
+    Returns:
+        日記の持ち主
+    """
+    owner = request.headers.get(OWNER_HEADER, "").strip()
+    return owner or DEFAULT_OWNER
+
+
+def _to_response(entry: DiaryEntry, snippet: str | None = None, score: float | None = None) -> DiaryResponse:
+    """日記をレスポンス形式へ変換する"""
+    return DiaryResponse(
+        id=entry.id,
+        content=entry.content,
+        entry_date=entry.entry_date,
+        created_at=entry.created_at,
+        snippet=snippet,
+        score=score,
+    )
+
+
+def _to_list_response(page: DiaryPage) -> DiaryListResponse:
+    """日記の1ページをレスポンス形式へ変換する"""
+    snippets: list[str | None] = list(page.snippets) if page.snippets else [None] * len(page.items)
+    return DiaryListResponse(
+        items=[_to_response(entry, snippet) for entry, snippet in zip(page.items, snippets, strict=True)],
+        next_cursor=page.next_cursor,
+    )
+
+
+@router.post("", response_model=DiaryResponse)
+async def create_diary(request: DiaryCreateRequest, http_request: Request) -> DiaryResponse:
+    """
+    日記を保存
+
+    Args:
+        request: 日記の保存リクエスト
+        http_request: FastAPIのリクエスト(共有サービスと持ち主の取得に使用)
+
+    Returns:
+        保存した日記
+
+    Raises:
+        HTTPException: 本文が空の場合、または保存に失敗した場合
+    """
+    if not request.content.strip():
+        raise HTTPException(status_code=400, detail="日記の本文が空です")
+    try:
+        entry = await get_diary_service(http_request).add(
+            get_diary_owner(http_request), request.content, request.entry_date
+        )
+        return _to_response(entry)
+    except Exception as e:
+        logger.error(f"日記保存エラー: {type(e).__name__}: {e!s}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"日記の保存に失敗しました: {e!s}") from e
+
+
+@router.get("", response_model=DiaryListResponse)
+async def list_diaries(
+    http_request: Request,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str | None = None,
+) -> DiaryListResponse:
+    """
+    日記を新しい順に取得
+
+    Args:
+        http_request: FastAPIのリクエスト(共有サービスと持ち主の取得に使用)
+        limit: 1ページの件数
+        cursor: 前のページのnext_cursor
+
+    Returns:
+        日記の1ページ
+
+    Raises:
+        HTTPException: cursorが不正な場合、または取得に失敗した場合
+    """
+    try:
+        page = await get_diary_service(http_request).list_entries(
+            get_diary_owner(http_request), limit, cursor
+        )
+        return _to_list_response(page)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"日記の取得に失敗しました: {e!s}") from e
+
+
+@router.get("/search", response_model=DiaryListResponse)
+async def search_diaries(
+    http_request: Request,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str | None = None,
+) -> DiaryListResponse:
+    """
+    日記を全文検索(空白で区切った語をすべて含む日記を返す)
+
+    Args:
+        http_request: FastAPIのリクエスト(共有サービスと持ち主の取得に使用)
+        q: 検索語
+        limit: 1ページの件数
+        cursor: 前のページのnext_cursor
+
+    Returns:
+        検索結果の1ページ(各日記に一致箇所の抜粋を含む)
+
+    Raises:
+        HTTPException: cursorが不正な場合、または検索に失敗した場合
+    """
+    try:
+        page = await get_diary_service(http_request).search(
+            get_diary_owner(http_request), q, limit, cursor
+        )
+        return _to_list_response(page)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"日記の検索に失敗しました: {e!s}") from e
+
+
+@router.get("/related", response_model=DiaryListResponse)
+async def related_diaries(
+    http_request: Request,
+    q: str = Query(..., min_length=1),
+    k: int = Query(5, ge=1, le=50),
+) -> DiaryListResponse:
+    """
+    クエリに意味の近い日記を取得(埋め込みベクトルのコサイン類似度の高い順)
+
+    Args:
+        http_request: FastAPIのリクエスト(共有サービスと持ち主の取得に使用)
+        q: クエリ
+        k: 取得する件数
+
+    Returns:
+        関連する日記(各日記に類似度を含む)
+
+    Raises:
+        HTTPException: 埋め込みの作成または検索に失敗した場合
+    """
+    try:
+        hits = await get_diary_service(http_request).related(get_diary_owner(http_request), q, k)
+        return DiaryListResponse(items=[_to_response(entry, score=score) for entry, score in hits])
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e) from e
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail="関連する日記の検索がタイムアウトしました") from e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"関連する日記の検索に失敗しました: {e!s}") from e
+
+
+@router.get("/{diary_id}", response_model=DiaryResponse)
+async def get_diary(diary_id: str, http_request: Request) -> DiaryResponse:
+    """
+    日記を取得
+
+    Args:
+        diary_id: 日記ID
+        http_request: FastAPIのリクエスト(共有サービスと持ち主の取得に使用)
+
+    Returns:
+        日記
+
+    Raises:
+        HTTPException: 日記が存在しない場合
+    """
+    try:
+        entry = await get_diary_service(http_request).get(get_diary_owner(http_request), diary_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"日記の取得に失敗しました: {e!s}") from e
+    if entry is None:
+        raise HTTPException(status_code=404, detail="日記が見つかりません")
+    return _to_response(entry)
+
+
+@router.delete("/{diary_id}", status_code=204)
+async def delete_diary(diary_id: str, http_request: Request) -> None:
+    """
+    日記を削除
+
+    Args:
+        diary_id: 日記ID
+        http_request: FastAPIのリクエスト(共有サービスと持ち主の取得に使用)
+
+    Raises:
+        HTTPException: 日記が存在しない場合、または削除に失敗した場合
+    """
+    try:
+        deleted = await get_diary_service(http_request).delete(get_diary_owner(http_request), diary_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"日記の削除に失敗しました: {e!s}") from e
+    if not deleted:
+        raise HTTPException(status_code=404, detail="日記が見つかりません")
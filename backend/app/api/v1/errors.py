@@ -0,0 +1,23 @@
+"""APIエンドポイント共通のエラー変換"""
+import math
+
+from fastapi import HTTPException
+
+from app.services.resilience import CircuitOpenError
+
+
+def upstream_unavailable(e: CircuitOpenError) -> HTTPException:
+    """
+    サーキットブレーカーによる即時失敗を503(Retry-After付き)に変換する
+
+    Args:
+        e: サーキットブレーカーの例外
+
+    Returns:
+        送出するHTTPException
+    """
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(math.ceil(e.retry_after))},
+    )
@@ -0,0 +1,74 @@
+"""APIエンドポイント共通のIdempotency-Keyの処理"""
+from collections.abc import Awaitable, Callable
+
+from fastapi import HTTPException, Request, Response
+from pydantic import BaseModel
+
+from app.services.idempotency import IdempotencyConflictError, StoredResponse
+from app.services.registry import get_idempotency_store
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+# 保存済み(または処理中)の結果を返した場合に付けるヘッダ
+REPLAYED_HEADER = "Idempotent-Replayed"
+_MAX_KEY_LENGTH = 255
+
+
+def get_idempotency_key(request: Request) -> str | None:
+    """
+    リクエストのIdempotency-Keyを取得する
+
+    Args:
+        request: FastAPIのリクエスト
+
+    Returns:
+        Idempotency-Key(未指定の場合はNone)
+
+    Raises:
+        HTTPException: キーが長すぎる場合
+    """
+    key = request.headers.get(IDEMPOTENCY_HEADER, "").strip()
+    if not key:
+        return None
+    if len(key) > _MAX_KEY_LENGTH:
+        raise HTTPException(
+            status_code=400, detail=f"{IDEMPOTENCY_HEADER}は{_MAX_KEY_LENGTH}文字以内で指定してください"
+        )
+    return key
+
+
+def json_result(model: BaseModel) -> StoredResponse:
+    """レスポンスのモデルを保存する結果に変換する"""
+    return StoredResponse(body=model.model_dump_json().encode("utf-8"), media_type="application/json")
+
+
+async def run_idempotent(
+    request: Request,
+    scope: str,
+    key: str,
+    fingerprint: str,
+    work: Callable[[], Awaitable[StoredResponse]],
+) -> Response:
+    """
+    同じIdempotency-Keyの結果があれば返し、無ければ処理を実行して保存する
+
+    Args:
+        request: FastAPIのリクエスト(共有サービスの取得に使用)
+        scope: キーを区別する範囲(ルート名)
+        key: Idempotency-Key
+        fingerprint: リクエストの内容のハッシュ
+        work: 処理を実行して結果を返すawaitableを作る関数(結果が無い場合にだけ1回呼び出す)
+
+    Returns:
+        結果のレスポンス(再利用した場合はIdempotent-Replayedヘッダ付き)
+
+    Raises:
+        HTTPException: 同じキーが異なる内容のリクエストに使われた場合(422)、または処理に失敗した場合
+    """
+    try:
+        stored, replayed = await get_idempotency_store(request).run(scope, key, fingerprint, work)
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    headers = dict(stored.headers)
+    if replayed:
+        headers[REPLAYED_HEADER] = "true"
+    return Response(content=stored.body, media_type=stored.media_type, headers=headers)
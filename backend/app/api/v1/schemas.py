@@ -1,33 +1,85 @@
-"""APIリクエスト/レスポンスのスキーマ定義"""
-from typing import Any
-
-from pydantic import BaseModel
-
-
-class Message(BaseModel):
-    """メッセージ"""
-    role: str
-    content: str
-
-
-class ChatMessageRequest(BaseModel):
-    """チャットメッセージリクエスト"""
-    content: str
-    messages: list[Message] | None = None
-    context: list[dict[str, Any]] | None = None
-
-
-class ChatMessageResponse(BaseModel):
-    """チャットメッセージレスポンス"""
-    content: str
-
-
-class SummarizeRequest(BaseModel):
-    """要約リクエスト"""
-    conversation: str
-
-
-class SummarizeResponse(BaseModel):
-    """要約レスポンス"""
-    summary: str
-
+"""APIリクエスト/レスポンスのスキーマ定義"""
+from typing import Any
+
+from pydantic import BaseModel
+
+
+class Message(BaseModel):
+    """メッセージ"""
+    role: str
+    content: str
+
+
+class ChatMessageRequest(BaseModel):
+    """チャットメッセージリクエスト"""
+    content: str
+    messages: list[Message] | None = None
+    context: list[dict[str, Any]] | None = None
+
+
+class ChatMessageResponse(BaseModel):
+    """チャットメッセージレスポンス"""
+    content: str
+
+
+class SummarizeRequest(BaseModel):
+    """要約リクエスト"""
+    conversation: str
+    # Trueの場合、作成した日記を保存する
+    save: bool = False
+    entry_date: str | None = None
+
+
+class SummarizeResponse(BaseModel):
+    """要約レスポンス"""
+    summary: str
+    # 保存した日記のID(save=Falseの場合はNone)
+    diary_id: str | None = None
+
+
+class SessionCreateRequest(BaseModel):
+    """セッション作成リクエスト"""
+    context: list[dict[str, Any]] | None = None
+
+
+class SessionMessageRequest(BaseModel):
+    """セッションへのメッセージ送信リクエスト(新しいメッセージのみ送る)"""
+    content: str
+    context: list[dict[str, Any]] | None = None
+
+
+class SessionMessageResponse(BaseModel):
+    """セッションへのメッセージ送信レスポンス"""
+    session_id: str
+    content: str
+
+
+class SessionResponse(BaseModel):
+    """セッション情報"""
+    session_id: str
+    summary: str
+    messages: list[Message]
+
+
+class DiaryCreateRequest(BaseModel):
+    """日記の保存リクエスト"""
+    content: str
+    entry_date: str | None = None
+
+
+class DiaryResponse(BaseModel):
+    """日記"""
+    id: str
+    content: str
+    entry_date: str | None = None
+    created_at: float
+    # 検索結果の場合は一致箇所の抜粋、関連日記の場合はコサイン類似度
+    snippet: str | None = None
+    score: float | None = None
+
+
+class DiaryListResponse(BaseModel):
+    """日記の一覧・検索結果"""
+    items: list[DiaryResponse]
+    # 次のページの取得に使う位置(最後のページの場合はNone)
+    next_cursor: str | None = None
@@ -1,60 +1,263 @@
+import asyncio
 import json
-from collections.abc import Iterator
+import logging
+import time
+from collections.abc import AsyncIterator, Awaitable
+from pathlib import Path
 
-from fastapi import APIRouter, File, HTTPException, UploadFile
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import APIRouter, File, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
-from app.services.openai_service import OpenAIService
+from app.api.v1.errors import upstream_unavailable
+from app.api.v1.idempotency import get_idempotency_key, run_idempotent
+from app.services.audio_io import UploadTooLargeError, spool_upload
+from app.services.idempotency import StoredResponse, fingerprint_file
+from app.services.metrics import PAYLOAD_BYTES, trace_stage
+from app.services.registry import get_audio_preprocessor, get_openai_service, get_registry
+from app.services.resilience import CircuitOpenError
+from app.services.stt_pipeline import stream_transcribe_file, transcribe_file
 
+logger = logging.getLogger(__name__)
 router = APIRouter()
-_openai_service: OpenAIService | None = None
 
 
-def get_openai_service() -> OpenAIService:
-    """OpenAIServiceのシングルトンインスタンスを取得する"""
-    global _openai_service
-    if _openai_service is None:
-        _openai_service = OpenAIService()
-    return _openai_service
+async def _spool(request: Request, file: UploadFile) -> Path:
+    """アップロードを設定に従って一時ファイルへ退避する"""
+    settings = get_registry(request).settings
+    try:
+        with trace_stage("upload_spool"):
+            path = await spool_upload(
+                file,
+                max_bytes=settings.stt_max_upload_bytes,
+                chunk_bytes=settings.stt_upload_chunk_bytes,
+                spool_dir=settings.stt_spool_dir or None,
+            )
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e)) from e
+    PAYLOAD_BYTES.labels("stt_upload").observe(path.stat().st_size)
+    return path
 
 
 @router.post("/transcribe", summary="音声をテキスト化(Whisper)")
-async def transcribe_audio(file: UploadFile = File(...)) -> JSONResponse:
+async def transcribe_audio(request: Request, file: UploadFile = File(...)) -> Response:
+    """
+    音声を文字起こしする
+
+    Idempotency-Keyヘッダを指定した場合、同じキー・同じ音声の再送には処理中または
+    保存済みの結果を返す(文字起こしを再度行わない)。
+    """
+    path = await _spool(request, file)
+    # 文字起こしを始めた後は、クライアントが切断しても再送のために処理を続けるため、
+    # 一時ファイルの削除は文字起こしの処理側で行う
+    handed_off = False
     try:
-        content = await file.read()
-        service = get_openai_service()
-        text = service.transcribe_audio(content, filename=file.filename or "audio.webm", mime_type=file.content_type or "audio/webm")
-        return JSONResponse({"text": text})
+        key = get_idempotency_key(request)
+        if key is None:
+            return JSONResponse({"text": await _transcribe(request, file, path)})
+
+        async def transcribe_and_cleanup() -> StoredResponse:
+            try:
+                text = await _transcribe(request, file, path)
+            finally:
+                path.unlink(missing_ok=True)
+            return StoredResponse(
+                body=json.dumps({"text": text}, ensure_ascii=False).encode("utf-8"),
+                media_type="application/json",
+            )
+
+        def work() -> Awaitable[StoredResponse]:
+            nonlocal handed_off
+            handed_off = True
+            return transcribe_and_cleanup()
+
+        fingerprint = await asyncio.to_thread(
+            fingerprint_file, path, file.filename or "", file.content_type or ""
+        )
+        return await run_idempotent(request, "stt_transcribe", key, fingerprint, work)
+    finally:
+        if not handed_off:
+            path.unlink(missing_ok=True)
+
+
+async def _transcribe(request: Request, file: UploadFile, path: Path) -> str:
+    """一時ファイルの音声を文字起こしする(失敗はHTTPExceptionに変換する)"""
+    try:
+        service = get_openai_service(request)
+        return await transcribe_file(
+            service,
+            path,
+            filename=file.filename or "audio.webm",
+            mime_type=file.content_type or "audio/webm",
+            settings=get_registry(request).settings,
+            preprocessor=get_audio_preprocessor(request),
+        )
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e) from e
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail="文字起こしがタイムアウトしました") from e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
 @router.post("/transcribe/stream", summary="音声をテキスト化(ストリーミング)SSE")
-async def transcribe_audio_stream(file: UploadFile = File(...)) -> StreamingResponse:
+async def transcribe_audio_stream(request: Request, file: UploadFile = File(...)) -> StreamingResponse:
     """
     音声を文字起こしし、SSEで部分テキストを逐次返す
 
+    上流のストリーミング文字起こしの差分をそのまま中継する。
+    長い録音は区間ごとに文字起こしし、完了した区間から順に返す。
+
     - イベント: data: {"delta": "テキストの断片"}
     - 完了時: data: {"done": true, "text": "全文"}
     """
+    path = await _spool(request, file)
     try:
-        content = await file.read()
-        service = get_openai_service()
+        service = get_openai_service(request)
+        settings = get_registry(request).settings
+        preprocessor = get_audio_preprocessor(request)
 
-        def sse_generator() -> Iterator[str]:
+        async def sse_generator() -> AsyncIterator[str]:
+            started = time.perf_counter()
             try:
                 acc = ""
-                for delta in service.stream_transcription_tokens(
-                    content, filename=file.filename or "audio.webm", mime_type=file.content_type or "audio/webm"
+                async for delta in stream_transcribe_file(
+                    service,
+                    path,
+                    filename=file.filename or "audio.webm",
+                    mime_type=file.content_type or "audio/webm",
+                    settings=settings,
+                    preprocessor=preprocessor,
                 ):
+                    if not acc:
+                        logger.info("STT最初の差分まで %.0fms", (time.perf_counter() - started) * 1000)
                     acc += delta
                     yield f"data: {json.dumps({'delta': delta})}\n\n"
                 yield f"data: {json.dumps({'done': True, 'text': acc})}\n\n"
             except Exception as exc:
                 yield f"event: error\ndata: {json.dumps({'error': str(exc)})}\n\n"
+            finally:
+                path.unlink(missing_ok=True)
 
         return StreamingResponse(sse_generator(), media_type="text/event-stream")
     except Exception as e:
+        path.unlink(missing_ok=True)
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+
+def _batch_error(e: BaseException) -> tuple[int, str]:
+    """一括文字起こしの1ファイルの失敗を(ステータスコード, メッセージ)に変換する"""
+    if isinstance(e, HTTPException):
+        return e.status_code, str(e.detail)
+    if isinstance(e, CircuitOpenError):
+        return 503, str(e)
+    if isinstance(e, TimeoutError):
+        return 504, "文字起こしがタイムアウトしました"
+    return 500, str(e) or type(e).__name__
+
+
+@router.post("/transcribe/batch", summary="複数の音声をまとめてテキスト化(NDJSON)")
+async def transcribe_audio_batch(request: Request, files: list[UploadFile] = File(...)) -> StreamingResponse:
+    """
+    複数の音声ファイルを並行して文字起こしし、完了した順にNDJSONで1行ずつ返す
+
+    同時に文字起こしするファイル数は STT_BATCH_PARALLELISM まで。
+    1ファイルの失敗(サイズ超過・上流の不調など)はそのファイルの行にだけ記録し、
+    他のファイルの処理は続ける。
+
+    - 成功: {"index": 0, "filename": "a.webm", "text": "..."}
+    - 失敗: {"index": 1, "filename": "b.webm", "error": "...", "status": 504}
+    - 完了時: {"done": true, "succeeded": 1, "failed": 1}
+
+    indexはアップロードされた順の番号(0始まり)。
+    """
+    settings = get_registry(request).settings
+    if len(files) > settings.stt_batch_max_files:
+        raise HTTPException(
+            status_code=400,
+            detail=f"一度に文字起こしできるファイル数は{settings.stt_batch_max_files}件までです",
+        )
+
+    # 応答を返し始める前にすべてのアップロードを一時ファイルへ退避する
+    paths: list[Path | None] = []
+    errors: dict[int, BaseException] = {}
+    for index, file in enumerate(files):
+        try:
+            paths.append(await _spool(request, file))
+        except HTTPException as e:
+            paths.append(None)
+            errors[index] = e
+    try:
+        service = get_openai_service(request)
+        preprocessor = get_audio_preprocessor(request)
+    except Exception as e:
+        for path in paths:
+            if path is not None:
+                path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=str(e)) from e
 
+    semaphore = asyncio.Semaphore(settings.stt_batch_parallelism)
+
+    async def transcribe_one(index: int) -> dict[str, object]:
+        file = files[index]
+        result: dict[str, object] = {"index": index, "filename": file.filename or f"audio-{index}"}
+        path = paths[index]
+        try:
+            if path is None:
+                raise errors[index]
+            async with semaphore:
+                result["text"] = await transcribe_file(
+                    service,
+                    path,
+                    filename=file.filename or "audio.webm",
+                    mime_type=file.content_type or "audio/webm",
+                    settings=settings,
+                    preprocessor=preprocessor,
+                )
+        except Exception as e:
+            status, message = _batch_error(e)
+            logger.warning("一括文字起こしの%d件目に失敗: %s", index, message)
+            result["error"] = message
+            result["status"] = status
+        finally:
+            if path is not None:
+                path.unlink(missing_ok=True)
+        return result
 
+    async def ndjson_generator() -> AsyncIterator[str]:
+        tasks = [asyncio.create_task(transcribe_one(index)) for index in range(len(files))]
+        succeeded = failed = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                if "error" in result:
+                    failed += 1
+                else:
+                    succeeded += 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, "succeeded": succeeded, "failed": failed}) + "\n"
+        finally:
+            # クライアントが切断した場合は残りの文字起こしを止め、開始前のファイルも削除する
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for path in paths:
+                if path is not None:
+                    path.unlink(missing_ok=True)
+
+    return StreamingResponse(ndjson_generator(), media_type="application/x-ndjson")
+
+
+@router.get("/preprocess/stats", summary="音声の前処理の統計")
+async def preprocess_stats(request: Request) -> JSONResponse:
+    """
+    文字起こし前の音声の前処理(無音の圧縮・再エンコード)の件数と削減量を返す
+
+    STT_PREPROCESS_ENABLED が無効の場合は {"enabled": false} を返す。
+    """
+    try:
+        preprocessor = get_audio_preprocessor(request)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+    if preprocessor is None:
+        return JSONResponse({"enabled": False})
+    return JSONResponse({"enabled": True, **preprocessor.stats()})
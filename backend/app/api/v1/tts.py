@@ -1,19 +1,35 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import Response
+import asyncio
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 
-from app.services.openai_service import OpenAIService
+from app.api.v1.errors import upstream_unavailable
+from app.api.v1.idempotency import get_idempotency_key, run_idempotent
+from app.services.idempotency import StoredResponse, fingerprint_payload
+from app.services.metrics import PAYLOAD_BYTES
+from app.services.registry import get_openai_service, get_tts_cache
+from app.services.resilience import CircuitOpenError
+from app.services.tts_cache import CachedAudio
 
 router = APIRouter()
-_openai_service: OpenAIService | None = None
+
+_MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "wav": "audio/wav",
+    "ogg": "audio/ogg",
+    "opus": "audio/ogg",
+    "aac": "audio/aac",
+    "flac": "audio/flac",
+    "webm": "audio/webm",
+    "pcm": "audio/pcm",
+}
 
 
-def get_openai_service() -> OpenAIService:
-    """OpenAIServiceのシングルトンインスタンスを取得する"""
-    global _openai_service
-    if _openai_service is None:
-        _openai_service = OpenAIService()
-    return _openai_service
+def _media_type(audio_format: str) -> str:
+    """音声フォーマットに対応するMIMEタイプを返す"""
+    return _MEDIA_TYPES.get(audio_format.lower(), "application/octet-stream")
 
 
 class TTSRequest(BaseModel):
@@ -23,21 +39,99 @@ class TTSRequest(BaseModel):
 
 
 @router.post("/synthesize", summary="テキストを音声化(TTS)")
-async def synthesize(req: TTSRequest) -> Response:
+async def synthesize(req: TTSRequest, request: Request) -> Response:
+    """
+    テキストを音声化する
+
+    Idempotency-Keyヘッダを指定した場合、同じキーの再送には処理中または保存済みの
+    音声を返す(音声合成を再度行わない)。音声はIdempotencyStoreに保存するため、
+    TTSCacheから追い出された後の再送でも上流を呼び出さない。
+    """
+    key = get_idempotency_key(request)
+    if key is None:
+        return _audio_response(await _synthesize(req, request), req.format)
+
+    async def work() -> StoredResponse:
+        cached = await _synthesize(req, request)
+        if cached.data is None and cached.path is not None:
+            body = await asyncio.to_thread(cached.path.read_bytes)
+        else:
+            # メモリ階層の音声はTTSCacheと同じbytesを参照する(コピーしない)
+            body = cached.data or b""
+        PAYLOAD_BYTES.labels("tts_audio").observe(len(body))
+        return StoredResponse(
+            body=body,
+            media_type=_media_type(req.format),
+            headers={"X-Cache": "HIT" if cached.hit else "MISS"},
+        )
+
+    return await run_idempotent(request, "tts_synthesize", key, fingerprint_payload(req.model_dump()), work)
+
+
+def _audio_response(cached: CachedAudio, audio_format: str) -> Response:
+    """キャッシュから取得した音声をレスポンスにする"""
+    media_type = _media_type(audio_format)
+    headers = {"X-Cache": "HIT" if cached.hit else "MISS"}
+    if cached.path is not None:
+        PAYLOAD_BYTES.labels("tts_audio").observe(cached.path.stat().st_size)
+        # ディスクキャッシュはファイルから直接送信する
+        return FileResponse(cached.path, media_type=media_type, headers=headers)
+    PAYLOAD_BYTES.labels("tts_audio").observe(len(cached.data or b""))
+    return Response(content=cached.data, media_type=media_type, headers=headers)
+
+
+async def _synthesize(req: TTSRequest, request: Request) -> CachedAudio:
+    """テキストを音声化する(キャッシュを使い、失敗はHTTPExceptionに変換する)"""
     try:
-        service = get_openai_service()
-        audio = service.synthesize_speech(req.text, voice=req.voice, audio_format=req.format)
-        media_type_map = {
-            "mp3": "audio/mpeg",
-            "wav": "audio/wav",
-            "ogg": "audio/ogg",
-            "aac": "audio/aac",
-            "flac": "audio/flac",
-            "webm": "audio/webm",
-        }
-        media_type = media_type_map.get(req.format.lower(), "application/octet-stream")
-        return Response(content=audio, media_type=media_type)
+        service = get_openai_service(request)
+        cache = get_tts_cache(request)
+        key = cache.make_key(req.text, req.voice, req.format, service.TTS_MODEL)
+        return await cache.get_or_create(
+            key,
+            lambda: service.synthesize_speech(req.text, voice=req.voice, audio_format=req.format),
+        )
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e) from e
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail="音声合成がタイムアウトしました") from e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
+@router.get("/cache/stats", summary="TTSキャッシュの統計情報")
+async def cache_stats(request: Request) -> dict[str, int | float]:
+    """TTSキャッシュのヒット/ミス数と使用量を返す"""
+    return get_tts_cache(request).stats()
+
+
+@router.get("/variants/stats", summary="TTS呼び出し方式の統計情報")
+async def variant_stats(request: Request) -> dict[str, object]:
+    """TTS呼び出し方式ごとの呼び出し回数と、条件ごとに記憶している方式を返す"""
+    return get_openai_service(request).tts_variant_stats()
+
+
+@router.post("/synthesize/stream", summary="テキストを音声化(ストリーミング)")
+async def synthesize_stream(req: TTSRequest, request: Request) -> StreamingResponse:
+    """
+    テキストを音声化し、上流から届いた音声チャンクを逐次返す
+
+    音声全体をメモリに保持しないため、テキスト長に関わらずメモリ使用量は一定。
+    Content-Type は実際に生成されたフォーマットに合わせる。
+    """
+    try:
+        service = get_openai_service(request)
+        speech = await service.open_speech_stream(req.text, voice=req.voice, audio_format=req.format)
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e) from e
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail="音声合成がタイムアウトしました") from e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    return StreamingResponse(
+        speech.iter_chunks(),
+        media_type=_media_type(speech.audio_format),
+        headers={"X-Audio-Format": speech.audio_format},
+        # 送信を始める前にクライアントが切断しても、同時実行枠と上流の接続を解放する
+        background=BackgroundTask(speech.aclose),
+    )
@@ -0,0 +1,225 @@
+"""音声対話(WebSocket)のエンドポイント"""
+import asyncio
+import contextlib
+import json
+import logging
+import math
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from typing import Any, Literal
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, Field, ValidationError
+
+from app.api.v1.schemas import Message
+from app.services.audio_io import UploadTooLargeError
+from app.services.metrics import VOICE_SESSIONS
+from app.services.registry import get_registry
+from app.services.resilience import CircuitOpenError
+from app.services.session_store import SessionNotFoundError
+from app.services.voice_session import UtteranceBuffer, VoiceEvent, VoicePipelineError, VoiceSession
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+_SUFFIXES = {
+    "audio/webm": ".webm",
+    "audio/ogg": ".ogg",
+    "audio/wav": ".wav",
+    "audio/mpeg": ".mp3",
+    "audio/mp4": ".m4a",
+}
+
+Send = Callable[[VoiceEvent], Awaitable[None]]
+
+
+class VoiceStartMessage(BaseModel):
+    type: Literal["start"]
+    session_id: str | None = Field(None, description="会話セッションID(省略時は接続内で履歴を保持)")
+    context: list[dict[str, Any]] | None = Field(None, description="コンテキスト情報(イベント情報など)")
+    messages: list[Message] | None = Field(None, description="それまでの会話履歴(セッションID省略時のみ)")
+    voice: str = Field("alloy", description="音声ボイス名")
+    format: str = Field("mp3", description="応答の音声フォーマット(mp3/wavなど)")
+    mime_type: str = Field("audio/webm", description="送信する音声のMIMEタイプ")
+    tts: bool = Field(True, description="応答を音声合成するか")
+
+
+@router.websocket("/ws")
+async def voice_session(websocket: WebSocket) -> None:
+    """
+    音声対話のWebSocket。発話の音声を受け取り、文字起こし・応答・応答の音声を逐次返す
+
+    クライアント → サーバー:
+        - 最初に {"type": "start", ...}(VoiceStartMessage)
+        - 発話の音声データ(バイナリフレーム、録音しながら分割して送ってよい)
+        - 発話の終わりに {"type": "end"}(応答中に送ると前の応答を打ち切る)
+        - 応答を打ち切る場合は {"type": "cancel"}
+
+    サーバー → クライアント:
+        - {"type": "ready"}
+        - {"type": "transcript.delta", "delta": ...} / {"type": "transcript.done", "text": ...}
+        - {"type": "reply.delta", "delta": ...} / {"type": "reply.done", "text": ...}
+        - {"type": "audio.start", "index": n, "format": ..., "text": 文}、音声データ(バイナリフレーム)、
+          {"type": "audio.end", "index": n}。応答の文ごとに順に届く
+        - {"type": "turn.done", "timings": {段階: 発話の終わりからの秒数}}
+        - {"type": "turn.cancelled"} / {"type": "error", "stage": ..., "error": ...}
+
+    応答中も次の発話の音声を受け付ける。
+    """
+    await websocket.accept()
+    VOICE_SESSIONS.inc()
+    try:
+        await _serve(websocket)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        VOICE_SESSIONS.dec()
+
+
+async def _serve(websocket: WebSocket) -> None:
+    """接続の開始から切断までを処理する"""
+    lock = asyncio.Lock()
+
+    async def send(event: VoiceEvent) -> None:
+        # 応答のタスクと受信側の両方から送るため、1フレームずつ順に送る
+        async with lock:
+            if isinstance(event, bytes):
+                await websocket.send_bytes(event)
+            else:
+                await websocket.send_json(event)
+
+    try:
+        start = VoiceStartMessage.model_validate_json(await websocket.receive_text())
+    except (ValidationError, KeyError) as e:
+        detail = f": {e}" if isinstance(e, ValidationError) else ""
+        await send({"type": "error", "stage": "start", "error": f"最初に start メッセージをJSONで送ってください{detail}"})
+        await websocket.close(code=1008)
+        return
+    try:
+        session = await _open_session(websocket, start)
+    except SessionNotFoundError:
+        await send({"type": "error", "stage": "start", "error": "セッションが見つかりません"})
+        await websocket.close(code=1008)
+        return
+    except Exception as e:
+        logger.error("音声対話の開始に失敗: %s: %s", type(e).__name__, e)
+        await send({"type": "error", "stage": "start", "error": str(e)})
+        await websocket.close(code=1011)
+        return
+
+    settings = get_registry(websocket).settings
+    mime_type = start.mime_type
+    filename = "utterance" + _SUFFIXES.get(mime_type.split(";")[0].strip().lower(), ".webm")
+    buffer = UtteranceBuffer(
+        settings.stt_max_upload_bytes,
+        suffix=Path(filename).suffix,
+        spool_dir=settings.stt_spool_dir or None,
+    )
+    turn: asyncio.Task[None] | None = None
+    await send({"type": "ready"})
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes") is not None:
+                try:
+                    await buffer.append(message["bytes"])
+                except UploadTooLargeError as e:
+                    await send({"type": "error", "stage": "upload", "error": str(e)})
+                continue
+            try:
+                command = json.loads(message.get("text") or "").get("type")
+            except (ValueError, AttributeError):
+                command = None
+            if command == "end":
+                path = buffer.take()
+                if path is None:
+                    await send({"type": "error", "stage": "upload", "error": "発話の音声が届いていません"})
+                    continue
+                # 応答中に次の発話が終わった場合は、前の応答を打ち切る(割り込み)
+                if await _cancel(turn):
+                    await send({"type": "turn.cancelled"})
+                turn = asyncio.create_task(_run_turn(session, path, filename, mime_type, send))
+            elif command == "cancel":
+                buffer.discard()
+                if await _cancel(turn):
+                    await send({"type": "turn.cancelled"})
+            else:
+                await send({"type": "error", "stage": "protocol", "error": f"未知のメッセージです: {command}"})
+    finally:
+        await _cancel(turn)
+        buffer.discard()
+
+
+async def _open_session(websocket: WebSocket, start: VoiceStartMessage) -> VoiceSession:
+    """開始メッセージに従ってVoiceSessionを用意する"""
+    registry = get_registry(websocket)
+    if start.session_id is not None:
+        conversations = registry.conversations()
+        await conversations.get_session(start.session_id)
+        return VoiceSession(
+            registry.openai(),
+            registry.settings,
+            conversations=conversations,
+            session_id=start.session_id,
+            context=start.context,
+            voice=start.voice,
+            audio_format=start.format,
+            tts=start.tts,
+            preprocessor=registry.audio_preprocessor(),
+        )
+    return VoiceSession(
+        registry.openai(),
+        registry.settings,
+        gemini=registry.gemini(),
+        context=start.context,
+        messages=[{"role": m.role, "content": m.content} for m in start.messages or []],
+        voice=start.voice,
+        audio_format=start.format,
+        tts=start.tts,
+        preprocessor=registry.audio_preprocessor(),
+    )
+
+
+async def _run_turn(session: VoiceSession, path: Path, filename: str, mime_type: str, send: Send) -> None:
+    """1ターンを処理してイベントを送る(終了時に発話の音声ファイルを削除する)"""
+    try:
+        # 送信の失敗や割り込みで抜けた場合も、その場でジェネレータを閉じて上流の呼び出しを止める
+        async with contextlib.aclosing(session.run_turn(path, filename, mime_type)) as events:
+            async for event in events:
+                await send(event)
+    except VoicePipelineError as e:
+        logger.warning("音声対話の処理に失敗(%s): %s: %s", e.stage, type(e.error).__name__, e.error)
+        with contextlib.suppress(Exception):
+            await send(_error_event(e))
+    except (WebSocketDisconnect, RuntimeError):
+        # 送信中に切断された(受信側で切断を検知して終了する)
+        pass
+    finally:
+        path.unlink(missing_ok=True)
+
+
+def _error_event(e: VoicePipelineError) -> dict[str, Any]:
+    """段階ごとの失敗をクライアントへ送るイベントにする"""
+    event: dict[str, Any] = {"type": "error", "stage": e.stage, "error": str(e)}
+    if isinstance(e.error, CircuitOpenError):
+        event["retry_after"] = math.ceil(e.error.retry_after)
+    elif isinstance(e.error, TimeoutError):
+        event["error"] = "処理がタイムアウトしました"
+    return event
+
+
+async def _cancel(task: "asyncio.Task[None] | None") -> bool:
+    """
+    実行中のターンを打ち切る
+
+    Returns:
+        打ち切ったか(実行中でなかった場合はFalse)
+    """
+    if task is None or task.done():
+        return False
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    return True
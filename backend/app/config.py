@@ -0,0 +1,300 @@
+"""アプリケーション設定(環境変数から読み込む)"""
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+
+def _env_int(name: str, default: int) -> int:
+    """
+    環境変数を整数として取得する
+
+    Args:
+        name: 環境変数名
+        default: 未設定時のデフォルト値
+
+    Returns:
+        環境変数の値(整数)
+
+    Raises:
+        ValueError: 整数として解釈できない場合
+    """
+    raw = os.getenv(name)
+    if raw is None or raw.strip() == "":
+        return default
+    try:
+        return int(raw)
+    except ValueError as e:
+        raise ValueError(f"{name} は整数で指定してください: {raw}") from e
+
+
+def _env_float(name: str, default: float) -> float:
+    """
+    環境変数を浮動小数点数として取得する
+
+    Args:
+        name: 環境変数名
+        default: 未設定時のデフォルト値
+
+    Returns:
+        環境変数の値(浮動小数点数)
+
+    Raises:
+        ValueError: 数値として解釈できない場合
+    """
+    raw = os.getenv(name)
+    if raw is None or raw.strip() == "":
+        return default
+    try:
+        return float(raw)
+    except ValueError as e:
+        raise ValueError(f"{name} は数値で指定してください: {raw}") from e
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    """
+    環境変数を真偽値として取得する
+
+    Args:
+        name: 環境変数名
+        default: 未設定時のデフォルト値
+
+    Returns:
+        "1", "true", "yes", "on" の場合にTrue
+    """
+    raw = os.getenv(name)
+    if raw is None or raw.strip() == "":
+        return default
+    return raw.strip().lower() in ("1", "true", "yes", "on")
+
+
+@dataclass(frozen=True)
+class Settings:
+    """アプリケーション設定"""
+
+    # Gemini
+    gemini_model: str
+    gemini_max_in_flight: int
+    gemini_timeout_seconds: float
+    gemini_prompt_cache_size: int
+    gemini_context_cache_enabled: bool
+    gemini_context_cache_min_tokens: int
+    gemini_context_cache_ttl_seconds: int
+    # チャット応答のプロンプトのトークン数の上限
+    prompt_token_budget: int
+    prompt_event_share: float
+    prompt_keep_recent_messages: int
+    prompt_condensed_message_tokens: int
+
+    # OpenAI(STT/TTS)
+    openai_max_connections: int
+    openai_max_keepalive_connections: int
+    openai_keepalive_expiry_seconds: float
+    openai_connect_timeout_seconds: float
+    openai_timeout_seconds: float
+    openai_max_retries: int
+    openai_max_in_flight: int
+    tts_stream_chunk_bytes: int
+    tts_variant_ttl_seconds: float
+
+    # 会話セッション
+    session_store: str
+    session_db_path: str
+    session_max_sessions: int
+    session_idle_ttl_seconds: float
+    session_history_token_budget: int
+    session_keep_recent_messages: int
+    # 会話履歴の要約(日記作成)
+    summary_chunk_tokens: int
+    summary_fan_out: int
+    summary_cache_size: int
+    # 日記の保存と関連日記の検索
+    diary_db_path: str
+    diary_embedder: str
+    diary_embedding_model: str
+    diary_embedding_dim: int
+    diary_index_batch_size: int
+    diary_index_max_owners: int
+    diary_context_top_k: int
+    diary_context_min_score: float
+    diary_context_max_chars: int
+
+    # STTアップロードと分割文字起こし
+    stt_max_upload_bytes: int
+    stt_upload_chunk_bytes: int
+    stt_spool_dir: str
+    stt_segment_min_bytes: int
+    stt_segment_seconds: float
+    stt_segment_overlap_seconds: float
+    stt_segment_parallelism: int
+    # 複数ファイルの一括文字起こし
+    stt_batch_max_files: int
+    stt_batch_max_upload_bytes: int
+    stt_batch_parallelism: int
+    # STT前の音声の前処理(無音の圧縮・再エンコード)
+    stt_preprocess_enabled: bool
+    stt_preprocess_codec: str
+    stt_preprocess_opus_bitrate_kbps: int
+    stt_vad_threshold_dbfs: float
+    stt_vad_max_silence_ms: int
+
+    # 音声対話(WebSocket)
+    voice_tts_prefetch: int
+    voice_sentence_min_chars: int
+
+    # Idempotency-Keyによる処理結果の再利用
+    idempotency_ttl_seconds: float
+    idempotency_max_bytes: int
+
+    # TTSキャッシュ
+    tts_cache_memory_bytes: int
+    tts_cache_dir: str
+    tts_cache_disk_bytes: int
+
+    # 上流呼び出しの期限・リトライ・ヘッジ・サーキットブレーカー
+    gemini_max_retries: int
+    gemini_hedge_enabled: bool
+    openai_hedge_enabled: bool
+    retry_base_delay_seconds: float
+    retry_max_delay_seconds: float
+    hedge_percentile: float
+    hedge_min_samples: int
+    circuit_failure_threshold: int
+    circuit_reset_seconds: float
+    deadline_chat_seconds: float
+    deadline_summary_seconds: float
+    deadline_stt_seconds: float
+    deadline_tts_seconds: float
+
+    # 受け付け制御(同時実行数・待ち行列・レート制限・アップロード量)
+    admission_queue_timeout_seconds: float
+    admission_chat_concurrency: int
+    admission_chat_queue: int
+    admission_summarize_concurrency: int
+    admission_summarize_queue: int
+    admission_stt_concurrency: int
+    admission_stt_queue: int
+    admission_stt_batch_concurrency: int
+    admission_stt_batch_queue: int
+    admission_tts_concurrency: int
+    admission_tts_queue: int
+    admission_voice_concurrency: int
+    rate_limit_per_minute: float
+    rate_limit_burst: int
+    rate_limit_trusted_proxies: int
+    upload_budget_bytes: int
+
+    # 監視
+    slow_request_seconds: float
+
+    # 起動時のウォームアップ
+    startup_warmup: bool
+    startup_warmup_timeout_seconds: float
+    startup_prewarm_connections: int
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    設定のシングルトンインスタンスを取得する
+
+    Returns:
+        環境変数から構築した設定
+    """
+    load_dotenv()
+    return Settings(
+        gemini_model=os.getenv("GEMINI_MODEL", "gemini-2.0-flash-lite-001"),
+        gemini_max_in_flight=max(1, _env_int("GEMINI_MAX_IN_FLIGHT", 16)),
+        gemini_timeout_seconds=_env_float("GEMINI_TIMEOUT_SECONDS", 60.0),
+        gemini_prompt_cache_size=max(1, _env_int("GEMINI_PROMPT_CACHE_SIZE", 256)),
+        gemini_context_cache_enabled=_env_bool("GEMINI_CONTEXT_CACHE_ENABLED", False),
+        gemini_context_cache_min_tokens=max(0, _env_int("GEMINI_CONTEXT_CACHE_MIN_TOKENS", 4096)),
+        gemini_context_cache_ttl_seconds=max(60, _env_int("GEMINI_CONTEXT_CACHE_TTL_SECONDS", 3600)),
+        prompt_token_budget=max(0, _env_int("PROMPT_TOKEN_BUDGET", 8000)),
+        prompt_event_share=min(0.9, max(0.1, _env_float("PROMPT_EVENT_SHARE", 0.4))),
+        prompt_keep_recent_messages=max(0, _env_int("PROMPT_KEEP_RECENT_MESSAGES", 6)),
+        prompt_condensed_message_tokens=max(16, _env_int("PROMPT_CONDENSED_MESSAGE_TOKENS", 120)),
+        session_store=os.getenv("SESSION_STORE", "memory").strip().lower(),
+        session_db_path=os.getenv("SESSION_DB_PATH", "data/sessions.db"),
+        session_max_sessions=max(1, _env_int("SESSION_MAX_SESSIONS", 1000)),
+        session_idle_ttl_seconds=max(0.0, _env_float("SESSION_IDLE_TTL_SECONDS", 7 * 24 * 3600.0)),
+        session_history_token_budget=max(1, _env_int("SESSION_HISTORY_TOKEN_BUDGET", 2000)),
+        session_keep_recent_messages=max(0, _env_int("SESSION_KEEP_RECENT_MESSAGES", 6)),
+        summary_chunk_tokens=max(256, _env_int("SUMMARY_CHUNK_TOKENS", 4000)),
+        summary_fan_out=max(1, _env_int("SUMMARY_FAN_OUT", 4)),
+        summary_cache_size=max(1, _env_int("SUMMARY_CACHE_SIZE", 256)),
+        diary_db_path=os.getenv("DIARY_DB_PATH", "data/diaries.db"),
+        diary_embedder=os.getenv("DIARY_EMBEDDER", "hash").strip().lower(),
+        diary_embedding_model=os.getenv("DIARY_EMBEDDING_MODEL", "text-embedding-3-small"),
+        diary_embedding_dim=max(16, _env_int("DIARY_EMBEDDING_DIM", 256)),
+        diary_index_batch_size=max(1, _env_int("DIARY_INDEX_BATCH_SIZE", 64)),
+        diary_index_max_owners=max(1, _env_int("DIARY_INDEX_MAX_OWNERS", 64)),
+        diary_context_top_k=max(0, _env_int("DIARY_CONTEXT_TOP_K", 3)),
+        diary_context_min_score=_env_float("DIARY_CONTEXT_MIN_SCORE", 0.2),
+        diary_context_max_chars=max(50, _env_int("DIARY_CONTEXT_MAX_CHARS", 400)),
+        openai_max_connections=max(1, _env_int("OPENAI_MAX_CONNECTIONS", 20)),
+        openai_max_keepalive_connections=max(0, _env_int("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 10)),
+        openai_keepalive_expiry_seconds=_env_float("OPENAI_KEEPALIVE_EXPIRY_SECONDS", 60.0),
+        openai_connect_timeout_seconds=_env_float("OPENAI_CONNECT_TIMEOUT_SECONDS", 5.0),
+        openai_timeout_seconds=_env_float("OPENAI_TIMEOUT_SECONDS", 120.0),
+        openai_max_retries=max(0, _env_int("OPENAI_MAX_RETRIES", 2)),
+        openai_max_in_flight=max(1, _env_int("OPENAI_MAX_IN_FLIGHT", 16)),
+        tts_stream_chunk_bytes=max(1024, _env_int("TTS_STREAM_CHUNK_BYTES", 16384)),
+        tts_variant_ttl_seconds=max(0.0, _env_float("TTS_VARIANT_TTL_SECONDS", 3600.0)),
+        stt_max_upload_bytes=max(1, _env_int("STT_MAX_UPLOAD_BYTES", 100 * 1024 * 1024)),
+        stt_upload_chunk_bytes=max(4096, _env_int("STT_UPLOAD_CHUNK_BYTES", 1024 * 1024)),
+        stt_spool_dir=os.getenv("STT_SPOOL_DIR", ""),
+        stt_segment_min_bytes=max(0, _env_int("STT_SEGMENT_MIN_BYTES", 1024 * 1024)),
+        stt_segment_seconds=max(10.0, _env_float("STT_SEGMENT_SECONDS", 120.0)),
+        stt_segment_overlap_seconds=max(0.0, _env_float("STT_SEGMENT_OVERLAP_SECONDS", 2.0)),
+        stt_segment_parallelism=max(1, _env_int("STT_SEGMENT_PARALLELISM", 4)),
+        stt_batch_max_files=max(1, _env_int("STT_BATCH_MAX_FILES", 10)),
+        stt_batch_max_upload_bytes=max(1, _env_int("STT_BATCH_MAX_UPLOAD_BYTES", 200 * 1024 * 1024)),
+        stt_batch_parallelism=max(1, _env_int("STT_BATCH_PARALLELISM", 3)),
+        stt_preprocess_enabled=_env_bool("STT_PREPROCESS_ENABLED", False),
+        stt_preprocess_codec=os.getenv("STT_PREPROCESS_CODEC", "opus").strip().lower(),
+        stt_preprocess_opus_bitrate_kbps=max(6, _env_int("STT_PREPROCESS_OPUS_BITRATE_KBPS", 32)),
+        stt_vad_threshold_dbfs=min(0.0, _env_float("STT_VAD_THRESHOLD_DBFS", -45.0)),
+        stt_vad_max_silence_ms=max(60, _env_int("STT_VAD_MAX_SILENCE_MS", 600)),
+        voice_tts_prefetch=max(1, _env_int("VOICE_TTS_PREFETCH", 2)),
+        voice_sentence_min_chars=max(1, _env_int("VOICE_SENTENCE_MIN_CHARS", 8)),
+        idempotency_ttl_seconds=max(1.0, _env_float("IDEMPOTENCY_TTL_SECONDS", 3600.0)),
+        idempotency_max_bytes=max(0, _env_int("IDEMPOTENCY_MAX_BYTES", 64 * 1024 * 1024)),
+        tts_cache_memory_bytes=max(0, _env_int("TTS_CACHE_MEMORY_BYTES", 32 * 1024 * 1024)),
+        tts_cache_dir=os.getenv("TTS_CACHE_DIR", ""),
+        tts_cache_disk_bytes=max(0, _env_int("TTS_CACHE_DISK_BYTES", 512 * 1024 * 1024)),
+        gemini_max_retries=max(0, _env_int("GEMINI_MAX_RETRIES", 2)),
+        gemini_hedge_enabled=_env_bool("GEMINI_HEDGE_ENABLED", False),
+        openai_hedge_enabled=_env_bool("OPENAI_HEDGE_ENABLED", False),
+        retry_base_delay_seconds=max(0.0, _env_float("RETRY_BASE_DELAY_SECONDS", 0.2)),
+        retry_max_delay_seconds=max(0.0, _env_float("RETRY_MAX_DELAY_SECONDS", 2.0)),
+        hedge_percentile=min(0.999, max(0.5, _env_float("HEDGE_PERCENTILE", 0.95))),
+        hedge_min_samples=max(1, _env_int("HEDGE_MIN_SAMPLES", 20)),
+        circuit_failure_threshold=max(1, _env_int("CIRCUIT_FAILURE_THRESHOLD", 5)),
+        circuit_reset_seconds=max(1.0, _env_float("CIRCUIT_RESET_SECONDS", 30.0)),
+        deadline_chat_seconds=max(1.0, _env_float("DEADLINE_CHAT_SECONDS", 90.0)),
+        deadline_summary_seconds=max(1.0, _env_float("DEADLINE_SUMMARY_SECONDS", 180.0)),
+        deadline_stt_seconds=max(1.0, _env_float("DEADLINE_STT_SECONDS", 300.0)),
+        deadline_tts_seconds=max(1.0, _env_float("DEADLINE_TTS_SECONDS", 90.0)),
+        admission_queue_timeout_seconds=max(0.0, _env_float("ADMISSION_QUEUE_TIMEOUT_SECONDS", 10.0)),
+        admission_chat_concurrency=max(1, _env_int("ADMISSION_CHAT_CONCURRENCY", 32)),
+        admission_chat_queue=max(0, _env_int("ADMISSION_CHAT_QUEUE", 64)),
+        admission_summarize_concurrency=max(1, _env_int("ADMISSION_SUMMARIZE_CONCURRENCY", 4)),
+        admission_summarize_queue=max(0, _env_int("ADMISSION_SUMMARIZE_QUEUE", 16)),
+        admission_stt_concurrency=max(1, _env_int("ADMISSION_STT_CONCURRENCY", 8)),
+        admission_stt_queue=max(0, _env_int("ADMISSION_STT_QUEUE", 16)),
+        admission_stt_batch_concurrency=max(1, _env_int("ADMISSION_STT_BATCH_CONCURRENCY", 2)),
+        admission_stt_batch_queue=max(0, _env_int("ADMISSION_STT_BATCH_QUEUE", 4)),
+        admission_tts_concurrency=max(1, _env_int("ADMISSION_TTS_CONCURRENCY", 16)),
+        admission_tts_queue=max(0, _env_int("ADMISSION_TTS_QUEUE", 32)),
+        admission_voice_concurrency=max(1, _env_int("ADMISSION_VOICE_CONCURRENCY", 16)),
+        rate_limit_per_minute=max(0.0, _env_float("RATE_LIMIT_PER_MINUTE", 60.0)),
+        rate_limit_burst=max(1, _env_int("RATE_LIMIT_BURST", 20)),
+        rate_limit_trusted_proxies=max(0, _env_int("RATE_LIMIT_TRUSTED_PROXIES", 0)),
+        upload_budget_bytes=max(1, _env_int("UPLOAD_BUDGET_BYTES", 512 * 1024 * 1024)),
+        slow_request_seconds=max(0.0, _env_float("SLOW_REQUEST_SECONDS", 0.0)),
+        startup_warmup=_env_bool("STARTUP_WARMUP", True),
+        startup_warmup_timeout_seconds=max(1.0, _env_float("STARTUP_WARMUP_TIMEOUT_SECONDS", 15.0)),
+        startup_prewarm_connections=max(0, _env_int("STARTUP_PREWARM_CONNECTIONS", 2)),
+    )
@@ -1,47 +1,117 @@
-"""FastAPIアプリケーションのエントリーポイント"""
-import os
-
-from dotenv import load_dotenv
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-
-from app.api.v1 import chat
-from app.api.v1 import stt as stt_api
-from app.api.v1 import tts as tts_api
-
-load_dotenv()
-
-app = FastAPI(
-    title="AudioDiary API",
-    description="AudioDiary Backend API with Gemini AI",
-    version="0.1.0",
-)
-
-# 環境変数からCORSのオリジンを取得(デフォルトはlocalhost)
-cors_origins = os.getenv("CORS_ALLOWED_ORIGINS", "http://localhost:3000")
-allowed_origins = [origin.strip() for origin in cors_origins.split(",")]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allowed_origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-app.include_router(chat.router, prefix="/api/v1/chat", tags=["chat"])
-app.include_router(stt_api.router, prefix="/api/v1/stt", tags=["stt"])
-app.include_router(tts_api.router, prefix="/api/v1/tts", tags=["tts"])
-
-
-@app.get("/")
-async def root() -> dict[str, str]:
-    """ヘルスチェックエンドポイント"""
-    return {"message": "AudioDiary API is running"}
-
-
-@app.get("/health")
-async def health() -> dict[str, str]:
-    """ヘルスチェックエンドポイント"""
-    return {"status": "healthy"}
-
+"""FastAPIアプリケーションのエントリーポイント"""
+import asyncio
+import contextlib
+import os
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+
+from app import IMPORT_STARTED
+from app.api.v1 import chat
+from app.api.v1 import diaries as diaries_api
+from app.api.v1 import stt as stt_api
+from app.api.v1 import tts as tts_api
+from app.api.v1 import voice as voice_api
+from app.config import get_settings
+from app.services.admission import AdmissionController, AdmissionMiddleware
+from app.services.metrics import (
+    MetricsMiddleware,
+    register_service_collector,
+    render_metrics,
+    unregister_collector,
+)
+from app.services.registry import ServiceRegistry
+from app.services.startup import FirstSuccessMiddleware, StartupTracker, warm_up
+
+# .env の読み込みもここで行われる
+settings = get_settings()
+startup = StartupTracker(IMPORT_STARTED, warmup_enabled=settings.startup_warmup)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """アプリの起動時に共有サービスを用意し、終了時に接続を閉じる"""
+    startup.mark("lifespan")
+    registry = ServiceRegistry(settings)
+    app.state.services = registry
+    collector = register_service_collector(registry.stats)
+    # ウォームアップはバックグラウンドで行い、その間も /health は応答する(完了までは /ready が503)
+    warmup_task = asyncio.create_task(warm_up(registry, startup, settings)) if settings.startup_warmup else None
+    if warmup_task is None:
+        startup.mark_ready()
+    try:
+        yield
+    finally:
+        if warmup_task is not None and not warmup_task.done():
+            warmup_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await warmup_task
+        unregister_collector(collector)
+        await registry.aclose()
+
+
+app = FastAPI(
+    title="AudioDiary API",
+    description="AudioDiary Backend API with Gemini AI",
+    version="0.1.0",
+    lifespan=lifespan,
+)
+
+# 環境変数からCORSのオリジンを取得(デフォルトはlocalhost)
+cors_origins = os.getenv("CORS_ALLOWED_ORIGINS", "http://localhost:3000")
+allowed_origins = [origin.strip() for origin in cors_origins.split(",")]
+
+# 受け付けない場合の429もCORSのヘッダ付きで返すよう、CORSより内側に置く
+app.add_middleware(AdmissionMiddleware, controller=AdmissionController.from_settings(settings))
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=allowed_origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+app.add_middleware(FirstSuccessMiddleware, tracker=startup)
+app.add_middleware(MetricsMiddleware, slow_request_seconds=settings.slow_request_seconds)
+
+app.include_router(chat.router, prefix="/api/v1/chat", tags=["chat"])
+app.include_router(diaries_api.router, prefix="/api/v1/diaries", tags=["diaries"])
+app.include_router(stt_api.router, prefix="/api/v1/stt", tags=["stt"])
+app.include_router(tts_api.router, prefix="/api/v1/tts", tags=["tts"])
+app.include_router(voice_api.router, prefix="/api/v1/voice", tags=["voice"])
+
+
+@app.get("/")
+async def root() -> dict[str, str]:
+    """ヘルスチェックエンドポイント"""
+    return {"message": "AudioDiary API is running"}
+
+
+@app.get("/health")
+async def health() -> dict[str, str]:
+    """ヘルスチェックエンドポイント"""
+    return {"status": "healthy"}
+
+
+@app.get("/ready")
+async def ready() -> JSONResponse:
+    """
+    レディネスチェックエンドポイント
+
+    起動時のウォームアップ(重いモジュールの読み込みと上流への接続)が終わるまでは503を返す。
+    起動の各段階と最初の成功応答までの秒数も返す。
+    """
+    return JSONResponse(startup.report(), status_code=200 if startup.ready else 503)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    """Prometheus形式のメトリクス"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+startup.mark("import")
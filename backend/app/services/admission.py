@@ -0,0 +1,460 @@
+"""受け付けるリクエスト量の制御(同時実行数・待ち行列・クライアントごとのレート制限・アップロード量)"""
+import asyncio
+import logging
+import math
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from starlette.websockets import WebSocketClose
+
+from app.config import Settings
+from app.services.metrics import (
+    ADMISSION_IN_FLIGHT,
+    ADMISSION_QUEUE_DEPTH,
+    ADMISSION_REJECTED,
+    UPLOAD_BUDGET_IN_USE,
+)
+
+logger = logging.getLogger(__name__)
+
+# 制御の対象とするルート(種類, パス)。対象はPOSTとWebSocketのみ(参照系のGETは制限しない)
+_ROUTE_CLASSES = (
+    ("summarize", re.compile(r"^/api/v1/chat/summarize$")),
+    ("chat", re.compile(r"^/api/v1/chat/(message(/stream)?|sessions/[^/]+/messages)$")),
+    # 一括文字起こしは1リクエストで複数ファイルを処理するため、単体の文字起こしとは別に数える
+    ("stt_batch", re.compile(r"^/api/v1/stt/transcribe/batch$")),
+    ("stt", re.compile(r"^/api/v1/stt/transcribe(/.+)?$")),
+    ("tts", re.compile(r"^/api/v1/tts/synthesize(/stream)?$")),
+    ("voice", re.compile(r"^/api/v1/voice/")),
+)
+# 音声のアップロードを伴うルートの種類
+_UPLOAD_CLASSES = {"stt", "stt_batch"}
+# Content-Length と音声ファイル自体のサイズの差(multipartの境界・ヘッダ分)として許容するバイト数
+_MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# レート制限で状態を保持するクライアント数の上限(古いものから捨てる)
+_MAX_TRACKED_CLIENTS = 10000
+
+
+class AdmissionRejectedError(Exception):
+    """リクエストを受け付けなかった場合の例外"""
+
+    def __init__(self, reason: str, detail: str, retry_after: float = 0.0, status_code: int = 429) -> None:
+        super().__init__(detail)
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class TokenBucketLimiter:
+    """クライアントごとのトークンバケットによるレート制限"""
+
+    def __init__(self, rate_per_second: float, burst: int, max_clients: int = _MAX_TRACKED_CLIENTS) -> None:
+        """
+        TokenBucketLimiterの初期化
+
+        Args:
+            rate_per_second: 1秒あたりに補充するトークン数
+            burst: バケットの容量(連続して受け付けられる数)
+            max_clients: 状態を保持するクライアント数の上限
+        """
+        self._rate = rate_per_second
+        self._burst = float(burst)
+        self._max_clients = max_clients
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def acquire(self, key: str) -> float:
+        """
+        トークンを1つ消費する
+
+        Args:
+            key: クライアントの識別子
+
+        Returns:
+            受け付ける場合は0。制限する場合は次のトークンが補充されるまでの秒数
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self._burst, now))
+        tokens = min(self._burst, tokens + (now - updated) * self._rate)
+        wait = 0.0
+        if tokens >= 1.0:
+            tokens -= 1.0
+        else:
+            wait = (1.0 - tokens) / self._rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self._max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class ByteBudget:
+    """処理中のアップロードの合計バイト数の上限"""
+
+    def __init__(self, capacity: int) -> None:
+        """
+        ByteBudgetの初期化
+
+        Args:
+            capacity: 同時に受け付けるアップロードの合計バイト数
+        """
+        self.capacity = capacity
+        self.in_use = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, size: int, timeout: float) -> bool:
+        """
+        指定バイト数の枠を確保する(空くまで待つ)
+
+        Args:
+            size: 確保するバイト数(容量を超える場合は容量分を確保する)
+            timeout: 待つ最大秒数
+
+        Returns:
+            確保できたか
+        """
+        size = min(size, self.capacity)
+        async with self._condition:
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: self.in_use + size <= self.capacity), timeout
+                )
+            except TimeoutError:
+                return False
+            self.in_use += size
+            UPLOAD_BUDGET_IN_USE.set(self.in_use)
+            return True
+
+    async def release(self, size: int) -> None:
+        """確保した枠を返す"""
+        async with self._condition:
+            self.in_use -= min(size, self.capacity)
+            UPLOAD_BUDGET_IN_USE.set(self.in_use)
+            self._condition.notify_all()
+
+
+class AdmissionGate:
+    """1種類のルートの同時実行数と待ち行列の長さを制限するクラス"""
+
+    def __init__(self, name: str, concurrency: int, max_queue: int) -> None:
+        """
+        AdmissionGateの初期化
+
+        Args:
+            name: ルートの種類
+            concurrency: 同時に処理するリクエスト数
+            max_queue: 処理の空きを待てるリクエスト数(0の場合は待たせずに断る)
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # 1リクエストの処理時間の移動平均(待ち時間の見積もりに使う)
+        self._service_seconds = 1.0
+
+    async def acquire(self, timeout: float) -> None:
+        """
+        処理の枠を確保する
+
+        Args:
+            timeout: 待ち行列で待つ最大秒数
+
+        Raises:
+            AdmissionRejectedError: 待ち行列が満杯、または待ちきれなかった場合
+        """
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                raise AdmissionRejectedError("queue_full", "混み合っているため受け付けられません", self.retry_after())
+            self.waiting += 1
+            ADMISSION_QUEUE_DEPTH.labels(self.name).set(self.waiting)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+            except TimeoutError as e:
+                raise AdmissionRejectedError(
+                    "queue_timeout", "混み合っているため処理を開始できませんでした", self.retry_after()
+                ) from e
+            finally:
+                self.waiting -= 1
+                ADMISSION_QUEUE_DEPTH.labels(self.name).set(self.waiting)
+        else:
+            await self._semaphore.acquire()
+        self.active += 1
+        ADMISSION_IN_FLIGHT.labels(self.name).set(self.active)
+
+    def release(self, elapsed: float) -> None:
+        """
+        処理の枠を返す
+
+        Args:
+            elapsed: 処理にかかった秒数
+        """
+        self.active -= 1
+        ADMISSION_IN_FLIGHT.labels(self.name).set(self.active)
+        self._service_seconds += (elapsed - self._service_seconds) * 0.2
+        self._semaphore.release()
+
+    def retry_after(self) -> float:
+        """待ち行列がはけるまでのおおよその秒数"""
+        return self._service_seconds * (self.waiting + 1) / self.concurrency
+
+
+@dataclass
+class AdmissionTicket:
+    """受け付けたリクエストが確保した枠(処理の終了時に release する)"""
+
+    gate: AdmissionGate
+    upload_bytes: int
+    started: float
+
+    async def release(self, budget: ByteBudget) -> None:
+        self.gate.release(time.perf_counter() - self.started)
+        if self.upload_bytes:
+            await budget.release(self.upload_bytes)
+
+
+class AdmissionController:
+    """ルートの種類ごとの受け付け制御をまとめるクラス"""
+
+    def __init__(
+        self,
+        gates: dict[str, AdmissionGate],
+        limiter: TokenBucketLimiter | None,
+        upload_budget: ByteBudget,
+        max_upload_bytes: int,
+        queue_timeout: float,
+        trusted_proxies: int = 0,
+        max_batch_upload_bytes: int | None = None,
+    ) -> None:
+        """
+        AdmissionControllerの初期化
+
+        Args:
+            gates: ルートの種類ごとの同時実行数・待ち行列
+            limiter: クライアントごとのレート制限(Noneの場合は制限しない)
+            upload_budget: 処理中のアップロードの合計バイト数の上限
+            max_upload_bytes: 1つの音声ファイルの最大バイト数
+            queue_timeout: 待ち行列・アップロード枠で待つ最大秒数
+            trusted_proxies: 前段のプロキシの段数(X-Forwarded-Forからクライアントを特定する)
+            max_batch_upload_bytes: 一括文字起こしのアップロード全体の最大バイト数(Noneの場合はmax_upload_bytes)
+        """
+        self._gates = gates
+        self._limiter = limiter
+        self._upload_budget = upload_budget
+        self._max_upload_bytes = max_upload_bytes
+        self._max_batch_upload_bytes = max_batch_upload_bytes or max_upload_bytes
+        self._queue_timeout = queue_timeout
+        self._trusted_proxies = trusted_proxies
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "AdmissionController":
+        """
+        設定から生成する
+
+        Args:
+            settings: アプリケーション設定
+
+        Returns:
+            AdmissionController
+        """
+        gates = {
+            "chat": AdmissionGate("chat", settings.admission_chat_concurrency, settings.admission_chat_queue),
+            "summarize": AdmissionGate(
+                "summarize", settings.admission_summarize_concurrency, settings.admission_summarize_queue
+            ),
+            "stt": AdmissionGate("stt", settings.admission_stt_concurrency, settings.admission_stt_queue),
+            "stt_batch": AdmissionGate(
+                "stt_batch", settings.admission_stt_batch_concurrency, settings.admission_stt_batch_queue
+            ),
+            "tts": AdmissionGate("tts", settings.admission_tts_concurrency, settings.admission_tts_queue),
+            # WebSocketは接続している間ずっと枠を使うため、待たせずに断る
+            "voice": AdmissionGate("voice", settings.admission_voice_concurrency, 0),
+        }
+        limiter = (
+            TokenBucketLimiter(settings.rate_limit_per_minute / 60.0, settings.rate_limit_burst)
+            if settings.rate_limit_per_minute > 0
+            else None
+        )
+        return cls(
+            gates,
+            limiter,
+            ByteBudget(settings.upload_budget_bytes),
+            max_upload_bytes=settings.stt_max_upload_bytes,
+            queue_timeout=settings.admission_queue_timeout_seconds,
+            trusted_proxies=settings.rate_limit_trusted_proxies,
+            max_batch_upload_bytes=settings.stt_batch_max_upload_bytes,
+        )
+
+    def classify(self, scope: Scope) -> str | None:
+        """
+        リクエストのルートの種類を返す
+
+        Returns:
+            ルートの種類(制御の対象外の場合はNone)
+        """
+        if scope["type"] == "http" and scope["method"] != "POST":
+            return None
+        path = scope["path"]
+        for name, pattern in _ROUTE_CLASSES:
+            if pattern.match(path):
+                return name
+        return None
+
+    def client_key(self, scope: Scope) -> str:
+        """
+        レート制限に使うクライアントの識別子を返す
+
+        前段のプロキシが付けた X-Forwarded-For の、信頼できる段数目(後ろから数える)を使う。
+        プロキシを信頼しない設定の場合は接続元のアドレスを使う。
+        """
+        if self._trusted_proxies > 0:
+            forwarded = Headers(scope=scope).get("x-forwarded-for")
+            if forwarded:
+                hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+                if hops:
+                    return hops[-min(self._trusted_proxies, len(hops))]
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def admit(self, scope: Scope, route_class: str) -> AdmissionTicket:
+        """
+        リクエストを受け付けるか判定し、処理の枠を確保する
+
+        Args:
+            scope: ASGIのスコープ
+            route_class: ルートの種類
+
+        Returns:
+            確保した枠
+
+        Raises:
+            AdmissionRejectedError: 受け付けない場合
+        """
+        upload_bytes = 0
+        if route_class in _UPLOAD_CLASSES:
+            max_bytes = self._upload_limit(route_class)
+            content_length = Headers(scope=scope).get("content-length")
+            upload_bytes = int(content_length) if content_length and content_length.isdigit() else max_bytes
+            if upload_bytes > max_bytes + _MULTIPART_OVERHEAD_BYTES:
+                raise AdmissionRejectedError(
+                    "too_large",
+                    f"アップロードサイズが上限({max_bytes}バイト)を超えています",
+                    status_code=413,
+                )
+
+        if self._limiter is not None:
+            wait = self._limiter.acquire(f"{self.client_key(scope)}:{route_class}")
+            if wait > 0:
+                raise AdmissionRejectedError("rate_limited", "リクエストが多すぎます", wait)
+
+        gate = self._gates[route_class]
+        if upload_bytes and not await self._upload_budget.acquire(upload_bytes, self._queue_timeout):
+            raise AdmissionRejectedError(
+                "upload_budget", "処理中のアップロードが多いため受け付けられません", gate.retry_after()
+            )
+        try:
+            await gate.acquire(self._queue_timeout)
+        except BaseException:
+            if upload_bytes:
+                await self._upload_budget.release(upload_bytes)
+            raise
+        return AdmissionTicket(gate, upload_bytes, time.perf_counter())
+
+    async def release(self, ticket: AdmissionTicket) -> None:
+        """確保した枠を返す"""
+        await ticket.release(self._upload_budget)
+
+    def body_limit(self, route_class: str) -> int | None:
+        """
+        受信する本文の最大バイト数を返す
+
+        Returns:
+            最大バイト数(音声のアップロードを伴わないルートの場合はNone)
+        """
+        if route_class not in _UPLOAD_CLASSES:
+            return None
+        return self._upload_limit(route_class) + _MULTIPART_OVERHEAD_BYTES
+
+    def _upload_limit(self, route_class: str) -> int:
+        """音声のアップロードの最大バイト数"""
+        return self._max_batch_upload_bytes if route_class == "stt_batch" else self._max_upload_bytes
+
+
+class AdmissionMiddleware:
+    """負荷の高いルートの受け付けを制御するASGIミドルウェア
+
+    受け付けない場合は本文を読む前に429(Retry-After付き)、または413を返す。
+    音声のアップロードはContent-Lengthが無い・偽っている場合に備え、受信したバイト数も数え、
+    上限を超えた時点で受信を打ち切って413を返す(アップロード全体の受信を待たない)。
+    WebSocketは接続を受け入れる前に1013(Try Again Later)で閉じる。
+    処理の枠はストリーミング応答の送信が終わるまで確保したままにする。
+    """
+
+    def __init__(self, app: ASGIApp, controller: AdmissionController) -> None:
+        """
+        AdmissionMiddlewareの初期化
+
+        Args:
+            app: 次のASGIアプリ
+            controller: 受け付け制御
+        """
+        self.app = app
+        self._controller = controller
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        route_class = self._controller.classify(scope) if scope["type"] in ("http", "websocket") else None
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            ticket = await self._controller.admit(scope, route_class)
+        except AdmissionRejectedError as e:
+            ADMISSION_REJECTED.labels(route_class, e.reason).inc()
+            logger.info("リクエストを受け付けませんでした(%s, %s): %s", route_class, e.reason, scope["path"])
+            await self._reject(scope, receive, send, e)
+            return
+        limit = self._controller.body_limit(route_class) if scope["type"] == "http" else None
+        if limit is not None:
+            receive = _limit_body(receive, limit)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self._controller.release(ticket)
+
+    @staticmethod
+    async def _reject(scope: Scope, receive: Receive, send: Send, e: AdmissionRejectedError) -> None:
+        """受け付けない旨の応答を返す"""
+        if scope["type"] == "websocket":
+            await WebSocketClose(code=1013, reason=e.detail)(scope, receive, send)
+            return
+        headers = {"Retry-After": str(max(1, math.ceil(e.retry_after)))} if e.status_code == 429 else None
+        await JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=headers)(scope, receive, send)
+
+
+def _limit_body(receive: Receive, max_bytes: int) -> Receive:
+    """
+    受信した本文のバイト数を数え、上限を超えたら413のHTTPExceptionを送出するreceiveを返す
+
+    本文の読み込み中に送出されるため、ルートの例外処理を経て413の応答になる。
+    """
+    received = 0
+
+    async def limited() -> Message:
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > max_bytes:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"アップロードサイズが上限({max_bytes - _MULTIPART_OVERHEAD_BYTES}バイト)を超えています",
+                )
+        return message
+
+    return limited
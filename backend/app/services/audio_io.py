@@ -0,0 +1,222 @@
+"""アップロード音声のディスク退避とffmpegによる音声変換"""
+import asyncio
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import BinaryIO
+
+from fastapi import UploadFile
+
+# 文字起こし用に変換するPCMの形式(16kHz・モノラル・16bit)
+PCM_SAMPLE_RATE = 16000
+PCM_SAMPLE_WIDTH = 2
+
+
+class UploadTooLargeError(ValueError):
+    """アップロードサイズが上限を超えた場合の例外"""
+
+    def __init__(self, max_bytes: int) -> None:
+        super().__init__(f"アップロードサイズが上限({max_bytes}バイト)を超えています")
+        self.max_bytes = max_bytes
+
+
+class AudioConversionError(RuntimeError):
+    """ffmpegによる音声変換に失敗した場合の例外"""
+
+
+async def spool_upload(
+    file: UploadFile,
+    max_bytes: int,
+    chunk_bytes: int,
+    spool_dir: str | None = None,
+) -> Path:
+    """
+    アップロードファイルを一定サイズずつ読み出して一時ファイルへ書き出す
+
+    受信中のサイズの上限はAdmissionMiddlewareで確認するため、ここではファイルごとの上限を確認する。
+    ffmpegにパスで渡すため名前付きの一時ファイルへ書き出す。コピーは1回のワーカースレッドで行う。
+
+    Args:
+        file: アップロードファイル
+        max_bytes: 受け付ける最大バイト数
+        chunk_bytes: 1回に読み出すバイト数
+        spool_dir: 一時ファイルの保存先(Noneの場合はシステムの一時ディレクトリ)
+
+    Returns:
+        書き出した一時ファイルのパス(呼び出し側で削除すること)
+
+    Raises:
+        UploadTooLargeError: サイズが上限を超えた場合
+    """
+    suffix = Path(file.filename or "").suffix or ".bin"
+    fd, name = tempfile.mkstemp(prefix="upload-", suffix=suffix, dir=spool_dir or None)
+    path = Path(name)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            await asyncio.to_thread(_copy_limited, file.file, out, max_bytes, chunk_bytes)
+        return path
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+
+
+def _copy_limited(src: BinaryIO, dst: BinaryIO, max_bytes: int, chunk_bytes: int) -> None:
+    """srcの先頭からdstへ一定サイズずつコピーする(上限を超えたらUploadTooLargeError)"""
+    src.seek(0)
+    total = 0
+    while chunk := src.read(chunk_bytes):
+        total += len(chunk)
+        if total > max_bytes:
+            raise UploadTooLargeError(max_bytes)
+        dst.write(chunk)
+
+
+def ffmpeg_available() -> bool:
+    """ffmpegが利用可能か判定する"""
+    return shutil.which("ffmpeg") is not None
+
+
+async def _run_ffmpeg(args: list[str], stdin: bytes | None = None) -> bytes:
+    """
+    ffmpegを実行し、標準出力を返す
+
+    Args:
+        args: ffmpegに渡す引数
+        stdin: 標準入力に渡すデータ
+
+    Returns:
+        標準出力の内容
+
+    Raises:
+        AudioConversionError: ffmpegが異常終了した場合
+    """
+    base = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    if stdin is None:
+        base.append("-nostdin")
+    proc = await asyncio.create_subprocess_exec(
+        *base,
+        *args,
+        stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out, err = await proc.communicate(input=stdin)
+    if proc.returncode != 0:
+        raise AudioConversionError(f"ffmpegの実行に失敗しました: {err.decode(errors='replace').strip()}")
+    return out
+
+
+async def decode_to_pcm(src: Path, spool_dir: str | None = None) -> Path:
+    """
+    音声ファイルを16kHz・モノラル・16bitのraw PCMへ変換する
+
+    Args:
+        src: 変換元の音声ファイル
+        spool_dir: 出力先ディレクトリ(Noneの場合はシステムの一時ディレクトリ)
+
+    Returns:
+        raw PCMファイルのパス(呼び出し側で削除すること)
+
+    Raises:
+        AudioConversionError: 変換に失敗した場合
+    """
+    fd, name = tempfile.mkstemp(prefix="pcm-", suffix=".raw", dir=spool_dir or None)
+    os.close(fd)
+    dst = Path(name)
+    try:
+        await _run_ffmpeg([
+            "-y",
+            "-i", str(src),
+            "-vn",
+            "-ac", "1",
+            "-ar", str(PCM_SAMPLE_RATE),
+            "-f", "s16le",
+            str(dst),
+        ])
+        return dst
+    except BaseException:
+        dst.unlink(missing_ok=True)
+        raise
+
+
+def pcm_duration(pcm: Path) -> float:
+    """raw PCMファイルの再生時間(秒)を返す"""
+    return pcm.stat().st_size / (PCM_SAMPLE_RATE * PCM_SAMPLE_WIDTH)
+
+
+def read_pcm_range(pcm: Path, start: float, duration: float) -> bytes:
+    """
+    raw PCMファイルから指定区間のサンプルを読み出す
+
+    Args:
+        pcm: raw PCMファイル
+        start: 開始位置(秒)
+        duration: 長さ(秒)
+
+    Returns:
+        指定区間のPCMデータ
+    """
+    frame = PCM_SAMPLE_WIDTH
+    offset = int(start * PCM_SAMPLE_RATE) * frame
+    length = int(duration * PCM_SAMPLE_RATE) * frame
+    with open(pcm, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+async def encode_pcm_to_flac(pcm: bytes) -> bytes:
+    """
+    raw PCMデータをFLACへエンコードする
+
+    Args:
+        pcm: 16kHz・モノラル・16bitのraw PCMデータ
+
+    Returns:
+        FLACデータ
+
+    Raises:
+        AudioConversionError: エンコードに失敗した場合
+    """
+    return await _run_ffmpeg(
+        [
+            "-f", "s16le",
+            "-ar", str(PCM_SAMPLE_RATE),
+            "-ac", "1",
+            "-i", "pipe:0",
+            "-c:a", "flac",
+            "-f", "flac",
+            "pipe:1",
+        ],
+        stdin=pcm,
+    )
+
+
+async def encode_pcm_file(pcm: Path, dst: Path, codec: str, bitrate_kbps: int = 32) -> None:
+    """
+    raw PCMファイルをFLACまたはOpus(Oggコンテナ)のファイルへエンコードする
+
+    入出力ともファイルのまま渡すため、長い録音でもメモリに読み込まない。
+
+    Args:
+        pcm: 16kHz・モノラル・16bitのraw PCMファイル
+        dst: 出力先のファイル(上書きする)
+        codec: "flac" または "opus"
+        bitrate_kbps: Opusのビットレート(kbps)
+
+    Raises:
+        AudioConversionError: エンコードに失敗した場合
+    """
+    if codec == "opus":
+        output = ["-c:a", "libopus", "-b:a", f"{bitrate_kbps}k", "-application", "voip", "-f", "ogg"]
+    else:
+        output = ["-c:a", "flac", "-f", "flac"]
+    await _run_ffmpeg([
+        "-y",
+        "-f", "s16le",
+        "-ar", str(PCM_SAMPLE_RATE),
+        "-ac", "1",
+        "-i", str(pcm),
+        *output,
+        str(dst),
+    ])
@@ -0,0 +1,505 @@
+"""文字起こし前の音声の前処理(無音の圧縮、16kHz・1チャンネルへの変換、再エンコード)"""
+import asyncio
+import io
+import logging
+import os
+import tempfile
+import wave
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+import numpy as np
+
+from app.services.audio_io import (
+    PCM_SAMPLE_RATE,
+    PCM_SAMPLE_WIDTH,
+    AudioConversionError,
+    decode_to_pcm,
+    encode_pcm_file,
+    ffmpeg_available,
+    pcm_duration,
+)
+from app.services.metrics import (
+    PAYLOAD_BYTES,
+    STT_PREPROCESS_SAVED_BYTES,
+    STT_PREPROCESS_SAVED_SECONDS,
+    STT_PREPROCESS_TOTAL,
+    trace_stage,
+)
+
+logger = logging.getLogger(__name__)
+
+# 前処理後のエンコード形式(opus/flacはffmpegが必要。無い場合はwavにする)
+CODECS = ("opus", "flac", "wav")
+_CODEC_FILES = {
+    "opus": (".ogg", "audio/ogg"),
+    "flac": (".flac", "audio/flac"),
+    "wav": (".wav", "audio/wav"),
+}
+_WAV_MIME_TYPES = {"audio/wav", "audio/x-wav", "audio/wave", "audio/vnd.wave"}
+
+# 音声区間の判定に使うフレームの長さ
+_FRAME_MS = 30
+# ノイズフロア(下位10%のフレーム)からこの差以上大きいフレームを音声とみなす
+_NOISE_MARGIN_DB = 12.0
+# 大きいフレーム(上位5%)からこの差以内のフレームは必ず音声とみなす(音声の多い録音を削らない)
+_SPEECH_HEADROOM_DB = 15.0
+# 前処理した音声を使うのは、これだけ短くなるか小さくなる場合に限る
+_MIN_SAVED_SECONDS = 1.0
+_MIN_SAVED_RATIO = 0.1
+# 一度にメモリへ読み込む長さ(秒)。長い録音もこの長さのブロックずつ処理する
+_BLOCK_SECONDS = 60
+_COPY_CHUNK_BYTES = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class PreparedAudio:
+    """前処理した音声ファイル(使い終わったら cleanup で削除する)"""
+
+    path: Path
+    filename: str
+    mime_type: str
+    original_bytes: int
+    processed_bytes: int
+    original_seconds: float
+    processed_seconds: float
+    # 前処理後の音声の16kHz・1チャンネル・16bitのraw PCM(区間分割に再利用する)
+    pcm: Path | None = None
+
+    @property
+    def saved_bytes(self) -> int:
+        """削減したバイト数(増えた場合は負)"""
+        return self.original_bytes - self.processed_bytes
+
+    @property
+    def saved_seconds(self) -> float:
+        """削減した音声の秒数"""
+        return self.original_seconds - self.processed_seconds
+
+    def cleanup(self) -> None:
+        """前処理したファイルを削除する"""
+        self.path.unlink(missing_ok=True)
+        if self.pcm is not None:
+            self.pcm.unlink(missing_ok=True)
+
+
+def frame_energy_dbfs(samples: np.ndarray, frame: int) -> np.ndarray:
+    """
+    フレームごとの音量(RMS、dBFS)を求める
+
+    Args:
+        samples: 16bit相当の値域のサンプル列
+        frame: 1フレームのサンプル数
+
+    Returns:
+        フレームごとの音量(最後の半端なフレームは無音で埋めて計算する)
+    """
+    count = -(-len(samples) // frame)
+    padded = np.zeros(count * frame, dtype=np.float32)
+    padded[: len(samples)] = samples
+    rms = np.sqrt(np.mean(np.square(padded.reshape(count, frame)), axis=1))
+    energy: np.ndarray = 20.0 * np.log10(rms / 32768.0 + 1e-10)
+    return energy
+
+
+def speech_frames(energy_dbfs: np.ndarray, threshold_dbfs: float) -> np.ndarray:
+    """
+    音声を含むフレームを判定する
+
+    閾値は設定値を下限として、録音のノイズフロアに合わせて引き上げる。
+    ただし録音中の大きな音からの差が小さいフレームは必ず音声とみなす。
+
+    Args:
+        energy_dbfs: フレームごとの音量
+        threshold_dbfs: 音声とみなす音量の下限
+
+    Returns:
+        音声を含むフレームのマスク
+    """
+    noise_floor = float(np.percentile(energy_dbfs, 10))
+    loud = float(np.percentile(energy_dbfs, 95))
+    threshold = min(max(threshold_dbfs, noise_floor + _NOISE_MARGIN_DB), loud - _SPEECH_HEADROOM_DB)
+    return energy_dbfs > threshold
+
+
+def silence_keep_mask(speech: np.ndarray, max_silence_frames: int) -> np.ndarray:
+    """
+    残すフレームのマスクを求める
+
+    音声のフレームはすべて残す。無音の区間は最大 max_silence_frames に縮め、
+    区間の前半と後半を半分ずつ残す(発話の前後の余韻を残すため)。
+    録音の先頭の無音は後ろ側だけ、末尾の無音は前側だけを残す。
+
+    Args:
+        speech: 音声を含むフレームのマスク
+        max_silence_frames: 1つの無音区間に残す最大フレーム数
+
+    Returns:
+        残すフレームのマスク
+    """
+    n = len(speech)
+    change = np.flatnonzero(np.diff(speech.astype(np.int8))) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [n]))
+    lengths = ends - starts
+    run = np.repeat(np.arange(len(starts)), lengths)
+    position = np.arange(n) - starts[run]
+    half = max_silence_frames // 2
+    keep_head = np.where(starts[run] == 0, 0, half)
+    keep_tail = np.where(ends[run] == n, 0, max_silence_frames - half)
+    keep: np.ndarray = speech | (position < keep_head) | (position >= lengths[run] - keep_tail)
+    return keep
+
+
+def resample(samples: np.ndarray, src_rate: int, dst_rate: int) -> np.ndarray:
+    """
+    サンプリングレートを変換する
+
+    ダウンサンプリングでは変換比の幅の移動平均で高域を落としてから(折り返し雑音の抑制)、
+    線形補間で間引く。音声認識用には十分な品質で、追加の依存を必要としない。
+
+    Args:
+        samples: サンプル列
+        src_rate: 変換元のサンプリングレート
+        dst_rate: 変換先のサンプリングレート
+
+    Returns:
+        変換後のサンプル列(float32)
+    """
+    samples = samples.astype(np.float32, copy=False)
+    if src_rate == dst_rate or len(samples) == 0:
+        return samples
+    if src_rate > dst_rate:
+        width = max(1, round(src_rate / dst_rate))
+        if width > 1:
+            samples = np.convolve(samples, np.full(width, 1.0 / width, dtype=np.float32), mode="same")
+    count = int(len(samples) * dst_rate / src_rate)
+    positions = np.arange(count, dtype=np.float64) * (src_rate / dst_rate)
+    resampled: np.ndarray = np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+    return resampled
+
+
+def read_wav(data: bytes) -> tuple[np.ndarray, int]:
+    """
+    PCM形式のWAVを読み込み、1チャンネルのサンプル列にする
+
+    Args:
+        data: WAVファイルの内容
+
+    Returns:
+        (16bit相当の値域のサンプル列, サンプリングレート)
+
+    Raises:
+        wave.Error: PCM形式のWAVでない場合
+        ValueError: 対応していないサンプル幅の場合
+    """
+    with wave.open(io.BytesIO(data), "rb") as src:
+        rate = src.getframerate()
+        samples = _wav_samples(src.readframes(src.getnframes()), src.getsampwidth(), src.getnchannels())
+    return samples, rate
+
+
+def wav_to_pcm(src: Path, dst: BinaryIO) -> int:
+    """
+    PCM形式のWAVを16kHz・1チャンネル・16bitのraw PCMへ変換して書き出す
+
+    一定の長さのブロックずつ読み込んで変換するため、長い録音でもメモリの使用量は増えない。
+    各ブロックの前後のサンプルも読み込んで計算するため、結果は全体を resample した場合と同じになる。
+
+    Args:
+        src: WAVファイル
+        dst: 書き出し先
+
+    Returns:
+        書き出したサンプル数
+
+    Raises:
+        wave.Error: PCM形式のWAVでない場合
+        ValueError: 対応していないサンプル幅の場合
+    """
+    with wave.open(str(src), "rb") as wav:
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        rate = wav.getframerate()
+        total = wav.getnframes()
+        ratio = rate / PCM_SAMPLE_RATE
+        count = int(total * PCM_SAMPLE_RATE / rate)
+        # resample と同じ移動平均の幅と、各サンプルの前後に必要なサンプル数
+        taps = max(1, round(ratio)) if rate > PCM_SAMPLE_RATE else 1
+        kernel = np.full(taps, 1.0 / taps, dtype=np.float32)
+        before, after = taps // 2, (taps - 1) // 2
+        block = PCM_SAMPLE_RATE * _BLOCK_SECONDS
+        for first in range(0, count, block):
+            positions = np.arange(first, min(count, first + block), dtype=np.float64) * ratio
+            # このブロックの補間に使う移動平均後のサンプルの範囲 [lo, hi)
+            lo = int(positions[0])
+            hi = min(total, int(positions[-1]) + 2)
+            start = max(0, lo - before)
+            stop = min(total, hi + after)
+            wav.setpos(start)
+            samples = _wav_samples(wav.readframes(stop - start), width, channels)
+            if taps > 1:
+                # 録音の範囲外は無音として扱う(np.convolve の mode="same" と同じ)
+                samples = np.concatenate((
+                    np.zeros(start - (lo - before), dtype=np.float32),
+                    samples,
+                    np.zeros(hi + after - stop, dtype=np.float32),
+                ))
+                samples = np.convolve(samples, kernel, mode="valid")
+            dst.write(_to_pcm16(np.interp(positions, np.arange(lo, hi), samples)))
+    return count
+
+
+def _wav_samples(frames: bytes, width: int, channels: int) -> np.ndarray:
+    """WAVのフレームを16bit相当の値域の1チャンネルのサンプル列(float32)にする"""
+    if width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128.0) * 256.0
+    elif width == 2:
+        samples = np.frombuffer(frames, dtype="<i2").astype(np.float32)
+    elif width == 4:
+        samples = np.frombuffer(frames, dtype="<i4").astype(np.float32) / 65536.0
+    else:
+        raise ValueError(f"対応していないサンプル幅です: {width * 8}bit")
+    if channels > 1:
+        samples = samples[: len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+def _to_pcm16(samples: np.ndarray) -> bytes:
+    """サンプル列を16bitのraw PCMにする"""
+    return np.clip(np.round(samples), -32768, 32767).astype("<i2").tobytes()
+
+
+def _pcm_to_wav(pcm: Path, dst: Path) -> None:
+    """16kHz・1チャンネル・16bitのraw PCMファイルをWAVファイルにする"""
+    with open(pcm, "rb") as src, wave.open(str(dst), "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(PCM_SAMPLE_WIDTH)
+        out.setframerate(PCM_SAMPLE_RATE)
+        while chunk := src.read(_COPY_CHUNK_BYTES):
+            out.writeframes(chunk)
+
+
+class AudioPreprocessor:
+    """文字起こしの前に音声を小さく・短くするクラス
+
+    音声を16kHz・1チャンネルのraw PCMファイルにデコードし、音量による音声区間の判定を
+    一定の長さのブロックずつNumPyで計算して長い無音を縮めてから再エンコードする。
+    録音全体をメモリに読み込まないため、長い録音でもメモリの使用量は増えない。
+    縮めたPCMは区間分割に再利用できるよう結果に含める。処理はすべてローカルで行い、
+    十分に削減できなかった場合や失敗した場合は元の音声をそのまま送る。
+    PCM形式のWAVはffmpegが無くても処理できる。
+    """
+
+    def __init__(
+        self,
+        codec: str,
+        threshold_dbfs: float,
+        max_silence_ms: int,
+        opus_bitrate_kbps: int,
+        spool_dir: str | None = None,
+    ) -> None:
+        """
+        AudioPreprocessorの初期化
+
+        Args:
+            codec: 前処理後のエンコード形式("opus" / "flac" / "wav")
+            threshold_dbfs: 音声とみなす音量の下限(dBFS)
+            max_silence_ms: 1つの無音区間に残す最大の長さ(ミリ秒)
+            opus_bitrate_kbps: Opusのビットレート(kbps)
+            spool_dir: 一時ファイルの保存先(Noneの場合はシステムの一時ディレクトリ)
+
+        Raises:
+            ValueError: 未知のエンコード形式が指定された場合
+        """
+        if codec not in CODECS:
+            raise ValueError(f"未知のSTT_PREPROCESS_CODECです: {codec}({', '.join(CODECS)} のいずれか)")
+        self._codec = codec
+        self._threshold_dbfs = threshold_dbfs
+        self._frame = PCM_SAMPLE_RATE * _FRAME_MS // 1000
+        self._max_silence_frames = max(1, max_silence_ms // _FRAME_MS)
+        self._opus_bitrate_kbps = opus_bitrate_kbps
+        self._spool_dir = spool_dir
+        self._applied = 0
+        self._skipped = 0
+        self._failed = 0
+        self._original_bytes = 0
+        self._processed_bytes = 0
+        self._original_seconds = 0.0
+        self._processed_seconds = 0.0
+
+    async def prepare(self, src: Path, filename: str, mime_type: str) -> PreparedAudio | None:
+        """
+        音声を前処理する
+
+        Args:
+            src: アップロードされた音声ファイル
+            filename: 元のファイル名
+            mime_type: MIMEタイプ
+
+        Returns:
+            前処理した音声。元の音声をそのまま送る場合はNone
+        """
+        try:
+            with trace_stage("audio_preprocess"):
+                prepared = await self._prepare(src, filename, mime_type)
+        except (AudioConversionError, wave.Error, EOFError, ValueError) as e:
+            logger.warning("音声の前処理に失敗したため元の音声を送信します: %s: %s", type(e).__name__, e)
+            self._failed += 1
+            STT_PREPROCESS_TOTAL.labels("failed").inc()
+            return None
+        if prepared is None:
+            self._skipped += 1
+            STT_PREPROCESS_TOTAL.labels("skipped").inc()
+            return None
+
+        self._applied += 1
+        self._original_bytes += prepared.original_bytes
+        self._processed_bytes += prepared.processed_bytes
+        self._original_seconds += prepared.original_seconds
+        self._processed_seconds += prepared.processed_seconds
+        STT_PREPROCESS_TOTAL.labels("applied").inc()
+        STT_PREPROCESS_SAVED_BYTES.inc(max(0, prepared.saved_bytes))
+        STT_PREPROCESS_SAVED_SECONDS.inc(max(0.0, prepared.saved_seconds))
+        PAYLOAD_BYTES.labels("stt_preprocessed").observe(prepared.processed_bytes)
+        logger.info(
+            "音声を前処理: %.1f秒 -> %.1f秒, %dバイト -> %dバイト(%s)",
+            prepared.original_seconds, prepared.processed_seconds,
+            prepared.original_bytes, prepared.processed_bytes, prepared.mime_type,
+        )
+        return prepared
+
+    def stats(self) -> dict[str, int | float]:
+        """
+        前処理の件数と削減量を返す
+
+        Returns:
+            統計情報
+        """
+        return {
+            "applied": self._applied,
+            "skipped": self._skipped,
+            "failed": self._failed,
+            "original_bytes": self._original_bytes,
+            "processed_bytes": self._processed_bytes,
+            "saved_bytes": self._original_bytes - self._processed_bytes,
+            "original_seconds": round(self._original_seconds, 3),
+            "processed_seconds": round(self._processed_seconds, 3),
+            "saved_seconds": round(self._original_seconds - self._processed_seconds, 3),
+        }
+
+    async def _prepare(self, src: Path, filename: str, mime_type: str) -> PreparedAudio | None:
+        """デコード・無音の圧縮・再エンコードを行い、削減できた場合だけ結果を返す"""
+        original_bytes = src.stat().st_size
+        decoded = await self._decode(src, mime_type)
+        if decoded is None:
+            return None
+        codec = self._codec if ffmpeg_available() else "wav"
+        suffix, prepared_mime = _CODEC_FILES[codec]
+        trimmed: Path | None = None
+        path: Path | None = None
+        try:
+            original_seconds = pcm_duration(decoded)
+            trimmed = self._temp_path("pcm-", ".raw")
+            with open(trimmed, "wb") as out:
+                kept = await asyncio.to_thread(self._compress_silence, decoded, out)
+            if kept is None:
+                # 音声区間が見つからない場合は判定を誤っている可能性があるため、元の音声を送る
+                logger.info("音声区間が見つからないため前処理を行いません: %s", filename)
+                return None
+            processed_seconds = kept / PCM_SAMPLE_RATE
+
+            path = self._temp_path("stt-", suffix)
+            await self._encode(trimmed, path, codec)
+            processed_bytes = path.stat().st_size
+            saved_seconds = original_seconds - processed_seconds
+            if saved_seconds < _MIN_SAVED_SECONDS and processed_bytes > original_bytes * (1 - _MIN_SAVED_RATIO):
+                return None
+            prepared = PreparedAudio(
+                path=path,
+                filename=Path(filename or "audio").stem + suffix,
+                mime_type=prepared_mime,
+                original_bytes=original_bytes,
+                processed_bytes=processed_bytes,
+                original_seconds=original_seconds,
+                processed_seconds=processed_seconds,
+                pcm=trimmed,
+            )
+            trimmed = path = None
+            return prepared
+        finally:
+            decoded.unlink(missing_ok=True)
+            # 結果として返さなかった一時ファイルを削除する
+            for leftover in (trimmed, path):
+                if leftover is not None:
+                    leftover.unlink(missing_ok=True)
+
+    async def _decode(self, src: Path, mime_type: str) -> Path | None:
+        """
+        16kHz・1チャンネル・16bitのraw PCMファイルにデコードする
+
+        PCM形式のWAVはNumPyで変換し、それ以外はffmpegでデコードする。
+        どちらもできない場合はNone。PCMファイルは呼び出し側で削除する。
+        """
+        if mime_type.split(";")[0].strip().lower() in _WAV_MIME_TYPES or src.suffix.lower() == ".wav":
+            pcm = self._temp_path("pcm-", ".raw")
+            try:
+                with open(pcm, "wb") as out:
+                    await asyncio.to_thread(wav_to_pcm, src, out)
+                return pcm
+            except (wave.Error, EOFError, ValueError) as e:
+                pcm.unlink(missing_ok=True)
+                if not ffmpeg_available():
+                    raise
+                logger.debug("WAVとして読み込めないためffmpegでデコードします: %s", e)
+            except BaseException:
+                pcm.unlink(missing_ok=True)
+                raise
+        if not ffmpeg_available():
+            return None
+        return await decode_to_pcm(src, self._spool_dir)
+
+    def _compress_silence(self, pcm: Path, out: BinaryIO) -> int | None:
+        """
+        長い無音を縮めたPCMを書き出す
+
+        PCMファイルをメモリマップし、音量の計算と書き出しをブロックずつ行う。
+
+        Returns:
+            書き出したサンプル数(音声区間が無い場合はNone)
+        """
+        if pcm.stat().st_size < PCM_SAMPLE_WIDTH:
+            return None
+        samples = np.memmap(pcm, dtype="<i2", mode="r")
+        frames_per_block = PCM_SAMPLE_RATE * _BLOCK_SECONDS // self._frame
+        block = frames_per_block * self._frame
+        energy = np.concatenate([
+            frame_energy_dbfs(samples[i : i + block], self._frame) for i in range(0, len(samples), block)
+        ])
+        speech = speech_frames(energy, self._threshold_dbfs)
+        if not speech.any():
+            return None
+        keep = silence_keep_mask(speech, self._max_silence_frames)
+        kept = 0
+        for index, i in enumerate(range(0, len(samples), block)):
+            part = samples[i : i + block]
+            first = index * frames_per_block
+            mask = np.repeat(keep[first : first + frames_per_block], self._frame)[: len(part)]
+            trimmed = part[mask]
+            out.write(trimmed.tobytes())
+            kept += len(trimmed)
+        return kept
+
+    async def _encode(self, pcm: Path, dst: Path, codec: str) -> None:
+        """PCMファイルを指定の形式のファイルにエンコードする"""
+        if codec == "wav":
+            await asyncio.to_thread(_pcm_to_wav, pcm, dst)
+        else:
+            await encode_pcm_file(pcm, dst, codec, self._opus_bitrate_kbps)
+
+    def _temp_path(self, prefix: str, suffix: str) -> Path:
+        """一時ファイルを作成してパスを返す"""
+        fd, name = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=self._spool_dir or None)
+        os.close(fd)
+        return Path(name)
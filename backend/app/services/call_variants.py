@@ -0,0 +1,176 @@
+"""上流APIの呼び出し方式(フォールバック)の選択結果を記憶する"""
+import logging
+import time
+from collections.abc import Awaitable, Callable, Hashable, Sequence
+from dataclasses import dataclass, field
+from typing import TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 呼び出し方式が上流に受け付けられなかったことを示すHTTPステータス(リクエストの形式の拒否)
+_CAPABILITY_STATUS = frozenset({400, 415, 422})
+
+
+def error_kind(error: BaseException) -> str:
+    """例外の種類を表す文字列(例外クラス名とHTTPステータス)を返す"""
+    status = getattr(error, "status_code", None)
+    return f"{type(error).__name__}:{status}" if status is not None else type(error).__name__
+
+
+def is_capability_error(error: BaseException) -> bool:
+    """
+    呼び出し方式そのものが使えないことを示す例外か判定する
+
+    SDKが引数を受け付けない場合(TypeError)と、上流がリクエストの形式を拒否した場合
+    (400/415/422)に限る。タイムアウト・429・5xxなどの一時的な失敗は含めない。
+
+    Args:
+        error: 発生した例外
+
+    Returns:
+        別の方式を試すべき例外の場合にTrue
+    """
+    if isinstance(error, TypeError):
+        return True
+    status = getattr(error, "status_code", None)
+    return isinstance(status, int) and status in _CAPABILITY_STATUS
+
+
+@dataclass
+class _Choice:
+    """呼び出し条件ごとの判定結果"""
+
+    variant: str
+    expires_at: float
+    # 判定済みの方式で発生したことのある例外の種類
+    seen_errors: set[str] = field(default_factory=set)
+
+
+@dataclass
+class _VariantCounts:
+    """方式ごとの呼び出し回数"""
+
+    attempts: int = 0
+    successes: int = 0
+    failures: int = 0
+
+
+class VariantSelector:
+    """複数の呼び出し方式を順に試し、成功した方式を条件ごとに記憶するクラス
+
+    記憶した方式は有効期限内であれば最初から直接使用する。
+    記憶した方式がこれまでに無い種類の例外で失敗した場合、または有効期限が
+    切れた場合にだけ、すべての方式を先頭から試し直す(再判定)。
+    次の方式を試すのは方式そのものが使えない場合(``is_capability_error``)だけで、
+    一時的な失敗などはそのまま送出する(リトライやサーキットブレーカーは呼び出し側に任せ、
+    一時的な失敗で別の方式を記憶しないようにする)。
+    """
+
+    def __init__(self, variants: Sequence[str], ttl_seconds: float) -> None:
+        """
+        VariantSelectorの初期化
+
+        Args:
+            variants: 試行する方式の名前(優先順)
+            ttl_seconds: 判定結果の有効期間(秒)
+        """
+        self._variants = list(variants)
+        self._ttl = ttl_seconds
+        self._choices: dict[Hashable, _Choice] = {}
+        self._counts = {name: _VariantCounts() for name in self._variants}
+        self._memo_hits = 0
+        self._probes = 0
+        self._fallbacks = 0
+
+    async def run(self, key: Hashable, attempts: dict[str, Callable[[], Awaitable[T]]]) -> T:
+        """
+        条件に合った方式で呼び出しを実行する
+
+        Args:
+            key: 判定結果を記憶する条件(モデル、SDKバージョン、フォーマットなど)
+            attempts: 方式名と、その方式で呼び出しを行うコルーチン関数
+
+        Returns:
+            成功した呼び出しの結果
+
+        Raises:
+            Exception: 方式そのものが使えない以外の理由で失敗した場合(その例外)、
+                またはすべての方式が使えなかった場合(最後の方式の例外)
+        """
+        choice = self._choices.get(key)
+        seen_errors: set[str] = set()
+        if choice is not None and choice.expires_at > time.monotonic():
+            self._memo_hits += 1
+            try:
+                return await self._attempt(choice.variant, attempts[choice.variant])
+            except Exception as e:
+                kind = error_kind(e)
+                if not is_capability_error(e) or kind in choice.seen_errors:
+                    raise
+                choice.seen_errors.add(kind)
+                logger.info("呼び出し方式を再判定: key=%s, variant=%s, error=%s", key, choice.variant, kind)
+            seen_errors = choice.seen_errors
+        elif choice is not None:
+            seen_errors = choice.seen_errors
+
+        self._probes += 1
+        last_error: Exception | None = None
+        for index, name in enumerate(self._variants):
+            if name not in attempts:
+                continue
+            try:
+                result = await self._attempt(name, attempts[name])
+            except Exception as e:
+                if not is_capability_error(e):
+                    raise
+                logger.warning("呼び出し方式(%s)が使えないため次の方式を試します: %s", name, e)
+                last_error = e
+                continue
+            if index > 0:
+                self._fallbacks += 1
+            self._choices[key] = _Choice(name, time.monotonic() + self._ttl, seen_errors)
+            return result
+        if last_error is None:
+            raise ValueError("試行できる呼び出し方式がありません")
+        raise last_error
+
+    def stats(self) -> dict[str, object]:
+        """
+        方式ごとの呼び出し回数と判定状況を返す
+
+        Returns:
+            統計情報
+        """
+        now = time.monotonic()
+        return {
+            "memo_hits": self._memo_hits,
+            "probes": self._probes,
+            "fallbacks": self._fallbacks,
+            "variants": {
+                name: {
+                    "attempts": counts.attempts,
+                    "successes": counts.successes,
+                    "failures": counts.failures,
+                }
+                for name, counts in self._counts.items()
+            },
+            "choices": {
+                "/".join(map(str, key)) if isinstance(key, tuple) else str(key): choice.variant
+                for key, choice in self._choices.items()
+                if choice.expires_at > now
+            },
+        }
+
+    async def _attempt(self, name: str, call: Callable[[], Awaitable[T]]) -> T:
+        """1つの方式で呼び出し、回数を数える"""
+        counts = self._counts[name]
+        counts.attempts += 1
+        try:
+            result = await call()
+        except Exception:
+            counts.failures += 1
+            raise
+        counts.successes += 1
+        return result
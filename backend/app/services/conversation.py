@@ -0,0 +1,213 @@
+"""サーバー側で履歴を保持する会話セッション"""
+import asyncio
+import contextlib
+import logging
+from collections.abc import AsyncGenerator
+from typing import TYPE_CHECKING, Any
+
+from app.services.session_store import Session, SessionNotFoundError, SessionStore
+from app.services.tokens import estimate_tokens
+
+if TYPE_CHECKING:
+    from app.services.gemini_service import GeminiService
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationService:
+    """会話履歴をセッションとして保持し、長くなった履歴を要約に圧縮するクラス"""
+
+    def __init__(
+        self,
+        store: SessionStore,
+        gemini: "GeminiService",
+        history_token_budget: int,
+        keep_recent_messages: int,
+    ) -> None:
+        """
+        ConversationServiceの初期化
+
+        Args:
+            store: セッションの保存先
+            gemini: 応答生成と要約に使用するGeminiService
+            history_token_budget: 要約されていない履歴のトークン数の上限
+            keep_recent_messages: 圧縮時にそのまま残す直近の発言数
+        """
+        self._store = store
+        self._gemini = gemini
+        self._history_token_budget = history_token_budget
+        self._keep_recent_messages = keep_recent_messages
+        self._compactions: dict[str, asyncio.Task[None]] = {}
+
+    async def create_session(self, context: list[dict[str, Any]] | None = None) -> Session:
+        """
+        新しいセッションを作成する
+
+        Args:
+            context: コンテキスト情報(イベント情報など)
+
+        Returns:
+            作成したセッション
+        """
+        return await self._store.create(context)
+
+    async def get_session(self, session_id: str) -> Session:
+        """
+        セッションを取得する
+
+        Args:
+            session_id: セッションID
+
+        Returns:
+            セッション
+
+        Raises:
+            SessionNotFoundError: セッションが存在しない場合
+        """
+        session = await self._store.get(session_id)
+        if session is None:
+            raise SessionNotFoundError(session_id)
+        return session
+
+    async def delete_session(self, session_id: str) -> None:
+        """セッションを削除する"""
+        task = self._compactions.pop(session_id, None)
+        if task is not None:
+            task.cancel()
+        await self._store.delete(session_id)
+
+    async def send_message(
+        self,
+        session_id: str,
+        content: str,
+        context: list[dict[str, Any]] | None = None,
+        past_diaries: list[str] | None = None,
+    ) -> str:
+        """
+        セッションに新しいメッセージを送り、AI応答を生成する
+
+        Args:
+            session_id: セッションID
+            content: ユーザーからのメッセージ
+            context: 更新後のコンテキスト情報(Noneの場合は保存済みのものを使う)
+            past_diaries: 今回のメッセージに関連する過去の日記(履歴には保存しない)
+
+        Returns:
+            AIからの応答テキスト
+
+        Raises:
+            SessionNotFoundError: セッションが存在しない場合
+            TimeoutError: API呼び出しがタイムアウトした場合
+            Exception: 応答生成に失敗した場合
+        """
+        session = await self.get_session(session_id)
+        if context is not None:
+            await self._store.set_context(session_id, context)
+            session.context = context
+
+        reply = await self._gemini.generate_response(
+            user_message=content,
+            context=session.context,
+            messages_history=session.messages or None,
+            history_summary=session.summary or None,
+            past_diaries=past_diaries,
+        )
+        new_messages = [
+            {"role": "user", "content": content},
+            {"role": "assistant", "content": reply},
+        ]
+        await self._store.append(session_id, new_messages)
+        self._maybe_schedule_compaction(session_id, session.messages + new_messages)
+        return reply
+
+    async def stream_message(
+        self,
+        session_id: str,
+        content: str,
+        context: list[dict[str, Any]] | None = None,
+        past_diaries: list[str] | None = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        セッションに新しいメッセージを送り、AI応答を生成されたそばから逐次返す
+
+        応答を最後まで返し終えた場合だけ履歴に保存する。
+        途中で反復をやめた場合(クライアント切断・割り込みなど)は保存しない。
+
+        Args:
+            session_id: セッションID
+            content: ユーザーからのメッセージ
+            context: 更新後のコンテキスト情報(Noneの場合は保存済みのものを使う)
+            past_diaries: 今回のメッセージに関連する過去の日記(履歴には保存しない)
+
+        Yields:
+            応答テキストの断片
+
+        Raises:
+            SessionNotFoundError: セッションが存在しない場合
+            TimeoutError: API呼び出しがタイムアウトした場合
+            Exception: 応答生成に失敗した場合
+        """
+        session = await self.get_session(session_id)
+        if context is not None:
+            await self._store.set_context(session_id, context)
+            session.context = context
+
+        stream = self._gemini.stream_response(
+            user_message=content,
+            context=session.context,
+            messages_history=session.messages or None,
+            history_summary=session.summary or None,
+            past_diaries=past_diaries,
+        )
+        reply = ""
+        try:
+            async for delta in stream:
+                reply += delta
+                yield delta
+        finally:
+            await stream.aclose()
+        new_messages = [
+            {"role": "user", "content": content},
+            {"role": "assistant", "content": reply},
+        ]
+        await self._store.append(session_id, new_messages)
+        self._maybe_schedule_compaction(session_id, session.messages + new_messages)
+
+    async def aclose(self) -> None:
+        """実行中の圧縮処理を停止する"""
+        tasks = list(self._compactions.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._compactions.clear()
+
+    def _maybe_schedule_compaction(self, session_id: str, messages: list[dict[str, str]]) -> None:
+        """履歴がトークン上限を超えていれば、バックグラウンドで圧縮を開始する"""
+        if session_id in self._compactions or len(messages) <= self._keep_recent_messages:
+            return
+        tokens = sum(estimate_tokens(m["content"]) for m in messages)
+        if tokens <= self._history_token_budget:
+            return
+        task = asyncio.create_task(self._compact(session_id))
+        self._compactions[session_id] = task
+        task.add_done_callback(lambda _t: self._compactions.pop(session_id, None))
+
+    async def _compact(self, session_id: str) -> None:
+        """直近以外の発言を要約に取り込み、履歴から取り除く"""
+        try:
+            session = await self._store.get(session_id)
+            if session is None:
+                return
+            old = session.messages[: len(session.messages) - self._keep_recent_messages]
+            if not old:
+                return
+            summary = await self._gemini.summarize_history(session.summary, old)
+            # 要約中に追加された発言は残したまま、要約済みの件数だけ先頭から削除する
+            await self._store.compact(session_id, summary, len(old))
+            logger.info("セッション履歴を圧縮: session=%s, messages=%d", session_id, len(old))
+        except SessionNotFoundError:
+            return
+        except Exception as e:
+            logger.warning("セッション履歴の圧縮に失敗: session=%s, %s", session_id, e)
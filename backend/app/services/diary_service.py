@@ -0,0 +1,259 @@
+"""日記の保存・検索と、応答生成に使う関連日記の取得"""
+import asyncio
+import contextlib
+import logging
+import time
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from app.services.diary_store import DiaryEntry, DiaryPage, DiaryStore
+from app.services.metrics import DIARY_QUERY_SECONDS, trace_stage
+from app.services.vector_index import Embedder, VectorIndex
+
+logger = logging.getLogger(__name__)
+
+
+class DiaryService:
+    """日記をDiaryStoreに保存し、持ち主ごとのベクトル索引で関連する日記を探すクラス
+
+    索引は持ち主ごとに初回の検索時に保存済みのベクトルから作り、以降は追加・削除のたびに
+    差分だけを反映する。埋め込みがまだ無い日記は、保存後にバックグラウンドで(または
+    次の検索の前に)まとめて埋め込みを作成して保存する。
+    """
+
+    def __init__(
+        self,
+        store: DiaryStore,
+        embedder: Embedder,
+        context_top_k: int,
+        context_min_score: float,
+        context_max_chars: int,
+        index_batch_size: int,
+        max_indexes: int,
+    ) -> None:
+        """
+        DiaryServiceの初期化
+
+        Args:
+            store: 日記の保存先
+            embedder: 埋め込みの作成方法
+            context_top_k: 応答生成のプロンプトに含める関連日記の件数(0で無効)
+            context_min_score: プロンプトに含める関連日記の最小のコサイン類似度
+            context_max_chars: プロンプトに含める関連日記1件あたりの最大文字数
+            index_batch_size: 1回の埋め込み作成にまとめる日記の件数
+            max_indexes: メモリに保持する持ち主ごとの索引の数(LRU)
+        """
+        self._store = store
+        self._embedder = embedder
+        self._context_top_k = context_top_k
+        self._context_min_score = context_min_score
+        self._context_max_chars = context_max_chars
+        self._index_batch_size = index_batch_size
+        self._max_indexes = max_indexes
+        self._indexes: OrderedDict[str, VectorIndex] = OrderedDict()
+        # 使用中のロックだけを保持する(持ち主が増えても、使い終わったロックは残らない)
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+        self._indexing: dict[str, asyncio.Task[None]] = {}
+
+    @property
+    def context_enabled(self) -> bool:
+        """応答生成のプロンプトに関連日記を含めるか"""
+        return self._context_top_k > 0
+
+    async def add(self, owner: str, content: str, entry_date: str | None = None) -> DiaryEntry:
+        """
+        日記を保存し、バックグラウンドで埋め込みを作成する
+
+        Args:
+            owner: 日記の持ち主
+            content: 日記の本文
+            entry_date: 日記の日付(YYYY-MM-DD)
+
+        Returns:
+            保存した日記
+        """
+        entry = await self._store.add(owner, content, entry_date)
+        self._schedule_indexing(owner)
+        return entry
+
+    async def get(self, owner: str, diary_id: str) -> DiaryEntry | None:
+        """持ち主の日記を取得する(存在しない場合はNone)"""
+        entry = await self._store.get(diary_id)
+        return entry if entry is not None and entry.owner == owner else None
+
+    async def delete(self, owner: str, diary_id: str) -> bool:
+        """
+        日記を削除する
+
+        Returns:
+            削除したか(存在しない場合はFalse)
+        """
+        seq = await self._store.delete(owner, diary_id)
+        if seq is None:
+            return False
+        index = self._indexes.get(owner)
+        if index is not None:
+            index.remove(seq)
+        return True
+
+    async def list_entries(self, owner: str, limit: int, cursor: str | None = None) -> DiaryPage:
+        """
+        日記を新しい順に取得する
+
+        Raises:
+            ValueError: cursorが不正な場合
+        """
+        return await self._store.list_entries(owner, limit, cursor)
+
+    async def search(self, owner: str, query: str, limit: int, cursor: str | None = None) -> DiaryPage:
+        """
+        日記を全文検索する
+
+        Raises:
+            ValueError: cursorが不正な場合
+        """
+        started = time.perf_counter()
+        try:
+            return await self._store.search(owner, query, limit, cursor)
+        finally:
+            DIARY_QUERY_SECONDS.labels("text").observe(time.perf_counter() - started)
+
+    async def related(self, owner: str, query: str, k: int) -> list[tuple[DiaryEntry, float]]:
+        """
+        クエリに意味の近い日記を探す
+
+        Args:
+            owner: 日記の持ち主
+            query: クエリ(ユーザーのメッセージなど)
+            k: 返す件数
+
+        Returns:
+            (日記, コサイン類似度) のリスト(類似度の高い順)
+        """
+        if k <= 0 or not query.strip():
+            return []
+        index = await self._ensure_index(owner)
+        if len(index) == 0:
+            return []
+        query_vector = (await self._embedder.embed([query]))[0]
+        started = time.perf_counter()
+        hits = index.search(query_vector, k)
+        DIARY_QUERY_SECONDS.labels("related").observe(time.perf_counter() - started)
+        entries = await self._store.get_many([seq for seq, _ in hits])
+        return [(entries[seq], score) for seq, score in hits if seq in entries]
+
+    async def context_for(self, owner: str, query: str) -> list[str]:
+        """
+        応答生成のプロンプトに含める関連日記を取得する
+
+        失敗しても応答生成は続けられるよう、例外は記録するだけで空のリストを返す。
+
+        Args:
+            owner: 日記の持ち主
+            query: ユーザーのメッセージ
+
+        Returns:
+            プロンプト用に整形した関連日記(関連度の高い順)
+        """
+        if not self.context_enabled:
+            return []
+        try:
+            with trace_stage("diary_retrieval"):
+                hits = await self.related(owner, query, self._context_top_k)
+        except Exception as e:
+            logger.warning("関連する日記の取得に失敗: owner=%s, %s", owner, e)
+            return []
+        return [
+            self._format_for_prompt(entry) for entry, score in hits if score >= self._context_min_score
+        ]
+
+    async def aclose(self) -> None:
+        """実行中の埋め込み作成を停止し、保存先を閉じる"""
+        tasks = list(self._indexing.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._indexing.clear()
+        self._indexes.clear()
+        await self._store.aclose()
+
+    def _format_for_prompt(self, entry: DiaryEntry) -> str:
+        """関連日記をプロンプト用の1項目に整形する"""
+        content = " ".join(entry.content.split())
+        if len(content) > self._context_max_chars:
+            content = content[: self._context_max_chars] + "..."
+        return f"[{entry.entry_date}] {content}" if entry.entry_date else content
+
+    def _schedule_indexing(self, owner: str) -> None:
+        """埋め込みの無い日記の索引付けをバックグラウンドで開始する(実行中なら何もしない)"""
+        if owner in self._indexing:
+            return
+        task = asyncio.create_task(self._index_background(owner))
+        self._indexing[owner] = task
+        task.add_done_callback(lambda _t: self._indexing.pop(owner, None))
+
+    async def _index_background(self, owner: str) -> None:
+        try:
+            await self._index_pending(owner)
+        except Exception as e:
+            # 次の検索の前に再度試みる
+            logger.warning("日記の埋め込みの作成に失敗: owner=%s, %s", owner, e)
+
+    async def _ensure_index(self, owner: str) -> VectorIndex:
+        """
+        持ち主の索引を用意し、埋め込みの無い日記を反映してから返す
+
+        Raises:
+            Exception: 埋め込みの作成に失敗した場合
+        """
+        async with self._lock(owner):
+            index = self._indexes.get(owner)
+            if index is None:
+                index = await self._load_index(owner)
+                self._indexes[owner] = index
+                while len(self._indexes) > self._max_indexes:
+                    self._indexes.popitem(last=False)
+            self._indexes.move_to_end(owner)
+        await self._index_pending(owner)
+        return index
+
+    async def _load_index(self, owner: str) -> VectorIndex:
+        """保存済みのベクトルから索引を作る"""
+        rows = await self._store.load_embeddings(owner, self._embedder.name)
+        index = VectorIndex(self._embedder.dim)
+        if rows:
+            # 1行ずつ変換せず、連結したバイト列から1つの配列として読み込む
+            vectors = np.frombuffer(b"".join(blob for _, blob in rows), dtype=np.float32)
+            index.add([seq for seq, _ in rows], vectors.reshape(len(rows), self._embedder.dim))
+        return index
+
+    async def _index_pending(self, owner: str) -> None:
+        """埋め込みの無い日記の埋め込みを作成して保存し、読み込み済みの索引に反映する"""
+        async with self._lock(owner):
+            while True:
+                pending = await self._store.unindexed(owner, self._embedder.name, self._index_batch_size)
+                if not pending:
+                    return
+                vectors = await self._embedder.embed([content for _, content in pending])
+                seqs = [seq for seq, _ in pending]
+                await self._store.save_embeddings(
+                    self._embedder.name,
+                    [(seq, vector.astype(np.float32).tobytes()) for seq, vector in zip(seqs, vectors, strict=True)],
+                )
+                index = self._indexes.get(owner)
+                if index is not None:
+                    index.add(seqs, vectors)
+                if len(pending) < self._index_batch_size:
+                    return
+
+    def _lock(self, owner: str) -> asyncio.Lock:
+        """持ち主ごとの索引の更新を直列にするロック(待っている処理が無くなると破棄される)"""
+        lock = self._locks.get(owner)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[owner] = lock
+        return lock
@@ -0,0 +1,406 @@
+"""日記の保存先(SQLite)と全文検索"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# 検索結果の抜粋の前後の文字数
+_SNIPPET_CHARS = 40
+
+
+@dataclass
+class DiaryEntry:
+    """保存した日記
+
+    ``seq`` は保存順の連番(ページングの位置とベクトル索引のキーに使う)。
+    """
+
+    id: str
+    owner: str
+    content: str
+    entry_date: str | None = None
+    created_at: float = field(default_factory=time.time)
+    seq: int = 0
+
+
+@dataclass
+class DiaryPage:
+    """日記の一覧・検索結果の1ページ"""
+
+    items: list[DiaryEntry]
+    # 次のページの位置(最後のページの場合はNone)
+    next_cursor: str | None = None
+    # 検索結果の場合は各日記の一致箇所の抜粋(itemsと同じ順)
+    snippets: list[str] | None = None
+
+
+class DiaryStore:
+    """日記をSQLiteファイルに保存し、FTS5で全文検索するクラス
+
+    日本語は単語の区切りが無いため、FTS5のtrigramトークナイザで3文字単位の索引を作る。
+    3文字未満の語を含む検索や、FTS5(trigram)が使えないSQLiteではLIKEで検索する。
+    埋め込みベクトルは日記ごとに1つ、作成したモデル名とともにBLOBで保存する。
+
+    sqlite3は同期APIのため、すべての操作をワーカースレッドで実行する。
+    """
+
+    def __init__(self, db_path: str) -> None:
+        """
+        DiaryStoreの初期化
+
+        Args:
+            db_path: SQLiteファイルのパス
+        """
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS diaries (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    owner TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    entry_date TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_diaries_owner ON diaries(owner, seq);
+                CREATE TABLE IF NOT EXISTS diary_embeddings (
+                    seq INTEGER PRIMARY KEY REFERENCES diaries(seq) ON DELETE CASCADE,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL
+                );
+                """
+            )
+        self._fts = self._create_fts()
+
+    def _create_fts(self) -> bool:
+        """
+        全文検索の索引を用意する
+
+        Returns:
+            FTS5(trigram)が使えるか
+        """
+        with self._lock, self._conn:
+            exists = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'diaries_fts'"
+            ).fetchone()
+            if exists:
+                return True
+            try:
+                self._conn.executescript(
+                    """
+                    CREATE VIRTUAL TABLE diaries_fts USING fts5(
+                        content, content='diaries', content_rowid='seq', tokenize='trigram'
+                    );
+                    CREATE TRIGGER IF NOT EXISTS diaries_fts_insert AFTER INSERT ON diaries BEGIN
+                        INSERT INTO diaries_fts(rowid, content) VALUES (new.seq, new.content);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS diaries_fts_delete AFTER DELETE ON diaries BEGIN
+                        INSERT INTO diaries_fts(diaries_fts, rowid, content)
+                            VALUES ('delete', old.seq, old.content);
+                    END;
+                    """
+                )
+                # 索引より前に保存された日記も検索できるようにする
+                self._conn.execute("INSERT INTO diaries_fts(diaries_fts) VALUES ('rebuild')")
+            except sqlite3.OperationalError as e:
+                logger.warning("SQLiteのFTS5(trigram)が使えないため、日記の検索はLIKEで行います: %s", e)
+                return False
+        return True
+
+    async def add(self, owner: str, content: str, entry_date: str | None = None) -> DiaryEntry:
+        """
+        日記を保存する
+
+        Args:
+            owner: 日記の持ち主
+            content: 日記の本文
+            entry_date: 日記の日付(YYYY-MM-DD)
+
+        Returns:
+            保存した日記
+        """
+        entry = DiaryEntry(id=uuid.uuid4().hex, owner=owner, content=content, entry_date=entry_date)
+        entry.seq = await asyncio.to_thread(self._add, entry)
+        return entry
+
+    async def get(self, diary_id: str) -> DiaryEntry | None:
+        """日記を取得する(存在しない場合はNone)"""
+        return await asyncio.to_thread(self._get, diary_id)
+
+    async def get_many(self, seqs: list[int]) -> dict[int, DiaryEntry]:
+        """
+        連番を指定して日記をまとめて取得する
+
+        Args:
+            seqs: 日記の連番
+
+        Returns:
+            {連番: 日記}(削除済みの日記は含まない)
+        """
+        if not seqs:
+            return {}
+        return await asyncio.to_thread(self._get_many, seqs)
+
+    async def delete(self, owner: str, diary_id: str) -> int | None:
+        """
+        日記を削除する
+
+        Args:
+            owner: 日記の持ち主
+            diary_id: 日記ID
+
+        Returns:
+            削除した日記の連番(存在しない場合はNone)
+        """
+        return await asyncio.to_thread(self._delete, owner, diary_id)
+
+    async def list_entries(self, owner: str, limit: int, cursor: str | None = None) -> DiaryPage:
+        """
+        日記を新しい順に取得する
+
+        連番による位置指定(キーセット方式)のため、件数が増えても後ろのページが遅くならない。
+
+        Args:
+            owner: 日記の持ち主
+            limit: 1ページの件数
+            cursor: 前のページのnext_cursor
+
+        Returns:
+            日記の1ページ
+
+        Raises:
+            ValueError: cursorが不正な場合
+        """
+        before = _parse_cursor(cursor)
+        return await asyncio.to_thread(self._list, owner, limit, before)
+
+    async def search(self, owner: str, query: str, limit: int, cursor: str | None = None) -> DiaryPage:
+        """
+        日記を全文検索する
+
+        空白で区切った語をすべて含む日記を、一致度の高い順(LIKEの場合は新しい順)に返す。
+
+        Args:
+            owner: 日記の持ち主
+            query: 検索語
+            limit: 1ページの件数
+            cursor: 前のページのnext_cursor
+
+        Returns:
+            検索結果の1ページ
+
+        Raises:
+            ValueError: cursorが不正な場合
+        """
+        offset = _parse_cursor(cursor) or 0
+        terms = query.split()
+        if not terms:
+            return DiaryPage(items=[], snippets=[])
+        return await asyncio.to_thread(self._search, owner, terms, limit, offset)
+
+    async def save_embeddings(self, model: str, vectors: list[tuple[int, bytes]]) -> None:
+        """
+        日記の埋め込みベクトルを保存する(既存のものは置き換える)
+
+        Args:
+            model: 埋め込みを作成したモデル名
+            vectors: (日記の連番, ベクトルのバイト列)
+        """
+        await asyncio.to_thread(self._save_embeddings, model, vectors)
+
+    async def load_embeddings(self, owner: str, model: str) -> list[tuple[int, bytes]]:
+        """
+        持ち主の日記の埋め込みベクトルのうち、指定したモデルで作成したものを取得する
+
+        Returns:
+            (日記の連番, ベクトルのバイト列)
+        """
+        return await asyncio.to_thread(self._load_embeddings, owner, model)
+
+    async def unindexed(self, owner: str, model: str, limit: int) -> list[tuple[int, str]]:
+        """
+        指定したモデルの埋め込みがまだ無い日記を古い順に取得する
+
+        Returns:
+            (日記の連番, 本文)
+        """
+        return await asyncio.to_thread(self._unindexed, owner, model, limit)
+
+    async def aclose(self) -> None:
+        """保存先を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+    def _add(self, entry: DiaryEntry) -> int:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO diaries (id, owner, content, entry_date, created_at) VALUES (?, ?, ?, ?, ?)",
+                (entry.id, entry.owner, entry.content, entry.entry_date, entry.created_at),
+            )
+            return int(cursor.lastrowid or 0)
+
+    def _get(self, diary_id: str) -> DiaryEntry | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT seq, id, owner, content, entry_date, created_at FROM diaries WHERE id = ?",
+                (diary_id,),
+            ).fetchone()
+        return _to_entry(row) if row else None
+
+    def _get_many(self, seqs: list[int]) -> dict[int, DiaryEntry]:
+        placeholders = ",".join("?" * len(seqs))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT seq, id, owner, content, entry_date, created_at FROM diaries WHERE seq IN ({placeholders})",
+                seqs,
+            ).fetchall()
+        return {row[0]: _to_entry(row) for row in rows}
+
+    def _delete(self, owner: str, diary_id: str) -> int | None:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT seq FROM diaries WHERE id = ? AND owner = ?", (diary_id, owner)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM diaries WHERE seq = ?", (row[0],))
+        return int(row[0])
+
+    def _list(self, owner: str, limit: int, before: int | None) -> DiaryPage:
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT seq, id, owner, content, entry_date, created_at FROM diaries
+                WHERE owner = ? AND seq < ? ORDER BY seq DESC LIMIT ?
+                """,
+                (owner, before if before is not None else 2**63 - 1, limit + 1),
+            ).fetchall()
+        items = [_to_entry(row) for row in rows[:limit]]
+        next_cursor = str(items[-1].seq) if len(rows) > limit else None
+        return DiaryPage(items=items, next_cursor=next_cursor)
+
+    def _search(self, owner: str, terms: list[str], limit: int, offset: int) -> DiaryPage:
+        if self._fts and all(len(term) >= 3 for term in terms):
+            # 各語を引用符で囲み、FTS5の演算子として解釈させない
+            match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            sql = """
+                SELECT d.seq, d.id, d.owner, d.content, d.entry_date, d.created_at
+                FROM diaries_fts JOIN diaries AS d ON d.seq = diaries_fts.rowid
+                WHERE diaries_fts MATCH ? AND d.owner = ?
+                ORDER BY diaries_fts.rank LIMIT ? OFFSET ?
+            """
+            params: list[object] = [match, owner, limit + 1, offset]
+        else:
+            conditions = " AND ".join("content LIKE ? ESCAPE '\\'" for _ in terms)
+            sql = f"""
+                SELECT seq, id, owner, content, entry_date, created_at FROM diaries
+                WHERE owner = ? AND {conditions} ORDER BY seq DESC LIMIT ? OFFSET ?
+            """
+            params = [owner, *(f"%{_escape_like(term)}%" for term in terms), limit + 1, offset]
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        items = [_to_entry(row) for row in rows[:limit]]
+        next_cursor = str(offset + limit) if len(rows) > limit else None
+        return DiaryPage(
+            items=items,
+            next_cursor=next_cursor,
+            snippets=[_snippet(item.content, terms) for item in items],
+        )
+
+    def _save_embeddings(self, model: str, vectors: list[tuple[int, bytes]]) -> None:
+        with self._lock, self._conn:
+            # 保存前に削除された日記の分は外部キー制約で失敗するため除く
+            self._conn.executemany(
+                """
+                INSERT OR REPLACE INTO diary_embeddings (seq, model, vector)
+                SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM diaries WHERE seq = ?)
+                """,
+                [(seq, model, vector, seq) for seq, vector in vectors],
+            )
+
+    def _load_embeddings(self, owner: str, model: str) -> list[tuple[int, bytes]]:
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT e.seq, e.vector FROM diary_embeddings AS e JOIN diaries AS d ON d.seq = e.seq
+                WHERE d.owner = ? AND e.model = ? ORDER BY e.seq
+                """,
+                (owner, model),
+            ).fetchall()
+        return [(int(seq), bytes(vector)) for seq, vector in rows]
+
+    def _unindexed(self, owner: str, model: str, limit: int) -> list[tuple[int, str]]:
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT d.seq, d.content FROM diaries AS d
+                LEFT JOIN diary_embeddings AS e ON e.seq = d.seq AND e.model = ?
+                WHERE d.owner = ? AND e.seq IS NULL ORDER BY d.seq LIMIT ?
+                """,
+                (model, owner, limit),
+            ).fetchall()
+        return [(int(seq), str(content)) for seq, content in rows]
+
+
+def _to_entry(row: Any) -> DiaryEntry:
+    """SELECT seq, id, owner, content, entry_date, created_at の1行を日記にする"""
+    seq, diary_id, owner, content, entry_date, created_at = row
+    return DiaryEntry(
+        id=diary_id,
+        owner=owner,
+        content=content,
+        entry_date=entry_date,
+        created_at=created_at,
+        seq=seq,
+    )
+
+
+def _parse_cursor(cursor: str | None) -> int | None:
+    """ページの位置を整数として取り出す"""
+    if cursor is None or cursor == "":
+        return None
+    try:
+        value = int(cursor)
+    except ValueError as e:
+        raise ValueError(f"cursorが不正です: {cursor}") from e
+    if value < 0:
+        raise ValueError(f"cursorが不正です: {cursor}")
+    return value
+
+
+def _escape_like(term: str) -> str:
+    """LIKEの特殊文字をエスケープする"""
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _snippet(content: str, terms: list[str]) -> str:
+    """
+    本文のうち最初に一致した語の前後を抜き出す
+
+    Args:
+        content: 日記の本文
+        terms: 検索語
+
+    Returns:
+        抜粋(一致箇所が見つからない場合は先頭)
+    """
+    lowered = content.lower()
+    positions = [p for p in (lowered.find(term.lower()) for term in terms) if p >= 0]
+    center = min(positions) if positions else 0
+    start = max(0, center - _SNIPPET_CHARS)
+    end = min(len(content), center + _SNIPPET_CHARS)
+    prefix = "..." if start > 0 else ""
+    suffix = "..." if end < len(content) else ""
+    return f"{prefix}{content[start:end]}{suffix}"
@@ -1,186 +1,742 @@
-"""Gemini APIを使用した生成AIサービス"""
-import os
-from datetime import datetime
-from typing import Any
-
-import google.generativeai as genai
-from dotenv import load_dotenv
-
-load_dotenv()
-
-
-class GeminiService:
-    """Gemini APIを使用した生成AIサービスクラス"""
-
-    def __init__(self) -> None:
-        """
-        GeminiServiceの初期化
-
-        Raises:
-            ValueError: GEMINI_API_KEYが設定されていない場合
-        """
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEYが環境変数に設定されていません")
-
-        genai.configure(api_key=api_key)
-        # Gemini 2.0 Flash-Lite 安定版を使用(本番環境推奨)
-        # 参考: https://ai.google.dev/gemini-api/docs/models?hl=ja
-        # 他の選択肢:
-        # - gemini-2.0-flash-lite (最新版)
-        # - gemini-3-pro-preview (プレビュー版、高性能)
-        self.model = genai.GenerativeModel("gemini-2.0-flash-lite-001")
-
-    def _build_system_prompt(self, context: list[dict[str, Any]] | None = None) -> str:
-        """
-        システムプロンプトを構築
-
-        Args:
-            context: コンテキスト情報(イベント情報など)
-
-        Returns:
-            構築されたシステムプロンプト
-        """
-        base_prompt = """あなたは親しみやすい日記アシスタントです。
-ユーザーとの会話を通じて、過去の出来事や感情を深掘りし、日記作成を支援してください。
-"""
-        if context:
-            context_parts = []
-
-            for item in context:
-                summary = item.get("summary", "")
-                description = item.get("description", "")
-                start = item.get("start", "")
-                end = item.get("end", "")
-                location = item.get("location", "")
-
-                event_text = f"- {summary}"
-                if description:
-                    event_text += f": {description}"
-
-                # 時刻フォーマットの改善と日付の判定
-                time_info = ""
-                event_date = None
-
-                if start:
-                    if start.startswith(("2024-", "2025-")):
-                        try:
-                            start_dt = datetime.fromisoformat(start.replace("Z", "+00:00"))
-                            event_date = start_dt.date()
-
-                            if end:
-                                end_dt = datetime.fromisoformat(end.replace("Z", "+00:00"))
-                                if start_dt.date() == end_dt.date():
-                                    if start_dt.hour == 0 and start_dt.minute == 0 and end_dt.hour == 23 and end_dt.minute == 59:
-                                        time_info = " (終日)"
-                                    else:
-                                        time_info = f" ({start_dt.strftime('%H:%M')} - {end_dt.strftime('%H:%M')})"
-                                else:
-                                    time_info = f" ({start_dt.strftime('%m/%d %H:%M')} - {end_dt.strftime('%m/%d %H:%M')})"
-                            else:
-                                time_info = f" ({start_dt.strftime('%H:%M')})"
-                        except (ValueError, AttributeError):
-                            time_info = f" ({start})"
-                    else:
-                        time_info = f" ({start})"
-
-                event_text += time_info
-                if location:
-                    event_text += f" [場所: {location}]"
-
-                # 日付情報を追加(過去の出来事であることを明示)
-                if event_date:
-                    event_text += f" [日付: {event_date.strftime('%Y年%m月%d日')}]"
-
-                context_parts.append(event_text)
-
-            context_text = "\n".join(context_parts)
-            event_count = len(context)
-            base_prompt += f"\n\n過去に行った出来事({event_count}件):\n{context_text}\n\n重要な注意事項:\n- これらは既に終了した過去の出来事です\n- 「これから」「予定」「行く」などの未来形は使わないでください\n- 過去形「行った」「参加した」「終わった」などを使ってください\n- ユーザーが実際に何をしたか、どう感じたかを深掘りして聞いてください\n- 出来事の詳細、その時の感情、学びや気づきなどを引き出し、日記作成に役立つ情報を集めてください\n- 自然な会話で、過去の体験を振り返るような質問をしてください"
-        return base_prompt
-
-    async def generate_response(
-        self,
-        user_message: str,
-        context: list[dict[str, Any]] | None = None,
-        messages_history: list[dict[str, str]] | None = None,
-    ) -> str:
-        """
-        ユーザーメッセージに対するAI応答を生成
-
-        Args:
-            user_message: ユーザーからのメッセージ
-            context: コンテキスト情報(イベント情報など)
-            messages_history: 会話履歴
-
-        Returns:
-            AIからの応答テキスト
-
-        Raises:
-            Exception: API呼び出しに失敗した場合
-        """
-        try:
-            system_prompt = self._build_system_prompt(context)
-
-            if messages_history:
-                history_text = "\n".join([
-                    f"{msg['role']}: {msg['content']}"
-                    for msg in messages_history
-                ])
-                full_prompt = f"{system_prompt}\n\n会話履歴:\n{history_text}\n\nユーザー: {user_message}\nアシスタント:"
-            else:
-                full_prompt = f"{system_prompt}\n\nユーザー: {user_message}\nアシスタント:"
-
-            response = self.model.generate_content(full_prompt)
-            if not response.text:
-                raise Exception("Gemini APIからの応答が空です")
-            return str(response.text)
-        except Exception as e:
-            error_msg = str(e)
-            if "404" in error_msg or "not found" in error_msg.lower():
-                raise Exception(
-                    f"Geminiモデルが見つかりません。モデル名を確認してください。エラー: {error_msg}"
-                ) from e
-            raise Exception(f"Gemini API呼び出しに失敗しました: {error_msg}") from e
-
-    async def summarize_conversation(self, conversation: str) -> str:
-        """
-        会話履歴を要約
-
-        Args:
-            conversation: 会話履歴のテキスト
-
-        Returns:
-            要約されたテキスト
-
-        Raises:
-            Exception: API呼び出しに失敗した場合
-        """
-        try:
-            prompt = f"""以下の会話履歴を基に、大人が書く日記のような文章を作成してください。
-以下の点に注意してください:
-
-1. 一人称で書く(「私は」「自分は」など)
-2. 自然で感情的な表現を使う
-3. 出来事の詳細だけでなく、その時の感情や考えも含める
-4. 簡潔だが、読み手がその日の様子を理解できる内容にする
-5. 堅すぎず、かといって砕けすぎない丁寧な文体
-6. 「アシスタントとの会話」「AIとの会話」などの言及は不要で、自然に日記として書く
-
-会話履歴:
-{conversation}
-
-日記:"""
-
-            response = self.model.generate_content(prompt)
-            if not response.text:
-                raise Exception("要約生成の応答が空です")
-            return str(response.text)
-        except Exception as e:
-            error_msg = str(e)
-            if "404" in error_msg or "not found" in error_msg.lower():
-                raise Exception(
-                    f"Geminiモデルが見つかりません。モデル名を確認してください。エラー: {error_msg}"
-                ) from e
-            raise Exception(f"要約生成に失敗しました: {error_msg}") from e
-
+"""Gemini APIを使用した生成AIサービス"""
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from collections.abc import AsyncGenerator
+from datetime import datetime, timedelta
+from typing import Any
+
+import google.generativeai as genai
+
+from app.config import get_settings
+from app.services.metrics import (
+    GEMINI_CONTEXT_CACHE_ERRORS,
+    PROMPT_CHARS,
+    PROMPT_TOKENS,
+    trace_stage,
+)
+from app.services.prompt_assembler import PromptAssembler, context_key
+from app.services.resilience import CircuitOpenError, UpstreamGuard, build_policy, is_transient
+from app.services.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+# コンテキストキャッシュ自体が使えないことを示すHTTPステータス(モデルやAPIが非対応など)
+_CACHE_UNSUPPORTED_STATUS = frozenset({400, 404})
+# 一時的な失敗の後にコンテキストキャッシュを使わない秒数(失敗が続くたびに倍にする)
+_CACHE_BACKOFF_SECONDS = 30.0
+_CACHE_MAX_BACKOFF_SECONDS = 600.0
+
+# システムプロンプトの指示文(イベント情報の前に置く)
+_INSTRUCTIONS = """あなたは親しみやすい日記アシスタントです。
+ユーザーとの会話を通じて、過去の出来事や感情を深掘りし、日記作成を支援してください。
+"""
+
+
+def _is_date_only(value: Any) -> bool:
+    """日付のみ(YYYY-MM-DD)の文字列か判定する"""
+    return isinstance(value, str) and len(value) == 10 and "T" not in value
+
+
+class GeminiService:
+    """Gemini APIを使用した生成AIサービスクラス"""
+
+    def __init__(self) -> None:
+        """
+        GeminiServiceの初期化
+
+        Raises:
+            ValueError: GEMINI_API_KEYが設定されていない場合
+        """
+        # .env の読み込みは get_settings() で行う
+        settings = get_settings()
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError("GEMINI_API_KEYが環境変数に設定されていません")
+
+        genai.configure(api_key=api_key)
+        # Gemini 2.0 Flash-Lite 安定版を使用(本番環境推奨)
+        # 参考: https://ai.google.dev/gemini-api/docs/models?hl=ja
+        # 他の選択肢:
+        # - gemini-2.0-flash-lite (最新版)
+        # - gemini-3-pro-preview (プレビュー版、高性能)
+        self.model = genai.GenerativeModel(settings.gemini_model)
+        # 同時実行数の上限と1呼び出しあたりのタイムアウト
+        self._semaphore = asyncio.Semaphore(settings.gemini_max_in_flight)
+        self._timeout = settings.gemini_timeout_seconds
+        # リトライ・ヘッジ・サーキットブレーカーと、操作ごとの期限(リトライを含む)
+        self._guard = UpstreamGuard(
+            "Gemini",
+            build_policy(
+                settings,
+                max_retries=settings.gemini_max_retries,
+                hedge_enabled=settings.gemini_hedge_enabled,
+            ),
+        )
+        self._deadlines = {
+            "chat": settings.deadline_chat_seconds,
+            "summary": settings.deadline_summary_seconds,
+        }
+        # イベント情報のプロンプト部分のメモ(contextのハッシュ -> 文字列)
+        self._context_blocks: OrderedDict[str, str] = OrderedDict()
+        self._context_block_cache_size = settings.gemini_prompt_cache_size
+        self._context_block_hits = 0
+        self._context_block_misses = 0
+        # プロンプト全体をトークン数の上限に収める
+        self._assembler = PromptAssembler(
+            token_budget=settings.prompt_token_budget,
+            event_share=settings.prompt_event_share,
+            keep_recent_messages=settings.prompt_keep_recent_messages,
+            condensed_message_tokens=settings.prompt_condensed_message_tokens,
+            cache_size=settings.gemini_prompt_cache_size,
+        )
+        # Geminiのコンテキストキャッシュ(システムプロンプトのハッシュ -> (モデル, 有効期限))
+        self._model_name = settings.gemini_model
+        self._context_cache_enabled = settings.gemini_context_cache_enabled
+        self._context_cache_min_tokens = settings.gemini_context_cache_min_tokens
+        self._context_cache_ttl = settings.gemini_context_cache_ttl_seconds
+        self._cached_models: OrderedDict[str, tuple[genai.GenerativeModel, float]] = OrderedDict()
+        self._cache_creations: dict[str, asyncio.Task[genai.GenerativeModel]] = {}
+        # 一時的な失敗の後、この時刻(time.monotonic)まではキャッシュを作成しない
+        self._context_cache_retry_at = 0.0
+        self._context_cache_backoff = _CACHE_BACKOFF_SECONDS
+
+    async def _resolve_model(self, system_prompt: str, conversation: str) -> tuple[genai.GenerativeModel, str]:
+        """
+        送信に使うモデルとプロンプトを決める
+
+        システムプロンプトが十分に長い場合はGeminiのコンテキストキャッシュに登録し、
+        以降の呼び出しでは会話部分だけを送信する。キャッシュを使わない場合や
+        作成に失敗した場合は、システムプロンプトと会話部分を連結して送信する。
+        モデルやAPIがキャッシュに対応していない場合は以降キャッシュを使わず、
+        一時的な失敗の場合は一定時間(失敗が続くたびに延ばす)だけ使わない。
+
+        Args:
+            system_prompt: システムプロンプト(会話をまたいで変わらない部分)
+            conversation: 会話履歴と今回のメッセージ
+
+        Returns:
+            (使用するモデル, 送信するプロンプト)
+        """
+        full_prompt = f"{system_prompt}\n\n{conversation}"
+        if (
+            not self._context_cache_enabled
+            or time.monotonic() < self._context_cache_retry_at
+            or estimate_tokens(system_prompt) < self._context_cache_min_tokens
+        ):
+            return self.model, full_prompt
+
+        key = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+        entry = self._cached_models.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._cached_models.move_to_end(key)
+            return entry[0], conversation
+
+        # 同じシステムプロンプトのキャッシュ作成は1回にまとめる
+        task = self._cache_creations.get(key)
+        if task is None:
+            task = asyncio.create_task(self._create_cached_model(system_prompt))
+            self._cache_creations[key] = task
+            task.add_done_callback(lambda _t: self._cache_creations.pop(key, None))
+        try:
+            model = await asyncio.shield(task)
+        except Exception as e:
+            self._on_cache_error(e)
+            return self.model, full_prompt
+        self._context_cache_backoff = _CACHE_BACKOFF_SECONDS
+
+        # 期限切れ直前のキャッシュを使わないよう、TTLより少し早く破棄する
+        self._cached_models[key] = (model, time.monotonic() + self._context_cache_ttl * 0.9)
+        while len(self._cached_models) > self._context_block_cache_size:
+            self._cached_models.popitem(last=False)
+        return model, conversation
+
+    def _on_cache_error(self, error: Exception) -> None:
+        """コンテキストキャッシュの作成の失敗を記録し、以降キャッシュを使うかを決める"""
+        if not self._context_cache_enabled or time.monotonic() < self._context_cache_retry_at:
+            # 同じ作成を待っていた他の呼び出しで処理済み
+            return
+        if _cache_unsupported(error):
+            logger.warning("Geminiのコンテキストキャッシュに対応していないため無効化します: %s", error)
+            self._context_cache_enabled = False
+            GEMINI_CONTEXT_CACHE_ERRORS.labels("disabled").inc()
+            return
+        logger.warning(
+            "Geminiのコンテキストキャッシュを作成できないため%.0f秒間使いません: %s: %s",
+            self._context_cache_backoff, type(error).__name__, error,
+        )
+        self._context_cache_retry_at = time.monotonic() + self._context_cache_backoff
+        self._context_cache_backoff = min(self._context_cache_backoff * 2, _CACHE_MAX_BACKOFF_SECONDS)
+        GEMINI_CONTEXT_CACHE_ERRORS.labels("backoff").inc()
+
+    async def _create_cached_model(self, system_prompt: str) -> genai.GenerativeModel:
+        """
+        システムプロンプトをGeminiのコンテキストキャッシュに登録し、それを使うモデルを返す
+
+        Args:
+            system_prompt: キャッシュするシステムプロンプト
+
+        Returns:
+            キャッシュを参照するモデル
+        """
+        cached = await asyncio.to_thread(
+            genai.caching.CachedContent.create,
+            model=f"models/{self._model_name}",
+            system_instruction=system_prompt,
+            ttl=timedelta(seconds=self._context_cache_ttl),
+        )
+        return genai.GenerativeModel.from_cached_content(cached)
+
+    def prompt_cache_stats(self) -> dict[str, int | float]:
+        """イベント情報のプロンプトのメモのヒット/ミス数を返す"""
+        lookups = self._context_block_hits + self._context_block_misses
+        return {
+            "hits": self._context_block_hits,
+            "misses": self._context_block_misses,
+            "hit_ratio": self._context_block_hits / lookups if lookups else 0.0,
+            "items": len(self._context_blocks),
+        }
+
+    @staticmethod
+    def _observe_prompt(operation: str, prompt: str) -> None:
+        """送信するプロンプトの文字数と概算トークン数を記録する"""
+        PROMPT_CHARS.labels(operation).observe(len(prompt))
+        PROMPT_TOKENS.labels(operation).observe(estimate_tokens(prompt))
+
+    def resilience_stats(self) -> dict[str, object]:
+        """サーキットブレーカーの状態とリトライ・ヘッジの回数を返す"""
+        return self._guard.stats()
+
+    async def warm_up(self) -> None:
+        """
+        Geminiへの接続を確立しておく(起動時のウォームアップ用)
+
+        応答生成と同じ非同期クライアントでトークン数の計算(課金対象外)を1回呼び出し、
+        最初のリクエストで接続の確立を待たずに済むようにする。
+
+        Raises:
+            TimeoutError: タイムアウトした場合
+            Exception: API呼び出しに失敗した場合
+        """
+        await asyncio.wait_for(
+            self.model.count_tokens_async("warm-up", request_options={"timeout": self._timeout}),
+            timeout=self._timeout,
+        )
+
+    async def _generate_text(
+        self,
+        prompt: str,
+        system_prompt: str | None = None,
+        operation: str = "chat",
+    ) -> str:
+        """
+        Geminiへ非同期にプロンプトを送信し、応答テキストを取得する
+
+        イベントループをブロックしないようSDKの非同期APIを使用し、
+        同時実行数をセマフォで制限する。一時的な障害は操作ごとの期限内でリトライする。
+
+        Args:
+            prompt: 送信するプロンプト
+            system_prompt: 会話をまたいで変わらないシステムプロンプト(コンテキストキャッシュの対象)
+            operation: 操作名("chat" または "summary"。期限の選択に使用)
+
+        Returns:
+            応答テキスト(空の場合は空文字列)
+
+        Raises:
+            TimeoutError: タイムアウトした場合
+            CircuitOpenError: Geminiが不調で呼び出しを止めている場合
+        """
+        model = self.model
+        if system_prompt is not None:
+            model, prompt = await self._resolve_model(system_prompt, prompt)
+        self._observe_prompt(operation, prompt)
+
+        async def attempt() -> Any:
+            return await asyncio.wait_for(
+                model.generate_content_async(
+                    prompt,
+                    request_options={"timeout": self._timeout},
+                ),
+                timeout=self._timeout,
+            )
+
+        response = await self._guard.call(
+            operation, attempt, deadline=self._deadlines[operation], hedge=True, slot=self._semaphore
+        )
+        return str(response.text or "")
+
+    def _context_block(self, context: list[dict[str, Any]]) -> str:
+        """
+        イベント情報のプロンプト部分をメモ化して返す
+
+        内容のハッシュをキーにLRUでメモ化するため、同じセッション内で同じcontextが
+        繰り返し送られても再構築しない。
+
+        Args:
+            context: コンテキスト情報(イベント情報など)
+
+        Returns:
+            イベント情報と注意事項のプロンプト
+        """
+        key = context_key(context)
+        block = self._context_blocks.get(key)
+        if block is not None:
+            self._context_blocks.move_to_end(key)
+            self._context_block_hits += 1
+            return block
+        self._context_block_misses += 1
+
+        context_text = "\n".join(self._format_event(item) for item in context)
+        event_count = len(context)
+        block = f"\n\n過去に行った出来事({event_count}件):\n{context_text}\n\n重要な注意事項:\n- これらは既に終了した過去の出来事です\n- 「これから」「予定」「行く」などの未来形は使わないでください\n- 過去形「行った」「参加した」「終わった」などを使ってください\n- ユーザーが実際に何をしたか、どう感じたかを深掘りして聞いてください\n- 出来事の詳細、その時の感情、学びや気づきなどを引き出し、日記作成に役立つ情報を集めてください\n- 自然な会話で、過去の体験を振り返るような質問をしてください"
+        self._context_blocks[key] = block
+        while len(self._context_blocks) > self._context_block_cache_size:
+            self._context_blocks.popitem(last=False)
+        return block
+
+    @staticmethod
+    def _format_event(item: dict[str, Any]) -> str:
+        """
+        イベント1件をプロンプト用の1行に整形する
+
+        Args:
+            item: イベント情報
+
+        Returns:
+            整形したテキスト
+        """
+        summary = item.get("summary", "")
+        description = item.get("description", "")
+        start = item.get("start", "")
+        end = item.get("end", "")
+        location = item.get("location", "")
+
+        event_text = f"- {summary}"
+        if description:
+            event_text += f": {description}"
+
+        # 時刻フォーマットの改善と日付の判定
+        time_info = ""
+        event_date = None
+
+        if start:
+            try:
+                start_dt = datetime.fromisoformat(str(start).replace("Z", "+00:00"))
+                event_date = start_dt.date()
+                end_dt = datetime.fromisoformat(str(end).replace("Z", "+00:00")) if end else None
+
+                if _is_date_only(start):
+                    # 終日イベント(Google Calendarの終了日は翌日を指す)
+                    last_day = end_dt.date() - timedelta(days=1) if end_dt and _is_date_only(end) else event_date
+                    if last_day > event_date:
+                        time_info = f" ({start_dt.strftime('%m/%d')} - {last_day.strftime('%m/%d')} 終日)"
+                    else:
+                        time_info = " (終日)"
+                elif end_dt:
+                    if start_dt.date() == end_dt.date():
+                        if start_dt.hour == 0 and start_dt.minute == 0 and end_dt.hour == 23 and end_dt.minute == 59:
+                            time_info = " (終日)"
+                        else:
+                            time_info = f" ({start_dt.strftime('%H:%M')} - {end_dt.strftime('%H:%M')})"
+                    else:
+                        time_info = f" ({start_dt.strftime('%m/%d %H:%M')} - {end_dt.strftime('%m/%d %H:%M')})"
+                else:
+                    time_info = f" ({start_dt.strftime('%H:%M')})"
+            except (ValueError, TypeError, AttributeError):
+                event_date = None
+                time_info = f" ({start})"
+
+        event_text += time_info
+        if location:
+            event_text += f" [場所: {location}]"
+
+        # 日付情報を追加(過去の出来事であることを明示)
+        if event_date:
+            event_text += f" [日付: {event_date.strftime('%Y年%m月%d日')}]"
+
+        return event_text
+
+    async def generate_response(
+        self,
+        user_message: str,
+        context: list[dict[str, Any]] | None = None,
+        messages_history: list[dict[str, str]] | None = None,
+        history_summary: str | None = None,
+        past_diaries: list[str] | None = None,
+    ) -> str:
+        """
+        ユーザーメッセージに対するAI応答を生成
+
+        Args:
+            user_message: ユーザーからのメッセージ
+            context: コンテキスト情報(イベント情報など)
+            messages_history: 会話履歴
+            history_summary: 会話履歴より前の会話の要約
+            past_diaries: 今回のメッセージに関連する過去の日記
+
+        Returns:
+            AIからの応答テキスト
+
+        Raises:
+            TimeoutError: API呼び出しがタイムアウトした場合
+            CircuitOpenError: Geminiが不調で呼び出しを止めている場合
+            Exception: API呼び出しに失敗した場合
+        """
+        try:
+            system_prompt, conversation = self._build_chat_prompt(
+                user_message, context, messages_history, history_summary, past_diaries
+            )
+            text = await self._generate_text(conversation, system_prompt=system_prompt)
+            if not text:
+                raise Exception("Gemini APIからの応答が空です")
+            return text
+        except (TimeoutError, CircuitOpenError):
+            raise
+        except Exception as e:
+            raise self._wrap_chat_error(e) from e
+
+    async def stream_response(
+        self,
+        user_message: str,
+        context: list[dict[str, Any]] | None = None,
+        messages_history: list[dict[str, str]] | None = None,
+        history_summary: str | None = None,
+        past_diaries: list[str] | None = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        ユーザーメッセージに対するAI応答を生成されたそばから逐次返す
+
+        Gemini のストリーミング生成をバックグラウンドタスクで受信し、
+        呼び出し側が途中で反復をやめた場合(クライアント切断など)は
+        タスクをキャンセルして上流の生成も停止する。
+
+        Args:
+            user_message: ユーザーからのメッセージ
+            context: コンテキスト情報(イベント情報など)
+            messages_history: 会話履歴
+            history_summary: 会話履歴より前の会話の要約
+            past_diaries: 今回のメッセージに関連する過去の日記
+
+        Yields:
+            応答テキストの断片
+
+        Raises:
+            TimeoutError: 最初の応答までにタイムアウトした場合
+            CircuitOpenError: Geminiが不調で呼び出しを止めている場合
+            Exception: API呼び出しに失敗した場合
+        """
+        system_prompt, conversation = self._build_chat_prompt(
+            user_message, context, messages_history, history_summary, past_diaries
+        )
+        queue: asyncio.Queue[str | BaseException | None] = asyncio.Queue()
+
+        async def pump() -> None:
+            try:
+                model, prompt = await self._resolve_model(system_prompt, conversation)
+                self._observe_prompt("chat_stream", prompt)
+                async with self._semaphore:
+                    # リトライは最初の応答を受け取るまで(テキストを返し始めた後は行わない)
+                    response = await self._guard.call(
+                        "chat_stream",
+                        lambda: asyncio.wait_for(
+                            model.generate_content_async(
+                                prompt,
+                                stream=True,
+                                request_options={"timeout": self._timeout},
+                            ),
+                            timeout=self._timeout,
+                        ),
+                        deadline=self._deadlines["chat"],
+                    )
+                    async for chunk in response:
+                        try:
+                            text = chunk.text
+                        except ValueError:
+                            # テキストを含まないチャンク(終了理由のみ等)は読み飛ばす
+                            continue
+                        if text:
+                            await queue.put(text)
+                await queue.put(None)
+            except Exception as e:
+                await queue.put(e)
+
+        task = asyncio.create_task(pump())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if isinstance(item, (TimeoutError, CircuitOpenError)):
+                    raise item
+                if isinstance(item, BaseException):
+                    raise self._wrap_chat_error(item) from item
+                yield item
+        finally:
+            if not task.done():
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+
+    def _build_chat_prompt(
+        self,
+        user_message: str,
+        context: list[dict[str, Any]] | None = None,
+        messages_history: list[dict[str, str]] | None = None,
+        history_summary: str | None = None,
+        past_diaries: list[str] | None = None,
+    ) -> tuple[str, str]:
+        """
+        チャット応答生成用のプロンプトを組み立てる
+
+        システムプロンプトはcontextだけで決まるようにし、会話ごとに変わる要約や履歴は
+        会話部分に含める。これによりシステムプロンプトをキャッシュの単位として再利用できる。
+        全体はPROMPT_TOKEN_BUDGETの概算トークン数に収め、イベント情報が枠に収まらない場合は
+        メッセージとの関連度と日付の近さで選んだイベントだけを含める。
+
+        Args:
+            user_message: ユーザーからのメッセージ
+            context: コンテキスト情報(イベント情報など)
+            messages_history: 会話履歴
+            history_summary: 会話履歴より前の会話の要約
+            past_diaries: 今回のメッセージに関連する過去の日記
+
+        Returns:
+            (システムプロンプト, 会話部分)
+        """
+        with trace_stage("prompt_build"):
+            assembled = self._assembler.assemble(
+                instructions=_INSTRUCTIONS,
+                user_message=user_message,
+                context=context,
+                messages_history=messages_history,
+                history_summary=history_summary,
+                past_diaries=past_diaries,
+                format_event=self._format_event,
+                events_block=self._context_block,
+            )
+        return assembled.system_prompt, assembled.conversation
+
+    @staticmethod
+    def _wrap_chat_error(e: BaseException) -> Exception:
+        """
+        チャット応答生成時の例外をユーザー向けのメッセージに変換する
+
+        Args:
+            e: 発生した例外
+
+        Returns:
+            変換後の例外
+        """
+        error_msg = str(e)
+        if "404" in error_msg or "not found" in error_msg.lower():
+            return Exception(
+                f"Geminiモデルが見つかりません。モデル名を確認してください。エラー: {error_msg}"
+            )
+        return Exception(f"Gemini API呼び出しに失敗しました: {error_msg}")
+
+    async def summarize_history(self, previous_summary: str, messages: list[dict[str, str]]) -> str:
+        """
+        会話の古い部分を、以降の応答生成で参照する要約に圧縮する
+
+        Args:
+            previous_summary: これまでの要約(無い場合は空文字列)
+            messages: 要約に取り込む発言
+
+        Returns:
+            更新後の要約
+
+        Raises:
+            TimeoutError: API呼び出しがタイムアウトした場合
+            CircuitOpenError: Geminiが不調で呼び出しを止めている場合
+            Exception: API呼び出しに失敗した場合
+        """
+        try:
+            history_text = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+            prompt = f"""以下は日記アシスタントとユーザーの会話の記録です。
+これまでの要約と新しい会話をまとめ、以降の会話で参照するための要約を作成してください。
+ユーザーが話した出来事、感情、気づき、アシスタントが既に尋ねた質問を漏らさず、簡潔な箇条書きで書いてください。
+
+これまでの要約:
+{previous_summary or "(なし)"}
+
+新しい会話:
+{history_text}
+
+要約:"""
+            text = await self._generate_text(prompt, operation="summary")
+            if not text:
+                raise Exception("会話履歴の要約の応答が空です")
+            return text
+        except (TimeoutError, CircuitOpenError):
+            raise
+        except Exception as e:
+            raise Exception(f"会話履歴の要約に失敗しました: {e!s}") from e
+
+    async def summarize_conversation(self, conversation: str) -> str:
+        """
+        会話履歴を要約
+
+        Args:
+            conversation: 会話履歴のテキスト
+
+        Returns:
+            要約されたテキスト
+
+        Raises:
+            TimeoutError: API呼び出しがタイムアウトした場合
+            CircuitOpenError: Geminiが不調で呼び出しを止めている場合
+            Exception: API呼び出しに失敗した場合
+        """
+        return await self._write_diary("会話履歴", conversation)
+
+    async def write_diary_from_notes(self, notes: str) -> str:
+        """
+        会話の要点メモから日記を作成
+
+        Args:
+            notes: summarize_chunk / merge_notes で作成した要点メモ
+
+        Returns:
+            日記のテキスト
+
+        Raises:
+            TimeoutError: API呼び出しがタイムアウトした場合
+            CircuitOpenError: Geminiが不調で呼び出しを止めている場合
+            Exception: API呼び出しに失敗した場合
+        """
+        return await self._write_diary("会話の要点(時系列順)", notes)
+
+    async def summarize_chunk(self, chunk: str, index: int, total: int) -> str:
+        """
+        長い会話履歴の一部分から、日記作成に必要な要点を抜き出す
+
+        Args:
+            chunk: 会話履歴の一部分
+            index: 何番目の部分か(0始まり)
+            total: 部分の総数
+
+        Returns:
+            要点メモ(箇条書き)
+
+        Raises:
+            TimeoutError: API呼び出しがタイムアウトした場合
+            CircuitOpenError: Geminiが不調で呼び出しを止めている場合
+            Exception: API呼び出しに失敗した場合
+        """
+        prompt = f"""以下は日記アシスタントとユーザーの長い会話の一部({index + 1}/{total})です。
+後で日記を書くために、ユーザーが話した出来事、その時の感情や考え、気づきを漏らさず、
+時系列順の簡潔な箇条書きで書き出してください。アシスタントの発言そのものは不要です。
+
+会話の一部:
+{chunk}
+
+要点:"""
+        return await self._generate_notes(prompt)
+
+    async def merge_notes(self, notes: list[str]) -> str:
+        """
+        複数の要点メモを1つにまとめる
+
+        Args:
+            notes: 時系列順の要点メモ
+
+        Returns:
+            まとめた要点メモ(箇条書き)
+
+        Raises:
+            TimeoutError: API呼び出しがタイムアウトした場合
+            CircuitOpenError: Geminiが不調で呼び出しを止めている場合
+            Exception: API呼び出しに失敗した場合
+        """
+        joined = "\n\n".join(f"[{i + 1}]\n{note}" for i, note in enumerate(notes))
+        prompt = f"""以下は1つの会話を時系列順に区切って書き出した要点メモです。
+重複を除いて1つの時系列順の箇条書きにまとめてください。
+出来事、感情、気づきは省略せず、表現だけを簡潔にしてください。
+
+要点メモ:
+{joined}
+
+まとめた要点:"""
+        return await self._generate_notes(prompt)
+
+    async def _generate_notes(self, prompt: str) -> str:
+        """要点メモ用のプロンプトを送信し、空の応答をエラーにする"""
+        try:
+            text = await self._generate_text(prompt, operation="summary")
+            if not text:
+                raise Exception("要点の抽出の応答が空です")
+            return text
+        except (TimeoutError, CircuitOpenError):
+            raise
+        except Exception as e:
+            raise Exception(f"要点の抽出に失敗しました: {e!s}") from e
+
+    async def _write_diary(self, label: str, source: str) -> str:
+        """
+        会話履歴または要点メモを基に日記を作成する
+
+        Args:
+            label: プロンプト中での素材の見出し
+            source: 会話履歴または要点メモ
+
+        Returns:
+            日記のテキスト
+
+        Raises:
+            TimeoutError: API呼び出しがタイムアウトした場合
+            CircuitOpenError: Geminiが不調で呼び出しを止めている場合
+            Exception: API呼び出しに失敗した場合
+        """
+        try:
+            prompt = f"""以下の{label}を基に、大人が書く日記のような文章を作成してください。
+以下の点に注意してください:
+
+1. 一人称で書く(「私は」「自分は」など)
+2. 自然で感情的な表現を使う
+3. 出来事の詳細だけでなく、その時の感情や考えも含める
+4. 簡潔だが、読み手がその日の様子を理解できる内容にする
+5. 堅すぎず、かといって砕けすぎない丁寧な文体
+6. 「アシスタントとの会話」「AIとの会話」などの言及は不要で、自然に日記として書く
+
+{label}:
+{source}
+
+日記:"""
+
+            text = await self._generate_text(prompt, operation="summary")
+            if not text:
+                raise Exception("要約生成の応答が空です")
+            return text
+        except (TimeoutError, CircuitOpenError):
+            raise
+        except Exception as e:
+            error_msg = str(e)
+            if "404" in error_msg or "not found" in error_msg.lower():
+                raise Exception(
+                    f"Geminiモデルが見つかりません。モデル名を確認してください。エラー: {error_msg}"
+                ) from e
+            raise Exception(f"要約生成に失敗しました: {error_msg}") from e
+
+
+def _cache_unsupported(error: Exception) -> bool:
+    """
+    コンテキストキャッシュ自体が使えないことを示すエラーか判定する
+
+    SDKにキャッシュの機能が無い場合(AttributeError / TypeError / NotImplementedError)と、
+    上流がモデルやAPIの非対応として拒否した場合(400/404)に限る。
+    タイムアウト・429・5xx・接続断などの一時的な失敗は含めない。
+    """
+    if is_transient(error):
+        return False
+    if isinstance(error, (AttributeError, TypeError, NotImplementedError)):
+        return True
+    status = getattr(error, "code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "status_code", None)
+    return isinstance(status, int) and status in _CACHE_UNSUPPORTED_STATUS
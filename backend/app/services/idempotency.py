@@ -0,0 +1,212 @@
+"""Idempotency-Keyによる処理結果の保存と再送リクエストへの再利用"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+# 大きな音声ファイルを一度にメモリへ読み込まないよう、一定サイズずつハッシュを計算する
+_HASH_CHUNK_BYTES = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class StoredResponse:
+    """保存した処理結果(そのままHTTPレスポンスとして返す)"""
+
+    body: bytes
+    media_type: str
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class _Entry:
+    """キー1つ分の状態(処理中はtask、完了後はresponseを持つ)"""
+
+    fingerprint: str
+    task: asyncio.Task[StoredResponse] | None = None
+    response: StoredResponse | None = None
+    expires_at: float = 0.0
+
+
+class IdempotencyConflictError(Exception):
+    """同じIdempotency-Keyが異なる内容のリクエストに使われた場合の例外"""
+
+
+class IdempotencyStore:
+    """Idempotency-Keyごとに処理結果を一定時間保持するクラス
+
+    同じキーのリクエストが処理中に届いた場合は、その処理の完了を待って同じ結果を返す
+    (上流を再度呼び出さない)。完了後は有効期限まで結果をメモリに保持する。
+    失敗した処理の結果は保存しないため、再送すると改めて処理する。
+    キーはルートごとに区別し、同じキーで内容の異なるリクエストは受け付けない。
+    """
+
+    def __init__(self, ttl_seconds: float, max_bytes: int) -> None:
+        """
+        IdempotencyStoreの初期化
+
+        Args:
+            ttl_seconds: 完了した結果を保持する秒数
+            max_bytes: 保持する結果の合計バイト数の上限(超えたら古いものから捨てる)
+        """
+        self._ttl = ttl_seconds
+        self._max_bytes = max_bytes
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+
+    async def run(
+        self,
+        scope: str,
+        key: str,
+        fingerprint: str,
+        work: Callable[[], Awaitable[StoredResponse]],
+    ) -> tuple[StoredResponse, bool]:
+        """
+        キーに対応する結果を返し、無ければ処理を実行して保存する
+
+        Args:
+            scope: キーを区別する範囲(ルート名)
+            key: クライアントが指定したIdempotency-Key
+            fingerprint: リクエストの内容のハッシュ
+            work: 処理を実行して結果を返すawaitableを作る関数(結果が無い場合にだけ1回呼び出す)
+
+        Returns:
+            (結果, 既存の結果を再利用したか)
+
+        Raises:
+            IdempotencyConflictError: 同じキーが異なる内容のリクエストに使われた場合
+            Exception: 処理に失敗した場合(処理中に届いた同じキーのリクエストにも同じ例外を送出する)
+        """
+        self._evict_expired()
+        entry_key = f"{scope}:{key}"
+        entry = self._entries.get(entry_key)
+        if entry is not None and entry.fingerprint != fingerprint:
+            raise IdempotencyConflictError(f"Idempotency-Keyが別の内容のリクエストに使われています: {key}")
+
+        if entry is not None and entry.response is not None:
+            self._entries.move_to_end(entry_key)
+            self._hits += 1
+            return entry.response, True
+
+        if entry is not None and entry.task is not None:
+            self._coalesced += 1
+            # 呼び出し元がキャンセルされても、元のリクエストのために処理は続ける
+            return await asyncio.shield(entry.task), True
+
+        self._misses += 1
+        # workはここで同期的に呼び出す(呼び出し側は処理を引き渡したかをwork内で判断できる)
+        task = asyncio.create_task(self._execute(work()))
+        entry = _Entry(fingerprint=fingerprint, task=task)
+        self._entries[entry_key] = entry
+        task.add_done_callback(lambda t: self._on_done(entry_key, entry, t))
+        # クライアントが切断しても処理を続け、再送されたリクエストが結果を受け取れるようにする
+        return await asyncio.shield(task), False
+
+    def stats(self) -> dict[str, int | float]:
+        """
+        結果の再利用回数と保持量を返す
+
+        Returns:
+            統計情報
+        """
+        lookups = self._hits + self._misses + self._coalesced
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "hit_ratio": (self._hits + self._coalesced) / lookups if lookups else 0.0,
+            "items": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    async def aclose(self) -> None:
+        """処理中の結果を待っているタスクを停止し、保存した結果を捨てる"""
+        tasks = [e.task for e in self._entries.values() if e.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._entries.clear()
+        self._bytes = 0
+
+    @staticmethod
+    async def _execute(pending: Awaitable[StoredResponse]) -> StoredResponse:
+        return await pending
+
+    def _on_done(self, entry_key: str, entry: _Entry, task: asyncio.Task[StoredResponse]) -> None:
+        """処理が終わったら、成功した場合は結果を保存し、失敗した場合はキーを解放する"""
+        if self._entries.get(entry_key) is not entry:
+            return
+        if task.cancelled() or task.exception() is not None:
+            del self._entries[entry_key]
+            return
+        response = task.result()
+        entry.task = None
+        entry.response = response
+        entry.expires_at = time.monotonic() + self._ttl
+        self._bytes += len(response.body)
+        self._evict_over_budget()
+
+    def _evict_expired(self) -> None:
+        """有効期限を過ぎた結果を捨てる"""
+        now = time.monotonic()
+        expired = [
+            k for k, e in self._entries.items() if e.response is not None and e.expires_at <= now
+        ]
+        for k in expired:
+            self._drop(k)
+
+    def _evict_over_budget(self) -> None:
+        """合計バイト数が上限を超えた分を、参照の古い完了済みの結果から捨てる"""
+        for k in list(self._entries):
+            if self._bytes <= self._max_bytes:
+                return
+            if self._entries[k].response is not None:
+                self._drop(k)
+
+    def _drop(self, entry_key: str) -> None:
+        entry = self._entries.pop(entry_key)
+        if entry.response is not None:
+            self._bytes -= len(entry.response.body)
+
+
+def fingerprint_payload(payload: Any) -> str:
+    """
+    JSONに変換できるリクエストの内容からハッシュを作る
+
+    Args:
+        payload: リクエストの内容
+
+    Returns:
+        SHA-256の16進文字列
+    """
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def fingerprint_file(path: Path, *extra: str) -> str:
+    """
+    ファイルの内容(と追加の値)からハッシュを作る
+
+    同期処理のため、呼び出し側でワーカースレッドから実行する。
+
+    Args:
+        path: ファイルのパス
+        extra: ハッシュに含める追加の値(ファイル名など)
+
+    Returns:
+        SHA-256の16進文字列
+    """
+    digest = hashlib.sha256()
+    for value in extra:
+        digest.update(value.encode("utf-8") + b"\0")
+    with open(path, "rb") as f:
+        while chunk := f.read(_HASH_CHUNK_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
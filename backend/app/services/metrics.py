@@ -0,0 +1,324 @@
+"""Prometheusメトリクスとリクエスト単位の処理時間の内訳"""
+import logging
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+_LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+_SIZE_BUCKETS = tuple(float(4 ** i) for i in range(4, 15))
+_FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "audiodiary_http_request_duration_seconds",
+    "HTTPリクエストの処理時間(ストリーミング応答は送信完了まで)",
+    ["method", "route", "status"],
+    buckets=_LATENCY_BUCKETS,
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "audiodiary_http_requests_in_flight",
+    "処理中のHTTPリクエスト数",
+)
+UPSTREAM_SECONDS = Histogram(
+    "audiodiary_upstream_duration_seconds",
+    "上流API呼び出し1回あたりの時間(リトライ・ヘッジは個別に計測)",
+    ["provider", "operation", "outcome"],
+    buckets=_LATENCY_BUCKETS,
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "audiodiary_upstream_requests_in_flight",
+    "実行中の上流API呼び出し数",
+    ["provider"],
+)
+PROMPT_CHARS = Histogram(
+    "audiodiary_prompt_chars",
+    "Geminiへ送信したプロンプトの文字数",
+    ["operation"],
+    buckets=_SIZE_BUCKETS,
+)
+PROMPT_TOKENS = Histogram(
+    "audiodiary_prompt_tokens",
+    "Geminiへ送信したプロンプトの概算トークン数",
+    ["operation"],
+    buckets=_SIZE_BUCKETS,
+)
+PROMPT_SECTION_TOKENS = Histogram(
+    "audiodiary_prompt_section_tokens",
+    "チャット応答のプロンプトの部分ごとの概算トークン数(instructions / events / diaries / summary / history / message)",
+    ["section"],
+    buckets=_SIZE_BUCKETS,
+)
+PROMPT_ITEMS_OMITTED = Counter(
+    "audiodiary_prompt_items_omitted_total",
+    "トークン数の上限のためプロンプトから省いた項目数(events / diaries / history)と短縮した発言数(history_condensed)",
+    ["section"],
+)
+PAYLOAD_BYTES = Histogram(
+    "audiodiary_payload_bytes",
+    "アップロード音声・合成音声のバイト数",
+    ["kind"],
+    buckets=_SIZE_BUCKETS,
+)
+UPSTREAM_RETRIES = Counter(
+    "audiodiary_upstream_retries_total",
+    "一時的な障害によるリトライ回数",
+    ["provider"],
+)
+UPSTREAM_HEDGES = Counter(
+    "audiodiary_upstream_hedges_total",
+    "ヘッジとして行った2本目の呼び出し数",
+    ["provider"],
+)
+GEMINI_CONTEXT_CACHE_ERRORS = Counter(
+    "audiodiary_gemini_context_cache_errors_total",
+    "Geminiのコンテキストキャッシュの作成の失敗数(disabled: 非対応のため無効化, backoff: 一時的に使わない)",
+    ["action"],
+)
+STT_PREPROCESS_TOTAL = Counter(
+    "audiodiary_stt_preprocess_total",
+    "文字起こし前の音声の前処理の件数(applied: 前処理した音声を送信, skipped: 元の音声を送信, failed: 失敗)",
+    ["result"],
+)
+STT_PREPROCESS_SAVED_BYTES = Counter(
+    "audiodiary_stt_preprocess_saved_bytes_total",
+    "前処理で削減した送信バイト数",
+)
+STT_PREPROCESS_SAVED_SECONDS = Counter(
+    "audiodiary_stt_preprocess_saved_audio_seconds_total",
+    "前処理(無音の圧縮)で削減した音声の秒数",
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "audiodiary_admission_in_flight",
+    "受け付け制御の対象ルートで処理中のリクエスト数",
+    ["route_class"],
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "audiodiary_admission_queue_depth",
+    "受け付け制御の対象ルートで処理の空きを待っているリクエスト数",
+    ["route_class"],
+)
+ADMISSION_REJECTED = Counter(
+    "audiodiary_admission_rejected",
+    "受け付けなかったリクエスト数(queue_full / queue_timeout / rate_limited / upload_budget / too_large)",
+    ["route_class", "reason"],
+)
+UPLOAD_BUDGET_IN_USE = Gauge(
+    "audiodiary_upload_budget_bytes_in_use",
+    "処理中のアップロードが確保しているバイト数",
+)
+VOICE_SESSIONS = Gauge(
+    "audiodiary_voice_sessions",
+    "接続中の音声対話(WebSocket)の数",
+)
+VOICE_TURN_SECONDS = Histogram(
+    "audiodiary_voice_turn_seconds",
+    "音声対話の1ターンで、発話の終わりから各段階に到達するまでの時間",
+    ["milestone"],
+    buckets=_LATENCY_BUCKETS,
+)
+DIARY_QUERY_SECONDS = Histogram(
+    "audiodiary_diary_query_duration_seconds",
+    "日記の検索時間(text: 全文検索, related: 埋め込みの近傍検索。埋め込みの作成を除く)",
+    ["kind"],
+    buckets=_FAST_BUCKETS,
+)
+STARTUP_SECONDS = Gauge(
+    "audiodiary_startup_seconds",
+    "アプリの読み込み開始から各段階(import, lifespan, ready, first_success)までの秒数",
+    ["phase"],
+)
+
+_current_trace: ContextVar["RequestTrace | None"] = ContextVar("request_trace", default=None)
+
+
+@dataclass
+class RequestTrace:
+    """1リクエストの処理段階ごとの所要時間"""
+
+    started: float = field(default_factory=time.perf_counter)
+    stages: dict[str, float] = field(default_factory=dict)
+
+    def add(self, stage: str, seconds: float) -> None:
+        """段階の所要時間を加算する"""
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def trace_stage(stage: str) -> Iterator[None]:
+    """
+    処理段階の所要時間を、実行中のリクエストの内訳に記録する
+
+    リクエストの外(バックグラウンド処理など)では何もしない。
+
+    Args:
+        stage: 段階名(例: "prompt_build", "gemini.chat")
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(stage, time.perf_counter() - started)
+
+
+@contextmanager
+def observe_upstream(provider: str, operation: str) -> Iterator[None]:
+    """
+    上流API呼び出し1回の時間・結果・実行中の数を記録する
+
+    Args:
+        provider: 上流の名前("gemini" / "openai")
+        operation: 操作名("chat", "stt", "tts" など)
+    """
+    in_flight = UPSTREAM_IN_FLIGHT.labels(provider)
+    in_flight.inc()
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        with trace_stage(f"{provider}.{operation}"):
+            yield
+        outcome = "success"
+    finally:
+        in_flight.dec()
+        UPSTREAM_SECONDS.labels(provider, operation, outcome).observe(time.perf_counter() - started)
+
+
+class ServiceStatsCollector(Collector):
+    """スクレイプ時に各サービスのキャッシュ・サーキットブレーカーの状態を読み出すコレクタ"""
+
+    def __init__(self, read_stats: Callable[[], dict[str, Any]]) -> None:
+        """
+        ServiceStatsCollectorの初期化
+
+        Args:
+            read_stats: {"caches": {名前: stats}, "circuits": {上流名: stats}} を返す関数
+        """
+        self._read_stats = read_stats
+
+    def collect(self) -> Iterator[Any]:
+        stats = self._read_stats()
+        lookups = CounterMetricFamily(
+            "audiodiary_cache_lookups", "キャッシュの参照回数", labels=["cache", "result"]
+        )
+        ratio = GaugeMetricFamily(
+            "audiodiary_cache_hit_ratio", "キャッシュのヒット率", labels=["cache"]
+        )
+        for name, cache in stats.get("caches", {}).items():
+            for result in ("hits", "memory_hits", "disk_hits", "misses", "coalesced"):
+                if result in cache:
+                    lookups.add_metric([name, result], cache[result])
+            ratio.add_metric([name], cache.get("hit_ratio", 0.0))
+        circuit = GaugeMetricFamily(
+            "audiodiary_circuit_open", "サーキットブレーカーが開いているか(半開は0.5)", labels=["provider"]
+        )
+        for provider, state in stats.get("circuits", {}).items():
+            circuit.add_metric([provider], {"closed": 0.0, "half_open": 0.5}.get(state, 1.0))
+        yield lookups
+        yield ratio
+        yield circuit
+
+
+def register_service_collector(read_stats: Callable[[], dict[str, Any]]) -> Collector:
+    """サービスの統計を読み出すコレクタを登録する(終了時に unregister_collector で外す)"""
+    collector = ServiceStatsCollector(read_stats)
+    REGISTRY.register(collector)
+    return collector
+
+
+def unregister_collector(collector: Collector) -> None:
+    """登録したコレクタを外す"""
+    REGISTRY.unregister(collector)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """
+    Prometheusのテキスト形式でメトリクスを出力する
+
+    Returns:
+        (本文, Content-Type)
+    """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def route_template(scope: Scope) -> str:
+    """
+    ラベルに使うルートのパステンプレートを返す
+
+    パスパラメータの値をパラメータ名に戻すことで、セッションIDなどの値ごとに
+    系列が増えないようにする。どのルートにも一致しなかった場合は "unmatched"。
+    """
+    if scope.get("endpoint") is None:
+        return "unmatched"
+    params = {str(v): k for k, v in (scope.get("path_params") or {}).items()}
+    segments = scope["path"].split("/")
+    return "/".join(f"{{{params[seg]}}}" if seg in params else seg for seg in segments)
+
+
+class MetricsMiddleware:
+    """HTTPリクエストの処理時間を計測し、遅いリクエストの内訳をログに出すASGIミドルウェア
+
+    ストリーミング応答は本文の送信完了までを計測し、応答開始から完了までを
+    "response_streaming" 段階として内訳に含める。
+    """
+
+    def __init__(self, app: ASGIApp, slow_request_seconds: float = 0.0) -> None:
+        """
+        MetricsMiddlewareの初期化
+
+        Args:
+            app: 次のASGIアプリ
+            slow_request_seconds: 内訳をログに出す処理時間の閾値(秒、0以下で無効)
+        """
+        self.app = app
+        self._slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope.get("path") == "/metrics":
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace()
+        token = _current_trace.set(trace)
+        status = 500
+        response_started: float | None = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status, response_started
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_started = time.perf_counter()
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                if response_started is not None:
+                    trace.add("response_streaming", time.perf_counter() - response_started)
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            _current_trace.reset(token)
+            elapsed = time.perf_counter() - trace.started
+            route = route_template(scope)
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, str(status)).observe(elapsed)
+            if 0 < self._slow_request_seconds <= elapsed:
+                breakdown = ", ".join(
+                    f"{stage}={seconds * 1000:.0f}ms"
+                    for stage, seconds in sorted(trace.stages.items(), key=lambda kv: -kv[1])
+                )
+                logger.warning(
+                    "遅いリクエスト: %s %s %d %.0fms (%s)",
+                    scope["method"], route, status, elapsed * 1000, breakdown or "内訳なし",
+                )
@@ -1,24 +1,117 @@
+import asyncio
 import logging
 import os
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import AsyncExitStack
+from typing import Any, BinaryIO, Literal, cast
 
-from openai import OpenAI
+import httpx
+import openai
+from openai import AsyncOpenAI, BadRequestError, DefaultAsyncHttpxClient, UnprocessableEntityError
+
+from app.config import Settings, get_settings
+from app.services.call_variants import VariantSelector
+from app.services.metrics import PAYLOAD_BYTES
+from app.services.resilience import UpstreamGuard, build_policy
+
+# TTSのresponse_formatに指定できる値(それ以外は上流が拒否し、デフォルトフォーマットで再試行する)
+SpeechFormat = Literal["mp3", "opus", "aac", "flac", "wav", "pcm"]
 
 
 class OpenAIService:
     """OpenAIのSTT/TTSを扱うサービスクラス"""
 
-    def __init__(self) -> None:
+    STT_MODEL = "gpt-4o-mini-transcribe"
+    TTS_MODEL = "gpt-4o-mini-tts"
+    # TTS呼び出しの方式(優先順)
+    TTS_VARIANTS = ("streaming_format", "streaming_default", "non_streaming_format")
+
+    def __init__(self, settings: Settings | None = None) -> None:
         self._logger = logging.getLogger(__name__)
+        settings = settings or get_settings()
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY が設定されていません")
-        self.client = OpenAI(api_key=api_key)
+        # keep-aliveの接続プールをSTT/TTSで共有する
+        self._http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=settings.openai_max_connections,
+                max_keepalive_connections=settings.openai_max_keepalive_connections,
+                keepalive_expiry=settings.openai_keepalive_expiry_seconds,
+            ),
+            timeout=httpx.Timeout(
+                settings.openai_timeout_seconds,
+                connect=settings.openai_connect_timeout_seconds,
+            ),
+        )
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            http_client=self._http_client,
+            # リトライはUpstreamGuardで行う(SDKと二重にリトライしない)
+            max_retries=0,
+        )
+        self._guard = UpstreamGuard(
+            "OpenAI",
+            build_policy(
+                settings,
+                max_retries=settings.openai_max_retries,
+                hedge_enabled=settings.openai_hedge_enabled,
+            ),
+        )
+        self._max_keepalive_connections = settings.openai_max_keepalive_connections
+        self._stt_deadline = settings.deadline_stt_seconds
+        self._tts_deadline = settings.deadline_tts_seconds
+        # 埋め込みは応答生成の前に行うため、チャットと同じ期限にする
+        self._embedding_deadline = settings.deadline_chat_seconds
+        self._semaphore = asyncio.Semaphore(settings.openai_max_in_flight)
+        self._tts_chunk_bytes = settings.tts_stream_chunk_bytes
+        # 上流のストリーミング文字起こしに対応しているか(Noneは未判定)
+        self._stt_streaming_supported: bool | None = None
+        # (モデル, SDKバージョン, フォーマット)ごとに成功したTTS呼び出し方式を記憶する
+        self._tts_variants = VariantSelector(self.TTS_VARIANTS, settings.tts_variant_ttl_seconds)
+
+    def resilience_stats(self) -> dict[str, object]:
+        """サーキットブレーカーの状態とリトライ・ヘッジの回数を返す"""
+        return self._guard.stats()
+
+    async def warm_up(self, connections: int = 1) -> None:
+        """
+        OpenAIへのkeep-alive接続を開いておく(起動時のウォームアップ用)
 
-    def transcribe_audio(self, file_bytes: bytes, filename: str, mime_type: str = "audio/webm") -> str:
+        モデル一覧の取得を同時に複数回行い、その数の接続(TLSハンドシェイク済み)を
+        接続プールに残す。接続数はkeep-aliveの上限を超えない。
+
+        Args:
+            connections: 開いておく接続数
+
+        Raises:
+            Exception: API呼び出しに失敗した場合
+        """
+        count = min(connections, self._max_keepalive_connections)
+
+        async def fetch() -> None:
+            await self.client.models.list()
+
+        if count > 0:
+            await asyncio.gather(*(fetch() for _ in range(count)))
+
+    def tts_variant_stats(self) -> dict[str, object]:
+        """TTS呼び出し方式ごとの呼び出し回数と判定結果を返す"""
+        return self._tts_variants.stats()
+
+    def _tts_variant_key(self, audio_format: str, mode: str) -> tuple[str, ...]:
+        """TTS呼び出し方式の判定結果を記憶する条件"""
+        return (self.TTS_MODEL, openai.__version__, audio_format, mode)
+
+    async def aclose(self) -> None:
+        """HTTP接続プールを閉じる"""
+        await self.client.close()
+
+    async def transcribe_audio(self, file_bytes: bytes | BinaryIO, filename: str, mime_type: str = "audio/webm") -> str:
         """音声バイト列をテキスト化する
 
         Args:
-            file_bytes: 音声ファイルのバイト列
+            file_bytes: 音声ファイルのバイト列(またはバイナリモードで開いたファイル)
             filename: ファイル名
             mime_type: MIMEタイプ
 
@@ -26,16 +119,21 @@ class OpenAIService:
             文字起こし結果の全文
 
         Raises:
+            CircuitOpenError: OpenAIが不調で呼び出しを止めている場合
             Exception: 文字起こしに失敗した場合
         """
-        try:
+
+        async def attempt() -> str:
+            if not isinstance(file_bytes, bytes):
+                # リトライ時はファイルを先頭から送り直す
+                file_bytes.seek(0)
             # 高品質なSTTモデルに切り替え
-            with self.client.audio.transcriptions.with_streaming_response.create(
-                model="gpt-4o-mini-transcribe",
+            async with self.client.audio.transcriptions.with_streaming_response.create(
+                model=self.STT_MODEL,
                 file=(filename, file_bytes, mime_type),
                 response_format="text",
             ) as response:
-                data = response.parse()
+                data = await response.parse()
                 # response_format="text" の場合はそのままテキスト
                 if isinstance(data, str):
                     return data
@@ -44,75 +142,263 @@ class OpenAIService:
                 if not text:
                     raise RuntimeError("Transcription response has no text")
                 return str(text)
-        except Exception:
-            raise
 
-    def synthesize_speech(self, text: str, voice: str = "alloy", audio_format: str = "mp3") -> bytes:
+        # 開いたファイルは同時に2回読めないため、ヘッジはバイト列の場合のみ行う
+        return await self._guard.call(
+            "stt",
+            attempt,
+            deadline=self._stt_deadline,
+            hedge=isinstance(file_bytes, bytes),
+            slot=self._semaphore,
+        )
+
+    async def embed_texts(self, texts: list[str], model: str, dimensions: int) -> list[list[float]]:
+        """
+        テキストを埋め込みベクトルにする
+
+        Args:
+            texts: テキスト
+            model: 埋め込みモデル名
+            dimensions: ベクトルの次元数
+
+        Returns:
+            テキストと同じ順の埋め込みベクトル
+
+        Raises:
+            CircuitOpenError: OpenAIが不調で呼び出しを止めている場合
+            Exception: 埋め込みの作成に失敗した場合
+        """
+        async def attempt() -> list[list[float]]:
+            response = await self.client.embeddings.create(
+                model=model, input=texts, dimensions=dimensions
+            )
+            return [list(item.embedding) for item in sorted(response.data, key=lambda d: d.index)]
+
+        return await self._guard.call(
+            "embedding", attempt, deadline=self._embedding_deadline, hedge=True, slot=self._semaphore
+        )
+
+    async def synthesize_speech(self, text: str, voice: str = "alloy", audio_format: str = "mp3") -> bytes:
         """テキストをOpenAIのTTSで音声化する"""
+        async def attempt() -> bytes:
+            return await self._synthesize_with_fallback(text, voice, audio_format)
+
         try:
-            # 1st try: streaming + format明示
-            try:
-                with self.client.audio.speech.with_streaming_response.create(
-                    model="gpt-4o-mini-tts",
-                    voice=voice,
-                    input=text,
-                    format=audio_format,
-                ) as response:
-                    return response.read()
-            except Exception as e1:
-                self._logger.warning("TTS(streaming,format)失敗: %s", str(e1))
-                # 2nd try: streaming(デフォルトフォーマット)
-                try:
-                    with self.client.audio.speech.with_streaming_response.create(
-                        model="gpt-4o-mini-tts",
-                        voice=voice,
-                        input=text,
-                    ) as response:
-                        return response.read()
-                except Exception as e2:
-                    self._logger.warning("TTS(streaming,default)失敗: %s", str(e2))
-                    # 3rd try: 非ストリーミング
-                    try:
-                        result = self.client.audio.speech.create(
-                            model="gpt-4o-mini-tts",
-                            voice=voice,
-                            input=text,
-                            format=audio_format,
-                        )
-                        if hasattr(result, "read"):
-                            return result.read()
-                        audio_bytes = getattr(result, "audio", None)
-                        if isinstance(audio_bytes, (bytes, bytearray)):
-                            return bytes(audio_bytes)
-                        # 一部SDKはbase64等を返す可能性があるため最後にbytes()で強制
-                        return bytes(result)  # type: ignore[arg-type]
-                    except Exception as e3:
-                        self._logger.error("TTS失敗(全リトライ失敗): %s", str(e3))
-                        raise
+            return await self._guard.call(
+                "tts", attempt, deadline=self._tts_deadline, hedge=True, slot=self._semaphore
+            )
         except Exception as e:
             self._logger.exception("TTS処理中にエラー: %s", str(e))
             raise
 
-    def stream_transcription_tokens(self, file_bytes: bytes, filename: str, mime_type: str = "audio/webm"):
-        """文字起こし結果をトークン単位で逐次生成するジェネレータ
+    async def _synthesize_with_fallback(self, text: str, voice: str, audio_format: str) -> bytes:
+        """TTS呼び出しを複数の方式で順に試行する(成功した方式は記憶して次回から直接使う)"""
+
+        async def streaming_format() -> bytes:
+            async with self.client.audio.speech.with_streaming_response.create(
+                model=self.TTS_MODEL,
+                voice=voice,
+                input=text,
+                response_format=cast(SpeechFormat, audio_format),
+            ) as response:
+                return await response.read()
+
+        async def streaming_default() -> bytes:
+            async with self.client.audio.speech.with_streaming_response.create(
+                model=self.TTS_MODEL,
+                voice=voice,
+                input=text,
+            ) as response:
+                return await response.read()
+
+        async def non_streaming_format() -> bytes:
+            # SDKのバージョンによって戻り値の型が異なるため、属性を確かめてから取り出す
+            result: Any = await self.client.audio.speech.create(
+                model=self.TTS_MODEL,
+                voice=voice,
+                input=text,
+                response_format=cast(SpeechFormat, audio_format),
+            )
+            if hasattr(result, "read"):
+                return bytes(result.read())
+            audio_bytes = getattr(result, "audio", None)
+            if isinstance(audio_bytes, (bytes, bytearray)):
+                return bytes(audio_bytes)
+            # 一部SDKはbase64等を返す可能性があるため最後にbytes()で強制
+            return bytes(result)
+
+        try:
+            return await self._tts_variants.run(
+                self._tts_variant_key(audio_format, "bytes"),
+                {
+                    "streaming_format": streaming_format,
+                    "streaming_default": streaming_default,
+                    "non_streaming_format": non_streaming_format,
+                },
+            )
+        except Exception as e:
+            self._logger.error("TTS失敗: %s", str(e))
+            raise
+
+    async def open_speech_stream(self, text: str, voice: str = "alloy", audio_format: str = "mp3") -> "SpeechStream":
+        """TTSのストリーミング応答を開き、音声チャンクを逐次読み出せる状態にする
+
+        上流のレスポンスヘッダを受信した時点で返るため、呼び出し側は
+        音声全体の生成完了を待たずにクライアントへの送信を開始できる。
+        指定フォーマットが拒否された場合はデフォルトフォーマットで再試行し(結果は記憶する)、
+        実際に使用したフォーマットを ``SpeechStream.audio_format`` に保持する。
+
+        Args:
+            text: 音声化するテキスト
+            voice: 音声ボイス名
+            audio_format: 希望する音声フォーマット
+
+        Returns:
+            開かれた音声ストリーム(読み出し後は必ず閉じること)
+
+        Raises:
+            Exception: TTSの呼び出しに失敗した場合
+        """
+        stack = AsyncExitStack()
+        try:
+            await stack.enter_async_context(self._semaphore)
+
+            async def streaming_format() -> SpeechStream:
+                response = await stack.enter_async_context(
+                    self.client.audio.speech.with_streaming_response.create(
+                        model=self.TTS_MODEL,
+                        voice=voice,
+                        input=text,
+                        response_format=cast(SpeechFormat, audio_format),
+                    )
+                )
+                return SpeechStream(stack, response, audio_format, self._tts_chunk_bytes)
+
+            async def streaming_default() -> SpeechStream:
+                response = await stack.enter_async_context(
+                    self.client.audio.speech.with_streaming_response.create(
+                        model=self.TTS_MODEL,
+                        voice=voice,
+                        input=text,
+                    )
+                )
+                # デフォルトフォーマットはmp3
+                return SpeechStream(stack, response, "mp3", self._tts_chunk_bytes)
+
+            # リトライは音声を返し始める前(レスポンスヘッダの受信まで)に限る
+            return await self._guard.call(
+                "tts_stream",
+                lambda: self._tts_variants.run(
+                    self._tts_variant_key(audio_format, "stream"),
+                    {"streaming_format": streaming_format, "streaming_default": streaming_default},
+                ),
+                deadline=self._tts_deadline,
+            )
+        except BaseException as e:
+            # キャンセル時もセマフォと上流の接続を解放する
+            await stack.aclose()
+            if isinstance(e, Exception):
+                self._logger.exception("TTSストリーミング処理中にエラー: %s", str(e))
+            raise
+
+    async def stream_transcription_tokens(
+        self, file_bytes: bytes | BinaryIO, filename: str, mime_type: str = "audio/webm"
+    ) -> AsyncIterator[str]:
+        """文字起こし結果を上流のストリーミングAPIから逐次受け取って返す非同期ジェネレータ
 
-        OpenAIのストリーミングが利用不可の場合にも、最終結果を擬似的に分割して返す。
+        上流がストリーミングに対応していない場合(SDKやモデルが未対応など)は
+        通常の文字起こしを行い、完了した全文を1つの断片として返す。
+        非対応と判明した後はストリーミングを試さずに通常の文字起こしを行う
+        (音声ファイルが拒否された場合などは、そのリクエストだけ通常の文字起こしにする)。
 
         Args:
-            file_bytes: 音声ファイルのバイト列
+            file_bytes: 音声ファイルのバイト列(またはバイナリモードで開いたファイル)
             filename: ファイル名
             mime_type: MIMEタイプ
 
         Yields:
             逐次出力するテキスト断片
+
+        Raises:
+            Exception: 文字起こしに失敗した場合
         """
-        try:
-            # まずは最終結果を取得
-            full_text = self.transcribe_audio(file_bytes, filename, mime_type)
-            # 単語単位で区切って擬似ストリーム
-            for token in full_text.split():
-                yield token + " "
-        except Exception:
-            raise
+        if self._stt_streaming_supported is not False:
+            emitted = False
+            try:
+                async with self._semaphore:
+
+                    async def open_stream() -> Any:
+                        if not isinstance(file_bytes, bytes):
+                            file_bytes.seek(0)
+                        return await self.client.audio.transcriptions.create(
+                            model=self.STT_MODEL,
+                            file=(filename, file_bytes, mime_type),
+                            response_format="text",
+                            stream=True,
+                        )
+
+                    # リトライは差分を受け取り始める前に限る
+                    stream = await self._guard.call("stt_stream", open_stream, deadline=self._stt_deadline)
+                    async for event in stream:
+                        if getattr(event, "type", "") == "transcript.text.delta" and event.delta:
+                            emitted = True
+                            yield event.delta
+                self._stt_streaming_supported = True
+                return
+            except (TypeError, BadRequestError, UnprocessableEntityError) as e:
+                if emitted:
+                    raise
+                self._logger.warning("ストリーミング文字起こしが利用できないため通常の文字起こしに切り替えます: %s", e)
+                # 音声ファイル自体が拒否された場合などは、このリクエストだけ通常の文字起こしにする
+                if _streaming_unsupported(e):
+                    self._stt_streaming_supported = False
+                if not isinstance(file_bytes, bytes):
+                    file_bytes.seek(0)
+
+        # 完了した全文をまとめて返す(空白の無い日本語を崩さないよう分割しない)
+        full_text = await self.transcribe_audio(file_bytes, filename, mime_type)
+        if full_text:
+            yield full_text
 
 
+def _streaming_unsupported(error: Exception) -> bool:
+    """
+    ストリーミング文字起こし自体に対応していないことを示すエラーか判定する
+
+    SDKが ``stream`` 引数を受け付けない場合(TypeError)と、上流が ``stream`` を
+    拒否した場合に限る(音声ファイルの不備などによる400は含めない)。
+    """
+    if isinstance(error, TypeError) or getattr(error, "param", None) == "stream":
+        return True
+    message = str(error).lower()
+    return "stream" in message and "support" in message
+
+
+class SpeechStream:
+    """開かれたTTSストリーミング応答を表すクラス"""
+
+    def __init__(self, stack: AsyncExitStack, response: Any, audio_format: str, chunk_size: int) -> None:
+        self._stack = stack
+        self._response = response
+        self.audio_format = audio_format
+        self._chunk_size = chunk_size
+
+    async def iter_chunks(self) -> AsyncGenerator[bytes, None]:
+        """上流から届いた音声チャンクをそのまま返し、終了時に接続を閉じる
+
+        Yields:
+            音声データのチャンク
+        """
+        total = 0
+        try:
+            async for chunk in self._response.iter_bytes(self._chunk_size):
+                if chunk:
+                    total += len(chunk)
+                    yield chunk
+        finally:
+            PAYLOAD_BYTES.labels("tts_audio").observe(total)
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        """上流のレスポンスを閉じ、同時実行枠を解放する"""
+        await self._stack.aclose()
@@ -0,0 +1,329 @@
+"""トークン数の上限に収まるチャット応答のプロンプトの組み立て"""
+import hashlib
+import json
+import logging
+import math
+import unicodedata
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from typing import Any
+
+from app.services.metrics import PROMPT_ITEMS_OMITTED, PROMPT_SECTION_TOKENS
+from app.services.tokens import estimate_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+# 関連度に対する近さ(日付)の重み
+_RECENCY_WEIGHT = 0.5
+# 近さのスコアが半分になる日数
+_RECENCY_HALF_LIFE_DAYS = 7.0
+# 関連度の計算に含める直近の発言数(「それで?」のような短いメッセージを補う)
+_RELEVANCE_RECENT_MESSAGES = 2
+
+
+@dataclass
+class AssembledPrompt:
+    """組み立てたプロンプトと、部分ごとの概算トークン数"""
+
+    system_prompt: str
+    conversation: str
+    # 部分(instructions / events / diaries / summary / history / message)ごとの概算トークン数
+    usage: dict[str, int] = field(default_factory=dict)
+    # 上限のため省いた項目数(events / diaries / history)と短縮した発言数(history_condensed)
+    omitted: dict[str, int] = field(default_factory=dict)
+    # トークン数の上限(0は上限なし)
+    budget: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        """プロンプト全体の概算トークン数"""
+        return sum(self.usage.values())
+
+
+@dataclass(frozen=True)
+class _EventStats:
+    """イベント一覧ごとに1回だけ求める値(各イベントの行のトークン数・文字2-gram・開始日時)"""
+
+    costs: list[int]
+    grams: list[set[str]]
+    starts: list[datetime | None]
+
+
+class PromptAssembler:
+    """チャット応答のプロンプトをトークン数の上限に収めて組み立てるクラス
+
+    指示文・今回のメッセージ・直近の発言はそのまま含める。イベント情報は上限の一定割合までとし、
+    収まらない場合は今回のメッセージとの関連度と日付の近さで順位を付けて上位だけを含める。
+    残りの枠には、これまでの会話の要約・関連する日記・古い発言(1件ずつ短縮し、新しい順)を
+    収まるだけ含める。
+    イベントごとの行のトークン数などはcontextのハッシュをキーにLRUでメモ化し、
+    同じcontextが繰り返し送られても毎回イベントを整形し直さない。
+    """
+
+    def __init__(
+        self,
+        token_budget: int,
+        event_share: float,
+        keep_recent_messages: int,
+        condensed_message_tokens: int,
+        cache_size: int = 256,
+    ) -> None:
+        """
+        PromptAssemblerの初期化
+
+        Args:
+            token_budget: プロンプト全体の概算トークン数の上限(0以下で上限なし)
+            event_share: イベント情報に使う上限の割合
+            keep_recent_messages: そのまま含める直近の発言数
+            condensed_message_tokens: 古い発言1件を短縮する概算トークン数
+            cache_size: イベントごとの値をメモ化するcontextの数(LRU)
+        """
+        self._budget = max(0, token_budget)
+        self._event_share = event_share
+        self._keep_recent_messages = keep_recent_messages
+        self._condensed_message_tokens = condensed_message_tokens
+        self._cache_size = max(1, cache_size)
+        self._event_stats: OrderedDict[str, _EventStats] = OrderedDict()
+
+    def assemble(
+        self,
+        instructions: str,
+        user_message: str,
+        context: list[dict[str, Any]] | None,
+        messages_history: list[dict[str, str]] | None,
+        history_summary: str | None,
+        past_diaries: list[str] | None,
+        format_event: Callable[[dict[str, Any]], str],
+        events_block: Callable[[list[dict[str, Any]]], str],
+    ) -> AssembledPrompt:
+        """
+        プロンプトを組み立て、部分ごとの概算トークン数を記録する
+
+        Args:
+            instructions: システムプロンプトの指示文
+            user_message: ユーザーからのメッセージ
+            context: コンテキスト情報(イベント情報など)
+            messages_history: 会話履歴
+            history_summary: 会話履歴より前の会話の要約
+            past_diaries: 今回のメッセージに関連する過去の日記(関連度の高い順)
+            format_event: イベント1件をプロンプト用の1行に整形する関数(常に同じ関数を渡す)
+            events_block: 含めるイベントからシステムプロンプトのイベント情報部分を作る関数
+
+        Returns:
+            組み立てたプロンプト
+        """
+        history = messages_history or []
+        message_part = f"ユーザー: {user_message}\nアシスタント:"
+        usage: dict[str, int] = {"instructions": estimate_tokens(instructions)}
+        omitted: dict[str, int] = {}
+
+        # イベント情報(システムプロンプト)
+        events = list(context or [])
+        if events and self._budget:
+            query = "\n".join([user_message, *(m["content"] for m in history[-_RELEVANCE_RECENT_MESSAGES:])])
+            kept = self._select_events(events, query, format_event)
+            if len(kept) < len(events):
+                omitted["events"] = len(events) - len(kept)
+            events = kept
+        system_prompt = instructions + events_block(events) if events else instructions
+        usage["events"] = estimate_tokens(system_prompt) - usage["instructions"]
+
+        # 直近の発言と今回のメッセージは常にそのまま含める
+        split = max(0, len(history) - self._keep_recent_messages)
+        older, recent = history[:split], history[split:]
+        recent_lines = [_format_message(m) for m in recent]
+        usage["message"] = estimate_tokens(message_part)
+        used = usage["instructions"] + usage["events"] + usage["message"]
+        used += sum(estimate_tokens(line) + 1 for line in recent_lines)
+        remaining = self._budget - used if self._budget else math.inf
+
+        # 要約 → 関連する日記 → 古い発言(新しい順)の順に残りの枠を使う
+        summary = history_summary or ""
+        if summary and remaining < math.inf:
+            summary = truncate_to_tokens(summary, int(max(0, remaining)))
+        remaining -= estimate_tokens(summary)
+
+        diaries: list[str] = []
+        for diary in past_diaries or []:
+            cost = estimate_tokens(diary) + 1
+            if cost > remaining:
+                break
+            diaries.append(diary)
+            remaining -= cost
+        if past_diaries and len(diaries) < len(past_diaries):
+            omitted["diaries"] = len(past_diaries) - len(diaries)
+
+        older_lines: list[str] = []
+        condensed = 0
+        for message in reversed(older):
+            line = _format_message(message)
+            if self._budget:
+                short = truncate_to_tokens(line, self._condensed_message_tokens)
+                if short != line:
+                    condensed += 1
+                line = short
+            cost = estimate_tokens(line) + 1
+            if not line or cost > remaining:
+                break
+            older_lines.append(line)
+            remaining -= cost
+        older_lines.reverse()
+        if len(older_lines) < len(older):
+            omitted["history"] = len(older) - len(older_lines)
+        if condensed:
+            omitted["history_condensed"] = condensed
+
+        parts: list[str] = []
+        if diaries:
+            diaries_text = "\n".join(f"- {diary}" for diary in diaries)
+            parts.append(f"関連する過去の日記:\n{diaries_text}")
+        if summary:
+            parts.append(f"これまでの会話の要約:\n{summary}")
+        history_lines = older_lines + recent_lines
+        if history_lines:
+            history_text = "\n".join(history_lines)
+            parts.append(f"会話履歴:\n{history_text}")
+        parts.append(message_part)
+        conversation = "\n\n".join(parts)
+
+        usage["diaries"] = estimate_tokens(parts[0]) if diaries else 0
+        usage["summary"] = estimate_tokens(summary)
+        usage["history"] = estimate_tokens("\n".join(history_lines))
+        assembled = AssembledPrompt(
+            system_prompt=system_prompt,
+            conversation=conversation,
+            usage=usage,
+            omitted=omitted,
+            budget=self._budget,
+        )
+        self._observe(assembled)
+        return assembled
+
+    def _select_events(
+        self,
+        events: list[dict[str, Any]],
+        query: str,
+        format_event: Callable[[dict[str, Any]], str],
+    ) -> list[dict[str, Any]]:
+        """
+        イベント情報の枠に収まるイベントを選ぶ
+
+        すべて収まる場合は元のまま返す(システムプロンプトが変わらないため、メモ化と
+        コンテキストキャッシュがそのまま効く)。収まらない場合は関連度と日付の近さの
+        高い順に枠が埋まるまで選び、元の順序に戻して返す。
+        """
+        limit = int(self._budget * self._event_share)
+        stats = self._stats_for(events, format_event)
+        costs = stats.costs
+        if sum(costs) <= limit:
+            return events
+
+        query_grams = _bigrams(query)
+        now = datetime.now(UTC)
+        scores = [
+            _relevance(query_grams, grams) + _RECENCY_WEIGHT * _recency(started, now)
+            for grams, started in zip(stats.grams, stats.starts, strict=True)
+        ]
+        order = sorted(range(len(events)), key=lambda i: (-scores[i], i))
+        chosen: list[int] = []
+        used = 0
+        for i in order:
+            if used + costs[i] > limit:
+                continue
+            chosen.append(i)
+            used += costs[i]
+        return [events[i] for i in sorted(chosen)]
+
+    def _stats_for(
+        self, events: list[dict[str, Any]], format_event: Callable[[dict[str, Any]], str]
+    ) -> _EventStats:
+        """イベント一覧ごとの値をメモから返す(無ければ求めて保存する)"""
+        key = context_key(events)
+        stats = self._event_stats.get(key)
+        if stats is not None:
+            self._event_stats.move_to_end(key)
+            return stats
+        stats = _EventStats(
+            costs=[estimate_tokens(format_event(event)) + 1 for event in events],
+            grams=[_bigrams(_event_text(event)) for event in events],
+            starts=[_event_start(event) for event in events],
+        )
+        self._event_stats[key] = stats
+        while len(self._event_stats) > self._cache_size:
+            self._event_stats.popitem(last=False)
+        return stats
+
+    @staticmethod
+    def _observe(assembled: AssembledPrompt) -> None:
+        """部分ごとの概算トークン数と省いた項目数を記録する"""
+        for section, tokens in assembled.usage.items():
+            PROMPT_SECTION_TOKENS.labels(section).observe(tokens)
+        for section, count in assembled.omitted.items():
+            PROMPT_ITEMS_OMITTED.labels(section).inc(count)
+        if assembled.omitted:
+            logger.info(
+                "プロンプトを上限(%d)に収めるため省略: total=%d, usage=%s, omitted=%s",
+                assembled.budget,
+                assembled.total_tokens,
+                assembled.usage,
+                assembled.omitted,
+            )
+
+
+def context_key(context: list[dict[str, Any]]) -> str:
+    """
+    コンテキスト情報の内容からメモ化のキーを作る
+
+    Args:
+        context: コンテキスト情報(イベント情報など)
+
+    Returns:
+        SHA-256の16進文字列
+    """
+    data = json.dumps(context, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _format_message(message: dict[str, str]) -> str:
+    """会話履歴の1発言をプロンプト用の1行に整形する"""
+    return f"{message['role']}: {message['content']}"
+
+
+def _bigrams(text: str) -> set[str]:
+    """表記の揺れを揃えて文字2-gramの集合にする"""
+    normalized = "".join(unicodedata.normalize("NFKC", text).lower().split())
+    return {normalized[i : i + 2] for i in range(len(normalized) - 1)}
+
+
+def _event_text(event: dict[str, Any]) -> str:
+    """関連度の計算に使うイベントの件名・説明・場所"""
+    return " ".join(str(event.get(key) or "") for key in ("summary", "description", "location"))
+
+
+def _event_start(event: dict[str, Any]) -> datetime | None:
+    """イベントの開始日時(無い場合や読み取れない場合はNone)"""
+    start = event.get("start")
+    if not start:
+        return None
+    try:
+        started = datetime.fromisoformat(str(start).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return started if started.tzinfo is not None else started.replace(tzinfo=UTC)
+
+
+def _relevance(query_grams: set[str], grams: set[str]) -> float:
+    """イベントの文字2-gramのうちクエリに含まれるものの割合(0〜1)"""
+    if not grams or not query_grams:
+        return 0.0
+    return len(grams & query_grams) / len(grams)
+
+
+def _recency(started: datetime | None, now: datetime) -> float:
+    """イベントの開始日時が現在に近いほど1に近づくスコア(日時が無い場合は0)"""
+    if started is None:
+        return 0.0
+    days = abs((now - started).total_seconds()) / 86400
+    return float(0.5 ** (days / _RECENCY_HALF_LIFE_DAYS))
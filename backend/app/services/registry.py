@@ -0,0 +1,351 @@
+"""アプリ全体で共有するサービスのレジストリ"""
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from fastapi import Request
+from starlette.requests import HTTPConnection
+
+from app.config import Settings
+from app.services.idempotency import IdempotencyStore
+from app.services.session_store import SessionStore, create_session_store
+from app.services.tts_cache import TTSCache
+
+# 上流SDK(google.generativeai / openai)の読み込みは重いため、
+# サービスを初めて生成する時(またはウォームアップ時)まで遅らせる
+if TYPE_CHECKING:
+    from app.services.audio_preprocess import AudioPreprocessor
+    from app.services.conversation import ConversationService
+    from app.services.diary_service import DiaryService
+    from app.services.gemini_service import GeminiService
+    from app.services.openai_service import OpenAIService
+    from app.services.summarizer import ConversationSummarizer
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceRegistry:
+    """外部APIクライアントを保持し、lifespanで生成・破棄を管理するクラス"""
+
+    def __init__(self, settings: Settings) -> None:
+        """
+        ServiceRegistryの初期化
+
+        Args:
+            settings: アプリケーション設定
+        """
+        self._settings = settings
+        self._gemini: GeminiService | None = None
+        self._openai: OpenAIService | None = None
+        self._tts_cache: TTSCache | None = None
+        self._idempotency: IdempotencyStore | None = None
+        self._session_store: SessionStore | None = None
+        self._conversations: ConversationService | None = None
+        self._summarizer: ConversationSummarizer | None = None
+        self._audio_preprocessor: AudioPreprocessor | None = None
+        self._diaries: DiaryService | None = None
+
+    @property
+    def settings(self) -> Settings:
+        """アプリケーション設定"""
+        return self._settings
+
+    def gemini(self) -> "GeminiService":
+        """
+        GeminiServiceを取得する(初回呼び出し時に生成)
+
+        Returns:
+            共有のGeminiServiceインスタンス
+
+        Raises:
+            ValueError: GEMINI_API_KEYが設定されていない場合
+        """
+        if self._gemini is None:
+            from app.services.gemini_service import GeminiService
+
+            self._gemini = GeminiService()
+        return self._gemini
+
+    def openai(self) -> "OpenAIService":
+        """
+        OpenAIServiceを取得する(初回呼び出し時に生成)
+
+        Returns:
+            共有のOpenAIServiceインスタンス
+
+        Raises:
+            RuntimeError: OPENAI_API_KEYが設定されていない場合
+        """
+        if self._openai is None:
+            from app.services.openai_service import OpenAIService
+
+            self._openai = OpenAIService(self._settings)
+        return self._openai
+
+    def tts_cache(self) -> TTSCache:
+        """
+        TTSキャッシュを取得する(初回呼び出し時に生成)
+
+        Returns:
+            共有のTTSCacheインスタンス
+        """
+        if self._tts_cache is None:
+            disk_dir = Path(self._settings.tts_cache_dir) if self._settings.tts_cache_dir else None
+            self._tts_cache = TTSCache(
+                max_memory_bytes=self._settings.tts_cache_memory_bytes,
+                disk_dir=disk_dir,
+                max_disk_bytes=self._settings.tts_cache_disk_bytes,
+            )
+        return self._tts_cache
+
+    def idempotency(self) -> IdempotencyStore:
+        """
+        Idempotency-Keyごとの処理結果の保存先を取得する(初回呼び出し時に生成)
+
+        Returns:
+            共有のIdempotencyStoreインスタンス
+        """
+        if self._idempotency is None:
+            self._idempotency = IdempotencyStore(
+                ttl_seconds=self._settings.idempotency_ttl_seconds,
+                max_bytes=self._settings.idempotency_max_bytes,
+            )
+        return self._idempotency
+
+    def session_store(self) -> SessionStore:
+        """
+        会話セッションの保存先を取得する(初回呼び出し時に生成)
+
+        Returns:
+            設定に応じたSessionStore
+
+        Raises:
+            ValueError: SESSION_STOREに未知の値が指定された場合
+        """
+        if self._session_store is None:
+            self._session_store = create_session_store(
+                self._settings.session_store,
+                self._settings.session_db_path,
+                self._settings.session_max_sessions,
+                self._settings.session_idle_ttl_seconds,
+            )
+        return self._session_store
+
+    def conversations(self) -> "ConversationService":
+        """
+        会話セッションのサービスを取得する(初回呼び出し時に生成)
+
+        Returns:
+            共有のConversationServiceインスタンス
+
+        Raises:
+            ValueError: GEMINI_API_KEYが未設定、またはSESSION_STOREが不正な場合
+        """
+        if self._conversations is None:
+            from app.services.conversation import ConversationService
+
+            self._conversations = ConversationService(
+                store=self.session_store(),
+                gemini=self.gemini(),
+                history_token_budget=self._settings.session_history_token_budget,
+                keep_recent_messages=self._settings.session_keep_recent_messages,
+            )
+        return self._conversations
+
+    def summarizer(self) -> "ConversationSummarizer":
+        """
+        会話履歴の要約サービスを取得する(初回呼び出し時に生成)
+
+        Returns:
+            共有のConversationSummarizerインスタンス
+
+        Raises:
+            ValueError: GEMINI_API_KEYが設定されていない場合
+        """
+        if self._summarizer is None:
+            from app.services.summarizer import ConversationSummarizer
+
+            self._summarizer = ConversationSummarizer(
+                gemini=self.gemini(),
+                chunk_tokens=self._settings.summary_chunk_tokens,
+                fan_out=self._settings.summary_fan_out,
+                cache_size=self._settings.summary_cache_size,
+            )
+        return self._summarizer
+
+    def audio_preprocessor(self) -> "AudioPreprocessor | None":
+        """
+        STT前の音声の前処理を取得する(初回呼び出し時に生成)
+
+        Returns:
+            共有のAudioPreprocessorインスタンス。STT_PREPROCESS_ENABLEDが無効の場合はNone
+
+        Raises:
+            ValueError: STT_PREPROCESS_CODECに未知の値が指定された場合
+        """
+        if not self._settings.stt_preprocess_enabled:
+            return None
+        if self._audio_preprocessor is None:
+            # NumPyの読み込みも重いため、前処理を有効にした場合だけ読み込む
+            from app.services.audio_preprocess import AudioPreprocessor
+
+            self._audio_preprocessor = AudioPreprocessor(
+                codec=self._settings.stt_preprocess_codec,
+                threshold_dbfs=self._settings.stt_vad_threshold_dbfs,
+                max_silence_ms=self._settings.stt_vad_max_silence_ms,
+                opus_bitrate_kbps=self._settings.stt_preprocess_opus_bitrate_kbps,
+                spool_dir=self._settings.stt_spool_dir or None,
+            )
+        return self._audio_preprocessor
+
+    def diaries(self) -> "DiaryService":
+        """
+        日記の保存・検索サービスを取得する(初回呼び出し時に生成)
+
+        Returns:
+            共有のDiaryServiceインスタンス
+
+        Raises:
+            ValueError: DIARY_EMBEDDERに未知の値が指定された場合
+            RuntimeError: DIARY_EMBEDDER=openaiでOPENAI_API_KEYが設定されていない場合
+        """
+        if self._diaries is None:
+            # NumPyの読み込みも重いため、日記の機能を初めて使う時に読み込む
+            from app.services.diary_service import DiaryService
+            from app.services.diary_store import DiaryStore
+            from app.services.vector_index import Embedder, HashingEmbedder, OpenAIEmbedder
+
+            settings = self._settings
+            embedder: Embedder
+            if settings.diary_embedder == "hash":
+                embedder = HashingEmbedder(settings.diary_embedding_dim)
+            elif settings.diary_embedder == "openai":
+                embedder = OpenAIEmbedder(
+                    self.openai(), settings.diary_embedding_model, settings.diary_embedding_dim
+                )
+            else:
+                raise ValueError(f"未知のDIARY_EMBEDDERです: {settings.diary_embedder}")
+            self._diaries = DiaryService(
+                store=DiaryStore(settings.diary_db_path),
+                embedder=embedder,
+                context_top_k=settings.diary_context_top_k,
+                context_min_score=settings.diary_context_min_score,
+                context_max_chars=settings.diary_context_max_chars,
+                index_batch_size=settings.diary_index_batch_size,
+                max_indexes=settings.diary_index_max_owners,
+            )
+        return self._diaries
+
+    def stats(self) -> dict[str, dict[str, object]]:
+        """
+        生成済みのサービスのキャッシュとサーキットブレーカーの状態を返す
+
+        まだ生成されていないサービスは生成せずに省略する。
+
+        Returns:
+            {"caches": {キャッシュ名: stats}, "circuits": {上流名: 状態}}
+        """
+        caches: dict[str, object] = {}
+        circuits: dict[str, object] = {}
+        if self._tts_cache is not None:
+            caches["tts"] = self._tts_cache.stats()
+        if self._idempotency is not None:
+            caches["idempotency"] = self._idempotency.stats()
+        if self._summarizer is not None:
+            caches["summary"] = self._summarizer.stats()
+        if self._gemini is not None:
+            caches["gemini_prompt"] = self._gemini.prompt_cache_stats()
+            circuits["gemini"] = _circuit_state(self._gemini.resilience_stats())
+        if self._openai is not None:
+            circuits["openai"] = _circuit_state(self._openai.resilience_stats())
+        return {"caches": caches, "circuits": circuits}
+
+    async def aclose(self) -> None:
+        """保持しているクライアントの接続を閉じる"""
+        if self._idempotency is not None:
+            await self._idempotency.aclose()
+            self._idempotency = None
+        if self._conversations is not None:
+            await self._conversations.aclose()
+            self._conversations = None
+        if self._diaries is not None:
+            try:
+                await self._diaries.aclose()
+            except Exception as e:
+                logger.warning("日記の保存先のクローズに失敗: %s", e)
+            self._diaries = None
+        if self._session_store is not None:
+            try:
+                await self._session_store.aclose()
+            except Exception as e:
+                logger.warning("セッション保存先のクローズに失敗: %s", e)
+            self._session_store = None
+        if self._openai is not None:
+            try:
+                await self._openai.aclose()
+            except Exception as e:
+                logger.warning("OpenAIクライアントのクローズに失敗: %s", e)
+            self._openai = None
+        self._summarizer = None
+        self._audio_preprocessor = None
+        self._gemini = None
+
+
+def _circuit_state(resilience_stats: dict[str, object]) -> str:
+    """resilience_stats() の結果からサーキットブレーカーの状態を取り出す"""
+    circuit = resilience_stats.get("circuit")
+    return str(circuit.get("state", "closed")) if isinstance(circuit, dict) else "closed"
+
+
+def get_registry(request: HTTPConnection) -> ServiceRegistry:
+    """
+    リクエスト(またはWebSocket接続)に紐づくアプリのServiceRegistryを取得する
+
+    Args:
+        request: FastAPIのリクエスト、またはWebSocket接続
+
+    Returns:
+        lifespanで生成されたServiceRegistry
+    """
+    registry: ServiceRegistry = request.app.state.services
+    return registry
+
+
+def get_gemini_service(request: Request) -> "GeminiService":
+    """共有のGeminiServiceを取得する"""
+    return get_registry(request).gemini()
+
+
+def get_openai_service(request: Request) -> "OpenAIService":
+    """共有のOpenAIServiceを取得する"""
+    return get_registry(request).openai()
+
+
+def get_tts_cache(request: Request) -> TTSCache:
+    """共有のTTSキャッシュを取得する"""
+    return get_registry(request).tts_cache()
+
+
+def get_idempotency_store(request: Request) -> IdempotencyStore:
+    """共有のIdempotencyStoreを取得する"""
+    return get_registry(request).idempotency()
+
+
+def get_conversation_service(request: Request) -> "ConversationService":
+    """共有のConversationServiceを取得する"""
+    return get_registry(request).conversations()
+
+
+def get_summarizer(request: Request) -> "ConversationSummarizer":
+    """共有のConversationSummarizerを取得する"""
+    return get_registry(request).summarizer()
+
+
+def get_audio_preprocessor(request: Request) -> "AudioPreprocessor | None":
+    """共有のAudioPreprocessorを取得する(前処理が無効の場合はNone)"""
+    return get_registry(request).audio_preprocessor()
+
+
+def get_diary_service(request: Request) -> "DiaryService":
+    """共有のDiaryServiceを取得する"""
+    return get_registry(request).diaries()
@@ -0,0 +1,376 @@
+"""上流API呼び出しの期限・リトライ・ヘッジ・サーキットブレーカー"""
+import asyncio
+import contextlib
+import logging
+import random
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import TypeVar
+
+import httpx
+
+from app.config import Settings
+from app.services.metrics import UPSTREAM_HEDGES, UPSTREAM_RETRIES, observe_upstream
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 一時的な障害とみなすHTTPステータス
+_TRANSIENT_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# ステータスを持たない一時的な障害(接続断・タイムアウトなど)の例外クラス名
+_TRANSIENT_ERROR_NAMES = {
+    "APIConnectionError",
+    "APITimeoutError",
+    "ServiceUnavailable",
+    "DeadlineExceeded",
+    "ResourceExhausted",
+    "InternalServerError",
+}
+
+
+class CircuitOpenError(RuntimeError):
+    """上流が不調のため呼び出しを行わずに失敗させた場合の例外"""
+
+    def __init__(self, provider: str, retry_after: float) -> None:
+        super().__init__(f"{provider} が一時的に利用できません({retry_after:.0f}秒後に再試行してください)")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    再試行で回復する見込みのある例外か判定する
+
+    Args:
+        error: 発生した例外
+
+    Returns:
+        タイムアウト・接続エラー・429/5xxなどの場合にTrue
+    """
+    if isinstance(error, (TimeoutError, httpx.TransportError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None)
+    if isinstance(status, int) and status in _TRANSIENT_STATUS:
+        return True
+    return any(cls.__name__ in _TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+@dataclass(frozen=True)
+class ResiliencePolicy:
+    """上流ごとのリトライ・ヘッジ・サーキットブレーカーの設定"""
+
+    max_retries: int = 2
+    base_delay_seconds: float = 0.2
+    max_delay_seconds: float = 2.0
+    hedge_enabled: bool = False
+    hedge_percentile: float = 0.95
+    hedge_min_samples: int = 20
+    failure_threshold: int = 5
+    reset_seconds: float = 30.0
+
+
+def build_policy(settings: Settings, *, max_retries: int, hedge_enabled: bool) -> ResiliencePolicy:
+    """
+    設定から上流ごとのポリシーを作る
+
+    Args:
+        settings: アプリケーション設定
+        max_retries: リトライ回数
+        hedge_enabled: ヘッジを行うか
+
+    Returns:
+        ResiliencePolicy
+    """
+    return ResiliencePolicy(
+        max_retries=max_retries,
+        base_delay_seconds=settings.retry_base_delay_seconds,
+        max_delay_seconds=settings.retry_max_delay_seconds,
+        hedge_enabled=hedge_enabled,
+        hedge_percentile=settings.hedge_percentile,
+        hedge_min_samples=settings.hedge_min_samples,
+        failure_threshold=settings.circuit_failure_threshold,
+        reset_seconds=settings.circuit_reset_seconds,
+    )
+
+
+class CircuitBreaker:
+    """連続して失敗した上流への呼び出しを一定時間止めるサーキットブレーカー
+
+    閉(通常)→ 連続失敗が閾値に達すると開(即時失敗)→ 一定時間後に半開となり、
+    1件だけ試行を通す。試行が成功すれば閉に戻り、失敗すれば再び開になる。
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float) -> None:
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._trial_in_flight = False
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        """現在の状態("closed" / "open" / "half_open")"""
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self._reset_seconds:
+            return "half_open"
+        return "open"
+
+    def before_call(self) -> None:
+        """
+        呼び出しを通してよいか確認する
+
+        Raises:
+            CircuitOpenError: 開状態、または半開状態で試行中の呼び出しがある場合
+        """
+        if self._opened_at is None:
+            return
+        elapsed = time.monotonic() - self._opened_at
+        if elapsed >= self._reset_seconds and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return
+        self._rejected += 1
+        raise CircuitOpenError(self._name, max(1.0, self._reset_seconds - elapsed))
+
+    def record_success(self) -> None:
+        """呼び出しの成功を記録する"""
+        if self._opened_at is not None:
+            logger.info("サーキットブレーカーを閉じます: %s", self._name)
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        """一時的な障害による呼び出しの失敗を記録する"""
+        self._failures += 1
+        if self._trial_in_flight or (self._opened_at is None and self._failures >= self._failure_threshold):
+            logger.warning("サーキットブレーカーを開きます: %s(連続失敗 %d回)", self._name, self._failures)
+            self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+    def release(self) -> None:
+        """一時的な障害以外で終わった試行の枠を解放する"""
+        self._trial_in_flight = False
+
+    def stats(self) -> dict[str, int | str]:
+        """状態と連続失敗数を返す"""
+        return {"state": self.state, "consecutive_failures": self._failures, "rejected": self._rejected}
+
+
+class LatencyTracker:
+    """直近の呼び出し時間を保持し、パーセンタイルを求める"""
+
+    def __init__(self, window: int = 200) -> None:
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float) -> None:
+        """呼び出し時間を記録する"""
+        self._samples.append(seconds)
+
+    def percentile(self, q: float, min_samples: int) -> float | None:
+        """
+        直近の呼び出し時間のパーセンタイルを返す
+
+        Args:
+            q: 求めるパーセンタイル(0〜1)
+            min_samples: 計算に必要な最小サンプル数
+
+        Returns:
+            パーセンタイル(秒)。サンプルが足りない場合はNone
+        """
+        if len(self._samples) < max(1, min_samples):
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class UpstreamGuard:
+    """1つの上流(GeminiやOpenAI)への呼び出しを保護するクラス
+
+    操作ごとの期限(リトライを含めた全体の上限)を守りながら、一時的な障害を
+    ジッター付き指数バックオフでリトライする。ヘッジが有効な場合は、応答が
+    直近のp95を超えた時点で2本目の呼び出しを並行して行い、先に成功した方を使う。
+    連続して失敗した上流はサーキットブレーカーで一定時間即時に失敗させる。
+    """
+
+    def __init__(self, name: str, policy: ResiliencePolicy) -> None:
+        """
+        UpstreamGuardの初期化
+
+        Args:
+            name: 上流の名前(ログ・エラーメッセージ用)
+            policy: リトライ・ヘッジ・サーキットブレーカーの設定
+        """
+        self._name = name
+        self._provider = name.lower()
+        self._policy = policy
+        self._breaker = CircuitBreaker(name, policy.failure_threshold, policy.reset_seconds)
+        self._latency: dict[str, LatencyTracker] = {}
+        self._retries = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+
+    async def call(
+        self,
+        operation: str,
+        attempt: Callable[[], Awaitable[T]],
+        *,
+        deadline: float,
+        hedge: bool = False,
+        slot: asyncio.Semaphore | None = None,
+    ) -> T:
+        """
+        上流を呼び出す
+
+        Args:
+            operation: 操作名(呼び出し時間の統計の単位)
+            attempt: 1回分の呼び出しを行うコルーチン関数(リトライ・ヘッジで複数回呼ばれる)
+            deadline: リトライを含めた全体の期限(秒)
+            hedge: ヘッジを許可するか(同時に2回呼び出しても安全な操作のみTrue)
+            slot: 1回の呼び出しごとに確保する同時実行数の枠(呼び出し時間とヘッジまでの
+                待ち時間は枠を確保してから数えるため、混雑による待ちだけでヘッジしない)
+
+        Returns:
+            呼び出しの結果
+
+        Raises:
+            CircuitOpenError: サーキットブレーカーが開いている場合
+            TimeoutError: 期限までに成功しなかった場合
+            Exception: リトライできない失敗、またはリトライ回数を使い切った場合
+        """
+        self._breaker.before_call()
+        try:
+            async with asyncio.timeout(deadline):
+                result = await self._call_with_retry(operation, attempt, hedge, slot)
+        except Exception as e:
+            if is_transient(e):
+                self._breaker.record_failure()
+            else:
+                self._breaker.release()
+            raise
+        except BaseException:
+            self._breaker.release()
+            raise
+        self._breaker.record_success()
+        return result
+
+    def stats(self) -> dict[str, object]:
+        """
+        サーキットブレーカーの状態とリトライ・ヘッジの回数を返す
+
+        Returns:
+            統計情報
+        """
+        return {
+            "provider": self._provider,
+            "circuit": self._breaker.stats(),
+            "retries": self._retries,
+            "hedges": self._hedges,
+            "hedge_wins": self._hedge_wins,
+            "p95_seconds": {
+                operation: tracker.percentile(0.95, 1)
+                for operation, tracker in self._latency.items()
+            },
+        }
+
+    async def _call_with_retry(
+        self,
+        operation: str,
+        attempt: Callable[[], Awaitable[T]],
+        hedge: bool,
+        slot: asyncio.Semaphore | None,
+    ) -> T:
+        """一時的な障害をバックオフしながらリトライする"""
+        policy = self._policy
+        for retry in range(policy.max_retries + 1):
+            try:
+                return await self._call_once(operation, attempt, hedge, slot)
+            except Exception as e:
+                if retry >= policy.max_retries or not is_transient(e):
+                    raise
+                # Full Jitter: 0〜min(上限, 基準 * 2^n) の一様乱数だけ待つ
+                delay = random.uniform(0, min(policy.max_delay_seconds, policy.base_delay_seconds * 2 ** retry))
+                self._retries += 1
+                UPSTREAM_RETRIES.labels(self._provider).inc()
+                logger.warning(
+                    "%s(%s)が一時的に失敗したため%.2f秒後にリトライします: %s",
+                    self._name, operation, delay, e,
+                )
+                await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    async def _call_once(
+        self,
+        operation: str,
+        attempt: Callable[[], Awaitable[T]],
+        hedge: bool,
+        slot: asyncio.Semaphore | None,
+    ) -> T:
+        """1回呼び出す(ヘッジが有効ならp95超過時に2本目を並行して行う)"""
+        tracker = self._latency.setdefault(operation, LatencyTracker())
+
+        async def measured(acquired: asyncio.Event | None = None) -> T:
+            async with slot if slot is not None else contextlib.nullcontext():
+                if acquired is not None:
+                    acquired.set()
+                started = time.perf_counter()
+                with observe_upstream(self._provider, operation):
+                    result = await attempt()
+                tracker.add(time.perf_counter() - started)
+                return result
+
+        threshold = (
+            tracker.percentile(self._policy.hedge_percentile, self._policy.hedge_min_samples)
+            if hedge and self._policy.hedge_enabled
+            else None
+        )
+        if threshold is None:
+            return await measured()
+
+        acquired = asyncio.Event()
+        primary = asyncio.ensure_future(measured(acquired))
+        tasks = [primary]
+        try:
+            # ヘッジまでの待ち時間は、1本目が同時実行数の枠を確保してから数える
+            waiter = asyncio.ensure_future(acquired.wait())
+            try:
+                await asyncio.wait([primary, waiter], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+            if not primary.done():
+                done, _ = await asyncio.wait(tasks, timeout=threshold)
+                if not done:
+                    self._hedges += 1
+                    UPSTREAM_HEDGES.labels(self._provider).inc()
+                    tasks.append(asyncio.ensure_future(measured()))
+            last_error: BaseException | None = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        # 呼び出しの内部でキャンセルされた場合は失敗として扱う
+                        last_error = last_error or asyncio.CancelledError()
+                        continue
+                    error = task.exception()
+                    if error is None:
+                        if task is not primary:
+                            self._hedge_wins += 1
+                        return task.result()
+                    last_error = error
+            assert last_error is not None
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            for task in tasks:
+                with contextlib.suppress(BaseException):
+                    await task
@@ -0,0 +1,327 @@
+"""会話セッションの保存先"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+
+@dataclass
+class Session:
+    """会話セッション
+
+    ``summary`` には圧縮済みの古い会話の要約、``messages`` には要約されていない
+    直近の発言を保持する。
+    """
+
+    id: str
+    summary: str = ""
+    messages: list[dict[str, str]] = field(default_factory=list)
+    context: list[dict[str, Any]] | None = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+
+class SessionNotFoundError(KeyError):
+    """セッションが存在しない場合の例外"""
+
+
+class SessionStore(ABC):
+    """会話セッションの保存先のインターフェース"""
+
+    @abstractmethod
+    async def create(self, context: list[dict[str, Any]] | None = None) -> Session:
+        """新しいセッションを作成する"""
+
+    @abstractmethod
+    async def get(self, session_id: str) -> Session | None:
+        """セッションを取得する(存在しない場合はNone)"""
+
+    @abstractmethod
+    async def append(self, session_id: str, messages: list[dict[str, str]]) -> None:
+        """セッションに発言を追加する"""
+
+    @abstractmethod
+    async def set_context(self, session_id: str, context: list[dict[str, Any]] | None) -> None:
+        """セッションのコンテキスト(イベント情報など)を更新する"""
+
+    @abstractmethod
+    async def compact(self, session_id: str, summary: str, drop_count: int) -> None:
+        """古い発言を先頭から ``drop_count`` 件削除し、要約を置き換える"""
+
+    @abstractmethod
+    async def delete(self, session_id: str) -> None:
+        """セッションを削除する"""
+
+    async def aclose(self) -> None:
+        """保存先を閉じる"""
+        return None
+
+
+class InMemorySessionStore(SessionStore):
+    """プロセス内のメモリに保存する(開発用)
+
+    上限を超えた場合は最も長く使われていないセッションから破棄する。
+    一定時間更新の無いセッションは期限切れとして扱い、作成時にまとめて破棄する。
+    """
+
+    def __init__(self, max_sessions: int = 1000, idle_ttl_seconds: float = 0.0) -> None:
+        self._max_sessions = max_sessions
+        self._idle_ttl = idle_ttl_seconds
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+
+    async def create(self, context: list[dict[str, Any]] | None = None) -> Session:
+        session = Session(id=uuid.uuid4().hex, context=context)
+        self._prune()
+        self._sessions[session.id] = session
+        while len(self._sessions) > self._max_sessions:
+            self._sessions.popitem(last=False)
+        return self._copy(session)
+
+    async def get(self, session_id: str) -> Session | None:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if _expired(session.updated_at, self._idle_ttl):
+            del self._sessions[session_id]
+            return None
+        self._sessions.move_to_end(session_id)
+        return self._copy(session)
+
+    async def append(self, session_id: str, messages: list[dict[str, str]]) -> None:
+        session = self._require(session_id)
+        session.messages.extend(dict(m) for m in messages)
+        session.updated_at = time.time()
+
+    async def set_context(self, session_id: str, context: list[dict[str, Any]] | None) -> None:
+        session = self._require(session_id)
+        session.context = context
+        session.updated_at = time.time()
+
+    async def compact(self, session_id: str, summary: str, drop_count: int) -> None:
+        session = self._require(session_id)
+        session.summary = summary
+        del session.messages[:drop_count]
+        session.updated_at = time.time()
+
+    async def delete(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    def _prune(self) -> None:
+        """期限切れのセッションを破棄する"""
+        if self._idle_ttl <= 0:
+            return
+        expired = [sid for sid, s in self._sessions.items() if _expired(s.updated_at, self._idle_ttl)]
+        for sid in expired:
+            del self._sessions[sid]
+
+    def _require(self, session_id: str) -> Session:
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise SessionNotFoundError(session_id)
+        return session
+
+    @staticmethod
+    def _copy(session: Session) -> Session:
+        return Session(
+            id=session.id,
+            summary=session.summary,
+            messages=[dict(m) for m in session.messages],
+            context=session.context,
+            created_at=session.created_at,
+            updated_at=session.updated_at,
+        )
+
+
+class SQLiteSessionStore(SessionStore):
+    """SQLiteファイルに保存する(本番用)
+
+    sqlite3は同期APIのため、すべての操作をワーカースレッドで実行する。
+    ファイルが際限なく大きくならないよう、作成時に期限切れのセッションと、
+    上限を超えた分の最も長く更新されていないセッションを削除する。
+    """
+
+    def __init__(self, db_path: str, max_sessions: int = 1000, idle_ttl_seconds: float = 0.0) -> None:
+        self._max_sessions = max_sessions
+        self._idle_ttl = idle_ttl_seconds
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL DEFAULT '',
+                    context TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS session_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_session_messages_session
+                    ON session_messages(session_id, id);
+                CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at);
+                """
+            )
+
+    async def create(self, context: list[dict[str, Any]] | None = None) -> Session:
+        session = Session(id=uuid.uuid4().hex, context=context)
+        await asyncio.to_thread(self._create, session)
+        return session
+
+    async def get(self, session_id: str) -> Session | None:
+        return await asyncio.to_thread(self._get, session_id)
+
+    async def append(self, session_id: str, messages: list[dict[str, str]]) -> None:
+        await asyncio.to_thread(self._append, session_id, messages)
+
+    async def set_context(self, session_id: str, context: list[dict[str, Any]] | None) -> None:
+        await asyncio.to_thread(self._set_context, session_id, context)
+
+    async def compact(self, session_id: str, summary: str, drop_count: int) -> None:
+        await asyncio.to_thread(self._compact, session_id, summary, drop_count)
+
+    async def delete(self, session_id: str) -> None:
+        await asyncio.to_thread(self._delete, session_id)
+
+    async def aclose(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _create(self, session: Session) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO sessions (id, summary, context, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (
+                    session.id,
+                    session.summary,
+                    self._dump_context(session.context),
+                    session.created_at,
+                    session.updated_at,
+                ),
+            )
+            self._prune()
+
+    def _prune(self) -> None:
+        """期限切れのセッションと上限を超えた分を削除する(発言は外部キーで一緒に削除される)"""
+        if self._idle_ttl > 0:
+            self._conn.execute(
+                "DELETE FROM sessions WHERE updated_at < ?", (time.time() - self._idle_ttl,)
+            )
+        self._conn.execute(
+            """
+            DELETE FROM sessions WHERE id IN (
+                SELECT id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self._max_sessions,),
+        )
+
+    def _get(self, session_id: str) -> Session | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, context, created_at, updated_at FROM sessions WHERE id = ?",
+                (session_id,),
+            ).fetchone()
+            if row is None or _expired(row[3], self._idle_ttl):
+                return None
+            messages = self._conn.execute(
+                "SELECT role, content FROM session_messages WHERE session_id = ? ORDER BY id",
+                (session_id,),
+            ).fetchall()
+        return Session(
+            id=session_id,
+            summary=row[0],
+            messages=[{"role": role, "content": content} for role, content in messages],
+            context=json.loads(row[1]) if row[1] else None,
+            created_at=row[2],
+            updated_at=row[3],
+        )
+
+    def _append(self, session_id: str, messages: list[dict[str, str]]) -> None:
+        with self._lock, self._conn:
+            self._touch(session_id)
+            self._conn.executemany(
+                "INSERT INTO session_messages (session_id, role, content) VALUES (?, ?, ?)",
+                [(session_id, m["role"], m["content"]) for m in messages],
+            )
+
+    def _set_context(self, session_id: str, context: list[dict[str, Any]] | None) -> None:
+        with self._lock, self._conn:
+            self._touch(session_id)
+            self._conn.execute(
+                "UPDATE sessions SET context = ? WHERE id = ?",
+                (self._dump_context(context), session_id),
+            )
+
+    def _compact(self, session_id: str, summary: str, drop_count: int) -> None:
+        with self._lock, self._conn:
+            self._touch(session_id)
+            self._conn.execute("UPDATE sessions SET summary = ? WHERE id = ?", (summary, session_id))
+            self._conn.execute(
+                """
+                DELETE FROM session_messages WHERE id IN (
+                    SELECT id FROM session_messages WHERE session_id = ? ORDER BY id LIMIT ?
+                )
+                """,
+                (session_id, drop_count),
+            )
+
+    def _delete(self, session_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _touch(self, session_id: str) -> None:
+        """更新日時を更新する(セッションが無い場合は例外)"""
+        cursor = self._conn.execute(
+            "UPDATE sessions SET updated_at = ? WHERE id = ?", (time.time(), session_id)
+        )
+        if cursor.rowcount == 0:
+            raise SessionNotFoundError(session_id)
+
+    @staticmethod
+    def _dump_context(context: list[dict[str, Any]] | None) -> str | None:
+        return json.dumps(context, ensure_ascii=False) if context is not None else None
+
+
+def _expired(updated_at: float, idle_ttl: float) -> bool:
+    """最後の更新から期限(0以下で無期限)を過ぎたか"""
+    return idle_ttl > 0 and time.time() - updated_at > idle_ttl
+
+
+def create_session_store(
+    backend: str, db_path: str, max_sessions: int, idle_ttl_seconds: float = 0.0
+) -> SessionStore:
+    """
+    設定に応じたセッションの保存先を生成する
+
+    Args:
+        backend: "memory" または "sqlite"
+        db_path: SQLiteファイルのパス
+        max_sessions: 保持するセッション数の上限
+        idle_ttl_seconds: 更新の無いセッションを破棄するまでの秒数(0以下で無期限)
+
+    Returns:
+        セッションの保存先
+
+    Raises:
+        ValueError: 未知のbackendが指定された場合
+    """
+    if backend == "memory":
+        return InMemorySessionStore(max_sessions=max_sessions, idle_ttl_seconds=idle_ttl_seconds)
+    if backend == "sqlite":
+        return SQLiteSessionStore(db_path, max_sessions=max_sessions, idle_ttl_seconds=idle_ttl_seconds)
+    raise ValueError(f"SESSION_STORE は memory または sqlite を指定してください: {backend}")
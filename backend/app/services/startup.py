@@ -0,0 +1,194 @@
+"""起動時のウォームアップと起動時間の計測"""
+import asyncio
+import importlib
+import logging
+import time
+from collections.abc import Awaitable
+from typing import Any
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import Settings
+from app.services.metrics import STARTUP_SECONDS, route_template
+from app.services.registry import ServiceRegistry
+
+logger = logging.getLogger(__name__)
+
+# ウォームアップで読み込む、上流SDKに依存する重いモジュール
+_HEAVY_MODULES = (
+    "app.services.gemini_service",
+    "app.services.openai_service",
+    "app.services.conversation",
+    "app.services.summarizer",
+)
+# 音声の前処理を有効にした場合だけ読み込むモジュール(NumPyに依存する)
+_PREPROCESS_MODULES = ("app.services.audio_preprocess",)
+# 初回成功の計測から除くルート(ヘルスチェック・監視用)
+_INFRA_ROUTES = {"/", "/health", "/ready", "/metrics", "unmatched"}
+
+
+class StartupTracker:
+    """起動の各段階と、ルートごとの最初の成功応答までの時間を記録するクラス
+
+    時間はすべてアプリのパッケージを読み込み始めた時刻からの経過秒数で記録する。
+    """
+
+    def __init__(self, started_at: float, warmup_enabled: bool) -> None:
+        """
+        StartupTrackerの初期化
+
+        Args:
+            started_at: 計測基準の時刻(time.perf_counter()の値)
+            warmup_enabled: ウォームアップを行うか(行わない場合は起動直後から準備完了)
+        """
+        self._started_at = started_at
+        self.warmup_enabled = warmup_enabled
+        self.phases: dict[str, float] = {}
+        self.steps: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+        self.first_success: dict[str, float] = {}
+        self._ready = False
+
+    @property
+    def ready(self) -> bool:
+        """リクエストを受け付ける準備ができているか"""
+        return self._ready
+
+    def mark(self, phase: str) -> float:
+        """
+        起動の段階に到達した時刻を記録する
+
+        Args:
+            phase: 段階名("import", "lifespan", "ready" など)
+
+        Returns:
+            計測基準からの経過秒数
+        """
+        elapsed = time.perf_counter() - self._started_at
+        self.phases[phase] = elapsed
+        STARTUP_SECONDS.labels(phase).set(elapsed)
+        return elapsed
+
+    def mark_ready(self) -> None:
+        """準備完了を記録する"""
+        elapsed = self.mark("ready")
+        self._ready = True
+        steps = ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.steps.items())
+        logger.info(
+            "起動完了: import=%.0fms, ready=%.0fms (%s)",
+            self.phases.get("import", 0.0) * 1000, elapsed * 1000, steps or "ウォームアップなし",
+        )
+
+    def record_success(self, route: str) -> None:
+        """ルートの最初の成功応答を記録する(2回目以降は何もしない)"""
+        if route in self.first_success or route in _INFRA_ROUTES:
+            return
+        elapsed = time.perf_counter() - self._started_at
+        if not self.first_success:
+            STARTUP_SECONDS.labels("first_success").set(elapsed)
+            logger.info("最初の成功応答まで %.0fms: %s", elapsed * 1000, route)
+        self.first_success[route] = elapsed
+
+    def report(self) -> dict[str, Any]:
+        """
+        /ready で返す起動状況
+
+        Returns:
+            状態・各段階とウォームアップの各手順の秒数・失敗した手順
+        """
+        return {
+            "status": "ready" if self.ready else "starting",
+            "mode": "warm" if self.warmup_enabled else "lazy",
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "steps": {name: round(seconds, 4) for name, seconds in self.steps.items()},
+            "errors": dict(self.errors),
+            "first_success": {route: round(seconds, 4) for route, seconds in self.first_success.items()},
+        }
+
+
+async def warm_up(registry: ServiceRegistry, tracker: StartupTracker, settings: Settings) -> None:
+    """
+    重いモジュールの読み込みと上流への接続を済ませてから準備完了にする
+
+    各手順の失敗(APIキー未設定・上流の不調など)は記録するだけで、起動は止めない。
+    期限を過ぎた場合も残りの手順を打ち切って準備完了にする。
+
+    Args:
+        registry: サービスのレジストリ
+        tracker: 起動時間の記録先
+        settings: アプリケーション設定
+    """
+    try:
+        async with asyncio.timeout(settings.startup_warmup_timeout_seconds):
+            # イベントループを止めないよう、読み込みは別スレッドで行う(/health は応答し続ける)
+            await _step(tracker, "import", asyncio.to_thread(_import_heavy_modules, settings))
+            await asyncio.gather(
+                _step(tracker, "gemini_connect", _connect_gemini(registry)),
+                _step(tracker, "openai_connect", _connect_openai(registry, settings.startup_prewarm_connections)),
+            )
+    except TimeoutError:
+        logger.warning("ウォームアップが期限(%.0f秒)内に終わりませんでした", settings.startup_warmup_timeout_seconds)
+        tracker.errors.setdefault("warmup", "timeout")
+    finally:
+        if not tracker.ready:
+            tracker.mark_ready()
+
+
+def _import_heavy_modules(settings: Settings) -> None:
+    """上流SDKなど重いライブラリに依存するモジュールを読み込む"""
+    names = _HEAVY_MODULES + (_PREPROCESS_MODULES if settings.stt_preprocess_enabled else ())
+    for name in names:
+        importlib.import_module(name)
+
+
+async def _connect_gemini(registry: ServiceRegistry) -> None:
+    """Geminiのクライアントを生成し、接続を確立する"""
+    await registry.gemini().warm_up()
+
+
+async def _connect_openai(registry: ServiceRegistry, connections: int) -> None:
+    """OpenAIのクライアントを生成し、keep-aliveの接続を開いておく"""
+    await registry.openai().warm_up(connections)
+
+
+async def _step(tracker: StartupTracker, name: str, step: Awaitable[object]) -> None:
+    """ウォームアップの1手順を実行し、所要時間と失敗を記録する"""
+    started = time.perf_counter()
+    try:
+        await step
+    except Exception as e:
+        tracker.errors[name] = f"{type(e).__name__}: {e}"
+        logger.warning("ウォームアップの手順(%s)に失敗: %s", name, e)
+    finally:
+        tracker.steps[name] = time.perf_counter() - started
+
+
+class FirstSuccessMiddleware:
+    """ルートごとの最初の成功応答までの時間を記録するASGIミドルウェア"""
+
+    def __init__(self, app: ASGIApp, tracker: StartupTracker) -> None:
+        """
+        FirstSuccessMiddlewareの初期化
+
+        Args:
+            app: 次のASGIアプリ
+            tracker: 記録先
+        """
+        self.app = app
+        self._tracker = tracker
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+        if status < 400:
+            self._tracker.record_success(route_template(scope))
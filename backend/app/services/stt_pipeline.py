@@ -0,0 +1,315 @@
+"""長時間録音の分割並列文字起こし"""
+import asyncio
+import logging
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import asynccontextmanager
+from difflib import SequenceMatcher
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from app.config import Settings
+from app.services.audio_io import (
+    decode_to_pcm,
+    encode_pcm_to_flac,
+    ffmpeg_available,
+    pcm_duration,
+    read_pcm_range,
+)
+from app.services.metrics import trace_stage
+
+if TYPE_CHECKING:
+    from app.services.audio_preprocess import AudioPreprocessor
+    from app.services.openai_service import OpenAIService
+
+logger = logging.getLogger(__name__)
+
+# 重複除去で比較する末尾/先頭の文字数、重複とみなす最小一致文字数、
+# 区間の境界で途切れた語として許容する文字数(前後の合計)
+_OVERLAP_WINDOW_CHARS = 80
+_MIN_OVERLAP_CHARS = 6
+_EDGE_SLACK_CHARS = 8
+
+
+def plan_segments(duration: float, segment_seconds: float, overlap_seconds: float) -> list[tuple[float, float]]:
+    """
+    音声全体を重なりのある区間に分割する
+
+    Args:
+        duration: 音声全体の長さ(秒)
+        segment_seconds: 1区間の長さ(秒)
+        overlap_seconds: 隣接区間の重なり(秒)
+
+    Returns:
+        (開始位置, 長さ) のリスト
+    """
+    step = max(segment_seconds - overlap_seconds, 1.0)
+    segments: list[tuple[float, float]] = []
+    start = 0.0
+    while start < duration:
+        length = min(segment_seconds, duration - start)
+        segments.append((start, length))
+        if start + length >= duration:
+            break
+        start += step
+    return segments
+
+
+def _find_overlap(prev: str, text: str) -> tuple[int, int] | None:
+    """
+    前の区間の末尾と次の区間の先頭で重複している部分を探す
+
+    Args:
+        prev: それまでに連結した文字列
+        text: 次の区間の文字起こし結果
+
+    Returns:
+        (prevを切り詰める位置, textの採用開始位置)。重複が無い場合はNone
+    """
+    tail = prev[-_OVERLAP_WINDOW_CHARS:]
+    head = text[:_OVERLAP_WINDOW_CHARS]
+    match = SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(0, len(tail), 0, len(head))
+    dangling = (len(tail) - match.a - match.size) + match.b
+    if match.size < _MIN_OVERLAP_CHARS or dangling > _EDGE_SLACK_CHARS:
+        return None
+    return len(prev) - len(tail) + match.a + match.size, match.b + match.size
+
+
+def _separator(prev: str, text: str) -> str:
+    """重複が無い区間同士を連結する際の区切り文字を返す"""
+    return "" if prev[-1:].isspace() or not text[:1].isascii() else " "
+
+
+def merge_overlapping_transcripts(texts: list[str]) -> str:
+    """
+    重なりのある区間の文字起こし結果を順に連結し、重複部分を取り除く
+
+    前の区間の末尾と次の区間の先頭で最長一致する部分を探し、
+    一致部分を1回だけ残して連結する。空白の無い日本語にも対応するため文字単位で比較する。
+    一致が境界付近に無い場合は偶然の一致とみなし、そのまま連結する。
+
+    Args:
+        texts: 区間順の文字起こし結果
+
+    Returns:
+        連結した全文
+    """
+    merged = ""
+    for text in texts:
+        text = text.strip()
+        if not text:
+            continue
+        if not merged:
+            merged = text
+            continue
+        overlap = _find_overlap(merged, text)
+        if overlap is not None:
+            cut, start = overlap
+            merged = merged[:cut] + text[start:]
+        else:
+            merged = merged + _separator(merged, text) + text
+    return merged
+
+
+@asynccontextmanager
+async def _prepared_audio(
+    preprocessor: "AudioPreprocessor | None",
+    path: Path,
+    filename: str,
+    mime_type: str,
+) -> AsyncIterator[tuple[Path, str, str, Path | None]]:
+    """
+    前処理が有効であれば音声を前処理し、送信する音声ファイルを返す
+
+    前処理しなかった場合は元の音声ファイルをそのまま返す。
+    前処理したファイルはブロックを抜けるときに削除する。
+
+    Yields:
+        (音声ファイルのパス, ファイル名, MIMEタイプ, 前処理でデコード済みのraw PCM(無い場合はNone))
+    """
+    prepared = await preprocessor.prepare(path, filename, mime_type) if preprocessor is not None else None
+    if prepared is None:
+        yield path, filename, mime_type, None
+        return
+    try:
+        yield prepared.path, prepared.filename, prepared.mime_type, prepared.pcm
+    finally:
+        prepared.cleanup()
+
+
+async def _plan_file(
+    path: Path, settings: Settings, pcm: Path | None = None
+) -> tuple[Path, list[tuple[float, float]]] | None:
+    """
+    分割文字起こしの対象であればPCMへ変換して区間を計画する
+
+    Args:
+        path: 音声ファイルのパス
+        settings: アプリケーション設定
+        pcm: デコード済みのraw PCM(前処理で作成したもの。あればffmpegで再度デコードせず、分割しない場合は削除する)
+
+    Returns:
+        (PCMファイルのパス, 区間のリスト)。分割しない場合はNone
+    """
+    if path.stat().st_size < settings.stt_segment_min_bytes or not ffmpeg_available():
+        return None
+    if pcm is None:
+        with trace_stage("audio_decode"):
+            pcm = await decode_to_pcm(path, settings.stt_spool_dir or None)
+    duration = pcm_duration(pcm)
+    segments = plan_segments(
+        duration,
+        settings.stt_segment_seconds,
+        settings.stt_segment_overlap_seconds,
+    )
+    if len(segments) <= 1:
+        pcm.unlink(missing_ok=True)
+        return None
+    logger.info("分割文字起こし: %.1f秒を%d区間に分割", duration, len(segments))
+    return pcm, segments
+
+
+async def _iter_segment_texts(
+    service: "OpenAIService",
+    pcm: Path,
+    segments: list[tuple[float, float]],
+    parallelism: int,
+) -> AsyncGenerator[str, None]:
+    """
+    各区間を並列に文字起こしし、区間順に結果を返す
+
+    すべての区間を同時実行数の上限内で並行して処理し、
+    先頭から順に完了したものを返す。途中で失敗・中断した場合は残りを停止する。
+
+    Args:
+        service: OpenAIService
+        pcm: raw PCMファイル
+        segments: (開始位置, 長さ) のリスト
+        parallelism: 同時に文字起こしする区間数の上限
+
+    Yields:
+        区間ごとの文字起こし結果
+    """
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def transcribe_segment(index: int, start: float, length: float) -> str:
+        async with semaphore:
+            pcm_bytes = await asyncio.to_thread(read_pcm_range, pcm, start, length)
+            flac = await encode_pcm_to_flac(pcm_bytes)
+            return await service.transcribe_audio(
+                flac, filename=f"segment-{index:04d}.flac", mime_type="audio/flac"
+            )
+
+    tasks = [
+        asyncio.create_task(transcribe_segment(i, start, length))
+        for i, (start, length) in enumerate(segments)
+    ]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        # 1区間でも失敗したら、または呼び出し側が中断したら残りの区間の処理を止める
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def transcribe_file(
+    service: "OpenAIService",
+    path: Path,
+    filename: str,
+    mime_type: str,
+    settings: Settings,
+    preprocessor: "AudioPreprocessor | None" = None,
+) -> str:
+    """
+    ディスク上の音声ファイルを文字起こしする
+
+    十分に長い録音は重なりのある区間に分割して並列に文字起こしし、
+    順番通りに連結する。短い録音やffmpegが利用できない環境では1回の呼び出しで処理する。
+
+    Args:
+        service: OpenAIService
+        path: 音声ファイルのパス
+        filename: 元のファイル名
+        mime_type: MIMEタイプ
+        settings: アプリケーション設定
+        preprocessor: 送信前に無音の圧縮・再エンコードを行う場合のAudioPreprocessor
+
+    Returns:
+        文字起こし結果の全文
+
+    Raises:
+        Exception: 文字起こしに失敗した場合
+    """
+    async with _prepared_audio(preprocessor, path, filename, mime_type) as (path, filename, mime_type, pcm):
+        plan = await _plan_file(path, settings, pcm)
+        if plan is None:
+            with open(path, "rb") as f:
+                return await service.transcribe_audio(f, filename=filename, mime_type=mime_type)
+
+        pcm, segments = plan
+        try:
+            texts = [
+                text
+                async for text in _iter_segment_texts(service, pcm, segments, settings.stt_segment_parallelism)
+            ]
+            return merge_overlapping_transcripts(texts)
+        finally:
+            pcm.unlink(missing_ok=True)
+
+
+async def stream_transcribe_file(
+    service: "OpenAIService",
+    path: Path,
+    filename: str,
+    mime_type: str,
+    settings: Settings,
+    preprocessor: "AudioPreprocessor | None" = None,
+) -> AsyncIterator[str]:
+    """
+    ディスク上の音声ファイルを文字起こしし、得られた部分から逐次返す
+
+    短い録音は上流のストリーミング文字起こしの差分をそのまま返す。
+    長い録音は分割して並列に文字起こしし、完了した区間を先頭から順に
+    (前の区間との重複を除いて)返す。
+
+    Args:
+        service: OpenAIService
+        path: 音声ファイルのパス
+        filename: 元のファイル名
+        mime_type: MIMEタイプ
+        settings: アプリケーション設定
+        preprocessor: 送信前に無音の圧縮・再エンコードを行う場合のAudioPreprocessor
+
+    Yields:
+        文字起こし結果の差分
+
+    Raises:
+        Exception: 文字起こしに失敗した場合
+    """
+    async with _prepared_audio(preprocessor, path, filename, mime_type) as (path, filename, mime_type, pcm):
+        plan = await _plan_file(path, settings, pcm)
+        if plan is None:
+            with open(path, "rb") as f:
+                async for delta in service.stream_transcription_tokens(f, filename=filename, mime_type=mime_type):
+                    yield delta
+            return
+
+        pcm, segments = plan
+        try:
+            emitted = ""
+            async for text in _iter_segment_texts(service, pcm, segments, settings.stt_segment_parallelism):
+                text = text.strip()
+                if not text:
+                    continue
+                if not emitted:
+                    delta = text
+                else:
+                    # 送信済みの文字列は取り消せないため、次の区間側の重複だけを除く
+                    overlap = _find_overlap(emitted, text)
+                    delta = text[overlap[1]:] if overlap is not None else _separator(emitted, text) + text
+                if delta:
+                    emitted += delta
+                    yield delta
+        finally:
+            pcm.unlink(missing_ok=True)
@@ -0,0 +1,188 @@
+"""長い会話履歴の階層的な要約(map-reduce)"""
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from functools import partial
+from typing import TYPE_CHECKING
+
+from app.services.tokens import estimate_tokens, split_text_by_tokens
+
+if TYPE_CHECKING:
+    from app.services.gemini_service import GeminiService
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationSummarizer:
+    """会話履歴から日記を作成するクラス
+
+    短い会話は1回の呼び出しで日記にする。長い会話はトークン数の上限で区切り、
+    各部分の要点を並行して抽出(map)し、要点が1回で扱える量になるまで
+    まとめ直して(reduce)から日記にする。同じ会話の結果はキャッシュし、
+    処理中の同じ会話へのリクエストは1回の生成にまとめる。
+    """
+
+    def __init__(
+        self,
+        gemini: "GeminiService",
+        chunk_tokens: int,
+        fan_out: int,
+        cache_size: int,
+    ) -> None:
+        """
+        ConversationSummarizerの初期化
+
+        Args:
+            gemini: 要約に使用するGeminiService
+            chunk_tokens: 1回の呼び出しに含める会話・要点の概算トークン数の上限
+            fan_out: 1件の要約で同時に実行する呼び出し数の上限
+            cache_size: 結果を保持する会話数の上限(LRU)
+        """
+        self._gemini = gemini
+        self._chunk_tokens = chunk_tokens
+        self._fan_out = fan_out
+        self._cache_size = cache_size
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task[str]] = {}
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+
+    async def summarize(self, conversation: str) -> str:
+        """
+        会話履歴から日記を作成する
+
+        Args:
+            conversation: 会話履歴のテキスト
+
+        Returns:
+            日記のテキスト
+
+        Raises:
+            TimeoutError: API呼び出しがタイムアウトした場合
+            Exception: 要約生成に失敗した場合
+        """
+        key = hashlib.sha256(conversation.encode("utf-8")).hexdigest()
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self._hits += 1
+            return cached
+
+        task = self._inflight.get(key)
+        if task is None:
+            self._misses += 1
+            task = asyncio.create_task(self._summarize(key, conversation))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t))
+        else:
+            self._coalesced += 1
+        # 呼び出し元がキャンセルされても、待っている他のリクエストのために生成は続ける
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, int | float]:
+        """
+        キャッシュのヒット/ミス数を返す
+
+        Returns:
+            統計情報
+        """
+        lookups = self._hits + self._misses + self._coalesced
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "hit_ratio": self._hits / lookups if lookups else 0.0,
+            "items": len(self._cache),
+        }
+
+    async def _summarize(self, key: str, conversation: str) -> str:
+        """要約を生成し、結果をキャッシュに保存する"""
+        if estimate_tokens(conversation) <= self._chunk_tokens:
+            summary = await self._gemini.summarize_conversation(conversation)
+        else:
+            summary = await self._map_reduce(conversation)
+        self._cache[key] = summary
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return summary
+
+    async def _map_reduce(self, conversation: str) -> str:
+        """会話を分割して要点を抽出し、まとめ直してから日記にする"""
+        chunks = split_text_by_tokens(conversation, self._chunk_tokens)
+        total = len(chunks)
+        semaphore = asyncio.Semaphore(self._fan_out)
+
+        async def limited(factory: Callable[[], Awaitable[str]]) -> str:
+            async with semaphore:
+                return await factory()
+
+        notes = await _gather_ordered([
+            limited(partial(self._gemini.summarize_chunk, chunk, i, total))
+            for i, chunk in enumerate(chunks)
+        ])
+        levels = 1
+        while len(notes) > 1 and sum(estimate_tokens(n) for n in notes) > self._chunk_tokens:
+            groups = self._group_notes(notes)
+            notes = await _gather_ordered([
+                limited(partial(self._gemini.merge_notes, group)) if len(group) > 1 else _done(group[0])
+                for group in groups
+            ])
+            levels += 1
+        logger.info("会話を階層要約: chunks=%d, levels=%d", total, levels)
+        return await self._gemini.write_diary_from_notes("\n\n".join(notes))
+
+    def _group_notes(self, notes: list[str]) -> list[list[str]]:
+        """
+        要点メモを、1回の呼び出しで扱える量ずつ順番にまとめる
+
+        必ず件数が減るよう、1グループには少なくとも2件を入れる。
+
+        Args:
+            notes: 時系列順の要点メモ
+
+        Returns:
+            時系列順のグループのリスト
+        """
+        groups: list[list[str]] = []
+        current: list[str] = []
+        current_tokens = 0
+        for note in notes:
+            tokens = estimate_tokens(note)
+            if len(current) >= 2 and current_tokens + tokens > self._chunk_tokens:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(note)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    def _on_done(self, key: str, task: "asyncio.Task[str]") -> None:
+        """生成完了時に処理中の登録を外す"""
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # 待機者がいない場合でも例外未取得の警告を出さない
+            task.exception()
+
+
+async def _done(value: str) -> str:
+    """既に決まっている値をそのまま返す"""
+    return value
+
+
+async def _gather_ordered(coros: list[Awaitable[str]]) -> list[str]:
+    """
+    すべてを並行して実行し、元の順序で結果を返す
+
+    1つでも失敗した場合は残りをキャンセルして例外を送出する。
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return list(await asyncio.gather(*tasks))
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
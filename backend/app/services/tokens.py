@@ -0,0 +1,103 @@
+"""プロンプトのトークン数の概算"""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を概算する
+
+    トークナイザを使わずに見積もるため、ASCII文字は約4文字で1トークン、
+    日本語などの非ASCII文字は1文字で約1トークンとして数える。
+
+    Args:
+        text: 対象のテキスト
+
+    Returns:
+        概算トークン数
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    non_ascii_chars = len(text) - ascii_chars
+    return non_ascii_chars + (ascii_chars + 3) // 4
+
+
+def split_text_by_tokens(text: str, max_tokens: int) -> list[str]:
+    """
+    テキストを概算トークン数が上限以下の部分に分割する
+
+    行の途中では区切らず、行単位で詰められるだけ詰める。
+    1行だけで上限を超える場合は、その行を文字数で分割する。
+
+    Args:
+        text: 対象のテキスト
+        max_tokens: 1部分あたりの概算トークン数の上限
+
+    Returns:
+        元の順序を保った部分のリスト
+    """
+    max_tokens = max(1, max_tokens)
+    chunks: list[str] = []
+    current: list[str] = []
+    current_tokens = 0
+    for line in text.splitlines():
+        line_tokens = estimate_tokens(line) + 1
+        if line_tokens > max_tokens:
+            if current:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            chunks.extend(_split_line(line, max_tokens))
+            continue
+        if current and current_tokens + line_tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def truncate_to_tokens(text: str, max_tokens: int, ellipsis: str = "...") -> str:
+    """
+    テキストを概算トークン数が上限以下になるよう先頭から切り詰める
+
+    Args:
+        text: 対象のテキスト
+        max_tokens: 概算トークン数の上限(省略記号を含む)
+        ellipsis: 切り詰めた場合に末尾に付ける文字列
+
+    Returns:
+        上限以下のテキスト(上限が省略記号にも満たない場合は空文字列)
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    room = max_tokens - estimate_tokens(ellipsis)
+    if room <= 0:
+        return ""
+    ascii_chars = non_ascii_chars = 0
+    for i, ch in enumerate(text):
+        if ch.isascii():
+            ascii_chars += 1
+        else:
+            non_ascii_chars += 1
+        if non_ascii_chars + (ascii_chars + 3) // 4 > room:
+            return text[:i] + ellipsis
+    return text
+
+
+def _split_line(line: str, max_tokens: int) -> list[str]:
+    """上限を超える1行を、概算トークン数が上限以下になるよう文字数で分割する"""
+    parts: list[str] = []
+    start = 0
+    ascii_chars = non_ascii_chars = 0
+    for i, ch in enumerate(line):
+        if ch.isascii():
+            ascii_chars += 1
+        else:
+            non_ascii_chars += 1
+        if non_ascii_chars + (ascii_chars + 3) // 4 > max_tokens:
+            parts.append(line[start:i])
+            start = i
+            ascii_chars, non_ascii_chars = (1, 0) if ch.isascii() else (0, 1)
+    parts.append(line[start:])
+    return [part for part in parts if part]
@@ -0,0 +1,221 @@
+"""TTS音声のコンテンツアドレス型キャッシュ"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CachedAudio:
+    """キャッシュから取得した音声
+
+    メモリ上のデータ(``data``)かディスク上のファイル(``path``)のどちらか一方を持つ。
+    """
+
+    data: bytes | None = None
+    path: Path | None = None
+    hit: bool = False
+
+
+class TTSCache:
+    """メモリ(LRU)とディスクの2階層で合成済み音声を保持するキャッシュ
+
+    同じキーへの同時リクエストは1回の上流呼び出しにまとめる。
+    """
+
+    def __init__(
+        self,
+        max_memory_bytes: int,
+        disk_dir: Path | None = None,
+        max_disk_bytes: int = 0,
+    ) -> None:
+        """
+        TTSCacheの初期化
+
+        Args:
+            max_memory_bytes: メモリ階層に保持する音声の合計バイト数の上限
+            disk_dir: ディスク階層の保存先(Noneの場合はディスク階層を使わない)
+            max_disk_bytes: ディスク階層の合計バイト数の上限
+        """
+        self._max_memory_bytes = max_memory_bytes
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+
+        self._disk_dir = disk_dir if disk_dir is not None and max_disk_bytes > 0 else None
+        self._max_disk_bytes = max_disk_bytes
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        if self._disk_dir is not None:
+            self._load_disk_index(self._disk_dir)
+
+        self._inflight: dict[str, asyncio.Task[CachedAudio]] = {}
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._coalesced = 0
+
+    @staticmethod
+    def make_key(text: str, voice: str, audio_format: str, model: str) -> str:
+        """
+        合成パラメータからキャッシュキーを生成する
+
+        Args:
+            text: 音声化するテキスト
+            voice: 音声ボイス名
+            audio_format: 音声フォーマット
+            model: TTSモデル名
+
+        Returns:
+            SHA-256の16進文字列
+        """
+        payload = json.dumps([text, voice, audio_format.lower(), model], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get_or_create(self, key: str, factory: Callable[[], Awaitable[bytes]]) -> CachedAudio:
+        """
+        キャッシュから音声を取得し、無ければ生成して保存する
+
+        Args:
+            key: キャッシュキー
+            factory: キャッシュミス時に音声を生成するコルーチン関数
+
+        Returns:
+            取得または生成した音声
+
+        Raises:
+            Exception: 音声の生成に失敗した場合
+        """
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self._memory_hits += 1
+            return CachedAudio(data=data, hit=True)
+
+        if self._disk_dir is not None and key in self._disk:
+            self._disk.move_to_end(key)
+            self._disk_hits += 1
+            return CachedAudio(path=self._disk_path(key), hit=True)
+
+        task = self._inflight.get(key)
+        if task is None:
+            self._misses += 1
+            task = asyncio.create_task(self._fill(key, factory))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_fill_done(key, t))
+        else:
+            self._coalesced += 1
+        # 呼び出し元がキャンセルされても、待っている他のリクエストのために生成は続ける
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, int | float]:
+        """
+        キャッシュのヒット/ミス数と使用量を返す
+
+        Returns:
+            統計情報
+        """
+        hits = self._memory_hits + self._disk_hits
+        lookups = hits + self._misses + self._coalesced
+        return {
+            "memory_hits": self._memory_hits,
+            "disk_hits": self._disk_hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "memory_items": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_items": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+        }
+
+    async def _fill(self, key: str, factory: Callable[[], Awaitable[bytes]]) -> CachedAudio:
+        """上流で音声を生成し、各階層に保存する"""
+        data = await factory()
+        self._put_memory(key, data)
+        if self._disk_dir is not None:
+            try:
+                await self._put_disk(key, data)
+            except OSError as e:
+                logger.warning("TTSキャッシュのディスク書き込みに失敗: %s", e)
+        return CachedAudio(data=data)
+
+    def _on_fill_done(self, key: str, task: "asyncio.Task[CachedAudio]") -> None:
+        """生成完了時に処理中の登録を外す"""
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # 待機者がいない場合でも例外未取得の警告を出さない
+            task.exception()
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        """メモリ階層に保存し、上限を超えた分を古い順に追い出す"""
+        size = len(data)
+        if size > self._max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += size
+        while self._memory_bytes > self._max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    async def _put_disk(self, key: str, data: bytes) -> None:
+        """ディスク階層に保存し、上限を超えた分を古い順に削除する"""
+        size = len(data)
+        if size > self._max_disk_bytes:
+            return
+        await asyncio.to_thread(self._write_file, self._disk_path(key), data)
+        old = self._disk.pop(key, None)
+        if old is not None:
+            self._disk_bytes -= old
+        self._disk[key] = size
+        self._disk_bytes += size
+
+        evicted: list[Path] = []
+        while self._disk_bytes > self._max_disk_bytes:
+            evicted_key, evicted_size = self._disk.popitem(last=False)
+            self._disk_bytes -= evicted_size
+            evicted.append(self._disk_path(evicted_key))
+        if evicted:
+            await asyncio.to_thread(self._remove_files, evicted)
+
+    def _disk_path(self, key: str) -> Path:
+        """キャッシュキーに対応するファイルパスを返す"""
+        assert self._disk_dir is not None
+        return self._disk_dir / f"{key}.audio"
+
+    def _load_disk_index(self, disk_dir: Path) -> None:
+        """既存のキャッシュファイルを更新日時の古い順に索引へ登録する"""
+        disk_dir.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for path in disk_dir.glob("*.audio"):
+            with contextlib.suppress(OSError):
+                stat = path.stat()
+                entries.append((stat.st_mtime, path.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    @staticmethod
+    def _write_file(path: Path, data: bytes) -> None:
+        """一時ファイル経由でアトミックに書き込む"""
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _remove_files(paths: list[Path]) -> None:
+        """ファイルを削除する(既に無い場合は無視する)"""
+        for path in paths:
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
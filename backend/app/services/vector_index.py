@@ -0,0 +1,241 @@
+"""埋め込みベクトルの作成とNumPyによる近傍検索"""
+import asyncio
+import unicodedata
+import zlib
+from abc import ABC, abstractmethod
+from collections.abc import Sequence
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from app.services.openai_service import OpenAIService
+
+# 文字n-gramの長さ(日本語は単語の区切りが無いため、2文字と3文字の並びを特徴にする)
+_NGRAM_SIZES = (2, 3)
+# 索引の行数が足りなくなった時の最小の確保数
+_MIN_CAPACITY = 64
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    各行を長さ1のベクトルに正規化する(内積がコサイン類似度になるようにする)
+
+    Args:
+        vectors: (件数, 次元) の配列
+
+    Returns:
+        float32の正規化済み配列(長さ0の行は0のまま)
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    normalized: np.ndarray = matrix / np.maximum(norms, 1e-12)
+    return normalized
+
+
+class Embedder(ABC):
+    """テキストを埋め込みベクトルにするインターフェース"""
+
+    @property
+    @abstractmethod
+    def name(self) -> str:
+        """保存したベクトルと照合するための名前(モデルや次元が変わったら変える)"""
+
+    @property
+    @abstractmethod
+    def dim(self) -> int:
+        """ベクトルの次元数"""
+
+    @abstractmethod
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        """
+        テキストを埋め込みベクトルにする
+
+        Args:
+            texts: テキスト
+
+        Returns:
+            (件数, 次元) のfloat32配列(各行は正規化済み)
+        """
+
+
+class HashingEmbedder(Embedder):
+    """文字n-gramの出現回数を固定次元に畳み込む埋め込み(外部APIを使わない)
+
+    n-gramはCRC32で次元と符号に割り当てるため、プロセスをまたいでも同じベクトルになる。
+    言い回しの近さではなく語の重なりを表すが、同じ出来事や人・場所の名前を含む日記を拾える。
+    """
+
+    def __init__(self, dim: int) -> None:
+        """
+        HashingEmbedderの初期化
+
+        Args:
+            dim: ベクトルの次元数
+        """
+        self._dim = dim
+
+    @property
+    def name(self) -> str:
+        return f"hash-ngram-{self._dim}"
+
+    @property
+    def dim(self) -> int:
+        return self._dim
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return await asyncio.to_thread(self.embed_sync, texts)
+
+    def embed_sync(self, texts: list[str]) -> np.ndarray:
+        """embed の同期版"""
+        matrix = np.zeros((len(texts), self._dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.fromiter(
+                (zlib.crc32(gram.encode("utf-8")) for gram in _ngrams(text)), dtype=np.uint32
+            )
+            if hashes.size == 0:
+                continue
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+            counts = np.bincount(hashes % self._dim, weights=signs, minlength=self._dim)
+            # 頻出するn-gramの影響を抑える
+            matrix[row] = np.sign(counts) * np.log1p(np.abs(counts))
+        return normalize_rows(matrix)
+
+
+class OpenAIEmbedder(Embedder):
+    """OpenAIの埋め込みAPIを使う埋め込み"""
+
+    def __init__(self, openai: "OpenAIService", model: str, dim: int) -> None:
+        """
+        OpenAIEmbedderの初期化
+
+        Args:
+            openai: 共有のOpenAIService
+            model: 埋め込みモデル名
+            dim: ベクトルの次元数(モデルが次元の指定に対応している必要がある)
+        """
+        self._openai = openai
+        self._model = model
+        self._dim = dim
+
+    @property
+    def name(self) -> str:
+        return f"openai-{self._model}-{self._dim}"
+
+    @property
+    def dim(self) -> int:
+        return self._dim
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = await self._openai.embed_texts(texts, model=self._model, dimensions=self._dim)
+        return normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+class VectorIndex:
+    """正規化したベクトルを1つの配列に並べて保持し、コサイン類似度の上位を返すクラス
+
+    追加は配列の末尾への書き込み(容量は倍々で確保)、削除は末尾の行との入れ替えで行うため、
+    どちらも索引全体を作り直さない。検索は行列とベクトルの積1回で全件の類似度を求める。
+    """
+
+    def __init__(self, dim: int) -> None:
+        """
+        VectorIndexの初期化
+
+        Args:
+            dim: ベクトルの次元数
+        """
+        self._dim = dim
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._size = 0
+        self._positions: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        """確保しているメモリのバイト数"""
+        return int(self._vectors.nbytes + self._ids.nbytes)
+
+    def add(self, ids: Sequence[int], vectors: np.ndarray) -> None:
+        """
+        ベクトルを追加する(同じIDが既にある場合は置き換える)
+
+        Args:
+            ids: 各ベクトルのID
+            vectors: (件数, 次元) の正規化済み配列
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self._dim)
+        for item_id, vector in zip(ids, vectors, strict=True):
+            position = self._positions.get(item_id)
+            if position is None:
+                self._reserve(self._size + 1)
+                position = self._size
+                self._size += 1
+                self._ids[position] = item_id
+                self._positions[item_id] = position
+            self._vectors[position] = vector
+
+    def remove(self, item_id: int) -> bool:
+        """
+        ベクトルを削除する
+
+        Returns:
+            削除したか(IDが無かった場合はFalse)
+        """
+        position = self._positions.pop(item_id, None)
+        if position is None:
+            return False
+        last = self._size - 1
+        if position != last:
+            moved = int(self._ids[last])
+            self._vectors[position] = self._vectors[last]
+            self._ids[position] = moved
+            self._positions[moved] = position
+        self._size = last
+        return True
+
+    def search(self, query: np.ndarray, k: int) -> list[tuple[int, float]]:
+        """
+        クエリとのコサイン類似度が高い順にIDを返す
+
+        Args:
+            query: 正規化済みのクエリベクトル
+            k: 返す件数
+
+        Returns:
+            (ID, 類似度) のリスト(類似度の高い順)
+        """
+        if self._size == 0 or k <= 0:
+            return []
+        scores = self._vectors[: self._size] @ np.asarray(query, dtype=np.float32)
+        # 上位k件だけを部分的に選んでから並べる(全件のソートを避ける)
+        top = np.argpartition(-scores, k - 1)[:k] if k < self._size else np.arange(self._size)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(self._ids[i]), float(scores[i])) for i in top]
+
+    def _reserve(self, size: int) -> None:
+        """行数がsize以上になるよう配列を広げる"""
+        capacity = len(self._ids)
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2, _MIN_CAPACITY)
+        vectors = np.zeros((capacity, self._dim), dtype=np.float32)
+        vectors[: self._size] = self._vectors[: self._size]
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[: self._size] = self._ids[: self._size]
+        self._vectors = vectors
+        self._ids = ids
+
+
+def _ngrams(text: str) -> list[str]:
+    """表記の揺れ(全角・半角、大文字・小文字、空白)を揃えて文字n-gramに分ける"""
+    normalized = " ".join(unicodedata.normalize("NFKC", text).lower().split())
+    return [
+        normalized[i : i + n]
+        for n in _NGRAM_SIZES
+        for i in range(len(normalized) - n + 1)
+        if " " not in normalized[i : i + n]
+    ]
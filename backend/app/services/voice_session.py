@@ -0,0 +1,388 @@
+"""音声対話のパイプライン(STT → Gemini → TTS を断片ごとにつなぐ)"""
+import asyncio
+import logging
+import os
+import re
+import tempfile
+import time
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from app.config import Settings
+from app.services.audio_io import UploadTooLargeError
+from app.services.metrics import VOICE_TURN_SECONDS
+from app.services.stt_pipeline import stream_transcribe_file
+
+if TYPE_CHECKING:
+    from app.services.audio_preprocess import AudioPreprocessor
+    from app.services.conversation import ConversationService
+    from app.services.gemini_service import GeminiService
+    from app.services.openai_service import OpenAIService, SpeechStream
+
+logger = logging.getLogger(__name__)
+
+# 文の終わり(句点・感嘆符・疑問符・改行と、それに続く閉じ括弧。全角の記号はエスケープで書く)。
+# 半角のピリオドは小数点などと区別するため、後ろに空白が続く場合だけ文末とみなす
+_SENTENCE_END = re.compile(r"[。\uff01\uff1f!?…\n]+[」』\uff09)\"']*|\.(?=\s)")
+# クライアントへ送る前に溜めておけるイベント数(音声の送信が詰まったら上流の読み出しも待たせる)
+_OUTBOX_SIZE = 64
+
+# クライアントへ送るイベント(JSONにする辞書、または音声データ)
+VoiceEvent = dict[str, Any] | bytes
+
+
+class VoicePipelineError(Exception):
+    """音声対話のいずれかの段階で失敗した場合の例外"""
+
+    def __init__(self, stage: str, error: Exception) -> None:
+        super().__init__(str(error))
+        self.stage = stage
+        self.error = error
+
+
+class SentenceSplitter:
+    """ストリーミングで届くテキストを文単位に区切るクラス
+
+    短すぎる文は次の文とまとめ、TTSの呼び出しが細切れにならないようにする。
+    """
+
+    def __init__(self, min_chars: int) -> None:
+        """
+        SentenceSplitterの初期化
+
+        Args:
+            min_chars: 1回の音声合成に渡す最小の文字数
+        """
+        self._min_chars = min_chars
+        self._buffer = ""
+
+    def feed(self, delta: str) -> list[str]:
+        """
+        テキストの断片を追加し、区切れた文を返す
+
+        Args:
+            delta: テキストの断片
+
+        Returns:
+            区切れた文のリスト(まだ文が完結していなければ空)
+        """
+        self._buffer += delta
+        sentences: list[str] = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            sentence = self._buffer[start:match.end()].strip()
+            if len(sentence) >= self._min_chars:
+                sentences.append(sentence)
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self) -> str | None:
+        """
+        残っているテキストを最後の文として返す
+
+        Returns:
+            最後の文(残りが無い場合はNone)
+        """
+        rest = self._buffer.strip()
+        self._buffer = ""
+        return rest or None
+
+
+class UtteranceBuffer:
+    """WebSocketで届く1発話分の音声をディスクへ退避するクラス"""
+
+    def __init__(self, max_bytes: int, suffix: str, spool_dir: str | None = None) -> None:
+        """
+        UtteranceBufferの初期化
+
+        Args:
+            max_bytes: 1発話で受け付ける最大バイト数
+            suffix: 一時ファイルの拡張子
+            spool_dir: 一時ファイルの保存先(Noneの場合はシステムの一時ディレクトリ)
+        """
+        self._max_bytes = max_bytes
+        self._suffix = suffix
+        self._spool_dir = spool_dir
+        self._path: Path | None = None
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        """受信済みのバイト数"""
+        return self._size
+
+    async def append(self, chunk: bytes) -> None:
+        """
+        音声の断片を追記する
+
+        Args:
+            chunk: 音声データの断片
+
+        Raises:
+            UploadTooLargeError: サイズが上限を超えた場合(受信済みの音声は破棄する)
+        """
+        if self._size + len(chunk) > self._max_bytes:
+            self.discard()
+            raise UploadTooLargeError(self._max_bytes)
+        if self._path is None:
+            fd, name = tempfile.mkstemp(prefix="voice-", suffix=self._suffix, dir=self._spool_dir or None)
+            os.close(fd)
+            self._path = Path(name)
+        path = self._path
+
+        def write() -> None:
+            with open(path, "ab") as out:
+                out.write(chunk)
+
+        await asyncio.to_thread(write)
+        self._size += len(chunk)
+
+    def take(self) -> Path | None:
+        """
+        受信済みの音声ファイルを取り出し、次の発話の受信に備える
+
+        Returns:
+            音声ファイルのパス(呼び出し側で削除すること)。音声が無い場合はNone
+        """
+        path, self._path, self._size = self._path, None, 0
+        return path
+
+    def discard(self) -> None:
+        """受信済みの音声を破棄する"""
+        path = self.take()
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+
+class VoiceSession:
+    """1つのWebSocket接続での音声対話を扱うクラス
+
+    1ターン(ユーザーの1発話)ごとに、文字起こし・応答生成・音声合成を段階ごとに逐次つなぐ。
+    応答の最初の文が完結した時点で音声合成を始め、後続の文も並行して先に合成を始めておく。
+    会話履歴はセッションIDを指定した場合はサーバー側のセッションに、
+    指定しない場合はこの接続の中だけで保持する。
+    """
+
+    def __init__(
+        self,
+        openai: "OpenAIService",
+        settings: Settings,
+        *,
+        gemini: "GeminiService | None" = None,
+        conversations: "ConversationService | None" = None,
+        session_id: str | None = None,
+        context: list[dict[str, Any]] | None = None,
+        messages: list[dict[str, str]] | None = None,
+        voice: str = "alloy",
+        audio_format: str = "mp3",
+        tts: bool = True,
+        preprocessor: "AudioPreprocessor | None" = None,
+    ) -> None:
+        """
+        VoiceSessionの初期化
+
+        Args:
+            openai: 文字起こしと音声合成に使うOpenAIService
+            settings: アプリケーション設定
+            gemini: 接続内で履歴を保持する場合の応答生成に使うGeminiService
+            conversations: セッションIDを指定する場合のConversationService
+            session_id: 会話セッションID(Noneの場合は接続内で履歴を保持する)
+            context: コンテキスト情報(イベント情報など)
+            messages: 接続内で保持する場合の、それまでの会話履歴
+            voice: 音声ボイス名
+            audio_format: 希望する音声フォーマット
+            tts: 応答を音声合成するか
+            preprocessor: 文字起こし前の音声の前処理
+
+        Raises:
+            ValueError: 応答生成に使うサービスが指定されていない場合
+        """
+        if session_id is not None and conversations is None:
+            raise ValueError("セッションIDを指定する場合はConversationServiceが必要です")
+        if session_id is None and gemini is None:
+            raise ValueError("GeminiServiceが必要です")
+        self._openai = openai
+        self._settings = settings
+        self._gemini = gemini
+        self._conversations = conversations
+        self._session_id = session_id
+        self._context = context
+        self._history: list[dict[str, str]] = list(messages or [])
+        self._voice = voice
+        self._audio_format = audio_format
+        self._tts = tts
+        self._preprocessor = preprocessor
+
+    async def run_turn(self, path: Path, filename: str, mime_type: str) -> AsyncGenerator[VoiceEvent, None]:
+        """
+        1発話分の音声から応答の音声までを処理し、得られた部分から順にイベントを返す
+
+        イベントの順序:
+            transcript.delta* → transcript.done → (reply.delta | audio.start, 音声データ*, audio.end)*
+            → reply.done → turn.done。応答のテキストと音声は並行して届く。
+        反復を途中でやめた場合(割り込み・切断)は、実行中の上流の呼び出しもすべて止める。
+
+        Args:
+            path: 発話の音声ファイル
+            filename: ファイル名
+            mime_type: MIMEタイプ
+
+        Yields:
+            クライアントへ送るイベント
+
+        Raises:
+            VoicePipelineError: いずれかの段階で失敗した場合
+        """
+        started = time.perf_counter()
+        timings: dict[str, float] = {}
+
+        def mark(milestone: str) -> None:
+            if milestone not in timings:
+                elapsed = time.perf_counter() - started
+                timings[milestone] = round(elapsed, 4)
+                VOICE_TURN_SECONDS.labels(milestone).observe(elapsed)
+
+        transcript = ""
+        try:
+            async for delta in stream_transcribe_file(
+                self._openai, path, filename, mime_type, self._settings, preprocessor=self._preprocessor
+            ):
+                mark("first_transcript")
+                transcript += delta
+                yield {"type": "transcript.delta", "delta": delta}
+        except Exception as e:
+            raise VoicePipelineError("stt", e) from e
+        transcript = transcript.strip()
+        mark("transcript_done")
+        yield {"type": "transcript.done", "text": transcript}
+        if transcript:
+            async for event in self._respond(transcript, mark):
+                yield event
+        mark("done")
+        yield {"type": "turn.done", "timings": timings}
+
+    async def _respond(self, transcript: str, mark: Callable[[str], None]) -> AsyncGenerator[VoiceEvent, None]:
+        """応答の生成と音声合成を並行して行い、イベントを返す"""
+        outbox: asyncio.Queue[VoiceEvent | VoicePipelineError | None] = asyncio.Queue(_OUTBOX_SIZE)
+        sentences: asyncio.Queue[str | None] = asyncio.Queue()
+        pending: asyncio.Queue[tuple[int, str, asyncio.Task[SpeechStream]] | None] = asyncio.Queue()
+        # 合成中(再生待ちを含む)の文の数の上限
+        slots = asyncio.Semaphore(self._settings.voice_tts_prefetch)
+
+        async def generate_reply() -> None:
+            splitter = SentenceSplitter(self._settings.voice_sentence_min_chars)
+            reply = ""
+            stream = self._reply_stream(transcript)
+            try:
+                async for delta in stream:
+                    mark("first_reply")
+                    reply += delta
+                    await outbox.put({"type": "reply.delta", "delta": delta})
+                    for sentence in splitter.feed(delta):
+                        mark("first_sentence")
+                        await sentences.put(sentence)
+            finally:
+                await stream.aclose()
+            rest = splitter.flush()
+            if rest:
+                await sentences.put(rest)
+            await sentences.put(None)
+            if self._session_id is None:
+                self._history += [
+                    {"role": "user", "content": transcript},
+                    {"role": "assistant", "content": reply},
+                ]
+            await outbox.put({"type": "reply.done", "text": reply})
+
+        async def open_speech() -> None:
+            index = 0
+            while (sentence := await sentences.get()) is not None:
+                await slots.acquire()
+                task = asyncio.create_task(
+                    self._openai.open_speech_stream(sentence, voice=self._voice, audio_format=self._audio_format)
+                )
+                await pending.put((index, sentence, task))
+                index += 1
+            await pending.put(None)
+
+        async def play_speech() -> None:
+            while (item := await pending.get()) is not None:
+                index, sentence, task = item
+                try:
+                    speech = await task
+                    try:
+                        await outbox.put(
+                            {"type": "audio.start", "index": index, "format": speech.audio_format, "text": sentence}
+                        )
+                        async for chunk in speech.iter_chunks():
+                            mark("first_audio")
+                            await outbox.put(chunk)
+                        await outbox.put({"type": "audio.end", "index": index})
+                    finally:
+                        await speech.aclose()
+                finally:
+                    slots.release()
+
+        async def run(stage: str, step: Awaitable[None]) -> None:
+            try:
+                await step
+            except Exception as e:
+                await outbox.put(VoicePipelineError(stage, e))
+                return
+            await outbox.put(None)
+
+        steps = [run("chat", generate_reply())]
+        if self._tts:
+            steps += [run("tts", open_speech()), run("tts", play_speech())]
+        else:
+            # 音声合成しない場合は区切った文を読み捨てる
+            steps.append(run("tts", _drain(sentences)))
+        tasks = [asyncio.create_task(step) for step in steps]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                item = await outbox.get()
+                if item is None:
+                    remaining -= 1
+                elif isinstance(item, VoicePipelineError):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # 割り込み・切断・失敗時は、生成と合成を止めて開いた音声ストリームを閉じる
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            while not pending.empty():
+                unplayed = pending.get_nowait()
+                if unplayed is not None:
+                    await _discard_speech(unplayed[2])
+
+    def _reply_stream(self, transcript: str) -> AsyncGenerator[str, None]:
+        """会話履歴の保持方法に応じて、応答の生成を開始する"""
+        if self._session_id is not None and self._conversations is not None:
+            context, self._context = self._context, None
+            return self._conversations.stream_message(self._session_id, transcript, context=context)
+        if self._gemini is None:
+            raise ValueError("GeminiServiceが必要です")
+        return self._gemini.stream_response(
+            user_message=transcript,
+            context=self._context,
+            messages_history=self._history or None,
+        )
+
+
+async def _drain(queue: "asyncio.Queue[str | None]") -> None:
+    """終わり(None)が届くまでキューを読み捨てる"""
+    while await queue.get() is not None:
+        pass
+
+
+async def _discard_speech(task: "asyncio.Task[SpeechStream]") -> None:
+    """再生しなかった音声合成を止め、開いていたストリームを閉じる"""
+    task.cancel()
+    (speech,) = await asyncio.gather(task, return_exceptions=True)
+    if not isinstance(speech, BaseException):
+        await speech.aclose()
@@ -0,0 +1 @@
+"""スタブ上流を使ったAPIの負荷ベンチマーク"""
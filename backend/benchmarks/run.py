@@ -0,0 +1,489 @@
+"""スタブ上流に対してAPIへ並行負荷をかけ、レイテンシ・スループット・メモリを計測する
+
+    uv run python -m benchmarks.run
+    uv run python -m benchmarks.run --scenarios chat,tts --concurrency 32 --requests 500
+    uv run python -m benchmarks.run --max-p99-ms 2000 --max-health-p99-ms 100 --max-rss-mb 300
+
+APIとOpenAIのスタブをそれぞれ別プロセスで起動し(ネットワークには接続しない)、
+シナリオごとに指定した並行数でリクエストを送る。計測中は /health を一定間隔で
+呼び出し、その応答時間をイベントループの詰まりの指標として報告する。
+閾値を指定した場合、超えたシナリオがあれば終了コード1で終了する(CI向け)。
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import httpx
+
+from benchmarks.stubs import StubProfile
+
+SCENARIOS = ("chat", "summarize", "stt", "stt_stream", "tts")
+
+_BACKEND_DIR = Path(__file__).resolve().parent.parent
+_HEALTH_INTERVAL_SECONDS = 0.1
+_CONTEXT = [
+    {"type": "event", "title": "チームミーティング", "start": "2025-01-10T10:00:00", "end": "2025-01-10T11:00:00"},
+    {"type": "event", "title": "歯医者", "start": "2025-01-10T17:30:00", "end": "2025-01-10T18:00:00"},
+    {"type": "event", "title": "旅行", "start": "2025-01-11", "end": "2025-01-13"},
+]
+
+
+@dataclass
+class ScenarioResult:
+    """1シナリオの計測結果"""
+
+    name: str
+    requests: int = 0
+    errors: int = 0
+    elapsed_seconds: float = 0.0
+    latencies_ms: list[float] = field(default_factory=list)
+    first_byte_ms: list[float] = field(default_factory=list)
+    health_ms: list[float] = field(default_factory=list)
+    rss_mb: float = 0.0
+    error_samples: list[str] = field(default_factory=list)
+
+    def summary(self) -> dict[str, float | int | str | list[str]]:
+        """報告用の集計値を返す"""
+        return {
+            "scenario": self.name,
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": self.errors / self.requests if self.requests else 0.0,
+            "rps": self.requests / self.elapsed_seconds if self.elapsed_seconds else 0.0,
+            "p50_ms": percentile(self.latencies_ms, 0.50),
+            "p95_ms": percentile(self.latencies_ms, 0.95),
+            "p99_ms": percentile(self.latencies_ms, 0.99),
+            "ttfb_p50_ms": percentile(self.first_byte_ms, 0.50),
+            "ttfb_p95_ms": percentile(self.first_byte_ms, 0.95),
+            "health_p99_ms": percentile(self.health_ms, 0.99),
+            "rss_mb": self.rss_mb,
+            "error_samples": self.error_samples,
+        }
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """
+    パーセンタイルを求める(最近傍法)
+
+    Args:
+        samples: 計測値
+        q: 求めるパーセンタイル(0〜1)
+
+    Returns:
+        パーセンタイル(計測値が無い場合は0)
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def make_wav(seconds: float) -> bytes:
+    """文字起こし用の無音のWAV(16kHz・モノラル・16bit)を作る"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(16000)
+        out.writeframes(b"\x00\x00" * int(16000 * seconds))
+    return buffer.getvalue()
+
+
+def _free_port() -> int:
+    """空いているローカルのポート番号を返す"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def _rss_mb(pid: int, field_name: str = "VmHWM") -> float:
+    """プロセスのメモリ使用量(MB)を返す(VmHWMは起動からの最大値、/procが無い環境では0)"""
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith(field_name + ":"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def _children_peak_rss_mb() -> float:
+    """終了した子プロセスの最大RSS(MB)を返す"""
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Processes:
+    """APIとOpenAIスタブのプロセスを起動・停止する"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self._args = args
+        self._procs: list[subprocess.Popen[bytes]] = []
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="audiodiary-bench-")
+        self.app_port = _free_port()
+        self.openai_port = _free_port()
+        self.app_pid = 0
+
+    def start(self) -> None:
+        """プロセスを起動する"""
+        gemini = StubProfile(
+            latency_ms=self._args.gemini_latency_ms,
+            jitter_ms=self._args.gemini_jitter_ms,
+            error_rate=self._args.gemini_error_rate,
+            stream_chunks=self._args.stream_chunks,
+            chunk_interval_ms=self._args.chunk_interval_ms,
+        )
+        openai = StubProfile(
+            latency_ms=self._args.openai_latency_ms,
+            jitter_ms=self._args.openai_jitter_ms,
+            error_rate=self._args.openai_error_rate,
+            stream_chunks=self._args.stream_chunks,
+            chunk_interval_ms=self._args.chunk_interval_ms,
+            audio_bytes=self._args.tts_audio_bytes,
+        )
+        env = {
+            **os.environ,
+            **gemini.to_env("BENCH_GEMINI_"),
+            **openai.to_env("BENCH_OPENAI_"),
+            "GEMINI_API_KEY": "bench",
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{self.openai_port}/v1",
+            "SESSION_STORE": "memory",
+            "STT_SPOOL_DIR": self._tmpdir.name,
+            "TTS_CACHE_DIR": "",
+            # 負荷はすべて同じクライアントから送るため、指定が無ければクライアントごとのレート制限は外す
+            "RATE_LIMIT_PER_MINUTE": os.environ.get("RATE_LIMIT_PER_MINUTE", "0"),
+            "PYTHONPATH": str(_BACKEND_DIR),
+        }
+        for target, port in (("openai", self.openai_port), ("app", self.app_port)):
+            proc = subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.server", target, "--port", str(port)],
+                cwd=_BACKEND_DIR,
+                env=env,
+            )
+            self._procs.append(proc)
+        self.app_pid = self._procs[-1].pid
+
+    async def wait_ready(self, timeout: float = 30.0) -> None:
+        """APIの /ready が準備完了を返すまで(起動時のウォームアップが終わるまで)待つ"""
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while True:
+                for proc in self._procs:
+                    if proc.poll() is not None:
+                        raise RuntimeError(f"ベンチマーク対象のプロセスが終了しました: {proc.args!r}")
+                try:
+                    response = await client.get(f"http://127.0.0.1:{self.app_port}/ready", timeout=1.0)
+                    if response.status_code == 200:
+                        return
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise TimeoutError("APIの起動待ちがタイムアウトしました")
+                await asyncio.sleep(0.1)
+
+    def stop(self) -> float:
+        """
+        プロセスを停止する
+
+        Returns:
+            APIプロセスの最大RSS(MB)
+        """
+        peak = _rss_mb(self.app_pid) if self.app_pid else 0.0
+        for proc in self._procs:
+            proc.terminate()
+        for proc in self._procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        self._tmpdir.cleanup()
+        return peak or _children_peak_rss_mb()
+
+
+class LoadDriver:
+    """シナリオごとのリクエストを並行して送り、計測する"""
+
+    def __init__(self, client: httpx.AsyncClient, args: argparse.Namespace) -> None:
+        self._client = client
+        self._args = args
+        self._audio = make_wav(args.audio_seconds)
+        self._seq = 0
+
+    def _next(self) -> int:
+        """リクエストごとに異なる通し番号(キャッシュに当たらないようにする)"""
+        self._seq += 1
+        return self._seq
+
+    def _request(self, scenario: str) -> Callable[[], Awaitable[tuple[float, float]]]:
+        """シナリオの1リクエストを送るコルーチン関数を返す"""
+        n = self._next()
+        if scenario == "chat":
+            return lambda: self._send("POST", "/api/v1/chat/message", json={
+                "content": f"今日の出来事を話します({n})",
+                "messages": [
+                    {"role": "user", "content": "こんにちは"},
+                    {"role": "assistant", "content": "こんにちは!今日はどんな一日でしたか?"},
+                ],
+                "context": _CONTEXT,
+            })
+        if scenario == "summarize":
+            lines = [
+                f"user: 今日は{i}番目の話題について話しました({n})\nassistant: それは楽しそうですね。"
+                for i in range(max(1, self._args.summary_chars // 40))
+            ]
+            return lambda: self._send("POST", "/api/v1/chat/summarize", json={"conversation": "\n".join(lines)})
+        if scenario in ("stt", "stt_stream"):
+            path = "/api/v1/stt/transcribe" + ("/stream" if scenario == "stt_stream" else "")
+            return lambda: self._send("POST", path, files={"file": (f"audio-{n}.wav", self._audio, "audio/wav")})
+        return lambda: self._send("POST", "/api/v1/tts/synthesize", json={
+            "text": f"今日も一日お疲れさまでした。({n})", "format": "mp3",
+        })
+
+    async def _send(self, method: str, path: str, **kwargs: object) -> tuple[float, float]:
+        """
+        リクエストを送り、応答本文を最後まで受け取る
+
+        Returns:
+            (最初の応答バイトまでの時間, 全体の時間) (ミリ秒)
+
+        Raises:
+            RuntimeError: エラー応答、またはSSEでエラーイベントを受け取った場合
+        """
+        started = time.perf_counter()
+        first_byte: float | None = None
+        body = bytearray()
+        async with self._client.stream(method, path, **kwargs) as response:  # type: ignore[arg-type]
+            async for chunk in response.aiter_bytes():
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+                body.extend(chunk)
+        ended = time.perf_counter()
+        if response.status_code >= 400:
+            raise RuntimeError(f"HTTP {response.status_code}: {bytes(body[:200]).decode(errors='replace')}")
+        if b"event: error" in body:
+            raise RuntimeError(f"SSE error: {bytes(body[-200:]).decode(errors='replace')}")
+        return ((first_byte or ended) - started) * 1000, (ended - started) * 1000
+
+    async def run(self, scenario: str, app_pid: int) -> ScenarioResult:
+        """
+        シナリオを実行する
+
+        Args:
+            scenario: シナリオ名
+            app_pid: RSSを計測するAPIのプロセスID
+
+        Returns:
+            計測結果
+        """
+        args = self._args
+        for _ in range(args.warmup):
+            with contextlib.suppress(Exception):
+                await self._request(scenario)()
+
+        result = ScenarioResult(scenario)
+        remaining = args.requests
+        stop_at = time.monotonic() + args.duration if args.duration else None
+        done = asyncio.Event()
+
+        async def worker() -> None:
+            nonlocal remaining
+            while not done.is_set():
+                if stop_at is not None:
+                    if time.monotonic() >= stop_at:
+                        return
+                elif remaining <= 0:
+                    return
+                else:
+                    remaining -= 1
+                try:
+                    first_byte, total = await self._request(scenario)()
+                    result.latencies_ms.append(total)
+                    result.first_byte_ms.append(first_byte)
+                except Exception as e:
+                    result.errors += 1
+                    if len(result.error_samples) < 3:
+                        result.error_samples.append(f"{type(e).__name__}: {e}"[:300])
+                result.requests += 1
+
+        async def probe_health() -> None:
+            while not done.is_set():
+                started = time.perf_counter()
+                try:
+                    await self._client.get("/health")
+                    result.health_ms.append((time.perf_counter() - started) * 1000)
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(_HEALTH_INTERVAL_SECONDS)
+
+        prober = asyncio.create_task(probe_health())
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        finally:
+            result.elapsed_seconds = time.perf_counter() - started
+            done.set()
+            await prober
+        result.rss_mb = _rss_mb(app_pid, "VmRSS")
+        return result
+
+
+def _print_report(results: list[ScenarioResult], peak_rss_mb: float, args: argparse.Namespace) -> None:
+    """計測結果を表形式で出力する"""
+    print(
+        f"\nconcurrency={args.concurrency} gemini={args.gemini_latency_ms:.0f}ms±{args.gemini_jitter_ms:.0f} "
+        f"(error {args.gemini_error_rate:.0%}) openai={args.openai_latency_ms:.0f}ms±{args.openai_jitter_ms:.0f} "
+        f"(error {args.openai_error_rate:.0%})"
+    )
+    header = (
+        f"{'scenario':<11}{'reqs':>7}{'errors':>8}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+        f"{'ttfb p50':>10}{'health p99':>12}{'rss MB':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        s = result.summary()
+        print(
+            f"{s['scenario']:<11}{s['requests']:>7}{s['errors']:>8}{s['rps']:>9.1f}"
+            f"{s['p50_ms']:>9.0f}{s['p95_ms']:>9.0f}{s['p99_ms']:>9.0f}"
+            f"{s['ttfb_p50_ms']:>10.0f}{s['health_p99_ms']:>12.1f}{s['rss_mb']:>9.1f}"
+        )
+        for sample in result.error_samples:
+            print(f"    {sample}")
+    print(f"peak RSS: {peak_rss_mb:.1f} MB (latency in ms)")
+
+
+def _print_startup(startup: dict[str, object]) -> None:
+    """APIの /ready が返した起動時間を出力する"""
+    phases = startup.get("phases") or {}
+    steps = startup.get("steps") or {}
+    first_success = startup.get("first_success") or {}
+    if not isinstance(phases, dict) or not isinstance(steps, dict) or not isinstance(first_success, dict):
+        return
+
+    def fmt(values: dict[str, float]) -> str:
+        return ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in values.items()) or "-"
+
+    print(f"startup ({startup.get('mode')}): {fmt(phases)}")
+    print(f"  warm-up steps: {fmt(steps)}")
+    print(f"  first success: {fmt(first_success)}")
+
+
+def _check_thresholds(results: list[ScenarioResult], peak_rss_mb: float, args: argparse.Namespace) -> list[str]:
+    """閾値を超えた項目の説明を返す"""
+    failures: list[str] = []
+    for result in results:
+        s = result.summary()
+        checks = (
+            ("p99_ms", args.max_p99_ms),
+            ("health_p99_ms", args.max_health_p99_ms),
+            ("error_rate", args.max_error_rate),
+        )
+        for key, limit in checks:
+            value = float(s[key])  # type: ignore[arg-type]
+            if limit is not None and value > limit:
+                failures.append(f"{result.name}: {key}={value:.3f} > {limit}")
+    if args.max_rss_mb is not None and peak_rss_mb > args.max_rss_mb:
+        failures.append(f"peak_rss_mb={peak_rss_mb:.1f} > {args.max_rss_mb}")
+    return failures
+
+
+async def _run(args: argparse.Namespace) -> int:
+    """ベンチマーク全体を実行し、終了コードを返す"""
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = sorted(set(scenarios) - set(SCENARIOS))
+    if unknown:
+        raise SystemExit(f"不明なシナリオ: {', '.join(unknown)}(指定できるのは {', '.join(SCENARIOS)})")
+
+    processes = Processes(args)
+    processes.start()
+    results: list[ScenarioResult] = []
+    peak_rss_mb = 0.0
+    startup: dict[str, object] = {}
+    try:
+        await processes.wait_ready()
+        limits = httpx.Limits(max_connections=args.concurrency + 2, max_keepalive_connections=args.concurrency + 2)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{processes.app_port}",
+            limits=limits,
+            timeout=httpx.Timeout(args.timeout),
+        ) as client:
+            driver = LoadDriver(client, args)
+            for scenario in scenarios:
+                results.append(await driver.run(scenario, processes.app_pid))
+            # 起動の各段階と、ルートごとの最初の成功応答までの時間
+            startup = (await client.get("/ready")).json()
+    finally:
+        peak_rss_mb = processes.stop()
+
+    _print_report(results, peak_rss_mb, args)
+    _print_startup(startup)
+    if args.json:
+        Path(args.json).write_text(json.dumps({
+            "config": {k: v for k, v in vars(args).items() if k != "json"},
+            "peak_rss_mb": peak_rss_mb,
+            "startup": startup,
+            "results": [r.summary() for r in results],
+            "raw": [asdict(r) for r in results] if args.json_raw else None,
+        }, ensure_ascii=False, indent=2))
+    failures = _check_thresholds(results, peak_rss_mb, args)
+    for failure in failures:
+        print(f"閾値超過: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def _parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = parser.add_argument_group("負荷")
+    load.add_argument("--scenarios", default=",".join(SCENARIOS), help="実行するシナリオ(カンマ区切り)")
+    load.add_argument("--concurrency", type=int, default=16, help="同時に送るリクエスト数")
+    load.add_argument("--requests", type=int, default=200, help="シナリオごとのリクエスト数")
+    load.add_argument("--duration", type=float, default=0.0, help="シナリオごとの実行秒数(指定時は--requestsより優先)")
+    load.add_argument("--warmup", type=int, default=3, help="計測前に送るリクエスト数")
+    load.add_argument("--timeout", type=float, default=120.0, help="1リクエストのタイムアウト(秒)")
+    load.add_argument("--audio-seconds", type=float, default=5.0, help="文字起こしに送る音声の長さ(秒)")
+    load.add_argument("--summary-chars", type=int, default=2000, help="要約する会話のおおよその文字数")
+
+    stub = parser.add_argument_group("スタブ")
+    stub.add_argument("--gemini-latency-ms", type=float, default=300.0)
+    stub.add_argument("--gemini-jitter-ms", type=float, default=100.0)
+    stub.add_argument("--gemini-error-rate", type=float, default=0.0)
+    stub.add_argument("--openai-latency-ms", type=float, default=200.0)
+    stub.add_argument("--openai-jitter-ms", type=float, default=50.0)
+    stub.add_argument("--openai-error-rate", type=float, default=0.0)
+    stub.add_argument("--stream-chunks", type=int, default=8, help="ストリーミング応答の断片数")
+    stub.add_argument("--chunk-interval-ms", type=float, default=30.0, help="ストリーミング応答の断片の間隔")
+    stub.add_argument("--tts-audio-bytes", type=int, default=32 * 1024, help="合成音声のバイト数")
+
+    report = parser.add_argument_group("報告・閾値")
+    report.add_argument("--json", help="結果をJSONで書き出すパス")
+    report.add_argument("--json-raw", action="store_true", help="JSONに個々の計測値も含める")
+    report.add_argument("--max-p99-ms", type=float, help="シナリオごとのp99の上限")
+    report.add_argument("--max-health-p99-ms", type=float, help="負荷中の /health のp99の上限(イベントループの詰まり)")
+    report.add_argument("--max-error-rate", type=float, help="シナリオごとのエラー率の上限(0〜1)")
+    report.add_argument("--max-rss-mb", type=float, help="APIプロセスの最大RSSの上限")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    sys.exit(asyncio.run(_run(_parse_args(argv))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""ベンチマーク対象のプロセスを起動する
+
+    python -m benchmarks.server app --port 8000     # Geminiをスタブに差し替えたAPI
+    python -m benchmarks.server openai --port 8001  # OpenAI STT/TTSのスタブ
+
+スタブの振る舞いは BENCH_GEMINI_* / BENCH_OPENAI_* 環境変数で指定する
+(benchmarks.stubs.StubProfile を参照)。通常は benchmarks.run から起動される。
+"""
+import argparse
+
+import uvicorn
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("target", choices=["app", "openai"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    args = parser.parse_args()
+
+    if args.target == "openai":
+        from benchmarks.stubs import StubProfile, create_openai_stub_app
+
+        app = create_openai_stub_app(StubProfile.from_env("BENCH_OPENAI_"))
+    else:
+        # GeminiServiceが生成するモデルをスタブにするため、アプリの読み込み前に差し替える
+        import google.generativeai as genai
+
+        from benchmarks.stubs import StubGenerativeModel
+
+        genai.GenerativeModel = StubGenerativeModel  # type: ignore[misc, assignment]
+        from app.main import app
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
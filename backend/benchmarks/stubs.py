@@ -0,0 +1,214 @@
+"""ベンチマーク用のGemini・OpenAI(STT/TTS)のスタブ
+
+どちらも実際の上流と同じ呼び出し経路(SDK・HTTP・SSE)を通るよう、
+Geminiは GenerativeModel の代わりに差し替えるクラス、OpenAIは
+OPENAI_BASE_URL で向き先を変えられるローカルHTTPサーバーとして実装する。
+"""
+import asyncio
+import json
+import os
+import random
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+from typing import Any
+
+from google.api_core import exceptions as google_exceptions
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+_REPLY_TEXT = "今日はいろいろなことがあったんですね。一番印象に残っているのはどんなことですか?"
+_TRANSCRIPT_TEXT = "今日は朝から会議があって、午後は友達とカフェに行きました。"
+
+
+@dataclass(frozen=True)
+class StubProfile:
+    """スタブの応答の振る舞い"""
+
+    latency_ms: float = 200.0
+    jitter_ms: float = 50.0
+    error_rate: float = 0.0
+    stream_chunks: int = 8
+    chunk_interval_ms: float = 30.0
+    audio_bytes: int = 32 * 1024
+
+    @classmethod
+    def from_env(cls, prefix: str) -> "StubProfile":
+        """
+        環境変数から読み込む(例: prefix="BENCH_GEMINI_" なら BENCH_GEMINI_LATENCY_MS など)
+
+        Args:
+            prefix: 環境変数名の接頭辞
+
+        Returns:
+            StubProfile
+        """
+        default = cls()
+
+        def read(name: str, value: float) -> float:
+            raw = os.getenv(prefix + name)
+            return float(raw) if raw else value
+
+        return cls(
+            latency_ms=read("LATENCY_MS", default.latency_ms),
+            jitter_ms=read("JITTER_MS", default.jitter_ms),
+            error_rate=read("ERROR_RATE", default.error_rate),
+            stream_chunks=max(1, int(read("STREAM_CHUNKS", default.stream_chunks))),
+            chunk_interval_ms=read("CHUNK_INTERVAL_MS", default.chunk_interval_ms),
+            audio_bytes=max(1, int(read("AUDIO_BYTES", default.audio_bytes))),
+        )
+
+    def to_env(self, prefix: str) -> dict[str, str]:
+        """from_env で読み込める環境変数の辞書を返す"""
+        return {
+            prefix + "LATENCY_MS": str(self.latency_ms),
+            prefix + "JITTER_MS": str(self.jitter_ms),
+            prefix + "ERROR_RATE": str(self.error_rate),
+            prefix + "STREAM_CHUNKS": str(self.stream_chunks),
+            prefix + "CHUNK_INTERVAL_MS": str(self.chunk_interval_ms),
+            prefix + "AUDIO_BYTES": str(self.audio_bytes),
+        }
+
+    async def wait_first_byte(self) -> None:
+        """最初の応答までの待ち時間(latency ± jitter)だけ待つ"""
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        await asyncio.sleep(max(0.0, delay) / 1000)
+
+    async def wait_chunk(self) -> None:
+        """ストリーミングの断片の間隔だけ待つ"""
+        await asyncio.sleep(self.chunk_interval_ms / 1000)
+
+    def should_fail(self) -> bool:
+        """今回の呼び出しを失敗させるか"""
+        return random.random() < self.error_rate
+
+
+def _split(text: str, parts: int) -> list[str]:
+    """テキストをおおよそ均等な断片に分ける"""
+    size = max(1, -(-len(text) // parts))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class _StubChunk:
+    """Geminiの応答(ストリーミングの断片)の代わり"""
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+class _StubStream:
+    """Geminiのストリーミング応答の代わり(async for で断片を返す)"""
+
+    def __init__(self, profile: StubProfile, text: str) -> None:
+        self._profile = profile
+        self._text = text
+
+    async def __aiter__(self) -> AsyncIterator[_StubChunk]:
+        for i, part in enumerate(_split(self._text, self._profile.stream_chunks)):
+            if i:
+                await self._profile.wait_chunk()
+            yield _StubChunk(part)
+
+
+class StubGenerativeModel:
+    """google.generativeai.GenerativeModel の代わりに使うスタブ
+
+    振る舞いは BENCH_GEMINI_* 環境変数で指定する。失敗させる場合は
+    実際の上流と同じく一時的な障害(503)として例外を送出する。
+    """
+
+    def __init__(self, model_name: str = "stub", **_: Any) -> None:
+        self.model_name = model_name
+        self._profile = StubProfile.from_env("BENCH_GEMINI_")
+
+    @classmethod
+    def from_cached_content(cls, cached_content: Any, **_: Any) -> "StubGenerativeModel":
+        return cls(getattr(cached_content, "model", "stub"))
+
+    async def count_tokens_async(self, contents: Any, **_: Any) -> Any:
+        await self._profile.wait_first_byte()
+        return _StubChunk("")
+
+    async def generate_content_async(self, contents: Any, stream: bool = False, **_: Any) -> Any:
+        await self._profile.wait_first_byte()
+        if self._profile.should_fail():
+            raise google_exceptions.ServiceUnavailable("stub: injected failure")
+        # 要約・日記の生成は少し長めの応答にする
+        text = _REPLY_TEXT * (3 if "日記" in str(contents) else 1)
+        if stream:
+            return _StubStream(self._profile, text)
+        return _StubChunk(text)
+
+
+def _error_response() -> JSONResponse:
+    """OpenAIの一時的な障害と同じ形式のエラー応答"""
+    return JSONResponse(
+        {"error": {"message": "stub: injected failure", "type": "server_error", "code": None}},
+        status_code=503,
+    )
+
+
+def create_openai_stub_app(profile: StubProfile) -> Starlette:
+    """
+    OpenAIの文字起こし・音声合成APIのスタブサーバーを作る
+
+    Args:
+        profile: 応答の振る舞い
+
+    Returns:
+        ASGIアプリ
+    """
+
+    async def transcriptions(request: Request) -> Response:
+        form = await request.form()
+        upload = form.get("file")
+        if upload is not None and not isinstance(upload, str):
+            await upload.read()
+        stream = str(form.get("stream", "")).lower() == "true"
+        await profile.wait_first_byte()
+        if profile.should_fail():
+            return _error_response()
+        if not stream:
+            return PlainTextResponse(_TRANSCRIPT_TEXT)
+
+        async def events() -> AsyncIterator[str]:
+            for i, part in enumerate(_split(_TRANSCRIPT_TEXT, profile.stream_chunks)):
+                if i:
+                    await profile.wait_chunk()
+                yield f"data: {json.dumps({'type': 'transcript.text.delta', 'delta': part})}\n\n"
+            yield f"data: {json.dumps({'type': 'transcript.text.done', 'text': _TRANSCRIPT_TEXT})}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def speech(request: Request) -> Response:
+        body = await request.json()
+        await profile.wait_first_byte()
+        if profile.should_fail():
+            return _error_response()
+        chunk = max(1, profile.audio_bytes // profile.stream_chunks)
+
+        async def audio() -> AsyncIterator[bytes]:
+            sent = 0
+            while sent < profile.audio_bytes:
+                if sent:
+                    await profile.wait_chunk()
+                size = min(chunk, profile.audio_bytes - sent)
+                yield b"\x00" * size
+                sent += size
+
+        fmt = body.get("response_format") or "mp3"
+        return StreamingResponse(audio(), media_type="audio/wav" if fmt == "wav" else "audio/mpeg")
+
+    async def models(request: Request) -> Response:
+        await profile.wait_first_byte()
+        return JSONResponse({"object": "list", "data": [
+            {"id": name, "object": "model", "created": 0, "owned_by": "stub"}
+            for name in ("gpt-4o-mini-transcribe", "gpt-4o-mini-tts")
+        ]})
+
+    return Starlette(routes=[
+        Route("/v1/models", models, methods=["GET"]),
+        Route("/v1/audio/transcriptions", transcriptions, methods=["POST"]),
+        Route("/v1/audio/speech", speech, methods=["POST"]),
+    ])
@@ -0,0 +1,148 @@
+"""受け付け制御のテスト"""
+from collections.abc import AsyncIterator
+
+import httpx
+import pytest
+from fastapi import FastAPI, File, UploadFile
+
+from app.services import admission
+from app.services.admission import (
+    AdmissionController,
+    AdmissionGate,
+    AdmissionMiddleware,
+    ByteBudget,
+    TokenBucketLimiter,
+)
+
+_MAX_UPLOAD_BYTES = 1024
+
+
+def _controller() -> AdmissionController:
+    gates = {name: AdmissionGate(name, 2, 2) for name in ("stt", "stt_batch")}
+    return AdmissionController(
+        gates,
+        None,
+        ByteBudget(10 * 1024 * 1024),
+        max_upload_bytes=_MAX_UPLOAD_BYTES,
+        queue_timeout=1.0,
+    )
+
+
+def _upload_app(received: list[int]) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/api/v1/stt/transcribe")
+    async def transcribe(file: UploadFile = File(...)) -> dict[str, int]:
+        data = await file.read()
+        received.append(len(data))
+        return {"size": len(data)}
+
+    app.add_middleware(AdmissionMiddleware, controller=_controller())
+    return app
+
+
+async def test_upload_without_content_length_is_cut_off_while_receiving() -> None:
+    received: list[int] = []
+    sent_chunks = 0
+
+    async def body() -> AsyncIterator[bytes]:
+        nonlocal sent_chunks
+        yield b'--b\r\nContent-Disposition: form-data; name="file"; filename="a.webm"\r\n\r\n'
+        for _ in range(1000):
+            sent_chunks += 1
+            yield b"x" * 1024
+        yield b"\r\n--b--\r\n"
+
+    transport = httpx.ASGITransport(app=_upload_app(received))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post(
+            "/api/v1/stt/transcribe",
+            content=body(),
+            headers={"Content-Type": "multipart/form-data; boundary=b"},
+        )
+
+    assert response.status_code == 413
+    assert received == []
+    # 上限(と multipart の余裕分)を超えた時点で受信を打ち切る
+    assert sent_chunks < 1000
+
+
+async def test_upload_within_limit_is_accepted() -> None:
+    received: list[int] = []
+    transport = httpx.ASGITransport(app=_upload_app(received))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post(
+            "/api/v1/stt/transcribe", files={"file": ("a.webm", b"x" * _MAX_UPLOAD_BYTES)}
+        )
+
+    assert response.status_code == 200
+    assert received == [_MAX_UPLOAD_BYTES]
+
+
+async def test_declared_content_length_over_limit_is_rejected_before_reading() -> None:
+    received: list[int] = []
+    transport = httpx.ASGITransport(app=_upload_app(received))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post(
+            "/api/v1/stt/transcribe", files={"file": ("a.webm", b"x" * (200 * 1024))}
+        )
+
+    assert response.status_code == 413
+    assert received == []
+
+
+class FakeClock:
+    """time.monotonic の代わりに進める時計"""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    fake = FakeClock()
+    monkeypatch.setattr(admission.time, "monotonic", fake)
+    return fake
+
+
+def test_token_bucket_allows_burst_then_limits(clock: FakeClock) -> None:
+    limiter = TokenBucketLimiter(rate_per_second=2.0, burst=3)
+
+    assert [limiter.acquire("a") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire("a") == pytest.approx(0.5)
+
+
+def test_token_bucket_refills_over_time(clock: FakeClock) -> None:
+    limiter = TokenBucketLimiter(rate_per_second=2.0, burst=3)
+    for _ in range(3):
+        limiter.acquire("a")
+
+    clock.now += 0.5
+    assert limiter.acquire("a") == 0.0
+    assert limiter.acquire("a") == pytest.approx(0.5)
+    # 長く空いても容量を超えては貯まらない
+    clock.now += 60.0
+    assert [limiter.acquire("a") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire("a") > 0.0
+
+
+def test_token_bucket_is_per_client(clock: FakeClock) -> None:
+    limiter = TokenBucketLimiter(rate_per_second=1.0, burst=1)
+
+    assert limiter.acquire("a") == 0.0
+    assert limiter.acquire("a") > 0.0
+    assert limiter.acquire("b") == 0.0
+
+
+def test_token_bucket_forgets_least_recent_client_over_limit(clock: FakeClock) -> None:
+    limiter = TokenBucketLimiter(rate_per_second=1.0, burst=1, max_clients=2)
+    limiter.acquire("a")
+    limiter.acquire("b")
+    limiter.acquire("c")
+
+    # 追い出されたaは満杯のバケットから始まる。残っているcは制限されたまま
+    assert limiter.acquire("a") == 0.0
+    assert limiter.acquire("c") > 0.0
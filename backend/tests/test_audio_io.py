@@ -0,0 +1,27 @@
+"""アップロードのディスク退避のテスト"""
+import io
+from pathlib import Path
+
+import pytest
+from fastapi import UploadFile
+
+from app.services.audio_io import UploadTooLargeError, spool_upload
+
+
+async def test_spool_upload_copies_whole_file(tmp_path: Path) -> None:
+    data = bytes(range(256)) * 100
+    upload = UploadFile(io.BytesIO(data), filename="voice.webm")
+    upload.file.seek(len(data))
+
+    path = await spool_upload(upload, max_bytes=len(data), chunk_bytes=1000, spool_dir=str(tmp_path))
+
+    assert path.suffix == ".webm"
+    assert path.read_bytes() == data
+
+
+async def test_spool_upload_rejects_oversized_file_and_removes_it(tmp_path: Path) -> None:
+    upload = UploadFile(io.BytesIO(b"x" * 5000), filename="voice.webm")
+
+    with pytest.raises(UploadTooLargeError):
+        await spool_upload(upload, max_bytes=4096, chunk_bytes=1024, spool_dir=str(tmp_path))
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,129 @@
+"""音声の前処理(無音の圧縮・サンプリングレート変換)のテスト"""
+import io
+import wave
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from app.services import audio_preprocess
+from app.services.audio_preprocess import (
+    AudioPreprocessor,
+    read_wav,
+    resample,
+    silence_keep_mask,
+    wav_to_pcm,
+)
+
+
+def _write_wav(path: Path, samples: np.ndarray, rate: int, channels: int = 1) -> None:
+    with wave.open(str(path), "wb") as out:
+        out.setnchannels(channels)
+        out.setsampwidth(2)
+        out.setframerate(rate)
+        out.writeframes(samples.astype("<i2").tobytes())
+
+
+def test_keep_mask_shortens_inner_silence_from_both_sides() -> None:
+    speech = np.array([1, 0, 0, 0, 0, 0, 0, 1], dtype=bool)
+
+    keep = silence_keep_mask(speech, 2)
+
+    assert keep.tolist() == [True, True, False, False, False, False, True, True]
+
+
+def test_keep_mask_leading_and_trailing_silence_keep_only_inner_side() -> None:
+    speech = np.array([0, 0, 0, 0, 1, 0, 0, 0, 0], dtype=bool)
+
+    keep = silence_keep_mask(speech, 2)
+
+    assert keep.tolist() == [False, False, False, True, True, True, False, False, False]
+
+
+def test_keep_mask_keeps_short_silence() -> None:
+    speech = np.array([1, 0, 1], dtype=bool)
+
+    assert silence_keep_mask(speech, 4).all()
+
+
+def test_resample_length_and_identity() -> None:
+    samples = np.arange(48000, dtype=np.float32)
+
+    assert len(resample(samples, 48000, 16000)) == 16000
+    assert len(resample(samples, 8000, 16000)) == 96000
+    assert resample(samples, 16000, 16000) is samples
+
+
+def test_resample_keeps_low_frequency_tone() -> None:
+    t = np.arange(48000) / 48000
+    tone = (10000 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+
+    out = resample(tone, 48000, 16000)
+
+    expected = 10000 * np.sin(2 * np.pi * 440 * np.arange(16000) / 16000)
+    assert np.abs(out[100:-100] - expected[100:-100]).max() < 500
+
+
+@pytest.mark.parametrize(("rate", "channels"), [(48000, 2), (44100, 1), (16000, 1), (8000, 1)])
+def test_wav_to_pcm_in_blocks_matches_whole_resample(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, rate: int, channels: int
+) -> None:
+    monkeypatch.setattr(audio_preprocess, "_BLOCK_SECONDS", 1)
+    rng = np.random.default_rng(0)
+    src = tmp_path / "in.wav"
+    _write_wav(src, rng.integers(-20000, 20000, int(rate * 2.5) * channels), rate, channels)
+    samples, src_rate = read_wav(src.read_bytes())
+    expected = np.clip(np.round(resample(samples, src_rate, 16000)), -32768, 32767)
+
+    out = io.BytesIO()
+    count = wav_to_pcm(src, out)
+
+    converted = np.frombuffer(out.getvalue(), dtype="<i2")
+    assert count == len(expected) == len(converted)
+    # ブロックごとに計算しても、浮動小数点の丸めの違いを除いて全体を変換した場合と一致する
+    assert np.abs(converted - expected).max() <= 1
+
+
+async def test_prepare_compresses_long_silence_and_keeps_pcm(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(audio_preprocess, "ffmpeg_available", lambda: False)
+    monkeypatch.setattr(audio_preprocess, "_BLOCK_SECONDS", 1)
+    rate = 16000
+    rng = np.random.default_rng(1)
+    speech = rng.integers(-12000, 12000, rate)
+    silence = rng.integers(-10, 10, rate * 5)
+    src = tmp_path / "in.wav"
+    _write_wav(src, np.concatenate([speech, silence, speech]), rate)
+    preprocessor = AudioPreprocessor(
+        codec="opus", threshold_dbfs=-45.0, max_silence_ms=600, opus_bitrate_kbps=32, spool_dir=str(tmp_path)
+    )
+
+    prepared = await preprocessor.prepare(src, "in.wav", "audio/wav")
+
+    assert prepared is not None
+    assert prepared.mime_type == "audio/wav"
+    assert prepared.original_seconds == pytest.approx(7.0)
+    assert prepared.processed_seconds == pytest.approx(2.6, abs=0.05)
+    assert prepared.pcm is not None
+    assert prepared.pcm.stat().st_size == round(prepared.processed_seconds * rate) * 2
+    with wave.open(str(prepared.path), "rb") as out:
+        assert out.getnframes() == prepared.pcm.stat().st_size // 2
+    # 一時ファイルは結果の2つだけが残り、cleanupで削除される
+    assert sorted(tmp_path.iterdir()) == sorted([src, prepared.path, prepared.pcm])
+    prepared.cleanup()
+    assert list(tmp_path.iterdir()) == [src]
+
+
+async def test_prepare_skips_audio_without_silence(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(audio_preprocess, "ffmpeg_available", lambda: False)
+    rng = np.random.default_rng(2)
+    src = tmp_path / "in.wav"
+    _write_wav(src, rng.integers(-12000, 12000, 16000 * 3), 16000)
+    preprocessor = AudioPreprocessor(
+        codec="wav", threshold_dbfs=-45.0, max_silence_ms=600, opus_bitrate_kbps=32, spool_dir=str(tmp_path)
+    )
+
+    assert await preprocessor.prepare(src, "in.wav", "audio/wav") is None
+    assert list(tmp_path.iterdir()) == [src]
+    assert preprocessor.stats()["skipped"] == 1
@@ -0,0 +1,54 @@
+"""負荷計測ハーネスのテスト(スタブ上流に対してすべてのシナリオが成功することを確認する)"""
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+from benchmarks.run import SCENARIOS, ScenarioResult, _check_thresholds, _parse_args, percentile
+
+_BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def test_percentile_nearest_rank() -> None:
+    samples = [float(v) for v in range(1, 101)]
+
+    assert percentile([], 0.99) == 0.0
+    assert percentile(samples, 0.50) == 50.0
+    assert percentile(samples, 0.99) == 99.0
+    assert percentile(samples, 1.0) == 100.0
+
+
+def test_check_thresholds_reports_exceeded_limits() -> None:
+    result = ScenarioResult("chat", requests=10, errors=1, elapsed_seconds=1.0, latencies_ms=[10.0] * 10)
+    args = _parse_args(["--max-p99-ms", "5", "--max-error-rate", "0.5", "--max-rss-mb", "100"])
+
+    failures = _check_thresholds([result], peak_rss_mb=200.0, args=args)
+
+    assert failures == ["chat: p99_ms=10.000 > 5.0", "peak_rss_mb=200.0 > 100.0"]
+
+
+def test_all_scenarios_succeed_against_stub_upstreams(tmp_path: Path) -> None:
+    report = tmp_path / "report.json"
+    completed = subprocess.run(
+        [
+            sys.executable, "-m", "benchmarks.run",
+            "--requests", "4",
+            "--concurrency", "2",
+            "--warmup", "1",
+            "--audio-seconds", "1",
+            "--gemini-latency-ms", "5", "--gemini-jitter-ms", "0",
+            "--openai-latency-ms", "5", "--openai-jitter-ms", "0",
+            "--chunk-interval-ms", "1",
+            "--max-error-rate", "0",
+            "--json", str(report),
+        ],
+        cwd=_BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        timeout=180,
+    )
+
+    assert completed.returncode == 0, completed.stderr[-2000:]
+    results = json.loads(report.read_text())["results"]
+    assert [r["scenario"] for r in results] == list(SCENARIOS)
+    assert all(r["requests"] == 4 and r["errors"] == 0 for r in results)
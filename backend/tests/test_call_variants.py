@@ -0,0 +1,105 @@
+"""呼び出し方式の選択と記憶のテスト"""
+from collections.abc import Awaitable, Callable
+
+import httpx
+import openai
+import pytest
+
+from app.services.call_variants import VariantSelector, is_capability_error
+
+
+def _status_error(status: int) -> openai.APIStatusError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/audio/speech")
+    return openai.APIStatusError("error", response=httpx.Response(status, request=request), body=None)
+
+
+class Variant:
+    """指定した結果を順に返す(例外の場合は送出する)呼び出し方式"""
+
+    def __init__(self, *outcomes: str | Exception) -> None:
+        self._outcomes = list(outcomes)
+        self.calls = 0
+
+    async def __call__(self) -> str:
+        self.calls += 1
+        outcome = self._outcomes.pop(0) if len(self._outcomes) > 1 else self._outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def _attempts(**variants: Variant) -> dict[str, Callable[[], Awaitable[str]]]:
+    return dict(variants)
+
+
+@pytest.mark.parametrize(
+    ("error", "expected"),
+    [
+        (TypeError("unexpected keyword"), True),
+        (_status_error(400), True),
+        (_status_error(422), True),
+        (_status_error(429), False),
+        (_status_error(503), False),
+        (TimeoutError(), False),
+        (RuntimeError("boom"), False),
+    ],
+)
+def test_is_capability_error(error: Exception, expected: bool) -> None:
+    assert is_capability_error(error) is expected
+
+
+async def test_falls_back_on_capability_error_and_remembers_choice() -> None:
+    selector = VariantSelector(["a", "b"], ttl_seconds=60)
+    a, b = Variant(_status_error(400)), Variant("from-b")
+
+    assert await selector.run("key", _attempts(a=a, b=b)) == "from-b"
+    assert await selector.run("key", _attempts(a=a, b=b)) == "from-b"
+    assert a.calls == 1
+    assert b.calls == 2
+    assert selector.stats()["choices"] == {"key": "b"}
+
+
+@pytest.mark.parametrize("error", [_status_error(429), _status_error(500), TimeoutError()])
+async def test_transient_error_is_raised_without_fallback(error: Exception) -> None:
+    selector = VariantSelector(["a", "b"], ttl_seconds=60)
+    a, b = Variant(error), Variant("from-b")
+
+    with pytest.raises(type(error)):
+        await selector.run("key", _attempts(a=a, b=b))
+    assert b.calls == 0
+    assert selector.stats()["choices"] == {}
+
+
+async def test_transient_error_on_remembered_variant_does_not_reprobe() -> None:
+    selector = VariantSelector(["a", "b"], ttl_seconds=60)
+    a, b = Variant("from-a", _status_error(503), "from-a"), Variant("from-b")
+
+    assert await selector.run("key", _attempts(a=a, b=b)) == "from-a"
+    with pytest.raises(openai.APIStatusError):
+        await selector.run("key", _attempts(a=a, b=b))
+    assert await selector.run("key", _attempts(a=a, b=b)) == "from-a"
+    assert b.calls == 0
+    assert selector.stats()["probes"] == 1
+
+
+async def test_new_capability_error_on_remembered_variant_reprobes_once() -> None:
+    selector = VariantSelector(["a", "b"], ttl_seconds=60)
+    a = Variant(_status_error(400))
+    b = Variant("from-b", TypeError("removed"), TypeError("removed"))
+
+    assert await selector.run("key", _attempts(a=a, b=b)) == "from-b"
+    # 記憶したbが新しい種類の例外で失敗したため再判定し、すべて使えなければ最後の例外を送出する
+    with pytest.raises(TypeError):
+        await selector.run("key", _attempts(a=a, b=b))
+    # 同じ種類の例外は再判定せずにそのまま送出する
+    with pytest.raises(TypeError):
+        await selector.run("key", _attempts(a=a, b=b))
+    assert selector.stats()["probes"] == 2
+
+
+async def test_expired_choice_is_reprobed() -> None:
+    selector = VariantSelector(["a", "b"], ttl_seconds=0)
+    a, b = Variant(_status_error(400), "from-a"), Variant("from-b")
+
+    assert await selector.run("key", _attempts(a=a, b=b)) == "from-b"
+    assert await selector.run("key", _attempts(a=a, b=b)) == "from-a"
@@ -0,0 +1,134 @@
+"""日記の保存先・ベクトル索引・関連日記の検索のテスト"""
+import gc
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from app.services.diary_service import DiaryService
+from app.services.diary_store import DiaryStore
+from app.services.vector_index import HashingEmbedder, VectorIndex, normalize_rows
+
+
+@pytest.fixture
+async def store(tmp_path: Path) -> AsyncIterator[DiaryStore]:
+    diary_store = DiaryStore(str(tmp_path / "diaries.db"))
+    yield diary_store
+    await diary_store.aclose()
+
+
+def _unit(*values: float) -> np.ndarray:
+    vector: np.ndarray = normalize_rows(np.array([values], dtype=np.float32))[0]
+    return vector
+
+
+def test_vector_index_returns_top_k_by_cosine_similarity() -> None:
+    index = VectorIndex(2)
+    index.add([1, 2, 3], normalize_rows(np.array([[1, 0], [1, 1], [0, 1]], dtype=np.float32)))
+
+    hits = index.search(_unit(1, 0.1), 2)
+
+    assert [item_id for item_id, _ in hits] == [1, 2]
+    assert hits[0][1] == pytest.approx(float(_unit(1, 0.1)[0]))
+    assert [item_id for item_id, _ in index.search(_unit(0, 1), 10)] == [3, 2, 1]
+
+
+def test_vector_index_remove_moves_last_row_and_add_replaces() -> None:
+    index = VectorIndex(2)
+    index.add([1, 2, 3], normalize_rows(np.array([[1, 0], [1, 1], [0, 1]], dtype=np.float32)))
+
+    assert index.remove(1)
+    assert not index.remove(1)
+    assert len(index) == 2
+    index.add([3], _unit(1, 0)[None, :])
+
+    assert [item_id for item_id, _ in index.search(_unit(1, 0), 1)] == [3]
+    assert len(index) == 2
+
+
+def test_vector_index_grows_capacity() -> None:
+    index = VectorIndex(4)
+    index.add(list(range(100)), normalize_rows(np.random.default_rng(0).normal(size=(100, 4))))
+
+    assert len(index) == 100
+    assert index.nbytes >= 100 * 4 * 4
+
+
+async def test_store_pages_newest_first_per_owner(store: DiaryStore) -> None:
+    for i in range(5):
+        await store.add("alice", f"日記{i}")
+    await store.add("bob", "別の人の日記")
+
+    first = await store.list_entries("alice", 2)
+    second = await store.list_entries("alice", 2, first.next_cursor)
+    last = await store.list_entries("alice", 2, second.next_cursor)
+
+    assert [e.content for e in first.items + second.items + last.items] == [f"日記{i}" for i in range(4, -1, -1)]
+    assert last.next_cursor is None
+    with pytest.raises(ValueError, match="cursor"):
+        await store.list_entries("alice", 2, "not-a-cursor")
+
+
+async def test_store_search_matches_all_terms_with_snippets(store: DiaryStore) -> None:
+    await store.add("alice", "今日は公園で桜を見ました")
+    await store.add("alice", "雨なので図書館で本を読みました")
+    await store.add("bob", "公園で桜を見た")
+
+    page = await store.search("alice", "公園 桜", 10)
+    short = await store.search("alice", "本", 10)
+
+    assert [e.content for e in page.items] == ["今日は公園で桜を見ました"]
+    assert page.snippets is not None
+    assert "公園" in page.snippets[0]
+    # 3文字未満の語はLIKEで検索する
+    assert [e.content for e in short.items] == ["雨なので図書館で本を読みました"]
+
+
+async def test_store_delete_is_scoped_to_owner_and_drops_embedding(store: DiaryStore) -> None:
+    entry = await store.add("alice", "削除する日記")
+    await store.save_embeddings("m", [(entry.seq, _unit(1, 0).tobytes())])
+
+    assert await store.delete("bob", entry.id) is None
+    assert await store.delete("alice", entry.id) == entry.seq
+    assert await store.get(entry.id) is None
+    assert await store.load_embeddings("alice", "m") == []
+
+
+async def test_service_related_indexes_pending_entries_per_owner(store: DiaryStore) -> None:
+    service = DiaryService(
+        store,
+        HashingEmbedder(256),
+        context_top_k=1,
+        context_min_score=0.0,
+        context_max_chars=100,
+        index_batch_size=2,
+        max_indexes=4,
+    )
+    for content in ("公園で桜を見た", "図書館で本を読んだ", "カレーを作った"):
+        await store.add("alice", content)
+    await store.add("bob", "公園で桜を見た")
+
+    hits = await service.related("alice", "桜の公園", 2)
+
+    assert hits[0][0].content == "公園で桜を見た"
+    assert all(entry.owner == "alice" for entry, _ in hits)
+    assert await service.context_for("alice", "桜の公園") == ["公園で桜を見た"]
+
+
+async def test_service_drops_locks_of_idle_owners(store: DiaryStore) -> None:
+    service = DiaryService(
+        store,
+        HashingEmbedder(64),
+        context_top_k=1,
+        context_min_score=0.0,
+        context_max_chars=100,
+        index_batch_size=8,
+        max_indexes=2,
+    )
+    for i in range(20):
+        await service.related(f"owner-{i}", "クエリ", 1)
+    gc.collect()
+
+    # 持ち主ごとのロックは使い終わると残らない(持ち主の数だけ増え続けない)
+    assert len(service._locks) == 0
@@ -0,0 +1,108 @@
+"""GeminiServiceのコンテキストキャッシュの切り替えのテスト"""
+from typing import Any
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from app.services import gemini_service
+from app.services.gemini_service import GeminiService
+
+_SYSTEM_PROMPT = "システムプロンプト"
+
+
+class FakeCacheCreator:
+    """指定どおりに失敗または成功するコンテキストキャッシュの作成"""
+
+    def __init__(self, errors: list[Exception | None]) -> None:
+        self._errors = errors
+        self.calls = 0
+
+    async def __call__(self, system_prompt: str) -> Any:
+        self.calls += 1
+        error = self._errors.pop(0)
+        if error is not None:
+            raise error
+        return "cached-model"
+
+
+@pytest.fixture
+def service(monkeypatch: pytest.MonkeyPatch) -> GeminiService:
+    monkeypatch.setenv("GEMINI_API_KEY", "test-key")
+    svc = GeminiService()
+    svc._context_cache_enabled = True
+    svc._context_cache_min_tokens = 0
+    return svc
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    fake = FakeClock()
+    monkeypatch.setattr(gemini_service.time, "monotonic", fake)
+    return fake
+
+
+@pytest.mark.parametrize(
+    "error",
+    [google_exceptions.ServiceUnavailable("busy"), google_exceptions.TooManyRequests("quota"), TimeoutError()],
+)
+async def test_transient_error_backs_off_then_retries(
+    service: GeminiService, clock: FakeClock, monkeypatch: pytest.MonkeyPatch, error: Exception
+) -> None:
+    creator = FakeCacheCreator([error, None])
+    monkeypatch.setattr(service, "_create_cached_model", creator)
+
+    model, prompt = await service._resolve_model(_SYSTEM_PROMPT, "会話")
+    assert model is service.model
+    assert prompt == f"{_SYSTEM_PROMPT}\n\n会話"
+
+    # 待機中はキャッシュの作成を試みない
+    await service._resolve_model(_SYSTEM_PROMPT, "会話")
+    assert creator.calls == 1
+
+    clock.now += 31
+    model, prompt = await service._resolve_model(_SYSTEM_PROMPT, "会話")
+    assert model == "cached-model"  # type: ignore[comparison-overlap]
+    assert prompt == "会話"
+    assert service._context_cache_enabled
+
+
+async def test_repeated_transient_errors_extend_backoff(
+    service: GeminiService, clock: FakeClock, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    creator = FakeCacheCreator([google_exceptions.ServiceUnavailable("busy")] * 2 + [None])
+    monkeypatch.setattr(service, "_create_cached_model", creator)
+
+    await service._resolve_model(_SYSTEM_PROMPT, "会話")
+    clock.now += 31
+    await service._resolve_model(_SYSTEM_PROMPT, "会話")
+    clock.now += 31
+    await service._resolve_model(_SYSTEM_PROMPT, "会話")
+    assert creator.calls == 2
+
+    clock.now += 30
+    assert (await service._resolve_model(_SYSTEM_PROMPT, "会話"))[1] == "会話"
+
+
+@pytest.mark.parametrize(
+    "error",
+    [google_exceptions.NotFound("model not found"), google_exceptions.InvalidArgument("unsupported"), AttributeError()],
+)
+async def test_capability_error_disables_caching(
+    service: GeminiService, monkeypatch: pytest.MonkeyPatch, error: Exception
+) -> None:
+    creator = FakeCacheCreator([error])
+    monkeypatch.setattr(service, "_create_cached_model", creator)
+
+    await service._resolve_model(_SYSTEM_PROMPT, "会話")
+    await service._resolve_model(_SYSTEM_PROMPT, "会話")
+
+    assert not service._context_cache_enabled
+    assert creator.calls == 1
@@ -0,0 +1,197 @@
+"""Idempotency-Keyによる結果の再利用のテスト"""
+import asyncio
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from app.api.v1 import idempotency as idempotency_api
+from app.api.v1 import tts
+from app.services import idempotency
+from app.services.idempotency import IdempotencyConflictError, IdempotencyStore, StoredResponse
+from app.services.tts_cache import TTSCache
+
+
+class SlowWork:
+    """呼び出し回数を数え、合図があるまで完了しない処理"""
+
+    def __init__(self, body: bytes = b"result") -> None:
+        self.calls = 0
+        self.release = asyncio.Event()
+        self._body = body
+
+    async def __call__(self) -> StoredResponse:
+        self.calls += 1
+        await self.release.wait()
+        return StoredResponse(body=self._body, media_type="text/plain")
+
+
+async def test_concurrent_retry_waits_for_original() -> None:
+    store = IdempotencyStore(ttl_seconds=60, max_bytes=1024)
+    work = SlowWork()
+    first = asyncio.create_task(store.run("s", "k", "fp", work))
+    second = asyncio.create_task(store.run("s", "k", "fp", work))
+    await asyncio.sleep(0)
+    work.release.set()
+
+    assert await first == (StoredResponse(body=b"result", media_type="text/plain"), False)
+    assert (await second)[1]
+    assert work.calls == 1
+    assert store.stats()["coalesced"] == 1
+
+
+async def test_completed_result_is_replayed() -> None:
+    store = IdempotencyStore(ttl_seconds=60, max_bytes=1024)
+    work = SlowWork()
+    work.release.set()
+    await store.run("s", "k", "fp", work)
+
+    response, replayed = await store.run("s", "k", "fp", work)
+
+    assert replayed
+    assert response.body == b"result"
+    assert work.calls == 1
+    # キーはルートごとに区別する
+    assert not (await store.run("other", "k", "fp", work))[1]
+
+
+async def test_same_key_with_different_request_conflicts() -> None:
+    store = IdempotencyStore(ttl_seconds=60, max_bytes=1024)
+    work = SlowWork()
+    work.release.set()
+    await store.run("s", "k", "fp", work)
+
+    with pytest.raises(IdempotencyConflictError):
+        await store.run("s", "k", "other", work)
+
+
+async def test_failure_releases_key() -> None:
+    store = IdempotencyStore(ttl_seconds=60, max_bytes=1024)
+
+    async def failing() -> StoredResponse:
+        raise RuntimeError("upstream")
+
+    with pytest.raises(RuntimeError):
+        await store.run("s", "k", "fp", failing)
+    work = SlowWork()
+    work.release.set()
+    assert not (await store.run("s", "k", "fp", work))[1]
+
+
+async def test_cancelled_caller_does_not_cancel_work() -> None:
+    store = IdempotencyStore(ttl_seconds=60, max_bytes=1024)
+    work = SlowWork()
+    first = asyncio.create_task(store.run("s", "k", "fp", work))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    work.release.set()
+
+    response, replayed = await store.run("s", "k", "fp", work)
+
+    assert replayed
+    assert response.body == b"result"
+    assert work.calls == 1
+
+
+async def test_expired_and_over_budget_results_are_dropped(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr(idempotency.time, "monotonic", lambda: now[0])
+    store = IdempotencyStore(ttl_seconds=10, max_bytes=10)
+    for key in ("a", "b"):
+        work = SlowWork(b"123456")
+        work.release.set()
+        await store.run("s", key, "fp", work)
+
+    # 上限を超えたため古いaが捨てられる
+    assert store.stats()["items"] == 1
+    assert store.stats()["bytes"] == 6
+    now[0] += 11
+    work = SlowWork()
+    work.release.set()
+    assert not (await store.run("s", "b", "fp", work))[1]
+
+
+class FakeOpenAI:
+    """音声合成の呼び出し回数を数えるOpenAIService"""
+
+    TTS_MODEL = "test-tts"
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    async def synthesize_speech(self, text: str, voice: str, audio_format: str) -> bytes:
+        self.calls += 1
+        return f"{text}:{voice}:{audio_format}".encode()
+
+
+def _tts_app(cache: TTSCache, monkeypatch: pytest.MonkeyPatch) -> tuple[FastAPI, FakeOpenAI, IdempotencyStore]:
+    service = FakeOpenAI()
+    store = IdempotencyStore(ttl_seconds=60, max_bytes=1024 * 1024)
+    monkeypatch.setattr(tts, "get_openai_service", lambda request: service)
+    monkeypatch.setattr(tts, "get_tts_cache", lambda request: cache)
+    monkeypatch.setattr(idempotency_api, "get_idempotency_store", lambda request: store)
+    app = FastAPI()
+    app.include_router(tts.router, prefix="/tts")
+    return app, service, store
+
+
+@pytest.fixture(params=["memory", "disk"])
+async def tts_client(
+    request: pytest.FixtureRequest, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> AsyncIterator[tuple[httpx.AsyncClient, FakeOpenAI, IdempotencyStore]]:
+    if request.param == "memory":
+        cache = TTSCache(max_memory_bytes=1024 * 1024)
+    else:
+        cache = TTSCache(max_memory_bytes=0, disk_dir=tmp_path, max_disk_bytes=1024 * 1024)
+    app, service, store = _tts_app(cache, monkeypatch)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client, service, store
+
+
+async def test_tts_replay_returns_stored_audio(
+    tts_client: tuple[httpx.AsyncClient, FakeOpenAI, IdempotencyStore],
+) -> None:
+    client, service, store = tts_client
+    payload = {"text": "こんにちは", "voice": "alloy", "format": "mp3"}
+    headers = {"Idempotency-Key": "key-1"}
+
+    first = await client.post("/tts/synthesize", json=payload, headers=headers)
+    second = await client.post("/tts/synthesize", json=payload, headers=headers)
+
+    audio = "こんにちは:alloy:mp3".encode()
+    assert first.status_code == second.status_code == 200
+    assert first.content == second.content == audio
+    assert first.headers["X-Cache"] == second.headers["X-Cache"] == "MISS"
+    assert "Idempotent-Replayed" not in first.headers
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert service.calls == 1
+    assert store.stats()["bytes"] == len(audio)
+
+
+async def test_tts_replay_after_cache_eviction_does_not_call_provider(monkeypatch: pytest.MonkeyPatch) -> None:
+    # 1件分しか入らないメモリだけのキャッシュで、元の音声を追い出してから再送する
+    app, service, _ = _tts_app(TTSCache(max_memory_bytes=20), monkeypatch)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        first = await client.post("/tts/synthesize", json={"text": "a"}, headers={"Idempotency-Key": "k"})
+        await client.post("/tts/synthesize", json={"text": "other text"})
+        replay = await client.post("/tts/synthesize", json={"text": "a"}, headers={"Idempotency-Key": "k"})
+
+    assert service.calls == 2
+    assert replay.content == first.content == b"a:alloy:mp3"
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert replay.headers["X-Cache"] == "MISS"
+
+
+async def test_tts_same_key_with_different_text_is_rejected(
+    tts_client: tuple[httpx.AsyncClient, FakeOpenAI, IdempotencyStore],
+) -> None:
+    client, _, _ = tts_client
+    headers = {"Idempotency-Key": "key-1"}
+    await client.post("/tts/synthesize", json={"text": "a"}, headers=headers)
+
+    response = await client.post("/tts/synthesize", json={"text": "b"}, headers=headers)
+
+    assert response.status_code == 422
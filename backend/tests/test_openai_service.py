@@ -0,0 +1,83 @@
+"""OpenAIServiceのストリーミング文字起こしの切り替えのテスト"""
+from collections.abc import AsyncIterator
+from types import SimpleNamespace
+from typing import Any
+
+import httpx
+import openai
+import pytest
+
+from app.config import get_settings
+from app.services.openai_service import OpenAIService
+
+
+def _bad_request(message: str, param: str | None = None) -> openai.BadRequestError:
+    response = httpx.Response(400, request=httpx.Request("POST", "https://api.openai.com/v1/audio/transcriptions"))
+    return openai.BadRequestError(message, response=response, body={"message": message, "param": param})
+
+
+class FakeTranscriptions:
+    """stream=Trueの呼び出しを指定どおりに失敗または成功させる"""
+
+    def __init__(self, errors: list[Exception | None]) -> None:
+        self._errors = errors
+        self.stream_calls = 0
+
+    async def create(self, **kwargs: Any) -> AsyncIterator[Any]:
+        assert kwargs["stream"] is True
+        self.stream_calls += 1
+        error = self._errors.pop(0)
+        if error is not None:
+            raise error
+
+        async def events() -> AsyncIterator[Any]:
+            yield SimpleNamespace(type="transcript.text.delta", delta="こんにちは")
+
+        return events()
+
+
+@pytest.fixture
+def service(monkeypatch: pytest.MonkeyPatch) -> OpenAIService:
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    svc = OpenAIService(get_settings())
+
+    async def transcribe_audio(*_args: Any, **_kwargs: Any) -> str:
+        return "全文"
+
+    monkeypatch.setattr(svc, "transcribe_audio", transcribe_audio)
+    return svc
+
+
+def _use(service: OpenAIService, transcriptions: FakeTranscriptions) -> None:
+    service.client = SimpleNamespace(audio=SimpleNamespace(transcriptions=transcriptions))  # type: ignore[assignment]
+
+
+async def _collect(service: OpenAIService) -> list[str]:
+    return [delta async for delta in service.stream_transcription_tokens(b"audio", "a.webm")]
+
+
+async def test_rejected_file_falls_back_for_that_request_only(service: OpenAIService) -> None:
+    transcriptions = FakeTranscriptions([None, _bad_request("Invalid file format."), None])
+    _use(service, transcriptions)
+
+    assert await _collect(service) == ["こんにちは"]
+    assert await _collect(service) == ["全文"]
+    assert await _collect(service) == ["こんにちは"]
+    assert transcriptions.stream_calls == 3
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        TypeError("create() got an unexpected keyword argument 'stream'"),
+        _bad_request("Invalid value.", param="stream"),
+        _bad_request("Streaming is not supported for this model."),
+    ],
+)
+async def test_capability_error_disables_streaming(service: OpenAIService, error: Exception) -> None:
+    transcriptions = FakeTranscriptions([error])
+    _use(service, transcriptions)
+
+    assert await _collect(service) == ["全文"]
+    assert await _collect(service) == ["全文"]
+    assert transcriptions.stream_calls == 1
@@ -0,0 +1,119 @@
+"""プロンプトの組み立てとイベント情報の選択のテスト"""
+from datetime import UTC, datetime, timedelta
+from typing import Any
+
+import pytest
+
+from app.services.prompt_assembler import PromptAssembler
+from app.services.tokens import estimate_tokens
+
+
+class CountingFormatter:
+    """整形した回数を数えるイベントの整形関数"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def __call__(self, event: dict[str, Any]) -> str:
+        self.calls += 1
+        return f"- {event['summary']}: {event.get('description', '')}"
+
+
+def _events_block(events: list[dict[str, Any]]) -> str:
+    return "\n\nイベント:\n" + "\n".join(f"- {e['summary']}" for e in events)
+
+
+def _assembler(budget: int = 200, event_share: float = 0.5) -> PromptAssembler:
+    return PromptAssembler(
+        token_budget=budget, event_share=event_share, keep_recent_messages=2, condensed_message_tokens=10
+    )
+
+
+def _assemble(
+    assembler: PromptAssembler,
+    message: str,
+    events: list[dict[str, Any]] | None = None,
+    history: list[dict[str, str]] | None = None,
+    summary: str | None = None,
+    diaries: list[str] | None = None,
+    format_event: CountingFormatter | None = None,
+) -> Any:
+    return assembler.assemble(
+        instructions="指示",
+        user_message=message,
+        context=events,
+        messages_history=history,
+        history_summary=summary,
+        past_diaries=diaries,
+        format_event=format_event or CountingFormatter(),
+        events_block=_events_block,
+    )
+
+
+def test_everything_fits_without_omission() -> None:
+    events = [{"summary": "散歩"}]
+    history = [{"role": "user", "content": "こんにちは"}, {"role": "assistant", "content": "やあ"}]
+
+    assembled = _assemble(_assembler(), "元気?", events, history, summary="前回の要約", diaries=["日記"])
+
+    assert assembled.omitted == {}
+    assert assembled.system_prompt == "指示" + _events_block(events)
+    assert "前回の要約" in assembled.conversation
+    assert "- 日記" in assembled.conversation
+    assert assembled.conversation.endswith("ユーザー: 元気?\nアシスタント:")
+
+
+def test_events_over_share_keep_most_relevant_in_original_order() -> None:
+    now = datetime.now(UTC)
+    events: list[dict[str, Any]] = [
+        {"summary": f"会議{i}", "description": "定例の打ち合わせ" * 3, "start": (now - timedelta(days=60)).isoformat()}
+        for i in range(10)
+    ]
+    events[3] = {"summary": "水族館", "description": "ペンギンを見た", "start": (now - timedelta(days=1)).isoformat()}
+    events[7] = {"summary": "水族館のカフェ", "description": "ペンギンのケーキ"}
+
+    assembled = _assemble(_assembler(budget=100, event_share=0.3), "水族館のペンギンがかわいかった", events)
+    kept = [line.removeprefix("- ") for line in assembled.system_prompt.splitlines()[3:]]
+
+    assert kept == ["水族館", "水族館のカフェ"]
+    assert assembled.omitted["events"] == 8
+    assert assembled.usage["events"] <= 30 + estimate_tokens("\n\nイベント:")
+
+
+def test_event_lines_are_formatted_once_per_context() -> None:
+    assembler = _assembler(budget=100, event_share=0.3)
+    formatter = CountingFormatter()
+    events = [{"summary": f"予定{i}", "description": "説明" * 5} for i in range(8)]
+
+    for message in ("一つ目", "二つ目", "三つ目"):
+        _assemble(assembler, message, events, format_event=formatter)
+
+    assert formatter.calls == len(events)
+    _assemble(assembler, "別のcontext", [*events, {"summary": "追加"}], format_event=formatter)
+    assert formatter.calls == 2 * len(events) + 1
+
+
+def test_old_history_is_condensed_and_dropped_newest_first() -> None:
+    history = [{"role": "user", "content": f"発言{i}" + "あ" * 30} for i in range(10)]
+
+    assembled = _assemble(_assembler(budget=130), "質問", history=history)
+
+    # 直近2件はそのまま、古い発言は短縮して新しい順に入るだけ含める
+    assert history[-1]["content"] in assembled.conversation
+    assert history[-2]["content"] in assembled.conversation
+    assert assembled.omitted["history"] > 0
+    assert assembled.omitted["history_condensed"] > 0
+    assert "発言7" in assembled.conversation
+    assert "発言0" not in assembled.conversation
+    assert assembled.total_tokens <= 130
+
+
+@pytest.mark.parametrize("budget", [0, -1])
+def test_no_budget_keeps_everything(budget: int) -> None:
+    events = [{"summary": f"予定{i}", "description": "説明" * 50} for i in range(20)]
+    history = [{"role": "user", "content": "あ" * 200} for _ in range(10)]
+
+    assembled = _assemble(_assembler(budget=budget), "質問", events, history)
+
+    assert assembled.omitted == {}
+    assert assembled.budget == 0
@@ -0,0 +1,182 @@
+"""上流呼び出しの保護(リトライ・ヘッジ・サーキットブレーカー)のテスト"""
+import asyncio
+import time
+
+import pytest
+
+from app.services.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ResiliencePolicy,
+    UpstreamGuard,
+    is_transient,
+)
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int) -> None:
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def _policy(**overrides: object) -> ResiliencePolicy:
+    values: dict[str, object] = {
+        "max_retries": 2,
+        "base_delay_seconds": 0.0,
+        "max_delay_seconds": 0.0,
+        "failure_threshold": 3,
+        "reset_seconds": 60.0,
+    }
+    values.update(overrides)
+    return ResiliencePolicy(**values)  # type: ignore[arg-type]
+
+
+def test_is_transient() -> None:
+    assert is_transient(TimeoutError())
+    assert is_transient(StatusError(429))
+    assert is_transient(StatusError(503))
+    assert not is_transient(StatusError(400))
+    assert not is_transient(ValueError())
+
+
+async def test_retries_transient_errors_until_success() -> None:
+    guard = UpstreamGuard("Test", _policy())
+    calls = 0
+
+    async def attempt() -> str:
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            raise StatusError(503)
+        return "ok"
+
+    assert await guard.call("op", attempt, deadline=5) == "ok"
+    assert calls == 3
+    assert guard.stats()["retries"] == 2
+
+
+async def test_does_not_retry_permanent_errors() -> None:
+    guard = UpstreamGuard("Test", _policy())
+    calls = 0
+
+    async def attempt() -> str:
+        nonlocal calls
+        calls += 1
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        await guard.call("op", attempt, deadline=5)
+    assert calls == 1
+    assert guard.stats()["circuit"] == {"state": "closed", "consecutive_failures": 0, "rejected": 0}
+
+
+async def test_deadline_bounds_total_time() -> None:
+    guard = UpstreamGuard("Test", _policy())
+
+    async def attempt() -> str:
+        await asyncio.sleep(10)
+        return "late"
+
+    started = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        await guard.call("op", attempt, deadline=0.05)
+    assert time.perf_counter() - started < 1
+
+
+async def test_circuit_opens_after_consecutive_failures() -> None:
+    guard = UpstreamGuard("Test", _policy(max_retries=0, failure_threshold=2))
+
+    async def failing() -> str:
+        raise StatusError(503)
+
+    for _ in range(2):
+        with pytest.raises(StatusError):
+            await guard.call("op", failing, deadline=5)
+
+    async def never_called() -> str:
+        raise AssertionError("circuit should be open")
+
+    with pytest.raises(CircuitOpenError):
+        await guard.call("op", never_called, deadline=5)
+
+
+def test_circuit_half_open_allows_single_trial(monkeypatch: pytest.MonkeyPatch) -> None:
+    breaker = CircuitBreaker("Test", failure_threshold=1, reset_seconds=10)
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+async def _warm_up(guard: UpstreamGuard, seconds: float, samples: int = 5) -> None:
+    """ヘッジの判定に必要な呼び出し時間のサンプルを作る"""
+
+    async def attempt() -> str:
+        await asyncio.sleep(seconds)
+        return "warm"
+
+    for _ in range(samples):
+        await guard.call("op", attempt, deadline=5, hedge=True)
+
+
+async def test_slow_call_is_hedged_and_faster_copy_wins() -> None:
+    guard = UpstreamGuard("Test", _policy(hedge_enabled=True, hedge_min_samples=5))
+    await _warm_up(guard, 0.01)
+    calls = 0
+
+    async def attempt() -> str:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(5)
+            return "slow"
+        return "fast"
+
+    assert await guard.call("op", attempt, deadline=5, hedge=True) == "fast"
+    stats = guard.stats()
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+
+
+async def test_hedge_survives_cancelled_attempt() -> None:
+    guard = UpstreamGuard("Test", _policy(max_retries=0, hedge_enabled=True, hedge_min_samples=5))
+    await _warm_up(guard, 0.01)
+    calls = 0
+
+    async def attempt() -> str:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(0.05)
+            # SDKの内部でキャンセルされた場合など
+            raise asyncio.CancelledError
+        await asyncio.sleep(0.1)
+        return "hedged"
+
+    assert await guard.call("op", attempt, deadline=5, hedge=True) == "hedged"
+
+
+async def test_waiting_for_slot_does_not_trigger_hedge() -> None:
+    guard = UpstreamGuard("Test", _policy(hedge_enabled=True, hedge_min_samples=5))
+    slot = asyncio.Semaphore(1)
+    await _warm_up(guard, 0.01)
+
+    async def attempt() -> str:
+        await asyncio.sleep(0.005)
+        return "ok"
+
+    # 枠が空くまで(p95の何倍もの時間)待たされても、確保後にすぐ終わればヘッジしない
+    await slot.acquire()
+    call = asyncio.create_task(guard.call("op", attempt, deadline=5, hedge=True, slot=slot))
+    await asyncio.sleep(0.2)
+    slot.release()
+
+    assert await call == "ok"
+    assert guard.stats()["hedges"] == 0
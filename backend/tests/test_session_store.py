@@ -0,0 +1,126 @@
+"""会話セッションの保存先と履歴の圧縮のテスト"""
+import asyncio
+import sqlite3
+from collections.abc import AsyncIterator
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from app.services.conversation import ConversationService
+from app.services.session_store import (
+    InMemorySessionStore,
+    SessionNotFoundError,
+    SessionStore,
+    SQLiteSessionStore,
+)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+async def store(request: pytest.FixtureRequest, tmp_path: Path) -> AsyncIterator[SessionStore]:
+    if request.param == "memory":
+        s: SessionStore = InMemorySessionStore(max_sessions=3, idle_ttl_seconds=60)
+    else:
+        s = SQLiteSessionStore(str(tmp_path / "sessions.db"), max_sessions=3, idle_ttl_seconds=60)
+    yield s
+    await s.aclose()
+
+
+async def test_append_and_compact(store: SessionStore) -> None:
+    session = await store.create([{"summary": "会議"}])
+    await store.append(session.id, [{"role": "user", "content": f"m{i}"} for i in range(5)])
+    await store.compact(session.id, "要約", 3)
+
+    loaded = await store.get(session.id)
+    assert loaded is not None
+    assert loaded.summary == "要約"
+    assert [m["content"] for m in loaded.messages] == ["m3", "m4"]
+    assert loaded.context == [{"summary": "会議"}]
+
+
+async def test_missing_session_raises(store: SessionStore) -> None:
+    assert await store.get("missing") is None
+    with pytest.raises(SessionNotFoundError):
+        await store.append("missing", [{"role": "user", "content": "x"}])
+
+
+async def test_oldest_sessions_are_evicted_over_limit(store: SessionStore) -> None:
+    ids = []
+    for _ in range(4):
+        ids.append((await store.create()).id)
+        # SQLiteは更新日時の順に削除するため、作成日時をずらす
+        await asyncio.sleep(0.01)
+
+    assert await store.get(ids[0]) is None
+    for sid in ids[1:]:
+        assert await store.get(sid) is not None
+
+
+def _age(store: SessionStore, session_id: str, seconds: float) -> None:
+    """セッションの最終更新日時を過去にずらす"""
+    if isinstance(store, InMemorySessionStore):
+        store._sessions[session_id].updated_at -= seconds
+    else:
+        assert isinstance(store, SQLiteSessionStore)
+        with store._conn:
+            store._conn.execute(
+                "UPDATE sessions SET updated_at = updated_at - ? WHERE id = ?", (seconds, session_id)
+            )
+
+
+async def test_idle_sessions_expire(store: SessionStore) -> None:
+    old = await store.create()
+    recent = await store.create()
+    _age(store, old.id, 120)
+
+    assert await store.get(old.id) is None
+    assert await store.get(recent.id) is not None
+
+
+async def test_sqlite_prunes_rows_and_messages_on_create(tmp_path: Path) -> None:
+    db_path = tmp_path / "sessions.db"
+    store = SQLiteSessionStore(str(db_path), max_sessions=10, idle_ttl_seconds=60)
+    old = await store.create()
+    await store.append(old.id, [{"role": "user", "content": "古い発言"}])
+    _age(store, old.id, 120)
+    await store.create()
+    await store.aclose()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM session_messages").fetchone()[0] == 0
+    finally:
+        conn.close()
+
+
+class FakeGemini:
+    """応答と要約を固定の文字列で返す"""
+
+    def __init__(self) -> None:
+        self.summarized: list[list[dict[str, str]]] = []
+
+    async def generate_response(self, user_message: str, **_kwargs: Any) -> str:
+        return "応答" * 50
+
+    async def summarize_history(self, summary: str, messages: list[dict[str, str]]) -> str:
+        self.summarized.append(messages)
+        return f"{summary}+{len(messages)}"
+
+
+async def test_conversation_compacts_history_over_budget() -> None:
+    store = InMemorySessionStore()
+    gemini = FakeGemini()
+    service = ConversationService(store, gemini, history_token_budget=100, keep_recent_messages=2)  # type: ignore[arg-type]
+    session = await service.create_session()
+
+    for i in range(3):
+        await service.send_message(session.id, f"メッセージ{i}")
+    await asyncio.gather(*service._compactions.values())
+
+    loaded = await service.get_session(session.id)
+    assert gemini.summarized
+    assert len(loaded.messages) == 2
+    assert loaded.messages[0]["content"] == "メッセージ2"
+    assert loaded.summary.startswith("+")
+    await service.aclose()
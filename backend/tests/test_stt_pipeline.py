@@ -0,0 +1,63 @@
+"""長時間録音の区間分割と重複除去のテスト"""
+from itertools import pairwise
+
+import pytest
+
+from app.services.stt_pipeline import merge_overlapping_transcripts, plan_segments
+
+
+def test_plan_segments_short_audio_is_single_segment() -> None:
+    assert plan_segments(30.0, 120.0, 2.0) == [(0.0, 30.0)]
+
+
+def test_plan_segments_overlap_and_cover_whole_audio() -> None:
+    segments = plan_segments(250.0, 100.0, 10.0)
+
+    assert segments == [(0.0, 100.0), (90.0, 100.0), (180.0, 70.0)]
+    for (start, length), (next_start, _) in pairwise(segments):
+        assert next_start < start + length
+    last_start, last_length = segments[-1]
+    assert last_start + last_length == pytest.approx(250.0)
+
+
+def test_plan_segments_ends_exactly_at_boundary() -> None:
+    assert plan_segments(190.0, 100.0, 10.0) == [(0.0, 100.0), (90.0, 100.0)]
+
+
+def test_plan_segments_overlap_larger_than_segment_still_advances() -> None:
+    segments = plan_segments(5.0, 2.0, 5.0)
+
+    assert [start for start, _ in segments] == [0.0, 1.0, 2.0, 3.0]
+
+
+def test_plan_segments_empty_audio() -> None:
+    assert plan_segments(0.0, 100.0, 10.0) == []
+
+
+def test_merge_removes_japanese_overlap() -> None:
+    texts = ["今日は朝から雨が降っていたので家で本を読んでいました", "家で本を読んでいました。午後は晴れました"]
+
+    assert merge_overlapping_transcripts(texts) == "今日は朝から雨が降っていたので家で本を読んでいました。午後は晴れました"
+
+
+def test_merge_tolerates_cut_word_at_boundary() -> None:
+    texts = ["we walked to the park and then we", "and then we went home for lunch"]
+
+    assert merge_overlapping_transcripts(texts) == "we walked to the park and then we went home for lunch"
+
+
+def test_merge_without_overlap_joins_with_separator() -> None:
+    assert merge_overlapping_transcripts(["good morning.", "See you later."]) == "good morning. See you later."
+    assert merge_overlapping_transcripts(["最初の区間。", "次の区間。"]) == "最初の区間。次の区間。"
+
+
+def test_merge_ignores_distant_coincidental_match() -> None:
+    # 一致部分が境界から遠い場合は重複とみなさない
+    prev = "ABCDEFGHIJ" + "x" * 30
+    text = "y" * 30 + "ABCDEFGHIJ"
+
+    assert merge_overlapping_transcripts([prev, text]) == prev + " " + text
+
+
+def test_merge_skips_empty_segments() -> None:
+    assert merge_overlapping_transcripts(["", "  テキスト  ", ""]) == "テキスト"
@@ -0,0 +1,73 @@
+"""会話履歴の階層的な要約のテスト"""
+import asyncio
+
+from app.services.summarizer import ConversationSummarizer
+
+
+class FakeGemini:
+    """呼び出しを記録し、入力に応じた短い文字列を返す"""
+
+    def __init__(self) -> None:
+        self.calls: list[str] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def _call(self, name: str) -> None:
+        self.calls.append(name)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+
+    async def summarize_conversation(self, conversation: str) -> str:
+        await self._call("direct")
+        return "日記"
+
+    async def summarize_chunk(self, chunk: str, index: int, total: int) -> str:
+        await self._call("chunk")
+        return f"要点{index}" + "x" * 40
+
+    async def merge_notes(self, notes: list[str]) -> str:
+        await self._call("merge")
+        return "統合" + "x" * 40
+
+    async def write_diary_from_notes(self, notes: str) -> str:
+        await self._call("diary")
+        return "長い日記"
+
+
+def _conversation(lines: int) -> str:
+    return "\n".join(f"ユーザー: 今日の出来事その{i}について話しました" for i in range(lines))
+
+
+async def test_short_conversation_uses_single_call() -> None:
+    gemini = FakeGemini()
+    summarizer = ConversationSummarizer(gemini, chunk_tokens=1000, fan_out=4, cache_size=8)  # type: ignore[arg-type]
+
+    assert await summarizer.summarize(_conversation(3)) == "日記"
+    assert gemini.calls == ["direct"]
+
+
+async def test_long_conversation_is_map_reduced_with_bounded_fan_out() -> None:
+    gemini = FakeGemini()
+    summarizer = ConversationSummarizer(gemini, chunk_tokens=60, fan_out=2, cache_size=8)  # type: ignore[arg-type]
+
+    assert await summarizer.summarize(_conversation(30)) == "長い日記"
+    assert gemini.calls.count("chunk") > 2
+    assert "merge" in gemini.calls
+    assert gemini.calls[-1] == "diary"
+    assert gemini.max_in_flight <= 2
+
+
+async def test_same_conversation_is_cached_and_coalesced() -> None:
+    gemini = FakeGemini()
+    summarizer = ConversationSummarizer(gemini, chunk_tokens=1000, fan_out=4, cache_size=8)  # type: ignore[arg-type]
+    conversation = _conversation(3)
+
+    await asyncio.gather(summarizer.summarize(conversation), summarizer.summarize(conversation))
+    await summarizer.summarize(conversation)
+
+    assert gemini.calls == ["direct"]
+    stats = summarizer.stats()
+    assert stats["coalesced"] == 1
+    assert stats["hits"] == 1
@@ -0,0 +1,52 @@
+"""トークン数の概算と分割のテスト"""
+from app.services.tokens import estimate_tokens, split_text_by_tokens, truncate_to_tokens
+
+
+def test_estimate_tokens_counts_ascii_and_japanese() -> None:
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+    assert estimate_tokens("日記") == 2
+    assert estimate_tokens("日記abcd") == 3
+
+
+def test_split_keeps_lines_together_and_order() -> None:
+    lines = [f"ユーザー: 発言{i}" for i in range(20)]
+    chunks = split_text_by_tokens("\n".join(lines), 30)
+
+    assert len(chunks) > 1
+    assert "\n".join(chunks).splitlines() == lines
+    for chunk in chunks:
+        assert sum(estimate_tokens(line) + 1 for line in chunk.splitlines()) <= 30
+
+
+def test_split_breaks_overlong_line_by_characters() -> None:
+    line = "あ" * 25
+    chunks = split_text_by_tokens(f"短い行\n{line}\n最後の行", 10)
+
+    assert chunks[0] == "短い行"
+    assert "".join(chunks[1:-1]) == line
+    assert all(estimate_tokens(chunk) <= 10 for chunk in chunks)
+    assert chunks[-1] == "最後の行"
+
+
+def test_split_drops_blank_chunks() -> None:
+    assert split_text_by_tokens("\n\n", 10) == []
+    assert "".join(split_text_by_tokens("text", 0)) == "text"
+
+
+def test_truncate_keeps_text_within_limit() -> None:
+    assert truncate_to_tokens("短い文", 10) == "短い文"
+
+
+def test_truncate_cuts_and_appends_ellipsis() -> None:
+    text = "今日は公園で桜を見ました"
+
+    short = truncate_to_tokens(text, 6)
+
+    assert short == "今日は公園..."
+    assert estimate_tokens(short) <= 6
+
+
+def test_truncate_returns_empty_when_no_room_for_ellipsis() -> None:
+    assert truncate_to_tokens("abcdefghijklmnop", 1) == ""
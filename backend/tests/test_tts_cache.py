@@ -0,0 +1,114 @@
+"""TTSCacheのテスト"""
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from app.services.tts_cache import TTSCache
+
+
+class CountingFactory:
+    """呼び出し回数を数え、合図があるまで完了しない音声生成"""
+
+    def __init__(self, data: bytes = b"audio") -> None:
+        self.calls = 0
+        self.release = asyncio.Event()
+        self._data = data
+
+    async def __call__(self) -> bytes:
+        self.calls += 1
+        await self.release.wait()
+        return self._data
+
+
+async def test_concurrent_requests_are_coalesced() -> None:
+    cache = TTSCache(max_memory_bytes=1024)
+    factory = CountingFactory()
+    waiters = [asyncio.create_task(cache.get_or_create("k", factory)) for _ in range(5)]
+    await asyncio.sleep(0)
+    factory.release.set()
+    results = await asyncio.gather(*waiters)
+
+    assert factory.calls == 1
+    assert all(r.data == b"audio" for r in results)
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["coalesced"] == 4
+
+
+async def test_second_request_hits_memory() -> None:
+    cache = TTSCache(max_memory_bytes=1024)
+    factory = CountingFactory()
+    factory.release.set()
+    first = await cache.get_or_create("k", factory)
+    second = await cache.get_or_create("k", factory)
+
+    assert not first.hit
+    assert second.hit
+    assert second.data == b"audio"
+    assert factory.calls == 1
+
+
+async def test_cancelled_waiter_does_not_cancel_generation() -> None:
+    cache = TTSCache(max_memory_bytes=1024)
+    factory = CountingFactory()
+    first = asyncio.create_task(cache.get_or_create("k", factory))
+    second = asyncio.create_task(cache.get_or_create("k", factory))
+    await asyncio.sleep(0)
+    first.cancel()
+    factory.release.set()
+
+    assert (await second).data == b"audio"
+    assert factory.calls == 1
+
+
+async def test_failure_is_not_cached() -> None:
+    cache = TTSCache(max_memory_bytes=1024)
+
+    async def failing() -> bytes:
+        raise RuntimeError("upstream")
+
+    with pytest.raises(RuntimeError):
+        await cache.get_or_create("k", failing)
+    factory = CountingFactory()
+    factory.release.set()
+    assert (await cache.get_or_create("k", factory)).data == b"audio"
+
+
+async def test_memory_tier_evicts_least_recently_used() -> None:
+    cache = TTSCache(max_memory_bytes=10)
+    for key in ("a", "b"):
+        factory = CountingFactory(b"12345")
+        factory.release.set()
+        await cache.get_or_create(key, factory)
+    # aを参照してからcを追加すると、bが追い出される
+    await cache.get_or_create("a", CountingFactory())
+    factory = CountingFactory(b"12345")
+    factory.release.set()
+    await cache.get_or_create("c", factory)
+
+    stats = cache.stats()
+    assert stats["memory_items"] == 2
+    assert stats["memory_bytes"] == 10
+    assert (await cache.get_or_create("a", CountingFactory())).hit
+
+
+async def test_disk_tier_survives_restart(tmp_path: Path) -> None:
+    cache = TTSCache(max_memory_bytes=1024, disk_dir=tmp_path, max_disk_bytes=1024)
+    factory = CountingFactory()
+    factory.release.set()
+    await cache.get_or_create("k", factory)
+
+    reloaded = TTSCache(max_memory_bytes=1024, disk_dir=tmp_path, max_disk_bytes=1024)
+    result = await reloaded.get_or_create("k", CountingFactory())
+
+    assert result.hit
+    assert result.path is not None
+    assert result.path.read_bytes() == b"audio"
+
+
+def test_make_key_ignores_format_case() -> None:
+    assert TTSCache.make_key("こんにちは", "alloy", "MP3", "m") == TTSCache.make_key(
+        "こんにちは", "alloy", "mp3", "m"
+    )
+    assert TTSCache.make_key("a", "alloy", "mp3", "m") != TTSCache.make_key("a", "nova", "mp3", "m")
@@ -0,0 +1,66 @@
+"""音声対話の文の区切りとターンの後始末のテスト"""
+from collections.abc import AsyncGenerator
+from pathlib import Path
+from typing import Any
+
+from app.api.v1.voice import _run_turn
+from app.services.voice_session import SentenceSplitter
+
+
+def test_splitter_returns_complete_sentences_only() -> None:
+    splitter = SentenceSplitter(min_chars=1)
+
+    assert splitter.feed("こんにちは。今日は") == ["こんにちは。"]
+    assert splitter.feed("いい天気ですね!明") == ["今日はいい天気ですね!"]
+    assert splitter.flush() == "明"
+    assert splitter.flush() is None
+
+
+def test_splitter_merges_short_sentences() -> None:
+    splitter = SentenceSplitter(min_chars=10)
+
+    assert splitter.feed("はい。そうです。") == []
+    assert splitter.feed("それでは始めましょう。") == ["はい。そうです。それでは始めましょう。"]
+
+
+def test_splitter_keeps_closing_quote_with_sentence() -> None:
+    splitter = SentenceSplitter(min_chars=1)
+
+    assert splitter.feed("彼は「行きます。」と言った") == ["彼は「行きます。」"]
+
+
+def test_splitter_english_period_needs_following_space() -> None:
+    splitter = SentenceSplitter(min_chars=1)
+
+    assert splitter.feed("Version 1.5 is out") == []
+    assert splitter.feed(". Next one") == ["Version 1.5 is out."]
+    assert splitter.flush() == "Next one"
+
+
+class FakeSession:
+    """イベントを返し続け、閉じられたかを記録するVoiceSession"""
+
+    def __init__(self) -> None:
+        self.closed = False
+
+    async def run_turn(self, path: Path, filename: str, mime_type: str) -> AsyncGenerator[dict[str, Any], None]:
+        try:
+            while True:
+                yield {"type": "text", "delta": "a"}
+        finally:
+            self.closed = True
+
+
+async def test_run_turn_closes_generator_when_send_fails(tmp_path: Path) -> None:
+    session = FakeSession()
+    path = tmp_path / "utterance.webm"
+    path.write_bytes(b"audio")
+
+    async def send(event: dict[str, Any]) -> None:
+        raise RuntimeError("WebSocket is not connected")
+
+    await _run_turn(session, path, "utterance.webm", "audio/webm", send)  # type: ignore[arg-type]
+
+    # 送信に失敗したらその場でジェネレータを閉じる(GCまで上流の処理を残さない)
+    assert session.closed
+    assert not path.exists()